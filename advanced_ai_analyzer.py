@@ -1,3 +1,4 @@
+import os
 import mysql.connector
 import pandas as pd
 import streamlit as st
@@ -5,11 +6,14 @@ import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.preprocessing import StandardScaler
-from sklearn.linear_model import LinearRegression
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.metrics import mean_squared_error, r2_score
+from lectura_sql import leer_sql, leer_sql_por_bloques, leer_pagina
+from estadisticas_tablas import CatalogoEstadisticas
+from muestreo_sql import leer_muestra
+from estadisticas_streaming import correlaciones_tabla, anomalias_tabla
+from almacen_modelos import (get_almacen_modelos, entrenar_objetivo, huella_datos, clave_modelo,
+                             COLUMNA_FECHA)
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -17,6 +21,7 @@ class AdvancedDatabaseAnalyzer:
     def __init__(self):
         self.connection = None
         self.tables = []
+        self.catalogo = None
 
     def connect_to_database(self):
         """Conectar a la base de datos MySQL"""
@@ -28,6 +33,7 @@ class AdvancedDatabaseAnalyzer:
                 password=st.secrets["mysql"]["password"],
                 database=st.secrets["mysql"]["database"]
             )
+            self.catalogo = CatalogoEstadisticas(self.connection)
             return True
         except Exception as e:
             st.error(f"Error conectando a la base de datos: {e}")
@@ -52,23 +58,47 @@ class AdvancedDatabaseAnalyzer:
         cursor.close()
         return columns
 
-    def get_table_data(self, table_name, limit=1000, where_clause=""):
-        """Obtener datos de una tabla con filtros opcionales"""
-        query = f"SELECT * FROM {table_name}"
+    def get_table_data(self, table_name, limit=1000, where_clause="", sampling=False, columns=None):
+        """Obtener datos de una tabla con filtros opcionales.
+
+        sampling: muestra aleatoria por clave en el servidor en lugar de las primeras filas
+        columns: columnas a leer (todas si es None)
+        """
+        if sampling:
+            return leer_muestra(self.connection, table_name, limit, columns, where=where_clause,
+                                catalogo=self.catalogo)
+        query = f"SELECT {', '.join(columns) if columns else '*'} FROM {table_name}"
         if where_clause:
             query += f" WHERE {where_clause}"
         query += f" LIMIT {limit}"
-        return pd.read_sql(query, self.connection)
+        return leer_sql(self.connection, query)
+
+    def iter_table_data(self, table_name, where_clause="", chunk_size=2000, limit=None):
+        """Generador de DataFrames de una tabla leídos por bloques (cursor no buffered)"""
+        query = f"SELECT * FROM {table_name}"
+        if where_clause:
+            query += f" WHERE {where_clause}"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        return leer_sql_por_bloques(self.connection, query, itersize=chunk_size)
+
+    def get_table_page(self, table_name, page, page_size=100, where_clause=""):
+        """Obtener una página (0-indexada) de una tabla con filtros opcionales"""
+        query = f"SELECT * FROM {table_name}"
+        if where_clause:
+            query += f" WHERE {where_clause}"
+        return leer_pagina(self.connection, query, page, page_size)
 
     def execute_custom_query(self, query):
         """Ejecutar consulta personalizada"""
         try:
-            return pd.read_sql(query, self.connection)
+            return leer_sql(self.connection, query)
         except Exception as e:
             st.error(f"Error ejecutando consulta: {e}")
             return pd.DataFrame()
 
-    def ai_data_insights(self, data, analysis_type):
+    def ai_data_insights(self, data, analysis_type, table_name=None, where_clause="", time_split=False,
+                         monthly=False):
         """Análisis de datos con IA"""
         insights = {}
 
@@ -78,11 +108,11 @@ class AdvancedDatabaseAnalyzer:
         if analysis_type == "clustering":
             insights = self.perform_clustering(data, numeric_cols)
         elif analysis_type == "trends":
-            insights = self.analyze_trends(data, numeric_cols)
+            insights = self.analyze_trends(data, numeric_cols, monthly=monthly)
         elif analysis_type == "anomalies":
             insights = self.detect_anomalies(data, numeric_cols)
         elif analysis_type == "predictions":
-            insights = self.make_predictions(data, numeric_cols)
+            insights = self.make_predictions(data, numeric_cols, table_name, where_clause, time_split)
         elif analysis_type == "correlations":
             insights = self.analyze_correlations(data, numeric_cols)
 
@@ -127,27 +157,67 @@ class AdvancedDatabaseAnalyzer:
             "K_range": list(K_range)
         }
 
-    def analyze_trends(self, data, numeric_cols):
-        """Analizar tendencias en los datos"""
-        trends = {}
+    def get_numeric_columns(self, table_name):
+        """Columnas numéricas de una tabla según el catálogo (sin leer datos)"""
+        return self.catalogo.columnas_numericas(table_name)
 
-        for col in numeric_cols:
-            if data[col].notna().sum() > 1:
-                # Calcular tendencia usando regresión lineal
-                x = np.arange(len(data)).reshape(-1, 1)
-                y = data[col].fillna(data[col].mean())
+    def perform_incremental_clustering(self, table_name, where_clause="", columns=None,
+                                       chunk_size=5000, sample_size=5000):
+        """Clustering de la tabla completa con MiniBatchKMeans leyendo por bloques.
 
-                model = LinearRegression()
-                model.fit(x, y)
+        El modelo se cachea por (tabla, filtro, columnas): los reruns no vuelven a entrenar.
+        """
+        columns = tuple(columns or self.get_numeric_columns(table_name))
+        if len(columns) < 2:
+            return {"error": "Se necesitan al menos 2 columnas numéricas para clustering"}
+        return _clustering_incremental(self, table_name, where_clause, columns, chunk_size, sample_size)
 
-                trend_direction = "Creciente" if model.coef_[0] > 0 else "Decreciente"
-                trend_strength = abs(model.coef_[0])
+    def analyze_correlations_full(self, table_name, where_clause="", columns=None):
+        """Correlaciones sobre la tabla completa leída por bloques (memoria acotada)"""
+        columns = list(columns or self.get_numeric_columns(table_name))
+        if len(columns) < 2:
+            return {"error": "Se necesitan al menos 2 columnas numéricas para correlaciones"}
+        return self._correlation_insights(correlaciones_tabla(self.connection, table_name, columns, where_clause))
+
+    def detect_anomalies_full(self, table_name, where_clause="", columns=None):
+        """Anomalías por IQR sobre la tabla completa con cuantiles aproximados por bloques"""
+        columns = list(columns or self.get_numeric_columns(table_name))
+        return anomalias_tabla(self.connection, table_name, columns, where_clause)
+
+    def analyze_trends(self, data, numeric_cols, monthly=False):
+        """Analizar tendencias en los datos.
+
+        Todas las columnas se ajustan en una sola operación matricial. Con monthly se
+        regresa la media mensual frente al mes de fecha_publicacion en vez del orden de filas.
+        """
+        cols = [col for col in numeric_cols if data[col].notna().sum() > 1]
+        if not cols:
+            return {}
+
+        if monthly and COLUMNA_FECHA in data.columns:
+            fechas = pd.to_datetime(data[COLUMNA_FECHA], errors='coerce')
+            meses = fechas.dt.year * 12 + fechas.dt.month
+            mensual = data[cols].groupby(meses).mean().sort_index()
+            # x = meses desde el primero, conservando los huecos entre meses
+            x = (mensual.index.to_numpy(dtype=float) - mensual.index.min())
+            Y = mensual.to_numpy(dtype=float)
+        else:
+            # Calcular tendencia usando regresión lineal sobre el orden de filas
+            x = np.arange(len(data), dtype=float)
+            Y = data[cols].astype(float)
+            Y = Y.fillna(Y.mean()).to_numpy()
+
+        slopes, r_squared = _regresion_lineal_lote(x, Y)
 
-                trends[col] = {
-                    "direction": trend_direction,
-                    "strength": trend_strength,
-                    "r_squared": model.score(x, y)
-                }
+        trends = {}
+        for col, slope, r2 in zip(cols, slopes, r_squared):
+            if np.isnan(slope):
+                continue
+            trends[col] = {
+                "direction": "Creciente" if slope > 0 else "Decreciente",
+                "strength": abs(slope),
+                "r_squared": r2
+            }
 
         return trends
 
@@ -175,12 +245,21 @@ class AdvancedDatabaseAnalyzer:
 
         return anomalies
 
-    def make_predictions(self, data, numeric_cols):
-        """Hacer predicciones usando Random Forest"""
+    def make_predictions(self, data, numeric_cols, table_name=None, where_clause="", time_split=False):
+        """Hacer predicciones usando Random Forest.
+
+        Los modelos se sirven del almacén mientras los datos no cambien; los objetivos
+        pendientes se entrenan en paralelo.
+        """
         if len(numeric_cols) < 2:
             return {"error": "Se necesitan al menos 2 columnas numéricas para predicciones"}
 
+        from joblib import Parallel, delayed
+
+        almacen = get_almacen_modelos()
+        marca_agua = huella_datos(data)
         predictions = {}
+        pendientes = []
 
         for target_col in numeric_cols[:2]:  # Limitar a 2 predicciones
             feature_cols = [col for col in numeric_cols if col != target_col]
@@ -188,39 +267,30 @@ class AdvancedDatabaseAnalyzer:
             if len(feature_cols) == 0:
                 continue
 
-            # Preparar datos
-            clean_data = data[feature_cols + [target_col]].dropna()
-
-            if len(clean_data) < 10:
-                continue
-
-            X = clean_data[feature_cols]
-            y = clean_data[target_col]
-
-            # Dividir datos
-            split_point = int(len(clean_data) * 0.8)
-            X_train, X_test = X[:split_point], X[split_point:]
-            y_train, y_test = y[:split_point], y[split_point:]
-
-            if len(X_test) == 0:
-                continue
-
-            # Entrenar modelo
-            model = RandomForestRegressor(n_estimators=50, random_state=42)
-            model.fit(X_train, y_train)
-
-            # Hacer predicciones
-            y_pred = model.predict(X_test)
-
-            predictions[target_col] = {
-                "mse": mean_squared_error(y_test, y_pred),
-                "r2": r2_score(y_test, y_pred),
-                "feature_importance": dict(zip(feature_cols, model.feature_importances_)),
-                "predictions": y_pred.tolist(),
-                "actual": y_test.tolist()
-            }
+            clave = clave_modelo(table_name, where_clause, feature_cols, target_col, time_split, marca_agua)
+            entrada = almacen.obtener(clave)
+            if entrada is not None:
+                predictions[target_col] = dict(entrada['metricas'], cached=True)
+            else:
+                pendientes.append((target_col, feature_cols, clave))
+
+        if pendientes:
+            # Un hilo por objetivo; RandomForest libera el GIL al construir los árboles
+            nucleos = os.cpu_count() or 1
+            n_jobs = max(1, nucleos // len(pendientes))
+            resultados = Parallel(n_jobs=min(len(pendientes), nucleos), prefer="threads")(
+                delayed(entrenar_objetivo)(data, feature_cols, target_col, time_split, n_jobs)
+                for target_col, feature_cols, _ in pendientes
+            )
+            for (target_col, _, clave), resultado in zip(pendientes, resultados):
+                if resultado is None:
+                    continue
+                model, metricas = resultado
+                almacen.guardar(clave, model, metricas)
+                predictions[target_col] = dict(metricas, cached=False)
 
-        return predictions
+        # Mantener el orden de los objetivos
+        return {col: predictions[col] for col in numeric_cols[:2] if col in predictions}
 
     def analyze_correlations(self, data, numeric_cols):
         """Analizar correlaciones entre variables"""
@@ -228,7 +298,10 @@ class AdvancedDatabaseAnalyzer:
             return {"error": "Se necesitan al menos 2 columnas numéricas para correlaciones"}
 
         corr_matrix = data[numeric_cols].corr()
+        return self._correlation_insights(corr_matrix)
 
+    def _correlation_insights(self, corr_matrix):
+        """Dict de resultados a partir de una matriz de correlación"""
         # Encontrar correlaciones más fuertes
         strong_correlations = []
 
@@ -248,6 +321,117 @@ class AdvancedDatabaseAnalyzer:
             "strong_correlations": strong_correlations
         }
 
+def _regresion_lineal_lote(x, Y):
+    """Pendiente y R² de la regresión de cada columna de Y frente a x, en una sola pasada.
+
+    Los NaN de Y se excluyen por columna. Equivale a un LinearRegression por columna.
+    """
+    validos = ~np.isnan(Y)
+    W = validos.astype(float)
+    Y0 = np.where(validos, Y, 0.0)
+    n = W.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        media_x = (x @ W) / n
+        media_y = Y0.sum(axis=0) / n
+        xc = (x[:, None] - media_x) * W
+        yc = (Y0 - media_y) * W
+        sxx = (xc * xc).sum(axis=0)
+        sxy = (xc * yc).sum(axis=0)
+        syy = (yc * yc).sum(axis=0)
+        slopes = np.where(sxx > 0, sxy / sxx, np.nan)
+        # Como LinearRegression.score: R² = 1 si y es constante (predicción exacta)
+        r_squared = np.where(syy > 0, 1 - (syy - slopes * sxy) / syy, 1.0)
+    slopes = np.where(n > 1, slopes, np.nan)
+    return slopes, r_squared
+
+
+def _muestreo_reservorio(muestra, vistos, bloque, tam_muestra, rng):
+    """Actualizar una muestra uniforme (algoritmo R vectorizado) con un bloque de filas"""
+    huecos = tam_muestra - len(muestra)
+    if huecos > 0:
+        muestra = np.vstack([muestra, bloque[:huecos]]) if len(muestra) else bloque[:huecos].copy()
+        vistos += min(huecos, len(bloque))
+        bloque = bloque[huecos:]
+    if len(bloque):
+        posiciones = rng.integers(0, vistos + np.arange(1, len(bloque) + 1))
+        aceptadas = posiciones < tam_muestra
+        # Asignación en orden: si dos filas caen en el mismo hueco gana la última, igual que en secuencial
+        muestra[posiciones[aceptadas]] = bloque[aceptadas]
+        vistos += len(bloque)
+    return muestra, vistos
+
+
+@st.cache_resource(show_spinner=False)
+def _clustering_incremental(_analyzer, table_name, where_clause, columns, chunk_size, sample_size):
+    """Dos pasadas por bloques: escalado + muestra, y ajuste incremental del modelo final"""
+    query = f"SELECT {', '.join(columns)} FROM {table_name}"
+    if where_clause:
+        query += f" WHERE {where_clause}"
+
+    def bloques():
+        for chunk in leer_sql_por_bloques(_analyzer.connection, query, itersize=chunk_size):
+            valores = chunk.apply(pd.to_numeric, errors='coerce').dropna().to_numpy(dtype=float)
+            if len(valores):
+                yield valores
+
+    # Pasada 1: media/desviación del escalado y muestra uniforme para el método del codo
+    rng = np.random.default_rng(42)
+    scaler = StandardScaler()
+    muestra = np.empty((0, len(columns)))
+    filas = 0
+    for valores in bloques():
+        scaler.partial_fit(valores)
+        muestra, filas = _muestreo_reservorio(muestra, filas, valores, sample_size, rng)
+
+    if len(muestra) < 5:
+        return {"error": "Datos insuficientes para clustering"}
+
+    # Método del codo sobre la muestra, reutilizando los centros de k-1 como arranque de k
+    muestra_escalada = scaler.transform(muestra)
+    K_range = range(2, min(11, len(muestra)))
+    inertias = []
+    centros_por_k = {}
+    centros = None
+    for k in K_range:
+        if centros is None:
+            modelo_k = MiniBatchKMeans(n_clusters=k, random_state=42, n_init=3)
+        else:
+            # Nuevo centro: el punto de la muestra más alejado de los centros actuales
+            distancias = ((muestra_escalada[:, None, :] - centros[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+            init = np.vstack([centros, muestra_escalada[distancias.argmax()]])
+            modelo_k = MiniBatchKMeans(n_clusters=k, init=init, n_init=1, random_state=42)
+        modelo_k.fit(muestra_escalada)
+        centros = modelo_k.cluster_centers_
+        centros_por_k[k] = centros
+        inertias.append(modelo_k.inertia_)
+
+    # Usar k=3 por defecto
+    optimal_k = 3 if len(K_range) >= 3 else max(K_range)
+
+    # Pasada 2: modelo final ajustado incrementalmente sobre todas las filas
+    # Sin reasignación de centros: los bloques llegan en orden de tabla y un centro sin puntos
+    # en los primeros bloques no debe saltar a otro grupo
+    kmeans = MiniBatchKMeans(n_clusters=optimal_k, init=centros_por_k[optimal_k], n_init=1,
+                             random_state=42, reassignment_ratio=0)
+    for valores in bloques():
+        kmeans.partial_fit(scaler.transform(valores))
+
+    cluster_data = pd.DataFrame(muestra, columns=list(columns))
+    cluster_data['Cluster'] = kmeans.predict(muestra_escalada)
+    # Tamaños estimados a partir de la muestra uniforme (evita una tercera pasada)
+    tamanos = np.round(np.bincount(cluster_data['Cluster'], minlength=optimal_k) / len(muestra) * filas).astype(int)
+
+    return {
+        "cluster_data": cluster_data,
+        "num_clusters": optimal_k,
+        "cluster_centers": kmeans.cluster_centers_,
+        "inertias": inertias,
+        "K_range": list(K_range),
+        "total_rows": filas,
+        "cluster_sizes": tamanos.tolist()
+    }
+
+
 def create_visualizations(insights, analysis_type):
     """Crear visualizaciones basadas en el tipo de análisis"""
 
@@ -260,6 +444,11 @@ def create_visualizations(insights, analysis_type):
                            color='Cluster', title="Análisis de Clusters")
             st.plotly_chart(fig)
 
+        if "total_rows" in insights:
+            st.write(f"**Filas agrupadas:** {insights['total_rows']:,} (gráfico sobre una muestra de {len(cluster_data):,})")
+            st.write("**Tamaño estimado de cada cluster:** " +
+                     ", ".join(f"{i}: {n:,}" for i, n in enumerate(insights["cluster_sizes"])))
+
         # Gráfico del método del codo
         if "inertias" in insights:
             fig = go.Figure()
@@ -282,6 +471,11 @@ def create_visualizations(insights, analysis_type):
     elif analysis_type == "predictions":
         for target, pred_info in insights.items():
             st.write(f"**Predicción para {target}**: R² = {pred_info['r2']:.3f}")
+            origen = "modelo guardado" if pred_info.get("cached") else "entrenado ahora"
+            if pred_info.get("split") == "temporal":
+                st.caption(f"División temporal (test desde {pred_info.get('test_desde')}) · {origen}")
+            else:
+                st.caption(origen)
 
             # Gráfico de importancia de características
             features = list(pred_info['feature_importance'].keys())
@@ -334,16 +528,83 @@ def main():
             # Filtros
             where_clause = st.sidebar.text_input("Filtro WHERE (opcional):", placeholder="columna = 'valor'")
             limit = st.sidebar.number_input("Límite de registros:", min_value=100, max_value=10000, value=1000)
+            muestra_aleatoria = st.sidebar.checkbox("Muestra aleatoria en el servidor", value=True,
+                                                    help="Si se desactiva se analizan las primeras filas de la tabla")
 
             # Tipo de análisis de IA
             analysis_type = st.sidebar.selectbox("Tipo de Análisis de IA:", [
                 "correlations", "clustering", "trends", "anomalies", "predictions"
             ])
 
+            # Navegación por páginas con el filtro actual
+            with st.expander(f"📄 Navegar {selected_table} por páginas"):
+                col_tam, col_pag = st.columns(2)
+                with col_tam:
+                    page_size = st.selectbox("Filas por página:", [50, 100, 500, 1000], index=1,
+                                             key=f"page_size_{selected_table}")
+                with col_pag:
+                    page = st.number_input("Página:", min_value=1, value=1, step=1,
+                                           key=f"page_{selected_table}")
+                try:
+                    page_data = analyzer.get_table_page(selected_table, int(page) - 1, page_size, where_clause)
+                    if page_data.empty:
+                        st.info("No hay registros en esta página")
+                    else:
+                        st.dataframe(page_data)
+                except Exception as e:
+                    st.error(f"Error cargando la página: {e}")
+
+            # Modos temporales (adjudicaciones con fecha_publicacion)
+            time_split = False
+            monthly = False
+            columnas_tabla = [col[0] for col in analyzer.catalogo.estructura(selected_table)]
+            if analysis_type == "trends" and COLUMNA_FECHA in columnas_tabla:
+                monthly = st.sidebar.checkbox(f"Tendencia mensual por {COLUMNA_FECHA}", value=False,
+                                              help="Regresa la media de cada mes frente al mes en lugar del orden de filas")
+            if analysis_type == "predictions":
+                if COLUMNA_FECHA in columnas_tabla:
+                    time_split = st.sidebar.checkbox(f"División temporal por {COLUMNA_FECHA}", value=False,
+                                                     help="Entrena con el 80% más antiguo y evalúa con el 20% más reciente")
+                if st.sidebar.button("🗑️ Descartar modelos guardados"):
+                    get_almacen_modelos().limpiar()
+
+            # Análisis sobre la tabla completa leída por bloques
+            tabla_completa = False
+            if analysis_type in ("clustering", "correlations", "anomalies"):
+                tabla_completa = st.sidebar.checkbox("Analizar la tabla completa (por bloques)", value=False)
+                if tabla_completa:
+                    columnas_numericas = analyzer.get_numeric_columns(selected_table)
+                    full_columns = st.sidebar.multiselect("Columnas a analizar:", columnas_numericas,
+                                                          default=columnas_numericas)
+                    if analysis_type == "clustering" and st.sidebar.button("🗑️ Descartar modelos cacheados"):
+                        _clustering_incremental.clear()
+
             # Cargar datos
-            if st.button(f"🚀 Analizar {selected_table} con IA"):
+            analizar = st.button(f"🚀 Analizar {selected_table} con IA")
+            if analizar and tabla_completa:
+                with st.spinner("Leyendo la tabla completa por bloques..."):
+                    if analysis_type == "clustering":
+                        insights = analyzer.perform_incremental_clustering(selected_table, where_clause, full_columns)
+                    elif analysis_type == "correlations":
+                        insights = analyzer.analyze_correlations_full(selected_table, where_clause, full_columns)
+                    else:
+                        insights = analyzer.detect_anomalies_full(selected_table, where_clause, full_columns)
+
+                st.subheader(f"🤖 Análisis de IA: {analysis_type.title()}")
+                if "error" in insights:
+                    st.error(insights["error"])
+                else:
+                    create_visualizations(insights, analysis_type)
+
+            elif analizar:
                 with st.spinner("Cargando y analizando datos..."):
-                    data = analyzer.get_table_data(selected_table, limit, where_clause)
+                    # Solo se transfieren las columnas numéricas, que son las que analiza la IA
+                    columnas_analisis = analyzer.get_numeric_columns(selected_table)
+                    if columnas_analisis and (time_split or monthly):
+                        columnas_analisis = columnas_analisis + [COLUMNA_FECHA]
+                    data = analyzer.get_table_data(selected_table, limit, where_clause,
+                                                   sampling=muestra_aleatoria,
+                                                   columns=columnas_analisis or None)
 
                     if not data.empty:
                         st.subheader(f"📊 Análisis de {selected_table}")
@@ -356,7 +617,8 @@ def main():
                         # Análisis de IA
                         st.subheader(f"🤖 Análisis de IA: {analysis_type.title()}")
 
-                        insights = analyzer.ai_data_insights(data, analysis_type)
+                        insights = analyzer.ai_data_insights(data, analysis_type, selected_table,
+                                                             where_clause, time_split, monthly)
 
                         if "error" in insights:
                             st.error(insights["error"])
@@ -0,0 +1,148 @@
+"""
+Almacén de modelos de predicción entrenados.
+
+make_predictions entrenaba un RandomForest por objetivo en cada clic. Aquí los
+modelos y sus métricas se guardan por clave (tabla, hash del filtro, columnas,
+objetivo, tipo de división y marca de agua de los datos) en memoria y en disco
+(joblib), y los objetivos se entrenan en paralelo.
+
+La marca de agua es una huella del contenido de los datos cargados: mientras
+los datos no cambien se sirven las métricas y predicciones guardadas; en cuanto
+cambian (filas nuevas, valores corregidos) la clave cambia y se reentrena.
+"""
+import hashlib
+import os
+import threading
+
+import pandas as pd
+import streamlit as st
+
+COLUMNA_FECHA = 'fecha_publicacion'
+DIRECTORIO_POR_DEFECTO = os.environ.get('MODELOS_CACHE_DIR', '.cache_modelos')
+
+
+def huella_datos(data):
+    """Marca de agua de un DataFrame: cambia si cambia cualquier fila o columna"""
+    if data.empty:
+        return 'vacio'
+    huellas = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    return hashlib.sha1(huellas.tobytes() + ','.join(map(str, data.columns)).encode()).hexdigest()[:16]
+
+
+def clave_modelo(table_name, where_clause, feature_cols, target_col, split_temporal, marca_agua):
+    filtro = hashlib.sha1((where_clause or '').strip().encode()).hexdigest()[:12]
+    partes = [table_name or 'consulta', filtro, ','.join(sorted(feature_cols)), target_col,
+              'temporal' if split_temporal else 'secuencial', marca_agua]
+    return hashlib.sha1('|'.join(partes).encode()).hexdigest()
+
+
+class AlmacenModelos:
+    """Modelos entrenados y métricas por clave, en memoria y persistidos con joblib"""
+
+    def __init__(self, directorio=DIRECTORIO_POR_DEFECTO):
+        self.directorio = directorio
+        self._memoria = {}
+        self._lock = threading.Lock()
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, f"{clave}.joblib") if self.directorio else None
+
+    def obtener(self, clave):
+        """Entrada {'modelo', 'metricas'} guardada o None"""
+        with self._lock:
+            if clave in self._memoria:
+                return self._memoria[clave]
+        ruta = self._ruta(clave)
+        if ruta and os.path.exists(ruta):
+            import joblib
+            try:
+                entrada = joblib.load(ruta)
+            except Exception:
+                return None
+            with self._lock:
+                self._memoria[clave] = entrada
+            return entrada
+        return None
+
+    def guardar(self, clave, modelo, metricas):
+        entrada = {'modelo': modelo, 'metricas': metricas}
+        with self._lock:
+            self._memoria[clave] = entrada
+        ruta = self._ruta(clave)
+        if ruta:
+            import joblib
+            try:
+                os.makedirs(self.directorio, exist_ok=True)
+                joblib.dump(entrada, ruta, compress=3)
+            except OSError:
+                pass
+        return entrada
+
+    def limpiar(self):
+        """Vaciar la memoria y borrar los modelos persistidos"""
+        with self._lock:
+            self._memoria.clear()
+        if self.directorio and os.path.isdir(self.directorio):
+            for nombre in os.listdir(self.directorio):
+                if nombre.endswith('.joblib'):
+                    try:
+                        os.remove(os.path.join(self.directorio, nombre))
+                    except OSError:
+                        pass
+
+
+@st.cache_resource
+def get_almacen_modelos():
+    """Almacén compartido por todas las sesiones del proceso"""
+    return AlmacenModelos()
+
+
+def entrenar_objetivo(data, feature_cols, target_col, split_temporal=False, n_jobs=1):
+    """Entrenar un RandomForest para target_col y devolver (modelo, métricas) o None si no hay datos.
+
+    Con split_temporal se entrena con el 80% más antiguo según fecha_publicacion
+    y se evalúa con el 20% más reciente; si no, se usa el orden de las filas.
+    """
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.metrics import mean_squared_error, r2_score
+
+    columnas = feature_cols + [target_col]
+    if split_temporal and COLUMNA_FECHA in data.columns:
+        clean_data = data[columnas + [COLUMNA_FECHA]].dropna()
+        clean_data = clean_data.sort_values(COLUMNA_FECHA, kind='mergesort')
+    else:
+        split_temporal = False
+        clean_data = data[columnas].dropna()
+
+    if len(clean_data) < 10:
+        return None
+
+    X = clean_data[feature_cols]
+    y = clean_data[target_col]
+
+    # Dividir datos
+    split_point = int(len(clean_data) * 0.8)
+    X_train, X_test = X[:split_point], X[split_point:]
+    y_train, y_test = y[:split_point], y[split_point:]
+
+    if len(X_test) == 0:
+        return None
+
+    # Entrenar modelo
+    model = RandomForestRegressor(n_estimators=50, random_state=42, n_jobs=n_jobs)
+    model.fit(X_train, y_train)
+
+    # Hacer predicciones
+    y_pred = model.predict(X_test)
+
+    metricas = {
+        "mse": mean_squared_error(y_test, y_pred),
+        "r2": r2_score(y_test, y_pred),
+        "feature_importance": dict(zip(feature_cols, model.feature_importances_)),
+        "predictions": y_pred.tolist(),
+        "actual": y_test.tolist(),
+        "split": "temporal" if split_temporal else "secuencial",
+    }
+    if split_temporal:
+        metricas["test_desde"] = str(clean_data[COLUMNA_FECHA].iloc[split_point])[:10]
+    return model, metricas
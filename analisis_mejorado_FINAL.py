@@ -8,9 +8,22 @@ from datetime import datetime
 import random
 import re
 import traceback
+import hashlib
+import numpy as np
 from io import BytesIO
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment
+from lectura_sql import iterar_filas
+from empresas import get_indice_empresas
+from perfiles_empresas import get_almacen_perfiles, frase_perfiles
+from busqueda_texto import BusquedaTrigramas, BusquedaTextoCompleto, CANDIDATOS
+from perfiles_xml import perfil_documento, iter_tag
+from trazas import trazar, span, span_actual, iniciar_traza, finalizar_traza, formatear_traza
+from diagnostico_sql import consulta_sql, iniciar_diagnostico, finalizar_diagnostico, agregar_por_forma
+from tabla_comparables import LogBusqueda, mostrar_comparables
+from precarga import refrescar_en_segundo_plano
+from cancelacion import (TokenCancelacion, ConsultaCancelada, vigilar, opciones_conexion,
+                         ejecucion_sustituida_streamlit, nueva_ejecucion, PRESUPUESTO_LOTE_S)
 
 st.set_page_config(page_title="Análisis de Bajas Estadísticas", page_icon="📊", layout="wide")
 
@@ -23,7 +36,8 @@ def get_connection():
             database=st.secrets["postgres"]["database"],
             user=st.secrets["postgres"]["user"],
             password=st.secrets["postgres"]["password"],
-            port=st.secrets["postgres"]["port"]
+            port=st.secrets["postgres"]["port"],
+            options=opciones_conexion()
         )
         return conn
     except Exception as e:
@@ -34,12 +48,21 @@ def get_tag_name(element):
     """Obtener nombre del tag sin namespace"""
     return element.tag.split('}')[-1] if '}' in element.tag else element.tag
 
+def _num_lotes(datos):
+    return len(datos['lotes']) if datos else 0
+
+@trazar(filas=_num_lotes)
 def extraer_datos_xml_completo(url):
     """Extraer datos completos del XML incluyendo lotes"""
     try:
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-        root = ET.fromstring(response.content)
+        with span("descarga_xml") as s:
+            response = requests.get(url, timeout=30)
+            response.raise_for_status()
+            s.anotar(bytes=len(response.content))
+        with span("parseo_xml"):
+            root = ET.fromstring(response.content)
+            # Perfil de namespaces (CODICE/eForms/UBL): permite filtrar por tag en iter()
+            perfil = perfil_documento(root, origen=url, contenido=response.content)
 
         datos = {
             'titulo': '',
@@ -49,138 +72,130 @@ def extraer_datos_xml_completo(url):
         }
 
         # BUSCAR TÍTULO
-        for elem in root.iter():
-            tag = get_tag_name(elem)
-            if tag == 'ProcurementProject':
-                for child in elem:
-                    child_tag = get_tag_name(child)
-                    if child_tag == 'Name' and child.text:
-                        texto = child.text.strip()
-                        if len(texto) > 15:
-                            datos['titulo'] = texto
-                            break
-                if datos['titulo']:
-                    break
+        for elem in iter_tag(root, perfil, 'cac:ProcurementProject'):
+            for child in elem:
+                child_tag = get_tag_name(child)
+                if child_tag == 'Name' and child.text:
+                    texto = child.text.strip()
+                    if len(texto) > 15:
+                        datos['titulo'] = texto
+                        break
+            if datos['titulo']:
+                break
 
         if not datos['titulo']:
-            for elem in root.iter():
-                tag = get_tag_name(elem)
-                if tag == 'Name' and elem.text:
+            for elem in iter_tag(root, perfil, 'cbc:Name'):
+                if elem.text:
                     texto = elem.text.strip()
                     if len(texto) > 20 and 'http' not in texto.lower():
                         datos['titulo'] = texto
                         break
 
         # BUSCAR ORGANISMO
-        for elem in root.iter():
-            tag = get_tag_name(elem)
-            if tag == 'PartyName' and elem.text:
+        for elem in iter_tag(root, perfil, 'cac:PartyName'):
+            if elem.text:
                 datos['organismo'] = elem.text.strip()
                 break
 
-        # BUSCAR UBICACIÓN (Ciudad y Provincia)
-        for elem in root.iter():
-            tag = get_tag_name(elem)
-            if tag == 'CityName' and elem.text:
-                if not datos.get('ubicacion'):  # Solo tomar la primera
-                    datos['ubicacion'] = elem.text.strip()
-            if tag == 'CountrySubentityCode' and elem.text:
+        # BUSCAR UBICACIÓN (Ciudad y Provincia) - solo el primero de cada uno
+        for elem in iter_tag(root, perfil, 'cbc:CityName'):
+            if elem.text:
+                datos['ubicacion'] = elem.text.strip()
+                break
+        for elem in iter_tag(root, perfil, 'cbc:CountrySubentityCode'):
+            if elem.text:
                 # Código de provincia (ej: ES-M para Madrid)
-                if not datos.get('provincia_codigo'):  # Solo tomar el primero
-                    datos['provincia_codigo'] = elem.text.strip()
-            if tag == 'CountrySubentity' and elem.text:
+                datos['provincia_codigo'] = elem.text.strip()
+                break
+        for elem in iter_tag(root, perfil, 'cbc:CountrySubentity'):
+            if elem.text:
                 # Nombre de la provincia
-                if not datos.get('provincia'):  # Solo tomar la primera
-                    datos['provincia'] = elem.text.strip()
+                datos['provincia'] = elem.text.strip()
+                break
 
         # BUSCAR LOTES
-        for elem in root.iter():
-            tag = get_tag_name(elem)
-            if tag == 'ProcurementProjectLot':
-                lote = {
-                    'numero': '',
-                    'titulo': '',
-                    'presupuesto': 0,
-                    'cpv': [],
-                    'criterios': []
-                }
+        for elem in iter_tag(root, perfil, 'cac:ProcurementProjectLot'):
+            lote = {
+                'numero': '',
+                'titulo': '',
+                'presupuesto': 0,
+                'cpv': [],
+                'criterios': []
+            }
 
-                for child in elem.iter():
-                    child_tag = get_tag_name(child)
-                    if child_tag == 'ID' and child.text:
-                        lote['numero'] = child.text.strip()
+            for child in iter_tag(elem, perfil, 'cbc:ID'):
+                if child.text:
+                    lote['numero'] = child.text.strip()
+                    break
+
+            for child in iter_tag(elem, perfil, 'cbc:Name'):
+                if child.text:
+                    if len(child.text.strip()) > 10:
+                        lote['titulo'] = child.text.strip()
                         break
 
-                for child in elem.iter():
-                    child_tag = get_tag_name(child)
-                    if child_tag == 'Name' and child.text:
-                        if len(child.text.strip()) > 10:
-                            lote['titulo'] = child.text.strip()
-                            break
+            # BUSCAR PRESUPUESTO - Priorizar PBL sobre valor estimado
+            importes_encontrados = {}
+            for child in elem.iter():
+                child_tag = get_tag_name(child)
+                if 'Amount' in child_tag and child.text:
+                    try:
+                        valor = float(child.text.strip())
+                        # Clasificar por tipo de importe
+                        if 'TaxExclusive' in child_tag or 'LineExtension' in child_tag:
+                            importes_encontrados['pbl_sin_iva'] = valor
+                        elif 'Payable' in child_tag or 'TaxInclusive' in child_tag:
+                            importes_encontrados['pbl_con_iva'] = valor
+                        elif 'Estimated' in child_tag:
+                            importes_encontrados['estimado'] = valor
+                        else:
+                            importes_encontrados['otro'] = valor
+                    except:
+                        pass
 
-                # BUSCAR PRESUPUESTO - Priorizar PBL sobre valor estimado
-                importes_encontrados = {}
-                for child in elem.iter():
-                    child_tag = get_tag_name(child)
-                    if 'Amount' in child_tag and child.text:
-                        try:
-                            valor = float(child.text.strip())
-                            # Clasificar por tipo de importe
-                            if 'TaxExclusive' in child_tag or 'LineExtension' in child_tag:
-                                importes_encontrados['pbl_sin_iva'] = valor
-                            elif 'Payable' in child_tag or 'TaxInclusive' in child_tag:
-                                importes_encontrados['pbl_con_iva'] = valor
-                            elif 'Estimated' in child_tag:
-                                importes_encontrados['estimado'] = valor
-                            else:
-                                importes_encontrados['otro'] = valor
-                        except:
-                            pass
-
-                # Priorizar: PBL sin IVA > PBL con IVA > Estimado > Otro
-                if 'pbl_sin_iva' in importes_encontrados:
-                    lote['presupuesto'] = importes_encontrados['pbl_sin_iva']
-                elif 'pbl_con_iva' in importes_encontrados:
-                    lote['presupuesto'] = importes_encontrados['pbl_con_iva']
-                elif 'estimado' in importes_encontrados:
-                    lote['presupuesto'] = importes_encontrados['estimado']
-                elif 'otro' in importes_encontrados:
-                    lote['presupuesto'] = importes_encontrados['otro']
-
-                for child in elem.iter():
-                    child_tag = get_tag_name(child)
-                    if child_tag == 'ItemClassificationCode' and child.text:
-                        cpv_digits = ''.join(filter(str.isdigit, child.text))
-                        if len(cpv_digits) >= 4:
-                            lote['cpv'].append(cpv_digits)
-
-                for child in elem.iter():
-                    child_tag = get_tag_name(child)
-                    if 'Criteria' in child_tag or 'Criterion' in child_tag:
-                        criterio = {}
-                        for subchild in child:
-                            subtag = get_tag_name(subchild)
-                            if subchild.text:
-                                if any(x in subtag for x in ['Description', 'Name']):
-                                    criterio['descripcion'] = subchild.text.strip()
-                                elif any(x in subtag for x in ['Weight', 'Numeric']):
-                                    criterio['peso'] = subchild.text.strip()
-
-                        if criterio.get('descripcion'):
-                            # Filtrar solvencia y requisitos previos
-                            desc_lower = criterio['descripcion'].lower()
-                            palabras_excluir = ['solvencia', 'solvències', 'habilitacion', 'capacidad',
-                                              'acreditacion', 'declaracion responsable', 'certificado',
-                                              'clasificacion empresarial', 'experiencia acreditada']
-
-                            # Si contiene palabras de exclusión, no es criterio de adjudicación
-                            if not any(palabra in desc_lower for palabra in palabras_excluir):
-                                lote['criterios'].append(criterio)
-
-                if lote['presupuesto'] > 0 or lote['cpv']:
-                    if not lote['numero']:
-                        lote['numero'] = str(len(datos['lotes']) + 1)
-                    datos['lotes'].append(lote)
+            # Priorizar: PBL sin IVA > PBL con IVA > Estimado > Otro
+            if 'pbl_sin_iva' in importes_encontrados:
+                lote['presupuesto'] = importes_encontrados['pbl_sin_iva']
+            elif 'pbl_con_iva' in importes_encontrados:
+                lote['presupuesto'] = importes_encontrados['pbl_con_iva']
+            elif 'estimado' in importes_encontrados:
+                lote['presupuesto'] = importes_encontrados['estimado']
+            elif 'otro' in importes_encontrados:
+                lote['presupuesto'] = importes_encontrados['otro']
+
+            for child in iter_tag(elem, perfil, 'cbc:ItemClassificationCode'):
+                if child.text:
+                    cpv_digits = ''.join(filter(str.isdigit, child.text))
+                    if len(cpv_digits) >= 4:
+                        lote['cpv'].append(cpv_digits)
+
+            for child in elem.iter():
+                child_tag = get_tag_name(child)
+                if 'Criteria' in child_tag or 'Criterion' in child_tag:
+                    criterio = {}
+                    for subchild in child:
+                        subtag = get_tag_name(subchild)
+                        if subchild.text:
+                            if any(x in subtag for x in ['Description', 'Name']):
+                                criterio['descripcion'] = subchild.text.strip()
+                            elif any(x in subtag for x in ['Weight', 'Numeric']):
+                                criterio['peso'] = subchild.text.strip()
+
+                    if criterio.get('descripcion'):
+                        # Filtrar solvencia y requisitos previos
+                        desc_lower = criterio['descripcion'].lower()
+                        palabras_excluir = ['solvencia', 'solvències', 'habilitacion', 'capacidad',
+                                          'acreditacion', 'declaracion responsable', 'certificado',
+                                          'clasificacion empresarial', 'experiencia acreditada']
+
+                        # Si contiene palabras de exclusión, no es criterio de adjudicación
+                        if not any(palabra in desc_lower for palabra in palabras_excluir):
+                            lote['criterios'].append(criterio)
+
+            if lote['presupuesto'] > 0 or lote['cpv']:
+                if not lote['numero']:
+                    lote['numero'] = str(len(datos['lotes']) + 1)
+                datos['lotes'].append(lote)
 
         # Si no hay lotes, buscar datos generales
         if not datos['lotes']:
@@ -225,14 +240,12 @@ def extraer_datos_xml_completo(url):
             elif 'otro' in importes_encontrados:
                 lote_general['presupuesto'] = importes_encontrados['otro']
 
-            for elem in root.iter():
-                tag = get_tag_name(elem)
-                if tag == 'ItemClassificationCode':
-                    cpv_text = elem.get('listID') or elem.text
-                    if cpv_text:
-                        cpv_digits = ''.join(filter(str.isdigit, cpv_text))
-                        if len(cpv_digits) >= 4 and cpv_digits not in lote_general['cpv']:
-                            lote_general['cpv'].append(cpv_digits)
+            for elem in iter_tag(root, perfil, 'cbc:ItemClassificationCode'):
+                cpv_text = elem.get('listID') or elem.text
+                if cpv_text:
+                    cpv_digits = ''.join(filter(str.isdigit, cpv_text))
+                    if len(cpv_digits) >= 4 and cpv_digits not in lote_general['cpv']:
+                        lote_general['cpv'].append(cpv_digits)
 
             for elem in root.iter():
                 tag = get_tag_name(elem)
@@ -305,6 +318,7 @@ def _find_json_value(data, key_to_find):
 
     return None
 
+@trazar(filas=_num_lotes)
 def extraer_datos_json_completo(json_data):
     """Extraer datos completos del JSON incluyendo lotes"""
     try:
@@ -830,83 +844,120 @@ def calcular_similitud_palabras(titulo_base, titulo_comparar):
 
     return min(similitud, 1.0)
 
-def detectar_grupo_similar(bajas, tolerancia=4):
+# Parámetros por defecto del cálculo de la baja recomendada
+TOLERANCIA_GRUPO = 4
+MARGEN_BAJA = 2
+# Decimales de las bajas (ROUND(..., 2) en la consulta); las diferencias se
+# redondean a esta precisión para comparar con la tolerancia como en decimal
+DECIMALES_BAJA = 2
+
+def _grupo_correlativo(bajas_ordenadas, tolerancia):
+    """(inicio, fin) del tramo más largo de bajas ordenadas con diferencias consecutivas ≤ tolerancia.
+
+    Con empate gana el primero (el de bajas más bajas); None si no hay ningún par.
+    """
+    if len(bajas_ordenadas) < 2:
+        return None
+    # En float, 8.14 - 4.14 puede dar 4.000000000000001: sin redondear, dos bajas
+    # justo a la distancia de la tolerancia quedarían fuera del grupo
+    cerca = np.round(np.diff(bajas_ordenadas), DECIMALES_BAJA) <= tolerancia
+    # Tramos de True en cerca: el tramo [i, j) de diferencias abarca las bajas i..j
+    bordes = np.flatnonzero(np.diff(np.concatenate(([False], cerca, [False])).astype(np.int8)))
+    if not len(bordes):
+        return None
+    inicios, fines = bordes[::2], bordes[1::2]
+    k = int(np.argmax(fines - inicios))
+    return int(inicios[k]), int(fines[k]) + 1
+
+def detectar_grupo_similar(bajas, tolerancia=TOLERANCIA_GRUPO):
     """
     Detecta el grupo más grande de bajas correlativas donde cada baja
     tiene una diferencia ≤ tolerancia (4%) con la siguiente.
     Retorna el grupo más grande de bajas correlativas (mínimo 2)
     """
-    if len(bajas) < 2:
+    # Se devuelven los valores originales (Decimal si vienen de PostgreSQL)
+    orden = np.argsort(np.asarray(bajas, dtype=float), kind='stable')
+    tramo = _grupo_correlativo(np.asarray(bajas, dtype=float)[orden], tolerancia)
+    if tramo is None:
         return []
+    return [bajas[i] for i in orden[tramo[0]:tramo[1]]]
 
-    # Ordenar bajas
-    bajas_ordenadas = sorted(bajas)
-    grupos = []
-
-    # Buscar todos los grupos posibles
-    i = 0
-    while i < len(bajas_ordenadas):
-        grupo_actual = [bajas_ordenadas[i]]
-
-        # Agregar bajas consecutivas mientras la diferencia sea ≤ tolerancia
-        j = i + 1
-        while j < len(bajas_ordenadas):
-            diferencia = bajas_ordenadas[j] - bajas_ordenadas[j-1]
-            if diferencia <= tolerancia:
-                grupo_actual.append(bajas_ordenadas[j])
-                j += 1
-            else:
-                break
-
-        # Guardar el grupo si tiene al menos 2 elementos
-        if len(grupo_actual) >= 2:
-            grupos.append(grupo_actual)
+@trazar('calcular_baja_recomendada', filas=lambda r: r['n'])
+def recomendacion_baja(bajas, tolerancia=TOLERANCIA_GRUPO, margen=MARGEN_BAJA, incluidas=None):
+    """Baja recomendada y su explicación, sin salida por pantalla.
 
-        # Avanzar al siguiente grupo
-        i = j if j > i + 1 else i + 1
+    - Si hay 2+ bajas correlativas (diferencia consecutiva ≤ tolerancia): máximo del grupo + margen
+    - Si todas diferentes: media + margen
 
-    # Retornar el grupo más grande
-    if grupos:
-        return max(grupos, key=len)
-    return []
-
-def calcular_baja_recomendada(bajas):
-    """
-    Calcula la baja recomendada según el nuevo algoritmo:
-    - Si hay 2+ bajas correlativas (diferencia consecutiva ≤4%): max del grupo + 2%
-    - Si todas diferentes: media + 2%
+    incluidas: máscara booleana opcional para descartar comparables. Es
+    vectorizado y trabaja sobre las bajas en memoria, así que puede
+    recalcularse en cada cambio de los controles.
     """
-    if not bajas:
-        return 0
+    valores = np.asarray(bajas, dtype=float)
+    if incluidas is not None:
+        valores = valores[np.asarray(incluidas, dtype=bool)]
+    if not len(valores):
+        return {'baja': 0, 'grupo': [], 'media': None, 'minima': None, 'maxima': None, 'n': 0,
+                'tolerancia': tolerancia, 'margen': margen}
+    ordenadas = np.sort(valores)
+    tramo = _grupo_correlativo(ordenadas, tolerancia)
+    grupo = ordenadas[tramo[0]:tramo[1]] if tramo else ordenadas[:0]
+    media = float(ordenadas.mean())
+    baja = float(grupo[-1]) + margen if len(grupo) else media + margen
+    return {'baja': baja, 'grupo': grupo.tolist(), 'media': media, 'minima': float(ordenadas[0]),
+            'maxima': float(ordenadas[-1]), 'n': len(ordenadas), 'tolerancia': tolerancia, 'margen': margen}
+
+def explicar_recomendacion(recomendacion):
+    """Líneas de markdown que explican cómo se ha calculado la baja recomendada"""
+    grupo = recomendacion['grupo']
+    tolerancia = recomendacion['tolerancia']
+    margen = recomendacion['margen']
+    if grupo:
+        diferencias = [f"{grupo[i+1] - grupo[i]:.1f}%" for i in range(len(grupo)-1)]
+        return [
+            f"✅ **Grupo de {len(grupo)} bajas correlativas encontrado**: {[f'{b:.1f}%' for b in grupo]}",
+            f"📏 **Diferencias consecutivas**: {' → '.join(diferencias)} (todas ≤{tolerancia:g}%)",
+            f"📊 **Cálculo**: Baja más alta ({grupo[-1]:.2f}%) + {margen:g}% = **{recomendacion['baja']:.2f}%**",
+        ]
+    if recomendacion['media'] is None:
+        return ["ℹ️ **Sin comparables incluidos**"]
+    return [
+        f"ℹ️ **No se encontró grupo correlativo** (diferencias consecutivas >{tolerancia:g}%)",
+        f"📊 **Cálculo**: Media de bajas ({recomendacion['media']:.2f}%) + {margen:g}% = **{recomendacion['baja']:.2f}%**",
+    ]
 
-    grupo_similar = detectar_grupo_similar(bajas, tolerancia=4)
+def _contrato_desde_fila(columns, row):
+    """Convertir una fila de la consulta de comparables en dict con el nombre de la empresa"""
+    contrato = dict(zip(columns, row))
 
-    if grupo_similar:
-        # Hay un grupo de bajas correlativas
-        baja_mas_alta = max(grupo_similar)
-        baja_mas_baja = min(grupo_similar)
-        rango = baja_mas_alta - baja_mas_baja
+    # Empresas del índice canónico: el JSON de cada valor se parsea una sola vez
+    indice = get_indice_empresas()
+    ids = indice.ids(contrato['adjudicatario'])
+    contrato['empresa_ids'] = list(ids)
+    empresa = indice.nombre(ids[0]) if ids else 'N/A'
 
-        # Calcular diferencias consecutivas
-        grupo_ordenado = sorted(grupo_similar)
-        diferencias = [f"{grupo_ordenado[i+1] - grupo_ordenado[i]:.1f}%"
-                      for i in range(len(grupo_ordenado)-1)]
+    contrato['empresa'] = empresa
+    return contrato
 
-        baja_recomendada = baja_mas_alta + 2
-        st.info(f"✅ **Grupo de {len(grupo_similar)} bajas correlativas encontrado**: {[f'{b:.1f}%' for b in grupo_ordenado]}")
-        st.info(f"📏 **Diferencias consecutivas**: {' → '.join(diferencias)} (todas ≤4%)")
-        st.info(f"📊 **Cálculo**: Baja más alta ({baja_mas_alta:.2f}%) + 2% = **{baja_recomendada:.2f}%**")
-    else:
-        # Todas diferentes, hacer media
-        media = sum(bajas) / len(bajas)
-        baja_recomendada = media + 2
-        st.info(f"ℹ️ **No se encontró grupo correlativo** (diferencias consecutivas >4%)")
-        st.info(f"📊 **Cálculo**: Media de bajas ({media:.2f}%) + 2% = **{baja_recomendada:.2f}%**")
+@trazar(filas=len)
+def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="", limit=10, ampliada=False, provincia_origen=None, palabras_clave_manual=None, modo_busqueda='recientes', token=None, log=None):
+    """Buscar contratos similares con criterios específicos.
+
+    modo_busqueda: 'recientes' trae los 300 candidatos más recientes del CPV y
+    presupuesto; 'trigramas' trae los más parecidos al título de referencia,
+    ordenados por similitud de trigramas en PostgreSQL; 'texto_completo' los
+    más relevantes para las palabras clave en título y descripción, ordenados
+    por ts_rank_cd (busqueda_texto.py).
 
-    return baja_recomendada
+    token: TokenCancelacion del lote (cancelacion.py). Si se agota su
+    presupuesto o la ejecución de Streamlit es sustituida, la consulta se
+    cancela en el servidor y se sigue con los contratos leídos hasta entonces.
 
-def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="", limit=10, ampliada=False, provincia_origen=None, palabras_clave_manual=None):
-    """Buscar contratos similares con criterios específicos"""
+    log: LogBusqueda (tabla_comparables.py) que recoge los mensajes de
+    diagnóstico para mostrarlos juntos; los errores se muestran directamente.
+    """
+    if log is None:
+        log = LogBusqueda()
     if isinstance(cpvs, str):
         cpvs = [cpvs]
 
@@ -918,7 +969,7 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
             cpv_digits = ''.join(filter(str.isdigit, str(cpv)))
             if len(cpv_digits) >= 2:
                 cpv_patterns.append(cpv_digits[:2])  # 2 dígitos (más amplio)
-        st.warning(f"🔄 **Búsqueda ampliada**: CPV primeros 2 dígitos (más flexible)")
+        log.warning(f"🔄 **Búsqueda ampliada**: CPV primeros 2 dígitos (más flexible)")
     else:
         # Búsqueda normal: usar primeros 3 dígitos
         for cpv in cpvs[:3]:
@@ -927,16 +978,16 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
                 cpv_patterns.append(cpv_digits[:3])  # 3 dígitos
 
     if not cpv_patterns:
-        st.warning("❌ No se pudieron extraer CPVs válidos")
+        log.warning("❌ No se pudieron extraer CPVs válidos")
         return []
 
     # Eliminar duplicados
     cpv_patterns = list(set(cpv_patterns))
 
     if ampliada:
-        st.info(f"🔍 **Buscando con CPV**: {', '.join(cpv_patterns)} (primeros 2 dígitos)")
+        log.info(f"🔍 **Buscando con CPV**: {', '.join(cpv_patterns)} (primeros 2 dígitos)")
     else:
-        st.info(f"🔍 **Buscando con CPV**: {', '.join(cpv_patterns)} (primeros 3 dígitos)")
+        log.info(f"🔍 **Buscando con CPV**: {', '.join(cpv_patterns)} (primeros 3 dígitos)")
 
     cpv_condition = " OR ".join([f"cpv::text ~ '^{cpv}'" for cpv in cpv_patterns])
 
@@ -949,18 +1000,17 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
         presupuesto_min_rango = presupuesto_objetivo * 0.3
         presupuesto_max_rango = presupuesto_objetivo * 2.0
         if provincia_origen:
-            st.warning(f"🔄 **Búsqueda ampliada** - Rango presupuesto (±100%): €{presupuesto_min_rango:,.0f} - €{presupuesto_max_rango:,.0f}")
-            st.info(f"💡 **Manteniendo**: Palabra clave + Provincia ({provincia_origen})")
+            log.warning(f"🔄 **Búsqueda ampliada** - Rango presupuesto (±100%): €{presupuesto_min_rango:,.0f} - €{presupuesto_max_rango:,.0f}")
+            log.info(f"💡 **Manteniendo**: Palabra clave + Provincia ({provincia_origen})")
         else:
-            st.warning(f"🔄 **Búsqueda ampliada** - Rango presupuesto (±100%): €{presupuesto_min_rango:,.0f} - €{presupuesto_max_rango:,.0f}")
+            log.warning(f"🔄 **Búsqueda ampliada** - Rango presupuesto (±100%): €{presupuesto_min_rango:,.0f} - €{presupuesto_max_rango:,.0f}")
     else:
         # Búsqueda normal: ±30% del objetivo
         presupuesto_min_rango = presupuesto_objetivo * 0.7
         presupuesto_max_rango = presupuesto_objetivo * 1.3
-        st.info(f"💰 **Rango presupuesto (±30%)**: €{presupuesto_min_rango:,.0f} - €{presupuesto_max_rango:,.0f}")
+        log.info(f"💰 **Rango presupuesto (±30%)**: €{presupuesto_min_rango:,.0f} - €{presupuesto_max_rango:,.0f}")
 
-    query = f"""
-    SELECT
+    columnas_sql = """
         titulo,
         entidad_compradora as organismo,
         importe_total,
@@ -970,9 +1020,8 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
         fecha_publicacion,
         ROUND(((importe_total - importe_adjudicacion) / NULLIF(importe_total, 0) * 100)::numeric, 2) as baja,
         cpv,
-        INITCAP(LOWER(TRIM(provincia))) as provincia
-    FROM adjudicaciones_metabase
-    WHERE importe_total IS NOT NULL
+        INITCAP(LOWER(TRIM(provincia))) as provincia"""
+    condiciones_sql = f"""importe_total IS NOT NULL
     AND importe_adjudicacion IS NOT NULL
     AND importe_total > 0
     AND importe_adjudicacion > 0
@@ -983,7 +1032,29 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
     AND ({cpv_condition})
     AND importe_total BETWEEN {presupuesto_min_rango} AND {presupuesto_max_rango}
     AND ROUND(((importe_total - importe_adjudicacion) / NULLIF(importe_total, 0) * 100)::numeric, 2) > 0.5
-    AND ROUND(((importe_total - importe_adjudicacion) / NULLIF(importe_total, 0) * 100)::numeric, 2) < 70
+    AND ROUND(((importe_total - importe_adjudicacion) / NULLIF(importe_total, 0) * 100)::numeric, 2) < 70"""
+
+    # Búsqueda por relevancia de texto: trigramas del título o palabras clave (texto completo)
+    busqueda = None
+    if modo_busqueda == 'trigramas':
+        # Texto de referencia: palabras manuales si las hay, si no el título
+        referencia = palabras_clave_manual.replace(',', ' ') if palabras_clave_manual else titulo_referencia
+        if (referencia or '').strip():
+            busqueda = BusquedaTrigramas(referencia)
+    elif modo_busqueda == 'texto_completo':
+        if palabras_clave_manual:
+            palabras_busqueda = [p.strip() for p in palabras_clave_manual.split(',') if p.strip()]
+        else:
+            palabras_busqueda = extraer_palabras_clave(titulo_referencia) if titulo_referencia else []
+        busqueda = BusquedaTextoCompleto(palabras_busqueda) or None
+    if busqueda is None:
+        modo_busqueda = 'recientes'
+    etiqueta_busqueda = {'trigramas': "similitud de título", 'texto_completo': "texto completo"}.get(modo_busqueda)
+
+    query = f"""
+    SELECT{columnas_sql}
+    FROM adjudicaciones_metabase
+    WHERE {condiciones_sql}
     ORDER BY fecha_publicacion DESC
     LIMIT 300
     """
@@ -994,39 +1065,82 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
         if not conn:
             return []
 
-        cur = conn.cursor()
-        cur.execute(query)
-        columns = [desc[0] for desc in cur.description]
+        span_actual().anotar(ampliada=ampliada, cpv=','.join(cpv_patterns), modo=modo_busqueda)
         results = []
 
-        for row in cur.fetchall():
-            contrato = dict(zip(columns, row))
-
-            # Extraer nombre de empresa
-            adj_raw = contrato['adjudicatario']
-            empresa = 'N/A'
-            if adj_raw:
-                try:
-                    adj_str = str(adj_raw)
-                    if adj_str.startswith('['):
-                        adj_array = json.loads(adj_str)
-                        if adj_array and 'adjudicatario' in adj_array[0]:
-                            empresa = adj_array[0]['adjudicatario'].get('name', 'N/A')
-                    elif adj_str.startswith('{'):
-                        adj_dict = json.loads(adj_str)
-                        if 'adjudicatario' in adj_dict:
-                            empresa = adj_dict['adjudicatario'].get('name', 'N/A')
-                    else:
-                        empresa = adj_str[:80]
-                except:
-                    empresa = str(adj_raw)[:80] if adj_raw else 'N/A'
-
-            contrato['empresa'] = empresa
-            results.append(contrato)
-
-        cur.close()
-
-        st.info(f"💾 **Contratos recuperados de BD**: {len(results)}")
+        # Presupuesto de tiempo del lote: una consulta cancelada deja los resultados leídos hasta entonces
+        busqueda_parcial = None
+        canceladas_previas = token.canceladas if token is not None else 0
+        en_servidor = busqueda is not None and busqueda.disponible(conn)
+        try:
+            if en_servidor:
+                # La base de datos filtra con el índice GIN y envía solo los más relevantes
+                query = f"""
+                SELECT{columnas_sql},
+                    {busqueda.expresion_rango()} as relevancia_texto
+                FROM adjudicaciones_metabase
+                WHERE {condiciones_sql}
+                AND {busqueda.condicion()}
+                ORDER BY relevancia_texto DESC, fecha_publicacion DESC
+                LIMIT {CANDIDATOS}
+                """
+                with span("consulta_sql") as s_consulta, consulta_sql("buscar_contratos", conn, query) as c_sql, \
+                        vigilar(conn, token):
+                    busqueda.preparar_sesion(conn)
+                    for columns, filas in iterar_filas(conn, query, itersize=100):
+                        for row in filas:
+                            contrato = _contrato_desde_fila(columns, row)
+                            contrato['relevancia_texto'] = round(float(contrato['relevancia_texto'] or 0), 3)
+                            results.append(contrato)
+                    s_consulta.filas = c_sql.filas = len(results)
+                log.info(f"🔤 **Búsqueda por {etiqueta_busqueda} (PostgreSQL)**: {len(results)} candidatos más relevantes")
+            elif busqueda is not None:
+                # Sin columna/índice (migraciones.py): la misma puntuación calculada en Python sobre los candidatos del CPV y presupuesto
+                query = f"""
+                SELECT{columnas_sql},
+                    descripcion as descripcion_busqueda
+                FROM adjudicaciones_metabase
+                WHERE {condiciones_sql}
+                """
+                candidatos_leidos = [0]
+                with span("consulta_sql") as s_consulta, consulta_sql("buscar_contratos", conn, query) as c_sql, \
+                        vigilar(conn, token):
+                    def filas_candidatas():
+                        try:
+                            for columns, filas in iterar_filas(conn, query, itersize=500):
+                                posicion_titulo = columns.index('titulo')
+                                posicion_descripcion = columns.index('descripcion_busqueda')
+                                candidatos_leidos[0] += len(filas)
+                                for row in filas:
+                                    yield (row[posicion_titulo] or '', row[posicion_descripcion] or ''), columns[:-1], row[:-1]
+                        except Exception:
+                            # Cancelada: el heap se queda con los mejores de las filas ya leídas
+                            if token is None or not token.cancelado():
+                                raise
+
+                    # Solo se guardan los mejores; el resto de filas se descarta según se leen
+                    for valor, (_, columns, row) in busqueda.mejores(filas_candidatas(), texto=lambda fila: fila[0]):
+                        contrato = _contrato_desde_fila(columns, row)
+                        contrato['relevancia_texto'] = round(valor, 3)
+                        results.append(contrato)
+                    s_consulta.filas = c_sql.filas = candidatos_leidos[0]
+                log.info(f"🔤 **Búsqueda por {etiqueta_busqueda} (local)**: {len(results)} de {candidatos_leidos[0]} candidatos")
+            else:
+                # Cursor de servidor: las filas llegan por bloques y se procesan según se reciben
+                with span("consulta_sql") as s_consulta, consulta_sql("buscar_contratos", conn, query) as c_sql, \
+                        vigilar(conn, token):
+                    for columns, filas in iterar_filas(conn, query, itersize=100):
+                        for row in filas:
+                            results.append(_contrato_desde_fila(columns, row))
+                    s_consulta.filas = c_sql.filas = len(results)
+        except ConsultaCancelada as e:
+            busqueda_parcial = e.motivo
+        if busqueda_parcial is None and token is not None and token.canceladas > canceladas_previas:
+            busqueda_parcial = token.motivo
+        if busqueda_parcial:
+            log.warning(f"⏱️ **Búsqueda interrumpida** ({busqueda_parcial}): se usan los {len(results)} contratos leídos hasta ese momento")
+
+        log.info(f"💾 **Contratos recuperados de BD**: {len(results)}")
 
         if not results:
             st.error("❌ No se encontraron contratos con ese CPV y presupuesto.")
@@ -1041,10 +1155,10 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
             if palabras_clave_manual:
                 # Procesar palabras clave manuales
                 palabras_objetivo = set([p.strip().lower() for p in palabras_clave_manual.split(',') if p.strip()])
-                st.info(f"🎯 **Palabras clave manuales**: {', '.join(sorted(palabras_objetivo))}")
+                log.info(f"🎯 **Palabras clave manuales**: {', '.join(sorted(palabras_objetivo))}")
             else:
                 palabras_objetivo = extraer_palabras_clave(titulo_referencia)
-                st.info(f"🎯 **Palabras clave extraídas automáticamente**: {', '.join(sorted(palabras_objetivo))}")
+                log.info(f"🎯 **Palabras clave extraídas automáticamente**: {', '.join(sorted(palabras_objetivo))}")
 
             # Función para normalizar texto (para búsqueda)
             def normalizar_para_busqueda(texto):
@@ -1060,49 +1174,46 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
                 return texto
 
             # Calcular palabras coincidentes y similitud para cada contrato
-            for c in results:
-                if palabras_clave_manual:
-                    # BÚSQUEDA DIRECTA EN TÍTULO (sin extraer palabras clave)
-                    # Normalizar título del contrato
-                    titulo_normalizado = normalizar_para_busqueda(c['titulo'])
-
-                    comunes = set()
-                    # Buscar cada palabra manual en el título
-                    for palabra_objetivo in palabras_objetivo:
-                        # Normalizar palabra objetivo
-                        palabra_normalizada = normalizar_para_busqueda(palabra_objetivo)
-
-                        # Buscar si la palabra está contenida en el título
-                        if palabra_normalizada in titulo_normalizado:
-                            comunes.add(palabra_objetivo)
-
-                    c['num_palabras_comunes'] = len(comunes)
-                    c['palabras_comunes'] = comunes
-                    if palabras_objetivo:
-                        c['similitud'] = len(comunes) / len(palabras_objetivo)  # Porcentaje de palabras encontradas
+            with span("puntuacion_palabras_clave") as s_palabras:
+                s_palabras.filas = len(results)
+                for c in results:
+                    if palabras_clave_manual:
+                        # BÚSQUEDA DIRECTA EN TÍTULO (sin extraer palabras clave)
+                        # Normalizar título del contrato
+                        titulo_normalizado = normalizar_para_busqueda(c['titulo'])
+
+                        comunes = set()
+                        # Buscar cada palabra manual en el título
+                        for palabra_objetivo in palabras_objetivo:
+                            # Normalizar palabra objetivo
+                            palabra_normalizada = normalizar_para_busqueda(palabra_objetivo)
+
+                            # Buscar si la palabra está contenida en el título
+                            if palabra_normalizada in titulo_normalizado:
+                                comunes.add(palabra_objetivo)
+
+                        c['num_palabras_comunes'] = len(comunes)
+                        c['palabras_comunes'] = comunes
+                        if palabras_objetivo:
+                            c['similitud'] = len(comunes) / len(palabras_objetivo)  # Porcentaje de palabras encontradas
+                        else:
+                            c['similitud'] = 0
                     else:
-                        c['similitud'] = 0
-                else:
-                    # Usar sistema automático de extracción de palabras clave
-                    palabras_contrato = extraer_palabras_clave(c['titulo'])
-                    comunes = palabras_objetivo.intersection(palabras_contrato)
-                    c['num_palabras_comunes'] = len(comunes)
-                    c['palabras_comunes'] = comunes
-                    c['similitud'] = calcular_similitud_palabras(titulo_referencia, c['titulo'])
+                        # Usar sistema automático de extracción de palabras clave
+                        palabras_contrato = extraer_palabras_clave(c['titulo'])
+                        comunes = palabras_objetivo.intersection(palabras_contrato)
+                        c['num_palabras_comunes'] = len(comunes)
+                        c['palabras_comunes'] = comunes
+                        c['similitud'] = calcular_similitud_palabras(titulo_referencia, c['titulo'])
 
             # FILTRAR: solo contratos con al menos 1 palabra en común
             results_filtrados = [c for c in results if c['num_palabras_comunes'] > 0]
 
-            st.info(f"🔍 **Contratos con palabras clave en común**: {len(results_filtrados)}")
+            log.info(f"🔍 **Contratos con palabras clave en común**: {len(results_filtrados)}")
 
             if not results_filtrados:
-                st.warning("⚠️ No se encontraron contratos con palabras clave similares")
-                st.write("**Mostrando los 5 más recientes sin filtro:**")
-                results = results[:5]
-                for i, c in enumerate(results, 1):
-                    fecha_str = str(c['fecha_publicacion'])[:10] if c['fecha_publicacion'] else 'N/A'
-                    st.write(f"{i}. [{fecha_str}] {c['titulo'][:70]}")
-                return results
+                log.warning("⚠️ No se encontraron contratos con palabras clave similares: se usan los 5 más recientes sin filtro")
+                return results[:5]
 
             results = results_filtrados
 
@@ -1179,8 +1290,8 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
 
             # Calcular proximidad geográfica mejorada
             if provincia_origen:
-                st.info(f"📍 **Provincia de origen**: {provincia_origen}")
-                st.info(f"🔍 **Provincia normalizada para búsqueda**: '{normalizar_texto(provincia_origen)}'")
+                log.info(f"📍 **Provincia de origen**: {provincia_origen}")
+                log.info(f"🔍 **Provincia normalizada para búsqueda**: '{normalizar_texto(provincia_origen)}'")
 
                 # Contador para debug
                 provincias_encontradas = {}  # provincia_original: provincia_normalizada
@@ -1204,17 +1315,17 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
 
                 # Mostrar info de debug detallada
                 if contratos_misma_provincia > 0:
-                    st.success(f"✅ **{contratos_misma_provincia} contratos encontrados en {provincia_origen}**")
+                    log.success(f"✅ **{contratos_misma_provincia} contratos encontrados en {provincia_origen}**")
                     if ejemplos_match:
-                        st.info(f"🔍 **Ejemplos de matches**: {' | '.join(ejemplos_match)}")
+                        log.info(f"🔍 **Ejemplos de matches**: {' | '.join(ejemplos_match)}")
                 else:
-                    st.warning(f"⚠️ **No se encontraron contratos en {provincia_origen}**")
+                    log.warning(f"⚠️ **No se encontraron contratos en {provincia_origen}**")
                     if provincias_encontradas:
                         # Mostrar las primeras 10 provincias con su normalización
                         provincias_debug = []
                         for prov_orig, prov_norm in sorted(list(provincias_encontradas.items()))[:10]:
                             provincias_debug.append(f"{prov_orig} ('{prov_norm}')")
-                        st.info(f"🗺️ **Provincias en resultados**:\n" + "\n".join([f"- {p}" for p in provincias_debug]))
+                        log.info(f"🗺️ **Provincias en resultados**:\n" + "\n".join([f"- {p}" for p in provincias_debug]))
                         st.error(f"❌ **Buscando**: '{normalizar_texto(provincia_origen)}' - **No coincide con ninguna**")
             else:
                 # Sin provincia origen, todos tienen misma proximidad
@@ -1235,48 +1346,50 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
 
             # Debug de niveles
             if provincia_origen:
-                st.info(f"📊 **Niveles disponibles**: Nivel 1: {len(nivel_1)}, Nivel 2: {len(nivel_2)}, Nivel 3: {len(nivel_3)}")
+                log.info(f"📊 **Niveles disponibles**: Nivel 1: {len(nivel_1)}, Nivel 2: {len(nivel_2)}, Nivel 3: {len(nivel_3)}")
 
             # ESTRATEGIA INTELIGENTE: Priorizar SIEMPRE misma provincia si existe
             if len(nivel_1) >= limit:
                 # Ideal: Hay suficientes contratos recientes de la misma zona
                 results_finales = nivel_1
-                st.success(f"✅ **Nivel 1**: {len(nivel_1)} contratos (Palabras clave + Misma zona + Recientes)")
+                log.success(f"✅ **Nivel 1**: {len(nivel_1)} contratos (Palabras clave + Misma zona + Recientes)")
             elif len(nivel_2) >= limit:
                 # Bueno: Hay suficientes contratos de la misma zona (aunque no sean recientes)
                 results_finales = nivel_2
-                st.info(f"ℹ️ **Nivel 2**: {len(nivel_2)} contratos (Palabras clave + Misma zona)")
+                log.info(f"ℹ️ **Nivel 2**: {len(nivel_2)} contratos (Palabras clave + Misma zona)")
             elif len(nivel_2) > 0:
                 # Hay algunos contratos de la misma zona pero no suficientes
                 # PRIORIZAR: Mostrar primero los de la misma zona, luego completar con otros
                 results_finales = nivel_2 + nivel_3
-                st.warning(f"⚠️ **Nivel mixto**: {len(nivel_2)} contratos de misma zona + {len(nivel_3)} de otras zonas")
-                st.info(f"💡 **Se priorizan los {len(nivel_2)} contratos de la misma provincia**")
+                log.warning(f"⚠️ **Nivel mixto**: {len(nivel_2)} contratos de misma zona + {len(nivel_3)} de otras zonas")
+                log.info(f"💡 **Se priorizan los {len(nivel_2)} contratos de la misma provincia**")
             else:
                 # No hay ningún contrato de la misma zona
                 results_finales = nivel_3
                 if provincia_origen:
-                    st.warning(f"⚠️ **Nivel 3**: {len(nivel_3)} contratos (No se encontraron en {provincia_origen})")
+                    log.warning(f"⚠️ **Nivel 3**: {len(nivel_3)} contratos (No se encontraron en {provincia_origen})")
                 else:
-                    st.warning(f"⚠️ **Nivel 3**: {len(nivel_3)} contratos (Solo palabras clave)")
+                    log.warning(f"⚠️ **Nivel 3**: {len(nivel_3)} contratos (Solo palabras clave)")
 
-            # ORDENAR: PRIMERO por proximidad (misma provincia primero), LUEGO por palabras comunes, LUEGO por fecha
+            # ORDENAR: PRIMERO por proximidad (misma provincia primero), LUEGO por palabras comunes,
+            # LUEGO por relevancia del texto (búsquedas por similitud o texto completo), LUEGO por fecha
             results_finales.sort(key=lambda x: (
                 x.get('proximidad', 0),  # 1 = misma provincia, 0 = otra provincia
                 x['num_palabras_comunes'],
+                x.get('relevancia_texto', 0),
                 x['fecha_publicacion'] if x['fecha_publicacion'] else datetime(1900, 1, 1)
             ), reverse=True)
 
             # Debug: Mostrar los primeros 3 contratos antes de enviar
             if provincia_origen and len(results_finales) >= 3:
-                st.info("🔍 **Debug - Primeros 3 contratos después de ordenar:**")
+                log.info("🔍 **Debug - Primeros 3 contratos después de ordenar:**")
                 for idx, c in enumerate(results_finales[:3], 1):
                     prov = c.get('provincia', 'N/A')
                     prox = c.get('proximidad', 0)
                     palabras = c.get('num_palabras_comunes', 0)
-                    st.text(f"  {idx}. Provincia: {prov} | Proximidad: {prox} | Palabras: {palabras}")
+                    log.text(f"  {idx}. Provincia: {prov} | Proximidad: {prox} | Palabras: {palabras}")
 
-            st.success(f"✅ **Mostrando los {min(limit, len(results_finales))} contratos más relevantes**")
+            log.success(f"✅ **Mostrando los {min(limit, len(results_finales))} contratos más relevantes**")
 
             results = results_finales
 
@@ -1286,21 +1399,9 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
             num_misma_provincia = sum(1 for c in contratos_mostrar if c.get('proximidad', 0) == 1)
             num_otras_provincias = len(contratos_mostrar) - num_misma_provincia
 
+            # El detalle de cada contrato (palabras coincidentes, zona) se muestra en la tabla de comparables
             if provincia_origen and num_misma_provincia > 0:
-                st.write(f"**Contratos encontrados:** {num_misma_provincia} de {provincia_origen} (📍), {num_otras_provincias} de otras provincias (📌)")
-            else:
-                st.write("**Contratos encontrados (ordenados por relevancia):**")
-
-            for i, c in enumerate(contratos_mostrar, 1):
-                fecha_str = str(c['fecha_publicacion'])[:10] if c['fecha_publicacion'] else 'N/A'
-                # Usar las palabras comunes ya calculadas
-                palabras_comunes = c.get('palabras_comunes', set())
-                num_coincidencias = c.get('num_palabras_comunes', 0)
-                provincia_str = c.get('provincia', 'N/A')
-                proximidad_icon = "📍" if c.get('proximidad', 0) == 1 else "📌"
-
-                st.write(f"{i}. [{num_coincidencias} palabra{'s' if num_coincidencias != 1 else ''} coincidente{'s' if num_coincidencias != 1 else ''}] {proximidad_icon} [{provincia_str}] [{fecha_str}] {c['titulo'][:60]}")
-                st.write(f"   💡 Palabras clave coincidentes: {', '.join(sorted(palabras_comunes))}")
+                log.write(f"**Contratos encontrados:** {num_misma_provincia} de {provincia_origen} (📍), {num_otras_provincias} de otras provincias (📌)")
 
         else:
             # Sin título, solo ordenar por fecha
@@ -1316,8 +1417,13 @@ def buscar_contratos(cpvs, presupuesto_min, presupuesto_max, titulo_referencia="
         if conn:
             conn.close()
 
-def generar_texto_informe(lote, contratos, baja_prom, baja_min, baja_max, empresas, num_lic_prom, datos):
-    """Generar texto del informe para copiar siguiendo la estructura estándar"""
+@trazar()
+def generar_texto_informe(lote, contratos, baja_prom, baja_min, baja_max, empresas, num_lic_prom, datos, rng=None):
+    """Generar texto del informe para copiar siguiendo la estructura estándar.
+
+    rng: random.Random opcional; con la misma semilla se eligen las mismas frases.
+    """
+    rng = rng or random
 
     # Variaciones para la introducción
     saludos = ["Buenos días,", "Buenas tardes,", "Estimados,"]
@@ -1358,8 +1464,8 @@ def generar_texto_informe(lote, contratos, baja_prom, baja_min, baja_max, empres
     despedidas = ["Un cordial saludo", "Saludos cordiales", "Atentamente"]
 
     # Generar el texto siguiendo la estructura del ejemplo
-    texto = f"{random.choice(saludos)}\n"
-    texto += f"{random.choice(intros_criterios)}\n"
+    texto = f"{rng.choice(saludos)}\n"
+    texto += f"{rng.choice(intros_criterios)}\n"
 
     # Criterios de adjudicación
     if lote['criterios']:
@@ -1381,7 +1487,7 @@ def generar_texto_informe(lote, contratos, baja_prom, baja_min, baja_max, empres
         texto += "OFERTA ECONÓMICA: 100 puntos\n"
 
     # Análisis de participación
-    texto += f"{random.choice(intros_participacion)}\n"
+    texto += f"{rng.choice(intros_participacion)}\n"
 
     # Empresas destacadas (priorizando las de la misma provincia)
     if empresas:
@@ -1410,21 +1516,39 @@ def generar_texto_informe(lote, contratos, baja_prom, baja_min, baja_max, empres
             empresas_texto += f" y {sorted_emp[-1][0]}"
         else:
             empresas_texto = sorted_emp[0][0]
-        texto += f" {random.choice(intros_empresas)} {empresas_texto}.\n"
+        texto += f" {rng.choice(intros_empresas)} {empresas_texto}.\n"
+
+        # Baja habitual de las empresas citadas según su perfil de licitación
+        frase = frase_perfiles([(emp, info.get('perfil')) for emp, info in sorted_emp[:3] if isinstance(info, dict)])
+        if frase:
+            texto += f"{frase}\n"
 
     # Análisis de ofertas
-    texto += f"{random.choice(analisis_ofertas)}\n"
+    texto += f"{rng.choice(analisis_ofertas)}\n"
 
     # Recomendación
-    texto += f"{random.choice(recomendaciones)}\n"
+    texto += f"{rng.choice(recomendaciones)}\n"
 
     # Despedida
-    texto += f"{random.choice(despedidas)}\n"
+    texto += f"{rng.choice(despedidas)}\n"
 
     return texto
 
+def perfiles_competidores():
+    """Almacén de perfiles de empresa, o None mientras se carga.
+
+    Si ha caducado se refresca en segundo plano con su propia conexión: el
+    análisis no espera y, hasta la primera carga completa, el informe sale
+    sin perfiles.
+    """
+    almacen = get_almacen_perfiles()
+    refrescar_en_segundo_plano(almacen, get_connection)
+    return almacen if almacen.cargado() else None
+
+@trazar()
 def crear_excel(datos_lote, contratos, baja_recomendada):
     """Crear archivo Excel con los resultados"""
+    span_actual().filas = len(contratos)
     wb = Workbook()
     ws = wb.active
     ws.title = "Análisis"
@@ -1501,6 +1625,345 @@ def crear_excel(datos_lote, contratos, baja_recomendada):
     buffer.seek(0)
     return buffer
 
+# Análisis guardados por sesión (clave de las entradas -> análisis); se descartan los más antiguos
+MAX_ANALISIS_SESION = 5
+
+def clave_analisis(source_type, xml_url, json_file, datos_manuales, palabras_clave_manual, modo_busqueda):
+    """Huella de las entradas del análisis: mismo documento y opciones de búsqueda -> misma clave"""
+    huella = hashlib.sha1()
+    entradas = [source_type, xml_url, palabras_clave_manual or '', modo_busqueda,
+                datos_manuales if source_type == "Manual" else None]
+    huella.update(json.dumps(entradas, default=str, sort_keys=True).encode('utf-8'))
+    if source_type == "JSON (Archivo)" and json_file is not None:
+        huella.update(json_file.getvalue())
+    return huella.hexdigest()[:16]
+
+def guardar_analisis(clave, analisis):
+    """Guardar el análisis en la sesión; sobrevive a los reruns por descargas y widgets"""
+    guardados = st.session_state.setdefault('analisis_por_clave', {})
+    guardados.pop(clave, None)
+    guardados[clave] = analisis
+    while len(guardados) > MAX_ANALISIS_SESION:
+        guardados.pop(next(iter(guardados)))
+
+def analizar_lote(lote, datos, palabras_clave_manual, modo_busqueda, presupuesto_lote_s):
+    """Buscar comparables y calcular la baja de un lote.
+
+    Devuelve un dict con todo lo que muestra mostrar_lote(): contratos,
+    estadísticas, texto del informe, Excel, avisos y mensajes de la búsqueda.
+    """
+    resultado = {'lote': lote, 'avisos': [], 'log': LogBusqueda(), 'contratos': [], 'bajas': []}
+
+    # Palabras clave (manuales o automáticas)
+    if palabras_clave_manual:
+        resultado['palabras_clave'] = ('manuales', sorted({p.strip().lower() for p in palabras_clave_manual.split(',') if p.strip()}))
+    elif lote['titulo']:
+        resultado['palabras_clave'] = ('automáticas', sorted(extraer_palabras_clave(lote['titulo'])))
+
+    if not (lote['cpv'] and lote['presupuesto'] > 0):
+        return resultado
+
+    avisos = resultado['avisos']
+    log_busqueda = resultado['log']
+    pres_min = lote['presupuesto'] * 0.5
+    pres_max = lote['presupuesto'] * 1.5
+
+    # Provincia que se usará para la búsqueda
+    provincia_busqueda = datos.get('provincia')
+    if provincia_busqueda:
+        avisos.append(('info', f"🌍 **Buscando contratos con filtro geográfico**: {provincia_busqueda}"))
+    else:
+        avisos.append(('info', f"🌍 **Buscando contratos sin filtro geográfico** (provincia no detectada en el documento)"))
+
+    # Presupuesto de tiempo de las búsquedas del lote (se cancelan también si se relanza el script)
+    token_lote = TokenCancelacion(presupuesto_lote_s, sustituida=ejecucion_sustituida_streamlit())
+
+    # Búsqueda normal
+    with st.spinner(f"Buscando contratos del lote {lote['numero']}..."):
+        contratos = buscar_contratos(
+            lote['cpv'],
+            pres_min,
+            pres_max,
+            titulo_referencia=lote['titulo'],
+            limit=10,
+            ampliada=False,
+            provincia_origen=provincia_busqueda,
+            palabras_clave_manual=palabras_clave_manual if palabras_clave_manual else None,
+            modo_busqueda=modo_busqueda,
+            token=token_lote,
+            log=log_busqueda
+        )
+
+    # Si hay menos de 3 contratos, hacer búsqueda ampliada
+    if len(contratos) < 3 and token_lote.cancelado():
+        avisos.append(('warning', f"⏱️ Sin tiempo para la búsqueda ampliada ({token_lote.motivo}): se usan {len(contratos)} contrato(s)"))
+    elif len(contratos) < 3:
+        avisos.append(('warning', f"⚠️ Solo se encontraron {len(contratos)} contrato(s). Búsqueda ampliada."))
+        if provincia_busqueda:
+            log_busqueda.info(f"🔄 **Ampliando CPV (2 dígitos) y presupuesto (±100%), manteniendo palabra clave + provincia**")
+        else:
+            log_busqueda.info(f"🔄 **Ampliando CPV (2 dígitos) y presupuesto (±100%), manteniendo palabra clave**")
+        with st.spinner(f"Buscando con criterios ampliados (lote {lote['numero']})..."):
+            contratos = buscar_contratos(
+                lote['cpv'],
+                pres_min,
+                pres_max,
+                titulo_referencia=lote['titulo'],
+                limit=10,
+                ampliada=True,
+                provincia_origen=provincia_busqueda,
+                palabras_clave_manual=palabras_clave_manual if palabras_clave_manual else None,
+                modo_busqueda=modo_busqueda,
+                token=token_lote,
+                log=log_busqueda
+            )
+
+        if len(contratos) < 3:
+            avisos.append(('error', f"❌ Solo se encontraron {len(contratos)} contrato(s) incluso con búsqueda ampliada"))
+
+    resultado['contratos'] = contratos
+    # Calcular estadísticas
+    bajas = [c['baja'] for c in contratos if c['baja']]
+    if not bajas:
+        return resultado
+
+    # Usar nuevo algoritmo de cálculo
+    recomendacion = recomendacion_baja(bajas)
+    baja_prom = recomendacion['baja']
+    num_lic_prom = sum([c['numero_licitadores'] or 0 for c in contratos]) / len(contratos)
+
+    # Perfil de licitación de cada empresa: una consulta por clave al almacén
+    indice_empresas = get_indice_empresas()
+    almacen_perfiles = perfiles_competidores()
+    competidores = {}
+    for c in contratos:
+        ids = c.get('empresa_ids')
+        if ids and ids[0] not in competidores:
+            perfil = almacen_perfiles.perfil(indice_empresas.clave(ids[0])) if almacen_perfiles else None
+            competidores[ids[0]] = (indice_empresas.nombre(ids[0]), perfil)
+    empresas_data = agrupar_empresas(contratos, competidores)
+
+    # Semilla de las frases del informe: el texto no cambia de redacción al recalcular
+    semilla = random.randrange(2**32)
+    resultado.update(
+        bajas=bajas,
+        baja_prom=baja_prom,
+        baja_min=min(bajas),
+        baja_max=max(bajas),
+        num_lic_prom=num_lic_prom,
+        explicacion=explicar_recomendacion(recomendacion),
+        competidores=competidores,
+        semilla=semilla,
+        empresas=empresas_data,
+        texto_informe=generar_texto_informe(lote, contratos, baja_prom, min(bajas), max(bajas), empresas_data, num_lic_prom, datos,
+                                            rng=random.Random(semilla)),
+        excel=crear_excel(lote, contratos, baja_prom).getvalue(),
+        datos=datos,
+    )
+    return resultado
+
+def agrupar_empresas(contratos, competidores):
+    """Empresas adjudicatarias de los contratos: nombre -> frecuencia, provincia y perfil.
+
+    competidores: id de empresa -> (nombre, perfil de licitación), ya leídos
+    del índice y del almacén, para poder recalcular sin consultarlos.
+    """
+    empresas_data = {}
+    for c in contratos:
+        ids = c.get('empresa_ids')
+        if ids:
+            id_emp = ids[0]
+            if id_emp not in empresas_data:
+                empresas_data[id_emp] = {
+                    'frecuencia': 0,
+                    'provincia': c.get('provincia', '').strip().lower() if c.get('provincia') else '',
+                    'perfil': competidores[id_emp][1]
+                }
+            empresas_data[id_emp]['frecuencia'] += 1
+    return {competidores[id_emp][0]: info for id_emp, info in empresas_data.items()}
+
+def recalcular_lote(resultado, tolerancia, margen, excluidos):
+    """Recalcular la baja y el informe de un lote con otros parámetros.
+
+    Trabaja solo con los comparables guardados en el resultado (no consulta
+    la base de datos ni vuelve a leer el documento). excluidos: posiciones
+    (desde 0) de los contratos que no se tienen en cuenta.
+    """
+    contratos = resultado['contratos']
+    incluidos = np.ones(len(contratos), dtype=bool)
+    incluidos[list(excluidos)] = False
+    contratos = [c for c, incluido in zip(contratos, incluidos) if incluido]
+    bajas = [c['baja'] for c in contratos if c['baja']]
+    recomendacion = recomendacion_baja(bajas, tolerancia, margen)
+    recalculo = {'contratos': contratos, 'bajas': bajas, 'baja_prom': recomendacion['baja'],
+                 'explicacion': explicar_recomendacion(recomendacion)}
+    if not bajas:
+        return recalculo
+    num_lic_prom = sum([c['numero_licitadores'] or 0 for c in contratos]) / len(contratos)
+    empresas_data = agrupar_empresas(contratos, resultado['competidores'])
+    recalculo.update(
+        baja_min=recomendacion['minima'],
+        baja_max=recomendacion['maxima'],
+        num_lic_prom=num_lic_prom,
+        empresas=empresas_data,
+        texto_informe=generar_texto_informe(resultado['lote'], contratos, recomendacion['baja'], recomendacion['minima'],
+                                            recomendacion['maxima'], empresas_data, num_lic_prom, resultado['datos'],
+                                            rng=random.Random(resultado['semilla'])),
+    )
+    return recalculo
+
+def _etiqueta_comparable(contratos, i):
+    c = contratos[i]
+    baja = f"{c['baja']:.2f}%" if c.get('baja') else "sin baja"
+    return f"#{i + 1} · {baja} · {(c.get('titulo') or '')[:60]}"
+
+def controles_recalculo(resultado, clave):
+    """Controles del "¿y si...?" de un lote; devuelve (tolerancia, margen, excluidos)"""
+    contratos = resultado['contratos']
+    with st.expander("🧪 ¿Y si...? Ajustar el cálculo sin volver a buscar"):
+        col1, col2 = st.columns(2)
+        with col1:
+            tolerancia = st.slider("Tolerancia del grupo correlativo (%)", 0.5, 10.0, float(TOLERANCIA_GRUPO), 0.5,
+                                   key=f"tolerancia_{clave}",
+                                   help="Diferencia máxima entre bajas consecutivas para considerarlas del mismo grupo")
+        with col2:
+            margen = st.slider("Margen sobre la baja (%)", 0.0, 5.0, float(MARGEN_BAJA), 0.5,
+                               key=f"margen_{clave}",
+                               help="Puntos que se suman a la baja más alta del grupo (o a la media)")
+        excluidos = st.multiselect("Excluir comparables", range(len(contratos)),
+                                   format_func=lambda i: _etiqueta_comparable(contratos, i),
+                                   key=f"excluidos_{clave}")
+    return tolerancia, margen, excluidos
+
+@st.fragment
+def mostrar_lote(resultado, clave):
+    """Panel de resultados de un lote.
+
+    Es un fragmento: descargar el Excel, seleccionar una fila, editar el texto
+    o mover los controles del "¿y si...?" solo vuelve a ejecutar este panel,
+    con los datos guardados en la sesión.
+    clave: identifica el análisis, para que los widgets no se mezclen entre análisis.
+    """
+    lote = resultado['lote']
+    clave = f"{clave}_{lote['numero']}"
+    st.markdown(f"## 📦 Lote {lote['numero']}: {lote['titulo'][:80] if lote['titulo'] else 'Sin título'}")
+
+    st.markdown(f"**Presupuesto:** €{lote['presupuesto']:,.2f}")
+    st.markdown(f"**CPV:** {', '.join(lote['cpv']) if lote['cpv'] else 'No especificado'}")
+
+    # Mostrar palabras clave (manuales o automáticas)
+    if resultado.get('palabras_clave') and resultado['palabras_clave'][1]:
+        origen, palabras = resultado['palabras_clave']
+        st.markdown(f"**🔑 Palabras clave ({origen}):** {', '.join(palabras)}")
+
+    # Criterios
+    st.markdown("### ⚖️ Criterios de Adjudicación")
+    if lote['criterios']:
+        lineas = []
+        for i, crit in enumerate(lote['criterios'], 1):
+            # Manejar tanto strings como diccionarios
+            if isinstance(crit, dict):
+                desc = crit.get('descripcion', f'Criterio {i}')
+                peso = crit.get('peso', '')
+                lineas.append(f"**{i}.** {desc}: **{peso}**" if peso else f"**{i}.** {desc}")
+            else:
+                # Es un string
+                lineas.append(f"**{i}.** {crit}")
+        st.markdown("\n\n".join(lineas))
+    else:
+        st.info("ℹ️ No se encontraron criterios de adjudicación")
+
+    if not (lote['cpv'] and lote['presupuesto'] > 0):
+        st.warning("⚠️ No se pudo extraer CPV o presupuesto del lote")
+        return
+
+    st.markdown("### 🔍 Búsqueda de Contratos Similares")
+    for nivel, texto in resultado['avisos']:
+        getattr(st, nivel)(texto)
+    resultado['log'].mostrar()
+
+    if not resultado['bajas']:
+        return
+    todos = resultado['contratos']
+
+    st.markdown("### 📊 Resultados")
+
+    # Recalcular con los comparables en memoria si se ha cambiado algún parámetro
+    tolerancia, margen, excluidos = controles_recalculo(resultado, clave)
+    modificado = (tolerancia, margen) != (TOLERANCIA_GRUPO, MARGEN_BAJA) or bool(excluidos)
+    actual = recalcular_lote(resultado, tolerancia, margen, excluidos) if modificado else resultado
+    contratos = actual['contratos']
+    if not actual['bajas']:
+        st.warning("⚠️ No queda ningún comparable con baja: incluye alguno para calcular la recomendación")
+        return
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        delta = f"{actual['baja_prom'] - resultado['baja_prom']:+.2f} pp" if modificado else None
+        st.metric("🎯 Baja Recomendada", f"{actual['baja_prom']:.2f}%", delta=delta, delta_color="off")
+    with col2:
+        st.metric("📈 Contratos Analizados", len(contratos))
+    with col3:
+        st.metric("👥 Licitadores Promedio", f"{actual['num_lic_prom']:.0f}")
+
+    st.markdown(f"**Rango de bajas:** {actual['baja_min']:.1f}% - {actual['baja_max']:.1f}%")
+    st.markdown("\n\n".join(actual['explicacion']))
+
+    # Sección de descarga y texto
+    st.markdown("---")
+    st.markdown("### 📝 Informe Generado")
+
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        # on_click='ignore': descargar no vuelve a ejecutar nada
+        st.download_button(
+            label="📥 Descargar análisis en Excel",
+            # Con parámetros cambiados el Excel se genera al vuelo con los valores mostrados
+            data=crear_excel(lote, contratos, actual['baja_prom']).getvalue() if modificado else resultado['excel'],
+            file_name=f"analisis_lote_{lote['numero']}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click='ignore',
+            use_container_width=True
+        )
+    with col2:
+        st.info(f"✅ {len(contratos)} contratos incluidos en el análisis")
+
+    # Texto para copiar
+    st.markdown("#### 📄 Texto del Informe (Copia y Pega)")
+    st.text_area(
+        label="Texto completo del análisis:",
+        value=actual['texto_informe'],
+        height=300,
+        help="Copia este texto para usar en tu informe"
+    )
+
+    # Contratos comparables: una tabla ordenable con la ficha de la fila seleccionada
+    st.markdown(f"#### 📋 Contratos encontrados ({len(todos)})")
+    mostrar_comparables(todos, clave=clave)
+
+def mostrar_analisis(analisis, clave):
+    """Cabecera del análisis y un fragmento por lote"""
+    datos = analisis['datos']
+    if analisis['fuente'] == "Manual":
+        st.success(f"✅ Datos manuales procesados - {len(datos['lotes'])} lote(s) encontrado(s)")
+    else:
+        source_name = "XML" if analisis['fuente'] == "XML (URL)" else "JSON"
+        st.success(f"✅ {source_name} procesado - {len(datos['lotes'])} lote(s) encontrado(s)")
+
+    # Mostrar datos extraídos
+    with st.expander("📋 Datos extraídos del documento"):
+        provincia = datos.get('provincia') or "No detectada (no se aplicará filtro geográfico)"
+        st.markdown("\n\n".join([
+            f"**Título:** {datos.get('titulo', 'No detectado')}",
+            f"**Organismo:** {datos.get('organismo', 'No detectado')}",
+            f"**Ubicación:** {datos.get('ubicacion', 'No detectado')}",
+            f"**📍 Provincia:** {provincia}",
+        ]))
+
+    for resultado in analisis['lotes']:
+        st.markdown("---")
+        mostrar_lote(resultado, clave)
+
 # Sistema de autenticación
 def check_login():
     """Verificar si el usuario está autenticado"""
@@ -1531,9 +1994,54 @@ def check_login():
 
         st.stop()
 
+# Las consultas de una ejecución anterior que siga en marcha se cancelan (cancelacion.py)
+nueva_ejecucion()
+
 # Verificar autenticación antes de mostrar la app
 check_login()
 
+# Trazas de rendimiento (desactivadas por defecto)
+medir_tiempos = st.sidebar.checkbox(
+    "⏱️ Medir tiempos por etapa",
+    value=False,
+    help="Registra descarga, parseo, SQL, palabras clave, cálculo de baja, informe y Excel del próximo análisis"
+)
+
+# Diagnóstico de consultas SQL (duración, filas, plan y log de consultas lentas)
+diagnostico_activo = st.sidebar.checkbox(
+    "🩺 Diagnóstico SQL",
+    value=False,
+    help="Mide cada consulta de búsqueda del próximo análisis y añade las lentas al log de consultas lentas "
+         "(resumen por forma de consulta: python diagnostico_sql.py)"
+)
+if diagnostico_activo:
+    umbral_lenta_ms = st.sidebar.number_input("Umbral de consulta lenta (ms):", min_value=0, value=1000, step=100)
+    incluir_explain = st.sidebar.checkbox(
+        "Incluir plan estimado (EXPLAIN)",
+        value=False,
+        help="Guarda el plan estimado de las consultas lentas sin volver a ejecutarlas "
+             "(con tiempos reales: python diagnostico_sql.py --explain)"
+    )
+
+# Presupuesto de tiempo de las búsquedas de cada lote
+presupuesto_lote_s = st.sidebar.number_input(
+    "Tiempo máximo de búsqueda por lote (s):",
+    min_value=1, value=PRESUPUESTO_LOTE_S, step=5,
+    help="Pasado este tiempo las consultas del lote se cancelan en el servidor y se usan los contratos encontrados hasta entonces"
+)
+
+# Modo de búsqueda de contratos comparables
+modo_busqueda = st.sidebar.selectbox(
+    "Búsqueda de comparables:",
+    options=['recientes', 'trigramas', 'texto_completo'],
+    format_func=lambda modo: {'recientes': "300 más recientes + palabras clave",
+                              'trigramas': "Similitud de título (pg_trgm)",
+                              'texto_completo': "Palabras clave en título y descripción"}[modo],
+    help="'Similitud de título' ordena los candidatos por trigramas del título en PostgreSQL; "
+         "'Palabras clave' los ordena por relevancia de texto completo (título y descripción). "
+         "Ambos traen solo los más relevantes, sin ventana de recencia"
+)
+
 # Interfaz principal
 st.title("📊 Análisis de Bajas Estadísticas")
 st.markdown("---")
@@ -1686,6 +2194,10 @@ palabras_clave_manual = st.text_input(
     help="Separadas por comas. Si lo dejas vacío, se extraerán automáticamente del título del contrato"
 )
 
+# Las entradas del análisis identifican su resultado guardado en la sesión
+clave_actual = clave_analisis(source_type, xml_url, json_file, st.session_state.get('datos_manuales'),
+                              palabras_clave_manual, modo_busqueda)
+
 if st.button("🚀 Analizar Contrato", type="primary"):
     if source_type == "XML (URL)" and not xml_url:
         st.warning("Por favor, introduce una URL")
@@ -1695,215 +2207,77 @@ if st.button("🚀 Analizar Contrato", type="primary"):
         st.warning("Por favor, completa y valida el formulario primero")
     else:
         datos = None
-
-        if source_type == "XML (URL)":
-            with st.spinner("Procesando XML..."):
-                datos = extraer_datos_xml_completo(xml_url)
-        elif source_type == "JSON (Archivo)":
-            with st.spinner("Procesando JSON..."):
-                try:
-                    # Leer el archivo JSON
-                    json_content = json_file.read().decode('utf-8')
-                    datos = extraer_datos_json_completo(json_content)
-                except Exception as e:
-                    st.error(f"Error leyendo archivo JSON: {e}")
-                    datos = None
-        else:  # Manual
-            datos = st.session_state.get('datos_manuales')
-
-        if not datos or not datos['lotes']:
-            if source_type == "Manual":
-                st.error(f"Error al procesar los datos manuales")
-            else:
-                source_name = "XML" if source_type == "XML (URL)" else "JSON"
-                st.error(f"No se pudieron extraer lotes del {source_name}")
-        else:
-            if source_type == "Manual":
-                st.success(f"✅ Datos manuales procesados - {len(datos['lotes'])} lote(s) encontrado(s)")
-            else:
-                source_name = "XML" if source_type == "XML (URL)" else "JSON"
-                st.success(f"✅ {source_name} procesado - {len(datos['lotes'])} lote(s) encontrado(s)")
-
-            # Mostrar datos extraídos
-            with st.expander("📋 Datos extraídos del documento"):
-                st.write(f"**Título:** {datos.get('titulo', 'No detectado')}")
-                st.write(f"**Organismo:** {datos.get('organismo', 'No detectado')}")
-                st.write(f"**Ubicación:** {datos.get('ubicacion', 'No detectado')}")
-                if datos.get('provincia'):
-                    st.write(f"**📍 Provincia:** {datos.get('provincia')}")
-                else:
-                    st.write(f"**📍 Provincia:** No detectada (no se aplicará filtro geográfico)")
-
-            # Analizar cada lote
-            for lote in datos['lotes']:
-                st.markdown("---")
-                st.markdown(f"## 📦 Lote {lote['numero']}: {lote['titulo'][:80] if lote['titulo'] else 'Sin título'}")
-
-                st.markdown(f"**Presupuesto:** €{lote['presupuesto']:,.2f}")
-                st.markdown(f"**CPV:** {', '.join(lote['cpv']) if lote['cpv'] else 'No especificado'}")
-
-                # Mostrar palabras clave (manuales o automáticas)
-                if palabras_clave_manual:
-                    palabras_mostrar = set([p.strip().lower() for p in palabras_clave_manual.split(',') if p.strip()])
-                    st.markdown(f"**🔑 Palabras clave (manuales):** {', '.join(sorted(palabras_mostrar))}")
-                elif lote['titulo']:
-                    palabras_clave = extraer_palabras_clave(lote['titulo'])
-                    if palabras_clave:
-                        st.markdown(f"**🔑 Palabras clave (automáticas):** {', '.join(sorted(palabras_clave))}")
-
-                # Criterios
-                st.markdown("### ⚖️ Criterios de Adjudicación")
-                if lote['criterios']:
-                    for i, crit in enumerate(lote['criterios'], 1):
-                        # Manejar tanto strings como diccionarios
-                        if isinstance(crit, dict):
-                            desc = crit.get('descripcion', f'Criterio {i}')
-                            peso = crit.get('peso', '')
-                            st.write(f"**{i}.** {desc}: **{peso}**" if peso else f"**{i}.** {desc}")
-                        else:
-                            # Es un string
-                            st.write(f"**{i}.** {crit}")
+        traza = iniciar_traza("analisis", fuente=source_type) if medir_tiempos else None
+        diagnostico = (iniciar_diagnostico(umbral_ms=umbral_lenta_ms, explain=incluir_explain)
+                       if diagnostico_activo else None)
+
+        try:
+            if source_type == "XML (URL)":
+                with st.spinner("Procesando XML..."):
+                    datos = extraer_datos_xml_completo(xml_url)
+            elif source_type == "JSON (Archivo)":
+                with st.spinner("Procesando JSON..."):
+                    try:
+                        # Leer el archivo JSON
+                        json_content = json_file.getvalue().decode('utf-8')
+                        datos = extraer_datos_json_completo(json_content)
+                    except Exception as e:
+                        st.error(f"Error leyendo archivo JSON: {e}")
+                        datos = None
+            else:  # Manual
+                datos = st.session_state.get('datos_manuales')
+
+            if not datos or not datos['lotes']:
+                if source_type == "Manual":
+                    st.error(f"Error al procesar los datos manuales")
                 else:
-                    st.info("ℹ️ No se encontraron criterios de adjudicación")
-
-                # Buscar contratos
-                if lote['cpv'] and lote['presupuesto'] > 0:
-                    st.markdown("### 🔍 Búsqueda de Contratos Similares")
-
-                    pres_min = lote['presupuesto'] * 0.5
-                    pres_max = lote['presupuesto'] * 1.5
+                    source_name = "XML" if source_type == "XML (URL)" else "JSON"
+                    st.error(f"No se pudieron extraer lotes del {source_name}")
+            else:
+                # Analizar cada lote y guardar el resultado: los reruns posteriores solo lo muestran
+                resultados = [analizar_lote(lote, datos, palabras_clave_manual, modo_busqueda, presupuesto_lote_s)
+                              for lote in datos['lotes']]
+                guardar_analisis(clave_actual, {'fuente': source_type, 'datos': datos, 'lotes': resultados})
+        finally:
+            # También si el análisis se interrumpe (error, cancelación o rerun de Streamlit):
+            # la traza y el diagnóstico no quedan activos en el contexto y se conserva lo medido
+            if traza:
+                finalizar_traza(traza)
+                st.session_state.ultima_traza = traza.to_dict()
+            if diagnostico:
+                finalizar_diagnostico(diagnostico)
+                st.session_state.ultimo_diagnostico = diagnostico.to_dict()
+
+# Resultado guardado para las entradas actuales (también tras descargas y cambios de widgets)
+analisis_guardado = st.session_state.get('analisis_por_clave', {}).get(clave_actual)
+if analisis_guardado:
+    mostrar_analisis(analisis_guardado, clave_actual)
+
+# Panel de rendimiento del último análisis
+if medir_tiempos and st.session_state.get('ultima_traza'):
+    with st.sidebar.expander("⏱️ Rendimiento del último análisis", expanded=True):
+        st.code("\n".join(formatear_traza(st.session_state.ultima_traza)), language=None)
+        st.download_button(
+            label="📥 Descargar traza (JSON)",
+            data=json.dumps(st.session_state.ultima_traza, ensure_ascii=False, indent=2),
+            file_name="traza_analisis.json",
+            mime="application/json"
+        )
 
-                    # Mostrar provincia que se usará para la búsqueda
-                    provincia_busqueda = datos.get('provincia')
-                    if provincia_busqueda:
-                        st.info(f"🌍 **Buscando contratos con filtro geográfico**: {provincia_busqueda}")
-                    else:
-                        st.info(f"🌍 **Buscando contratos sin filtro geográfico** (provincia no detectada en el documento)")
-
-                    # Búsqueda normal
-                    with st.spinner("Buscando contratos..."):
-                        contratos = buscar_contratos(
-                            lote['cpv'],
-                            pres_min,
-                            pres_max,
-                            titulo_referencia=lote['titulo'],
-                            limit=10,
-                            ampliada=False,
-                            provincia_origen=provincia_busqueda,
-                            palabras_clave_manual=palabras_clave_manual if palabras_clave_manual else None
-                        )
-
-                    # Si hay menos de 3 contratos, hacer búsqueda ampliada
-                    if len(contratos) < 3:
-                        st.warning(f"⚠️ Solo se encontraron {len(contratos)} contrato(s). Ampliando búsqueda...")
-                        if provincia_busqueda:
-                            st.info(f"🔄 **Ampliando CPV (2 dígitos) y presupuesto (±100%), manteniendo palabra clave + provincia**")
-                        else:
-                            st.info(f"🔄 **Ampliando CPV (2 dígitos) y presupuesto (±100%), manteniendo palabra clave**")
-                        with st.spinner("Buscando con criterios ampliados..."):
-                            contratos = buscar_contratos(
-                                lote['cpv'],
-                                pres_min,
-                                pres_max,
-                                titulo_referencia=lote['titulo'],
-                                limit=10,
-                                ampliada=True,
-                                provincia_origen=provincia_busqueda,
-                                palabras_clave_manual=palabras_clave_manual if palabras_clave_manual else None
-                            )
-
-                        if len(contratos) < 3:
-                            st.error(f"❌ Solo se encontraron {len(contratos)} contrato(s) incluso con búsqueda ampliada")
-
-                    if contratos:
-                        # Calcular estadísticas
-                        bajas = [c['baja'] for c in contratos if c['baja']]
-
-                        if bajas:
-                            baja_min = min(bajas)
-                            baja_max = max(bajas)
-
-                            # Usar nuevo algoritmo de cálculo
-                            baja_prom = calcular_baja_recomendada(bajas)
-
-                            num_lic_prom = sum([c['numero_licitadores'] or 0 for c in contratos]) / len(contratos)
-
-                            st.markdown("### 📊 Resultados")
-
-                            col1, col2, col3 = st.columns(3)
-                            with col1:
-                                st.metric("🎯 Baja Recomendada", f"{baja_prom:.2f}%")
-                            with col2:
-                                st.metric("📈 Contratos Analizados", len(contratos))
-                            with col3:
-                                st.metric("👥 Licitadores Promedio", f"{num_lic_prom:.0f}")
-
-                            st.markdown(f"**Rango de bajas:** {baja_min:.1f}% - {baja_max:.1f}%")
-
-                            # Generar diccionario de empresas con información de provincia
-                            empresas_data = {}
-                            for c in contratos:
-                                emp = c['empresa']
-                                if emp and emp != 'N/A' and len(emp) > 3:
-                                    if emp not in empresas_data:
-                                        empresas_data[emp] = {
-                                            'frecuencia': 0,
-                                            'provincia': c.get('provincia', '').strip().lower() if c.get('provincia') else ''
-                                        }
-                                    empresas_data[emp]['frecuencia'] += 1
-
-                            # Generar texto del informe
-                            texto_informe = generar_texto_informe(lote, contratos, baja_prom, baja_min, baja_max, empresas_data, num_lic_prom, datos)
-
-                            # Sección de descarga y texto
-                            st.markdown("---")
-                            st.markdown("### 📝 Informe Generado")
-
-                            col1, col2 = st.columns([1, 1])
-                            with col1:
-                                excel_data = crear_excel(lote, contratos, baja_prom)
-                                st.download_button(
-                                    label="📥 Descargar análisis en Excel",
-                                    data=excel_data,
-                                    file_name=f"analisis_lote_{lote['numero']}.xlsx",
-                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                    use_container_width=True
-                                )
-                            with col2:
-                                st.info(f"✅ {len(contratos)} contratos incluidos en el análisis")
-
-                            # Texto para copiar
-                            st.markdown("#### 📄 Texto del Informe (Copia y Pega)")
-                            st.text_area(
-                                label="Texto completo del análisis:",
-                                value=texto_informe,
-                                height=300,
-                                help="Copia este texto para usar en tu informe"
-                            )
-
-                            # Mostrar contratos
-                            with st.expander(f"📋 Ver los {len(contratos)} contratos encontrados"):
-                                for i, c in enumerate(contratos, 1):
-                                    st.markdown(f"### {i}. {c['titulo']}")
-
-                                    col1, col2 = st.columns(2)
-                                    with col1:
-                                        st.write(f"**📍 Organismo:** {c['organismo']}")
-                                        st.write(f"**🏢 Adjudicatario:** {c['empresa']}")
-                                        st.write(f"**📍 Provincia:** {c.get('provincia', 'N/A')}")
-                                        st.write(f"**🔢 CPV:** {c.get('cpv', 'N/A')}")
-                                    with col2:
-                                        st.write(f"**💰 Presupuesto:** €{c['importe_total']:,.2f}")
-                                        st.write(f"**💵 Adjudicación:** €{c['importe_adjudicacion']:,.2f}")
-                                        st.write(f"**📉 Baja:** {c['baja']:.2f}%")
-                                        fecha = str(c['fecha_publicacion'])[:10] if c['fecha_publicacion'] else 'N/A'
-                                        st.write(f"**📅 Fecha:** {fecha}")
-                                        num_lic = c.get('numero_licitadores', 'N/A')
-                                        st.write(f"**👥 Licitadores:** {num_lic if num_lic else 'N/A'}")
-
-                                    st.divider()
-                else:
-                    st.warning("⚠️ No se pudo extraer CPV o presupuesto del lote")
+# Panel de consultas SQL del último análisis
+if diagnostico_activo and st.session_state.get('ultimo_diagnostico'):
+    with st.sidebar.expander("🩺 Consultas SQL del último análisis", expanded=True):
+        registros = st.session_state.ultimo_diagnostico
+        lentas = sum(1 for r in registros if r['duracion_ms'] >= umbral_lenta_ms)
+        st.caption(f"{len(registros)} consultas, {lentas} por encima de {umbral_lenta_ms} ms")
+        st.dataframe(pd.DataFrame(agregar_por_forma(registros))[
+            ['origen', 'consultas', 'total_ms', 'max_ms', 'filas_media', 'forma']], hide_index=True)
+        st.download_button(
+            label="📥 Descargar consultas (JSON)",
+            data=json.dumps(registros, ensure_ascii=False, indent=2, default=str),
+            file_name="consultas_sql.json",
+            mime="application/json"
+        )
 
 st.markdown("---")
 st.caption("📊 Análisis basado en datos del Portal de Contratación del Estado")
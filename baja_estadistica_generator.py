@@ -1,25 +1,24 @@
-import mysql.connector
-import psycopg2
-import psycopg2.extras
 import pandas as pd
 import streamlit as st
-import plotly.express as px
-import plotly.graph_objects as go
 from datetime import datetime, timedelta
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import re
 import random
 import requests
 import xml.etree.ElementTree as ET
-from bs4 import BeautifulSoup
 import warnings
 import io
 import json
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from openpyxl.utils.dataframe import dataframe_to_rows
+from recursos import extraer_precio, calcular_similitud_tfidf, CPV_8_DIGITOS, SUFIJOS_SOCIETARIOS
+from lectura_sql import leer_sql
+from perfiles_xml import perfil_documento, iter_tag
+from empresas import get_indice_empresas
+from perfiles_empresas import get_almacen_perfiles, frase_perfiles
+from organismos import get_indice_organismos
+from precarga import refrescar_en_segundo_plano
+from busqueda_texto import BusquedaTextoCompleto
+from diagnostico_sql import consulta_sql, iniciar_diagnostico, finalizar_diagnostico, agregar_por_forma
+from cancelacion import opciones_conexion
+# psycopg2, sklearn y openpyxl se importan en los métodos que los usan
 warnings.filterwarnings('ignore')
 
 def extraer_criterio_individual(criteria_elem):
@@ -67,6 +66,65 @@ def extraer_criterio_individual(criteria_elem):
 
     return criterio_info if criterio_info else None
 
+
+# Términos de búsqueda por nombre de tag (modo producción de extract_xml_data)
+TERMINOS_TITULO = ('name', 'titulo', 'title', 'objeto', 'description')
+TERMINOS_ORGANISMO = ('contractingparty', 'organismo', 'organo', 'entity', 'contracting', 'buyername')
+TERMINOS_IMPORTE = ('importe', 'valor', 'value', 'amount', 'precio')
+TERMINOS_CPV = ('cpv', 'classificationcode', 'codigo')
+TERMINOS_UBICACION = ('location', 'place', 'lugar', 'provincia', 'city', 'countrysubentity')
+TERMINOS_PROCEDIMIENTO = ('procedimiento', 'procedure', 'tipo')
+TERMINOS_DESCRIPCION = ('descripcion', 'description', 'detalle')
+
+CRITERIOS_TAGS = (
+    'AwardingCriteria', 'AwardingTerms', 'EvaluationCriteria',
+    'Criterion', 'Criteria', 'CriterioAdjudicacion',
+    'CriteriosEvaluacion', 'Subcriteria'
+)
+CRITERIOS_PALABRAS = (
+    'criterio', 'criteria', 'evaluación', 'evaluation',
+    'puntuación', 'scoring', 'peso', 'weight', 'puntos', 'points'
+)
+CRITERIOS_INDICADORES = (
+    'económico', 'técnico', 'calidad', 'precio', 'plazo',
+    'economic', 'technical', 'quality', 'price', 'deadline',
+    '%', 'puntos', 'points'
+)
+CRITERIOS_INDICADORES_AMPLIOS = (
+    'económico', 'técnico', 'calidad', 'precio', 'plazo', 'coste',
+    'economic', 'technical', 'quality', 'price', 'cost', 'delivery',
+    'experiencia', 'experience', 'capacidad', 'capacity',
+    'oferta', 'offer', 'propuesta', 'proposal',
+    'valoración', 'evaluation', 'puntuación', 'scoring',
+    '%', 'punto', 'point', 'peso', 'weight'
+)
+
+NUMERO_XML = re.compile(r'[\d]+\.?\d*')
+DIGITOS = re.compile(r'\d+')
+
+
+def _texto_primer_hijo(elem, termino):
+    """Texto del primer hijo directo cuyo tag contiene termino (None si está vacío)"""
+    for child in elem:
+        if termino in child.tag.lower() and child.text:
+            return child.text.strip() or None
+    return None
+
+
+def _deduplicar_criterios(criterios):
+    """Criterios sin descripciones repetidas (ni de 5 caracteres o menos)"""
+    criterios_unicos = []
+    descripciones_vistas = set()
+    for criterio in criterios:
+        if isinstance(criterio, dict):
+            desc = criterio.get('descripcion', '').lower().strip()
+        else:
+            desc = str(criterio).lower().strip()
+        if desc and desc not in descripciones_vistas and len(desc) > 5:
+            criterios_unicos.append(criterio)
+            descripciones_vistas.add(desc)
+    return criterios_unicos
+
 class BajaEstadisticaGenerator:
     def __init__(self):
         self.connection = None
@@ -99,18 +157,25 @@ class BajaEstadisticaGenerator:
 
     def connect_to_database(self):
         """Conectar a la base de datos PostgreSQL oclemconcursos"""
+        self.connection = self.nueva_conexion()
+        return self.connection is not None
+
+    def nueva_conexion(self):
+        """Conexión nueva a oclemconcursos (None si falla); también para las cargas en segundo plano"""
+        import psycopg2
+
         try:
-            self.connection = psycopg2.connect(
+            return psycopg2.connect(
                 host=st.secrets["postgres"]["host"],
                 database=st.secrets["postgres"]["database"],
                 user=st.secrets["postgres"]["user"],
                 password=st.secrets["postgres"]["password"],
-                port=st.secrets["postgres"]["port"]
+                port=st.secrets["postgres"]["port"],
+                options=opciones_conexion()
             )
-            return True
         except Exception as e:
             st.error(f"Error conectando a la base de datos: {e}")
-            return False
+            return None
 
     def extract_json_data(self, json_data, numero_lote=None):
         """Extraer datos de un JSON de licitación
@@ -401,12 +466,14 @@ class BajaEstadisticaGenerator:
                     return v
         return value
 
-    def extract_xml_data(self, xml_url, numero_lote=None):
+    def extract_xml_data(self, xml_url, numero_lote=None, debug=False):
         """Extraer datos de un XML de contratación del estado
 
         Args:
             xml_url: URL del XML
             numero_lote: Número de lote específico a analizar (opcional)
+            debug: Mostrar la estructura del XML y el detalle de la búsqueda de criterios.
+                Sin debug (modo producción) los datos se extraen en un único recorrido del árbol.
         """
         try:
             # Descargar el XML
@@ -419,493 +486,667 @@ class BajaEstadisticaGenerator:
             # Parsear el XML
             root = ET.fromstring(response.content)
 
-            # Si se especifica un lote, filtrar el XML para trabajar solo con ese lote
+            # Si se especifica un lote, trabajar solo con el subárbol de ese lote
             if numero_lote:
-                lote_encontrado = False
-                # Buscar elementos de lote en el XML
-                for elem in root.iter():
-                    if 'lot' in elem.tag.lower() or 'lote' in elem.tag.lower():
-                        # Buscar el ID del lote
-                        lote_id = None
-                        for child in elem.iter():
-                            if 'id' in child.tag.lower() and child.text:
-                                lote_id = child.text.strip()
-                                break
+                lote = self._localizar_lote(root, numero_lote, origen=xml_url)
+                if lote is not None:
+                    root = lote  # Usar este elemento como raíz
+                    st.info(f"✅ Filtrando análisis para el Lote {numero_lote}")
+                else:
+                    st.warning(f"⚠️ No se encontró el lote {numero_lote}. Analizando todo el contrato.")
 
-                        # Si el ID coincide con el número de lote buscado
-                        if lote_id and (lote_id == numero_lote or lote_id == f"Lote {numero_lote}" or lote_id.endswith(numero_lote)):
-                            root = elem  # Usar este elemento como raíz
-                            lote_encontrado = True
-                            st.info(f"✅ Filtrando análisis para el Lote {numero_lote}")
-                            break
+            if debug:
+                return self._extraer_datos_xml_debug(root)
+            return self._extraer_datos_xml(root)
 
-                if not lote_encontrado:
-                    st.warning(f"⚠️ No se encontró el lote {numero_lote}. Analizando todo el contrato.")
+        except ET.ParseError as e:
+            st.error(f"⚠️ Error al leer el XML: El archivo no es un XML válido.")
+            st.error(f"Detalles técnicos: {e}")
+            st.info("💡 Verifica que la URL del XML sea correcta y que el archivo esté bien formado. Si el error persiste, es posible que el XML contenga caracteres especiales no codificados correctamente.")
+            return None
+        except Exception as e:
+            st.error(f"Error procesando XML: {e}")
+            return None
 
-            root_original = root  # Guardar referencia al root filtrado
+    def _localizar_lote(self, root, numero_lote, origen=None):
+        """Subárbol del lote pedido o None.
 
-            # Información de debug (opcional para ver la estructura)
-            debug_info = {
-                'total_elements': len(list(root.iter())),
-                'root_tag': root.tag,
-                'namespaces': set(),
-                'unique_tags': set()
-            }
+        Los lotes CODICE/UBL (ProcurementProjectLot) se indexan por su ID directo; solo
+        si el documento no tiene ninguno se recorre el árbol buscando tags con 'lot'.
+        """
+        numero_lote = str(numero_lote).strip()
+        perfil = perfil_documento(root, origen)
+        indice = {}
+        for lote in iter_tag(root, perfil, 'cac:ProcurementProjectLot'):
+            lote_id = lote.findtext(perfil.qn('cbc:ID')) if perfil else lote.findtext('{*}ID')
+            if lote_id and lote_id.strip():
+                indice.setdefault(lote_id.strip(), lote)
+
+        if indice:
+            for clave in (numero_lote, f"Lote {numero_lote}"):
+                if clave in indice:
+                    return indice[clave]
+            for lote_id, lote in indice.items():
+                if lote_id.endswith(numero_lote):
+                    return lote
+            return None
 
-            for elem in root.iter():
-                debug_info['unique_tags'].add(elem.tag.split('}')[-1])  # Sin namespace
-                if '}' in elem.tag:
-                    debug_info['namespaces'].add(elem.tag.split('}')[0] + '}')
+        # Documentos sin la estructura estándar: búsqueda por nombre de tag
+        for elem in root.iter():
+            if 'lot' in elem.tag.lower() or 'lote' in elem.tag.lower():
+                # Buscar el ID del lote
+                lote_id = None
+                for child in elem.iter():
+                    if 'id' in child.tag.lower() and child.text:
+                        lote_id = child.text.strip()
+                        break
 
-            # Extraer datos básicos
-            datos = {
-                'titulo': '',
-                'organismo': '',
-                'presupuesto': 0,
-                'cpv': '',
-                'tipo_procedimiento': '',
-                'criterios_adjudicacion': [],
-                'descripcion': '',
-                'ubicacion': '',
-                'debug_info': debug_info
-            }
+                # Si el ID coincide con el número de lote buscado
+                if lote_id and (lote_id == numero_lote or lote_id == f"Lote {numero_lote}" or lote_id.endswith(numero_lote)):
+                    return elem
+        return None
 
-            # Buscar elementos específicos de XMLs de contratación del estado
-            # Título - buscar específicamente en ProcurementProject/Name
-            # Primero buscar la estructura específica de contratación del estado
-            for elem in root.iter():
-                if 'procurementproject' in elem.tag.lower():
-                    for child in elem:
-                        if 'name' in child.tag.lower() and child.text:
-                            datos['titulo'] = child.text.strip()
-                            break
-                    if datos['titulo']:
+    def _extraer_datos_xml(self, root):
+        """Extracción en modo producción: un único recorrido del árbol rellena todos los campos.
+
+        Reproduce las mismas reglas y prioridades que el modo debug: para cada campo se
+        guarda el primer candidato de cada regla y al final se elige por prioridad.
+        """
+        titulo_proyecto = titulo_general = None
+        organismo_partido = organismo_general = None
+        presupuesto_tax = presupuesto_estimado = presupuesto_general = None
+        presupuesto_debug = presupuesto_error = None
+        cpv_codes, cpv_generales = [], []
+        ubicacion_especifica = ubicacion_general = None
+        procedimiento = descripcion = None
+        texto_mas_largo = ''
+        criterios_tags, criterios_contenido, criterios_agresivos = [], [], []
+
+        for elem in root.iter():
+            tag = elem.tag
+            if not isinstance(tag, str):
+                continue
+            tag_name = tag.split('}')[-1]
+            tag_lower = tag_name.lower()
+            texto = elem.text.strip() if elem.text else ''
+
+            # Estructuras específicas: el valor está en un hijo directo
+            if titulo_proyecto is None and 'procurementproject' in tag_lower:
+                titulo_proyecto = _texto_primer_hijo(elem, 'name')
+            if organismo_partido is None and 'partyname' in tag_lower:
+                organismo_partido = _texto_primer_hijo(elem, 'name')
+            if ubicacion_especifica is None and 'realizedlocation' in tag_lower:
+                ubicacion_especifica = _texto_primer_hijo(elem, 'countrysubentity')
+            if 'requiredcommodityclassification' in tag_lower:
+                for child in elem:
+                    if child.text:
+                        cpv_text = child.text.strip()
+                        if len(cpv_text) >= 8 and cpv_text.isdigit():
+                            if 'itemclassificationcode' in child.tag.lower():
+                                cpv_codes.append(cpv_text)
+                            if 'name' in child.attrib:
+                                cpv_codes.append(cpv_text)
+
+            # Importes
+            if presupuesto_tax is None and 'taxexclusiveamount' in tag_lower and elem.text:
+                try:
+                    presupuesto_tax = float(texto.replace(',', '').replace(' ', ''))
+                    presupuesto_debug = {
+                        'tag': tag,
+                        'valor_original': texto,
+                        'currency': elem.get('currencyID', ''),
+                        'valor_procesado': presupuesto_tax
+                    }
+                except ValueError as e:
+                    presupuesto_error = f"Error procesando {elem.text}: {str(e)}"
+            if presupuesto_estimado is None and 'estimatedoverallcontractamount' in tag_lower and elem.text:
+                try:
+                    presupuesto_estimado = float(texto.replace(',', '').replace(' ', ''))
+                except ValueError:
+                    pass
+            if presupuesto_general is None and elem.text and any(term in tag_lower for term in TERMINOS_IMPORTE):
+                numeros = NUMERO_XML.findall(texto.replace(',', '').replace(' ', ''))
+                if numeros:
+                    presupuesto_general = float(numeros[0])
+
+            # CPV por búsqueda general (texto y atributos)
+            if any(term in tag_lower for term in TERMINOS_CPV) and len(texto) >= 8:
+                cpv_nums = DIGITOS.findall(texto)
+                if cpv_nums and len(cpv_nums[0]) >= 8:
+                    cpv_generales.append(cpv_nums[0])
+            for attr_name, attr_value in elem.attrib.items():
+                if 'code' in attr_name.lower() and len(attr_value) >= 8:
+                    cpv_nums = DIGITOS.findall(attr_value)
+                    if cpv_nums and len(cpv_nums[0]) >= 8:
+                        cpv_generales.append(cpv_nums[0])
+
+            # Campos por nombre de tag
+            if titulo_general is None and len(texto) > 10 and any(term in tag_lower for term in TERMINOS_TITULO):
+                titulo_general = texto
+            if organismo_general is None and len(texto) > 3 and any(term in tag_lower for term in TERMINOS_ORGANISMO):
+                organismo_general = texto
+            if ubicacion_general is None and len(texto) > 2 and any(term in tag_lower for term in TERMINOS_UBICACION):
+                ubicacion_general = texto
+            if procedimiento is None and elem.text and any(term in tag_lower for term in TERMINOS_PROCEDIMIENTO):
+                procedimiento = texto
+            if descripcion is None and len(texto) > 20 and any(term in tag_lower for term in TERMINOS_DESCRIPCION):
+                descripcion = texto
+            if len(texto) > 30 and len(texto) > len(texto_mas_largo):
+                texto_mas_largo = texto
+
+            # Criterios de adjudicación (estrategias 1, 1.5 y final del modo debug)
+            if any(term in tag_name for term in CRITERIOS_TAGS):
+                if 'Terms' in tag_name or 'Container' in tag_name:
+                    for criteria_elem in elem:
+                        if any(term in criteria_elem.tag for term in CRITERIOS_TAGS):
+                            criterio_info = extraer_criterio_individual(criteria_elem)
+                            if criterio_info:
+                                criterios_tags.append(criterio_info)
+                else:
+                    criterio_info = extraer_criterio_individual(elem)
+                    if criterio_info:
+                        criterios_tags.append(criterio_info)
+            if len(texto) > 10:
+                text_lower = texto.lower()
+                if (any(keyword in text_lower for keyword in CRITERIOS_PALABRAS)
+                        and any(indicator in text_lower for indicator in CRITERIOS_INDICADORES)):
+                    criterios_contenido.append({'descripcion': texto})
+                if 15 < len(texto) < 500 and any(indicator in text_lower for indicator in CRITERIOS_INDICADORES_AMPLIOS):
+                    criterios_agresivos.append({
+                        'descripcion': texto,
+                        'fuente': 'extraccion_agresiva',
+                        'tag': tag
+                    })
+
+        datos = {
+            'titulo': titulo_proyecto or titulo_general or texto_mas_largo[:200],
+            'organismo': organismo_partido or organismo_general or '',
+            'presupuesto': 0,
+            'cpv': '',
+            'tipo_procedimiento': procedimiento or '',
+            'criterios_adjudicacion': [],
+            'descripcion': descripcion or '',
+            'ubicacion': ubicacion_especifica or ubicacion_general or '',
+            'debug_info': {'root_tag': root.tag, 'modo': 'produccion'}
+        }
+
+        if presupuesto_tax is not None:
+            datos['presupuesto'] = presupuesto_tax
+            datos['presupuesto_debug'] = presupuesto_debug
+        elif presupuesto_estimado is not None:
+            datos['presupuesto'] = presupuesto_estimado
+        elif presupuesto_general is not None:
+            datos['presupuesto'] = presupuesto_general
+        if presupuesto_error:
+            datos['presupuesto_error'] = presupuesto_error
+
+        cpv_codes = cpv_codes or cpv_generales
+        if cpv_codes:
+            datos['cpv'] = ', '.join(list(set(cpv_codes)))  # Eliminar duplicados
+
+        criterios = criterios_tags or criterios_contenido or criterios_agresivos or [
+            {'descripcion': 'Criterio económico - Oferta económica', 'peso': '60%'},
+            {'descripcion': 'Criterio técnico - Aspectos técnicos', 'peso': '40%'}
+        ]
+        datos['criterios_adjudicacion'] = _deduplicar_criterios(criterios)[:8]
+
+        return datos
+
+    def _extraer_datos_xml_debug(self, root):
+        """Extracción con información de depuración (varios recorridos del árbol)"""
+        # Información de debug (opcional para ver la estructura)
+        debug_info = {
+            'total_elements': len(list(root.iter())),
+            'root_tag': root.tag,
+            'namespaces': set(),
+            'unique_tags': set()
+        }
+
+        for elem in root.iter():
+            debug_info['unique_tags'].add(elem.tag.split('}')[-1])  # Sin namespace
+            if '}' in elem.tag:
+                debug_info['namespaces'].add(elem.tag.split('}')[0] + '}')
+
+        # Extraer datos básicos
+        datos = {
+            'titulo': '',
+            'organismo': '',
+            'presupuesto': 0,
+            'cpv': '',
+            'tipo_procedimiento': '',
+            'criterios_adjudicacion': [],
+            'descripcion': '',
+            'ubicacion': '',
+            'debug_info': debug_info
+        }
+
+        # Buscar elementos específicos de XMLs de contratación del estado
+        # Título - buscar específicamente en ProcurementProject/Name
+        # Primero buscar la estructura específica de contratación del estado
+        for elem in root.iter():
+            if 'procurementproject' in elem.tag.lower():
+                for child in elem:
+                    if 'name' in child.tag.lower() and child.text:
+                        datos['titulo'] = child.text.strip()
                         break
+                if datos['titulo']:
+                    break
 
-            # Si no se encuentra, buscar de forma general
-            if not datos['titulo']:
-                for titulo in root.iter():
-                    if any(term in titulo.tag.lower() for term in ['name', 'titulo', 'title', 'objeto', 'description']):
-                        if titulo.text and len(titulo.text.strip()) > 10:
-                            datos['titulo'] = titulo.text.strip()
-                            break
+        # Si no se encuentra, buscar de forma general
+        if not datos['titulo']:
+            for titulo in root.iter():
+                if any(term in titulo.tag.lower() for term in ['name', 'titulo', 'title', 'objeto', 'description']):
+                    if titulo.text and len(titulo.text.strip()) > 10:
+                        datos['titulo'] = titulo.text.strip()
+                        break
 
-            # Organismo - buscar específicamente en PartyName/Name
-            # Primero buscar la estructura específica
-            for elem in root.iter():
-                if 'partyname' in elem.tag.lower():
-                    for child in elem:
-                        if 'name' in child.tag.lower() and child.text:
-                            datos['organismo'] = child.text.strip()
-                            break
-                    if datos['organismo']:
+        # Organismo - buscar específicamente en PartyName/Name
+        # Primero buscar la estructura específica
+        for elem in root.iter():
+            if 'partyname' in elem.tag.lower():
+                for child in elem:
+                    if 'name' in child.tag.lower() and child.text:
+                        datos['organismo'] = child.text.strip()
                         break
+                if datos['organismo']:
+                    break
 
-            # Si no se encuentra, buscar de forma general
-            if not datos['organismo']:
-                for org in root.iter():
-                    if any(term in org.tag.lower() for term in ['contractingparty', 'organismo', 'organo', 'entity', 'contracting', 'buyername']):
-                        if org.text and len(org.text.strip()) > 3:
-                            datos['organismo'] = org.text.strip()
-                            break
+        # Si no se encuentra, buscar de forma general
+        if not datos['organismo']:
+            for org in root.iter():
+                if any(term in org.tag.lower() for term in ['contractingparty', 'organismo', 'organo', 'entity', 'contracting', 'buyername']):
+                    if org.text and len(org.text.strip()) > 3:
+                        datos['organismo'] = org.text.strip()
+                        break
 
-            # Presupuesto - buscar elementos específicos de contratación del estado
-            presupuesto_encontrado = False
+        # Presupuesto - buscar elementos específicos de contratación del estado
+        presupuesto_encontrado = False
+
+        # Buscar específicamente TaxExclusiveAmount con currencyID="EUR"
+        for elem in root.iter():
+            if ('taxexclusiveamount' in elem.tag.lower() or elem.tag.endswith('TaxExclusiveAmount')):
+                # Verificar si tiene el atributo currencyID (opcional pero común)
+                currency_id = elem.get('currencyID', '')
+                if elem.text:
+                    try:
+                        # Limpiar y extraer número - puede ser 125000 directo
+                        valor_texto = elem.text.strip()
+                        # Eliminar caracteres no numéricos excepto puntos y comas
+                        valor_limpio = valor_texto.replace(',', '').replace(' ', '')
+
+                        # Convertir a float
+                        valor_numerico = float(valor_limpio)
+                        datos['presupuesto'] = valor_numerico
+                        presupuesto_encontrado = True
+
+                        # Debug info
+                        datos['presupuesto_debug'] = {
+                            'tag': elem.tag,
+                            'valor_original': valor_texto,
+                            'currency': currency_id,
+                            'valor_procesado': valor_numerico
+                        }
+                        break
+                    except Exception as e:
+                        # Debug de errores
+                        datos['presupuesto_error'] = f"Error procesando {elem.text}: {str(e)}"
+                        continue
 
-            # Buscar específicamente TaxExclusiveAmount con currencyID="EUR"
+        # Si no encuentra TaxExclusiveAmount, buscar EstimatedOverallContractAmount
+        if not presupuesto_encontrado:
             for elem in root.iter():
-                if ('taxexclusiveamount' in elem.tag.lower() or elem.tag.endswith('TaxExclusiveAmount')):
-                    # Verificar si tiene el atributo currencyID (opcional pero común)
-                    currency_id = elem.get('currencyID', '')
+                if 'estimatedoverallcontractamount' in elem.tag.lower() or elem.tag.endswith('EstimatedOverallContractAmount'):
                     if elem.text:
                         try:
-                            # Limpiar y extraer número - puede ser 125000 directo
-                            valor_texto = elem.text.strip()
-                            # Eliminar caracteres no numéricos excepto puntos y comas
-                            valor_limpio = valor_texto.replace(',', '').replace(' ', '')
-
-                            # Convertir a float
-                            valor_numerico = float(valor_limpio)
-                            datos['presupuesto'] = valor_numerico
+                            valor_limpio = elem.text.strip().replace(',', '').replace(' ', '')
+                            datos['presupuesto'] = float(valor_limpio)
                             presupuesto_encontrado = True
-
-                            # Debug info
-                            datos['presupuesto_debug'] = {
-                                'tag': elem.tag,
-                                'valor_original': valor_texto,
-                                'currency': currency_id,
-                                'valor_procesado': valor_numerico
-                            }
                             break
-                        except Exception as e:
-                            # Debug de errores
-                            datos['presupuesto_error'] = f"Error procesando {elem.text}: {str(e)}"
+                        except:
                             continue
 
-            # Si no encuentra TaxExclusiveAmount, buscar EstimatedOverallContractAmount
-            if not presupuesto_encontrado:
-                for elem in root.iter():
-                    if 'estimatedoverallcontractamount' in elem.tag.lower() or elem.tag.endswith('EstimatedOverallContractAmount'):
-                        if elem.text:
-                            try:
-                                valor_limpio = elem.text.strip().replace(',', '').replace(' ', '')
-                                datos['presupuesto'] = float(valor_limpio)
-                                presupuesto_encontrado = True
+        # Búsqueda general si no se encuentra en elementos específicos
+        if not presupuesto_encontrado:
+            for precio in root.iter():
+                if any(term in precio.tag.lower() for term in ['importe', 'valor', 'value', 'amount', 'precio']):
+                    if precio.text:
+                        try:
+                            texto_limpio = precio.text.strip().replace(',', '').replace(' ', '')
+                            numeros = re.findall(r'[\d]+\.?\d*', texto_limpio)
+                            if numeros:
+                                datos['presupuesto'] = float(numeros[0])
                                 break
-                            except:
-                                continue
-
-            # Búsqueda general si no se encuentra en elementos específicos
-            if not presupuesto_encontrado:
-                for precio in root.iter():
-                    if any(term in precio.tag.lower() for term in ['importe', 'valor', 'value', 'amount', 'precio']):
-                        if precio.text:
-                            try:
-                                texto_limpio = precio.text.strip().replace(',', '').replace(' ', '')
-                                numeros = re.findall(r'[\d]+\.?\d*', texto_limpio)
-                                if numeros:
-                                    datos['presupuesto'] = float(numeros[0])
-                                    break
-                            except:
-                                continue
-
-            # CPV - códigos de clasificación (puede haber varios)
-            cpv_codes = []
-
-            # Buscar específicamente en RequiredCommodityClassification/ItemClassificationCode
-            for elem in root.iter():
-                if 'requiredcommodityclassification' in elem.tag.lower():
-                    for child in elem:
-                        if 'itemclassificationcode' in child.tag.lower() and child.text:
-                            cpv_text = child.text.strip()
-                            if len(cpv_text) >= 8 and cpv_text.isdigit():
-                                cpv_codes.append(cpv_text)
-                        # También buscar atributos con name para descripción
-                        if 'name' in child.attrib and child.text:
-                            cpv_text = child.text.strip()
-                            if len(cpv_text) >= 8 and cpv_text.isdigit():
-                                cpv_codes.append(cpv_text)
+                        except:
+                            continue
 
-            # Si no se encuentra en la estructura específica, buscar de forma general
-            if not cpv_codes:
-                for cpv in root.iter():
-                    if any(term in cpv.tag.lower() for term in ['cpv', 'classificationcode', 'codigo']):
-                        if cpv.text and len(cpv.text.strip()) >= 8:
-                            cpv_nums = re.findall(r'\d+', cpv.text.strip())
-                            if cpv_nums and len(cpv_nums[0]) >= 8:
-                                cpv_codes.append(cpv_nums[0])
-                    # También buscar en atributos
-                    for attr_name, attr_value in cpv.attrib.items():
-                        if 'code' in attr_name.lower() and len(attr_value) >= 8:
-                            cpv_nums = re.findall(r'\d+', attr_value)
-                            if cpv_nums and len(cpv_nums[0]) >= 8:
-                                cpv_codes.append(cpv_nums[0])
-
-            # Guardar todos los CPVs encontrados, separados por comas
-            if cpv_codes:
-                datos['cpv'] = ', '.join(list(set(cpv_codes)))  # Eliminar duplicados
-
-            # Ubicación - buscar específicamente en RealizedLocation/CountrySubentity
-            for elem in root.iter():
-                if 'realizedlocation' in elem.tag.lower():
-                    for child in elem:
-                        if 'countrysubentity' in child.tag.lower() and child.text:
-                            datos['ubicacion'] = child.text.strip()
-                            break
-                    if datos['ubicacion']:
+        # CPV - códigos de clasificación (puede haber varios)
+        cpv_codes = []
+
+        # Buscar específicamente en RequiredCommodityClassification/ItemClassificationCode
+        for elem in root.iter():
+            if 'requiredcommodityclassification' in elem.tag.lower():
+                for child in elem:
+                    if 'itemclassificationcode' in child.tag.lower() and child.text:
+                        cpv_text = child.text.strip()
+                        if len(cpv_text) >= 8 and cpv_text.isdigit():
+                            cpv_codes.append(cpv_text)
+                    # También buscar atributos con name para descripción
+                    if 'name' in child.attrib and child.text:
+                        cpv_text = child.text.strip()
+                        if len(cpv_text) >= 8 and cpv_text.isdigit():
+                            cpv_codes.append(cpv_text)
+
+        # Si no se encuentra en la estructura específica, buscar de forma general
+        if not cpv_codes:
+            for cpv in root.iter():
+                if any(term in cpv.tag.lower() for term in ['cpv', 'classificationcode', 'codigo']):
+                    if cpv.text and len(cpv.text.strip()) >= 8:
+                        cpv_nums = re.findall(r'\d+', cpv.text.strip())
+                        if cpv_nums and len(cpv_nums[0]) >= 8:
+                            cpv_codes.append(cpv_nums[0])
+                # También buscar en atributos
+                for attr_name, attr_value in cpv.attrib.items():
+                    if 'code' in attr_name.lower() and len(attr_value) >= 8:
+                        cpv_nums = re.findall(r'\d+', attr_value)
+                        if cpv_nums and len(cpv_nums[0]) >= 8:
+                            cpv_codes.append(cpv_nums[0])
+
+        # Guardar todos los CPVs encontrados, separados por comas
+        if cpv_codes:
+            datos['cpv'] = ', '.join(list(set(cpv_codes)))  # Eliminar duplicados
+
+        # Ubicación - buscar específicamente en RealizedLocation/CountrySubentity
+        for elem in root.iter():
+            if 'realizedlocation' in elem.tag.lower():
+                for child in elem:
+                    if 'countrysubentity' in child.tag.lower() and child.text:
+                        datos['ubicacion'] = child.text.strip()
                         break
+                if datos['ubicacion']:
+                    break
 
-            # Si no se encuentra, buscar de forma general
-            if not datos['ubicacion']:
-                for ubicacion in root.iter():
-                    if any(term in ubicacion.tag.lower() for term in ['location', 'place', 'lugar', 'provincia', 'city', 'countrysubentity']):
-                        if ubicacion.text and len(ubicacion.text.strip()) > 2:
-                            datos['ubicacion'] = ubicacion.text.strip()
-                            break
-
-            # Procedimiento
-            for proc in root.iter():
-                if any(term in proc.tag.lower() for term in ['procedimiento', 'procedure', 'tipo']):
-                    if proc.text:
-                        datos['tipo_procedimiento'] = proc.text.strip()
+        # Si no se encuentra, buscar de forma general
+        if not datos['ubicacion']:
+            for ubicacion in root.iter():
+                if any(term in ubicacion.tag.lower() for term in ['location', 'place', 'lugar', 'provincia', 'city', 'countrysubentity']):
+                    if ubicacion.text and len(ubicacion.text.strip()) > 2:
+                        datos['ubicacion'] = ubicacion.text.strip()
                         break
 
-            # Criterios de adjudicación - búsqueda mejorada y más robusta
-            criterios = []
-            criterios_encontrados = False
-
-            with st.expander("🔍 Ver debug completo de búsqueda de criterios", expanded=False):
-                st.write("🔍 **Debug - Buscando criterios de adjudicación...**")
-
-                # DEBUG COMPLETO: Mostrar TODA la estructura del XML
-                st.write("🔍 **DEBUG COMPLETO: Analizando estructura del XML**")
+        # Procedimiento
+        for proc in root.iter():
+            if any(term in proc.tag.lower() for term in ['procedimiento', 'procedure', 'tipo']):
+                if proc.text:
+                    datos['tipo_procedimiento'] = proc.text.strip()
+                    break
 
-                # Mostrar todos los tags únicos en el XML
-                all_tags = set()
-                all_text_elements = []
+        # Criterios de adjudicación - búsqueda mejorada y más robusta
+        criterios = []
+        criterios_encontrados = False
 
-                for elem in root.iter():
-                    tag_name = elem.tag.split('}')[-1] if '}' in elem.tag else elem.tag
-                    all_tags.add(tag_name)
+        with st.expander("🔍 Ver debug completo de búsqueda de criterios", expanded=False):
+            st.write("🔍 **Debug - Buscando criterios de adjudicación...**")
 
-                    # Recopilar elementos con texto relevante
-                    if elem.text and len(elem.text.strip()) > 10:
-                        text = elem.text.strip()
-                        if any(keyword in text.lower() for keyword in [
-                            'criterio', 'criteria', 'económico', 'técnico', 'calidad', 'precio',
-                            'economic', 'technical', 'quality', 'price', 'evaluation', 'peso',
-                            'weight', 'puntos', 'points', '%'
-                        ]):
-                            all_text_elements.append({
-                                'tag': tag_name,
-                                'full_tag': elem.tag,
-                                'text': text[:100] + ('...' if len(text) > 100 else ''),
-                                'text_length': len(text)
-                            })
-
-                st.write(f"📋 **Tags únicos encontrados en el XML ({len(all_tags)}):**")
-                sorted_tags = sorted(all_tags)
-                # Mostrar tags en columnas para mejor visualización
-                col1, col2, col3 = st.columns(3)
-                for i, tag in enumerate(sorted_tags):
-                    if i % 3 == 0:
-                        col1.write(f"• {tag}")
-                    elif i % 3 == 1:
-                        col2.write(f"• {tag}")
-                    else:
-                        col3.write(f"• {tag}")
+            # DEBUG COMPLETO: Mostrar TODA la estructura del XML
+            st.write("🔍 **DEBUG COMPLETO: Analizando estructura del XML**")
 
-                st.write(f"📝 **Elementos con texto potencialmente relevante ({len(all_text_elements)}):**")
-                for elem_info in all_text_elements[:10]:  # Mostrar solo los primeros 10
-                    st.write(f"• **{elem_info['tag']}**: {elem_info['text']}")
+            # Mostrar todos los tags únicos en el XML
+            all_tags = set()
+            all_text_elements = []
 
-                if len(all_text_elements) > 10:
-                    st.write(f"... y {len(all_text_elements) - 10} elementos más")
+            for elem in root.iter():
+                tag_name = elem.tag.split('}')[-1] if '}' in elem.tag else elem.tag
+                all_tags.add(tag_name)
+
+                # Recopilar elementos con texto relevante
+                if elem.text and len(elem.text.strip()) > 10:
+                    text = elem.text.strip()
+                    if any(keyword in text.lower() for keyword in [
+                        'criterio', 'criteria', 'económico', 'técnico', 'calidad', 'precio',
+                        'economic', 'technical', 'quality', 'price', 'evaluation', 'peso',
+                        'weight', 'puntos', 'points', '%'
+                    ]):
+                        all_text_elements.append({
+                            'tag': tag_name,
+                            'full_tag': elem.tag,
+                            'text': text[:100] + ('...' if len(text) > 100 else ''),
+                            'text_length': len(text)
+                        })
+
+            st.write(f"📋 **Tags únicos encontrados en el XML ({len(all_tags)}):**")
+            sorted_tags = sorted(all_tags)
+            # Mostrar tags en columnas para mejor visualización
+            col1, col2, col3 = st.columns(3)
+            for i, tag in enumerate(sorted_tags):
+                if i % 3 == 0:
+                    col1.write(f"• {tag}")
+                elif i % 3 == 1:
+                    col2.write(f"• {tag}")
+                else:
+                    col3.write(f"• {tag}")
 
-                # Buscar específicamente palabras clave relacionadas con criterios
-                criterios_keywords = [
-                    'award', 'criteria', 'criterion', 'evaluation', 'scoring',
-                    'criterio', 'evaluacion', 'puntuacion', 'adjudicacion'
-                ]
+            st.write(f"📝 **Elementos con texto potencialmente relevante ({len(all_text_elements)}):**")
+            for elem_info in all_text_elements[:10]:  # Mostrar solo los primeros 10
+                st.write(f"• **{elem_info['tag']}**: {elem_info['text']}")
 
-                tags_with_keywords = []
-                for tag in sorted_tags:
-                    if any(keyword in tag.lower() for keyword in criterios_keywords):
-                        tags_with_keywords.append(tag)
+            if len(all_text_elements) > 10:
+                st.write(f"... y {len(all_text_elements) - 10} elementos más")
 
-                if tags_with_keywords:
-                    st.write(f"🎯 **Tags que contienen palabras clave de criterios:**")
-                    for tag in tags_with_keywords:
-                        st.write(f"• {tag}")
-                else:
-                    st.warning("⚠️ No se encontraron tags con palabras clave obvias de criterios")
+            # Buscar específicamente palabras clave relacionadas con criterios
+            criterios_keywords = [
+                'award', 'criteria', 'criterion', 'evaluation', 'scoring',
+                'criterio', 'evaluacion', 'puntuacion', 'adjudicacion'
+            ]
 
-                # Estrategia 1: Búsqueda flexible de criterios de adjudicación
-                st.write("🎯 **Estrategia 1: Búsqueda flexible de criterios**")
+            tags_with_keywords = []
+            for tag in sorted_tags:
+                if any(keyword in tag.lower() for keyword in criterios_keywords):
+                    tags_with_keywords.append(tag)
 
-                # Términos que pueden indicar criterios de adjudicación
-                criterios_tags = [
-                    'AwardingCriteria', 'AwardingTerms', 'EvaluationCriteria',
-                    'Criterion', 'Criteria', 'CriterioAdjudicacion',
-                    'CriteriosEvaluacion', 'Subcriteria'
-                ]
+            if tags_with_keywords:
+                st.write(f"🎯 **Tags que contienen palabras clave de criterios:**")
+                for tag in tags_with_keywords:
+                    st.write(f"• {tag}")
+            else:
+                st.warning("⚠️ No se encontraron tags con palabras clave obvias de criterios")
 
-                # Buscar elementos con nombres relacionados con criterios
-                for elem in root.iter():
-                    tag_name = elem.tag.split('}')[-1] if '}' in elem.tag else elem.tag
-
-                    # Verificar si el tag contiene alguno de los términos de criterios
-                    if any(term in tag_name for term in criterios_tags):
-                        st.write(f"📍 Encontrado elemento relevante: {elem.tag}")
-
-                        # Si es un contenedor de criterios (Terms), buscar sus hijos
-                        if 'Terms' in tag_name or 'Container' in tag_name:
-                            for criteria_elem in elem:
-                                if any(term in criteria_elem.tag for term in criterios_tags):
-                                    criterio_info = extraer_criterio_individual(criteria_elem)
-                                    if criterio_info:
-                                        criterios.append(criterio_info)
-                                        criterios_encontrados = True
-                                        st.write(f"  ✅ Criterio extraído desde contenedor: {criterio_info}")
+            # Estrategia 1: Búsqueda flexible de criterios de adjudicación
+            st.write("🎯 **Estrategia 1: Búsqueda flexible de criterios**")
 
-                        # Si es directamente un criterio
-                        else:
-                            criterio_info = extraer_criterio_individual(elem)
-                            if criterio_info:
-                                criterios.append(criterio_info)
-                                criterios_encontrados = True
-                                st.write(f"  ✅ Criterio extraído directo: {criterio_info}")
+            # Términos que pueden indicar criterios de adjudicación
+            criterios_tags = [
+                'AwardingCriteria', 'AwardingTerms', 'EvaluationCriteria',
+                'Criterion', 'Criteria', 'CriterioAdjudicacion',
+                'CriteriosEvaluacion', 'Subcriteria'
+            ]
 
-                # Estrategia 1.5: Buscar cualquier elemento que contenga información de criterios
-                if not criterios_encontrados:
-                    st.write("🔍 **Estrategia 1.5: Búsqueda por contenido de criterios**")
-                    for elem in root.iter():
-                        # Buscar elementos que contengan palabras clave en su texto
-                        if elem.text and len(elem.text.strip()) > 10:
-                            text_lower = elem.text.lower()
-                            if any(keyword in text_lower for keyword in [
-                                'criterio', 'criteria', 'evaluación', 'evaluation',
-                                'puntuación', 'scoring', 'peso', 'weight', 'puntos', 'points'
-                            ]):
-                                # Verificar que parece realmente un criterio
-                                if any(indicator in text_lower for indicator in [
-                                    'económico', 'técnico', 'calidad', 'precio', 'plazo',
-                                    'economic', 'technical', 'quality', 'price', 'deadline',
-                                    '%', 'puntos', 'points'
-                                ]):
-                                    criterio_info = {'descripcion': elem.text.strip()}
+            # Buscar elementos con nombres relacionados con criterios
+            for elem in root.iter():
+                tag_name = elem.tag.split('}')[-1] if '}' in elem.tag else elem.tag
+
+                # Verificar si el tag contiene alguno de los términos de criterios
+                if any(term in tag_name for term in criterios_tags):
+                    st.write(f"📍 Encontrado elemento relevante: {elem.tag}")
+
+                    # Si es un contenedor de criterios (Terms), buscar sus hijos
+                    if 'Terms' in tag_name or 'Container' in tag_name:
+                        for criteria_elem in elem:
+                            if any(term in criteria_elem.tag for term in criterios_tags):
+                                criterio_info = extraer_criterio_individual(criteria_elem)
+                                if criterio_info:
                                     criterios.append(criterio_info)
                                     criterios_encontrados = True
-                                    st.write(f"  📝 Criterio encontrado por contenido: {elem.text.strip()[:60]}...")
-
-                # Estrategia FINAL: Extraer CUALQUIER texto que parezca criterio (muy agresiva)
-                if not criterios_encontrados:
-                    st.write("🚨 **Estrategia FINAL: Extracción agresiva de cualquier criterio potencial**")
+                                    st.write(f"  ✅ Criterio extraído desde contenedor: {criterio_info}")
 
-                    # Buscar en TODOS los elementos de texto
-                    for elem in root.iter():
-                        if elem.text and len(elem.text.strip()) > 15:
-                            text = elem.text.strip()
-                            text_lower = text.lower()
+                    # Si es directamente un criterio
+                    else:
+                        criterio_info = extraer_criterio_individual(elem)
+                        if criterio_info:
+                            criterios.append(criterio_info)
+                            criterios_encontrados = True
+                            st.write(f"  ✅ Criterio extraído directo: {criterio_info}")
 
-                            # Criterios muy flexibles para detectar cualquier cosa que pueda ser un criterio
+            # Estrategia 1.5: Buscar cualquier elemento que contenga información de criterios
+            if not criterios_encontrados:
+                st.write("🔍 **Estrategia 1.5: Búsqueda por contenido de criterios**")
+                for elem in root.iter():
+                    # Buscar elementos que contengan palabras clave en su texto
+                    if elem.text and len(elem.text.strip()) > 10:
+                        text_lower = elem.text.lower()
+                        if any(keyword in text_lower for keyword in [
+                            'criterio', 'criteria', 'evaluación', 'evaluation',
+                            'puntuación', 'scoring', 'peso', 'weight', 'puntos', 'points'
+                        ]):
+                            # Verificar que parece realmente un criterio
                             if any(indicator in text_lower for indicator in [
-                                'económico', 'técnico', 'calidad', 'precio', 'plazo', 'coste',
-                                'economic', 'technical', 'quality', 'price', 'cost', 'delivery',
-                                'experiencia', 'experience', 'capacidad', 'capacity',
-                                'oferta', 'offer', 'propuesta', 'proposal',
-                                'valoración', 'evaluation', 'puntuación', 'scoring',
-                                '%', 'punto', 'point', 'peso', 'weight'
+                                'económico', 'técnico', 'calidad', 'precio', 'plazo',
+                                'economic', 'technical', 'quality', 'price', 'deadline',
+                                '%', 'puntos', 'points'
                             ]):
-                                # Verificar que no sea demasiado largo (probablemente no es un criterio)
-                                if len(text) < 500:
-                                    criterio_info = {
-                                        'descripcion': text,
-                                        'fuente': 'extraccion_agresiva',
-                                        'tag': elem.tag
-                                    }
-                                    criterios.append(criterio_info)
-                                    criterios_encontrados = True
-                                    st.write(f"  🎯 Criterio potencial extraído: {text[:80]}...")
-
-                    # Si aún no encuentra nada, usar criterios por defecto
-                    if not criterios_encontrados:
-                        st.warning("⚠️ No se pudieron extraer criterios específicos del XML")
-                        st.info("📋 Usando criterios estándar de contratación pública:")
-                        criterios = [
-                            {'descripcion': 'Criterio económico - Oferta económica', 'peso': '60%'},
-                            {'descripcion': 'Criterio técnico - Aspectos técnicos', 'peso': '40%'}
-                        ]
-                        criterios_encontrados = True
-
-                # Estrategia 2: Búsqueda más amplia por texto que contenga palabras clave
-                if not criterios_encontrados:
-                    st.write("🔍 **Búsqueda amplia de criterios...**")
-
-                    terminos_busqueda = [
-                        'criterio', 'criteria', 'award', 'evaluation', 'subcriteria',
-                        'weighting', 'peso', 'valoracion', 'puntuacion', 'scoring',
-                        'economic', 'technical', 'price', 'quality', 'técnico', 'económico'
-                    ]
-
-                    for elem in root.iter():
-                        # Buscar por nombre de tag
-                        if any(term in elem.tag.lower() for term in terminos_busqueda):
-                            if elem.text and len(elem.text.strip()) > 5:
-                                criterio_desc = elem.text.strip()
-                                criterios.append({'descripcion': criterio_desc})
-                                criterios_encontrados = True
-                                st.write(f"  📝 Criterio encontrado por tag: {criterio_desc[:50]}...")
-
-                        # Buscar por contenido de texto
-                        elif elem.text and any(term in elem.text.lower() for term in ['criterio', 'criteria', 'puntos', 'points', '%']):
-                            texto = elem.text.strip()
-                            if len(texto) > 10 and len(texto) < 200:  # Filtrar textos muy cortos o muy largos
-                                criterios.append({'descripcion': texto})
+                                criterio_info = {'descripcion': elem.text.strip()}
+                                criterios.append(criterio_info)
                                 criterios_encontrados = True
-                                st.write(f"  📝 Criterio encontrado por texto: {texto[:50]}...")
+                                st.write(f"  📝 Criterio encontrado por contenido: {elem.text.strip()[:60]}...")
 
-                # Estrategia 3: Búsqueda por atributos que contengan información de criterios
-                if not criterios_encontrados:
-                    st.write("🔍 **Búsqueda por atributos...**")
+            # Estrategia FINAL: Extraer CUALQUIER texto que parezca criterio (muy agresiva)
+            if not criterios_encontrados:
+                st.write("🚨 **Estrategia FINAL: Extracción agresiva de cualquier criterio potencial**")
 
-                    for elem in root.iter():
-                        for attr_name, attr_value in elem.attrib.items():
-                            if (any(term in attr_name.lower() for term in ['name', 'description', 'title']) and
-                                any(term in str(attr_value).lower() for term in ['criterio', 'criteria', 'economic', 'technical', 'price'])):
-                                criterios.append({'descripcion': str(attr_value)})
+                # Buscar en TODOS los elementos de texto
+                for elem in root.iter():
+                    if elem.text and len(elem.text.strip()) > 15:
+                        text = elem.text.strip()
+                        text_lower = text.lower()
+
+                        # Criterios muy flexibles para detectar cualquier cosa que pueda ser un criterio
+                        if any(indicator in text_lower for indicator in [
+                            'económico', 'técnico', 'calidad', 'precio', 'plazo', 'coste',
+                            'economic', 'technical', 'quality', 'price', 'cost', 'delivery',
+                            'experiencia', 'experience', 'capacidad', 'capacity',
+                            'oferta', 'offer', 'propuesta', 'proposal',
+                            'valoración', 'evaluation', 'puntuación', 'scoring',
+                            '%', 'punto', 'point', 'peso', 'weight'
+                        ]):
+                            # Verificar que no sea demasiado largo (probablemente no es un criterio)
+                            if len(text) < 500:
+                                criterio_info = {
+                                    'descripcion': text,
+                                    'fuente': 'extraccion_agresiva',
+                                    'tag': elem.tag
+                                }
+                                criterios.append(criterio_info)
                                 criterios_encontrados = True
-                                st.write(f"  📝 Criterio encontrado por atributo: {attr_value[:50]}...")
+                                st.write(f"  🎯 Criterio potencial extraído: {text[:80]}...")
 
-                # Si aún no encontramos criterios, crear criterios por defecto basados en patrones comunes
+                # Si aún no encuentra nada, usar criterios por defecto
                 if not criterios_encontrados:
-                    st.write("⚠️ **No se encontraron criterios específicos. Generando criterios por defecto...**")
+                    st.warning("⚠️ No se pudieron extraer criterios específicos del XML")
+                    st.info("📋 Usando criterios estándar de contratación pública:")
                     criterios = [
-                        {'descripcion': 'Oferta económica', 'peso': '80 puntos'},
-                        {'descripcion': 'Criterios técnicos', 'peso': '20 puntos'}
+                        {'descripcion': 'Criterio económico - Oferta económica', 'peso': '60%'},
+                        {'descripcion': 'Criterio técnico - Aspectos técnicos', 'peso': '40%'}
                     ]
                     criterios_encontrados = True
 
-                # Si aún no encontramos nada, hacer una búsqueda muy amplia
-                if not criterios:
-                    for elem in root.iter():
-                        # Buscar elementos que tengan texto descriptivo largo (probables criterios)
-                        if (elem.text and
-                            len(elem.text.strip()) > 30 and
-                            len(elem.text.strip()) < 300 and
-                            any(palabra in elem.text.lower() for palabra in
-                                ['económ', 'técnic', 'calidad', 'plazo', 'precio', 'punt', 'valor'])):
-
-                            criterios.append({'descripcion': elem.text.strip()})
-
-                # Deduplicar criterios por descripción
-                criterios_unicos = []
-                descripciones_vistas = set()
-
-                for criterio in criterios:
-                    if isinstance(criterio, dict):
-                        desc = criterio.get('descripcion', '').lower().strip()
-                    else:
-                        desc = str(criterio).lower().strip()
-
-                    # Solo agregar si no hemos visto esta descripción antes
-                    if desc and desc not in descripciones_vistas and len(desc) > 5:
-                        criterios_unicos.append(criterio)
-                        descripciones_vistas.add(desc)
+            # Estrategia 2: Búsqueda más amplia por texto que contenga palabras clave
+            if not criterios_encontrados:
+                st.write("🔍 **Búsqueda amplia de criterios...**")
 
-                # Limitar a máximo 8 criterios principales
-                if len(criterios_unicos) > 8:
-                    criterios_unicos = criterios_unicos[:8]
-                    st.info(f"🔧 Limitado a 8 criterios principales de {len(criterios)} encontrados")
+                terminos_busqueda = [
+                    'criterio', 'criteria', 'award', 'evaluation', 'subcriteria',
+                    'weighting', 'peso', 'valoracion', 'puntuacion', 'scoring',
+                    'economic', 'technical', 'price', 'quality', 'técnico', 'económico'
+                ]
 
-            datos['criterios_adjudicacion'] = criterios_unicos
+                for elem in root.iter():
+                    # Buscar por nombre de tag
+                    if any(term in elem.tag.lower() for term in terminos_busqueda):
+                        if elem.text and len(elem.text.strip()) > 5:
+                            criterio_desc = elem.text.strip()
+                            criterios.append({'descripcion': criterio_desc})
+                            criterios_encontrados = True
+                            st.write(f"  📝 Criterio encontrado por tag: {criterio_desc[:50]}...")
+
+                    # Buscar por contenido de texto
+                    elif elem.text and any(term in elem.text.lower() for term in ['criterio', 'criteria', 'puntos', 'points', '%']):
+                        texto = elem.text.strip()
+                        if len(texto) > 10 and len(texto) < 200:  # Filtrar textos muy cortos o muy largos
+                            criterios.append({'descripcion': texto})
+                            criterios_encontrados = True
+                            st.write(f"  📝 Criterio encontrado por texto: {texto[:50]}...")
+
+            # Estrategia 3: Búsqueda por atributos que contengan información de criterios
+            if not criterios_encontrados:
+                st.write("🔍 **Búsqueda por atributos...**")
 
-            # Descripción
-            for desc in root.iter():
-                if any(term in desc.tag.lower() for term in ['descripcion', 'description', 'detalle']):
-                    if desc.text and len(desc.text.strip()) > 20:
-                        datos['descripcion'] = desc.text.strip()
-                        break
+                for elem in root.iter():
+                    for attr_name, attr_value in elem.attrib.items():
+                        if (any(term in attr_name.lower() for term in ['name', 'description', 'title']) and
+                            any(term in str(attr_value).lower() for term in ['criterio', 'criteria', 'economic', 'technical', 'price'])):
+                            criterios.append({'descripcion': str(attr_value)})
+                            criterios_encontrados = True
+                            st.write(f"  📝 Criterio encontrado por atributo: {attr_value[:50]}...")
+
+            # Si aún no encontramos criterios, crear criterios por defecto basados en patrones comunes
+            if not criterios_encontrados:
+                st.write("⚠️ **No se encontraron criterios específicos. Generando criterios por defecto...**")
+                criterios = [
+                    {'descripcion': 'Oferta económica', 'peso': '80 puntos'},
+                    {'descripcion': 'Criterios técnicos', 'peso': '20 puntos'}
+                ]
+                criterios_encontrados = True
 
-            # Si no encontramos título, usar el texto más largo como descripción
-            if not datos['titulo']:
-                textos = []
+            # Si aún no encontramos nada, hacer una búsqueda muy amplia
+            if not criterios:
                 for elem in root.iter():
-                    if elem.text and len(elem.text.strip()) > 30:
-                        textos.append(elem.text.strip())
-                if textos:
-                    datos['titulo'] = max(textos, key=len)[:200]
+                    # Buscar elementos que tengan texto descriptivo largo (probables criterios)
+                    if (elem.text and
+                        len(elem.text.strip()) > 30 and
+                        len(elem.text.strip()) < 300 and
+                        any(palabra in elem.text.lower() for palabra in
+                            ['económ', 'técnic', 'calidad', 'plazo', 'precio', 'punt', 'valor'])):
 
-            return datos
+                        criterios.append({'descripcion': elem.text.strip()})
 
-        except ET.ParseError as e:
-            st.error(f"⚠️ Error al leer el XML: El archivo no es un XML válido.")
-            st.error(f"Detalles técnicos: {e}")
-            st.info("💡 Verifica que la URL del XML sea correcta y que el archivo esté bien formado. Si el error persiste, es posible que el XML contenga caracteres especiales no codificados correctamente.")
-            return None
-        except Exception as e:
-            st.error(f"Error procesando XML: {e}")
-            return None
+            # Deduplicar criterios por descripción
+            criterios_unicos = []
+            descripciones_vistas = set()
+
+            for criterio in criterios:
+                if isinstance(criterio, dict):
+                    desc = criterio.get('descripcion', '').lower().strip()
+                else:
+                    desc = str(criterio).lower().strip()
+
+                # Solo agregar si no hemos visto esta descripción antes
+                if desc and desc not in descripciones_vistas and len(desc) > 5:
+                    criterios_unicos.append(criterio)
+                    descripciones_vistas.add(desc)
+
+            # Limitar a máximo 8 criterios principales
+            if len(criterios_unicos) > 8:
+                criterios_unicos = criterios_unicos[:8]
+                st.info(f"🔧 Limitado a 8 criterios principales de {len(criterios)} encontrados")
+
+        datos['criterios_adjudicacion'] = criterios_unicos
+
+        # Descripción
+        for desc in root.iter():
+            if any(term in desc.tag.lower() for term in ['descripcion', 'description', 'detalle']):
+                if desc.text and len(desc.text.strip()) > 20:
+                    datos['descripcion'] = desc.text.strip()
+                    break
+
+        # Si no encontramos título, usar el texto más largo como descripción
+        if not datos['titulo']:
+            textos = []
+            for elem in root.iter():
+                if elem.text and len(elem.text.strip()) > 30:
+                    textos.append(elem.text.strip())
+            if textos:
+                datos['titulo'] = max(textos, key=len)[:200]
+
+        return datos
 
 
     def get_contratos_data(self, limit=500):
@@ -936,10 +1177,18 @@ class BajaEstadisticaGenerator:
         ORDER BY fecha_publicacion DESC
         LIMIT {limit}
         """
-        return pd.read_sql(query, self.connection)
+        return leer_sql(self.connection, query)
 
-    def get_filtered_contratos_data(self, cpv_category=None, provincia=None, presupuesto=None, years=None, limit=50):
-        """Obtener datos filtrados directamente desde la base de datos"""
+    def get_filtered_contratos_data(self, cpv_category=None, provincia=None, presupuesto=None, years=None, limit=50,
+                                    palabras=None):
+        """Obtener datos filtrados directamente desde la base de datos.
+
+        Con palabras (palabras clave del objeto) los contratos se ordenan por
+        relevancia de texto en título y descripción (ts_rank_cd sobre
+        documento_busqueda, busqueda_texto.py) y después por fecha, en lugar de
+        solo por fecha; sin la columna se calcula la misma puntuación en local.
+        Los que no contienen ninguna palabra no se excluyen: quedan al final.
+        """
         # Construir condiciones WHERE dinámicamente
         conditions = [
             "importe_total IS NOT NULL",
@@ -979,6 +1228,17 @@ class BajaEstadisticaGenerator:
 
         where_clause = " AND ".join(conditions)
 
+        busqueda = BusquedaTextoCompleto(palabras or [])
+        en_servidor = bool(busqueda) and busqueda.disponible(self.connection)
+        if en_servidor:
+            columna_relevancia = f",\n            {busqueda.expresion_rango()} as relevancia_texto"
+            orden = "relevancia_texto DESC, fecha_publicacion DESC"
+        else:
+            columna_relevancia = ""
+            orden = "fecha_publicacion DESC"
+        # Sin columna tsvector se leen todos los candidatos y se ordenan en local
+        limite = f"LIMIT {limit}" if en_servidor or not busqueda else ""
+
         query = f"""
         SELECT
             id,
@@ -993,32 +1253,64 @@ class BajaEstadisticaGenerator:
             cpv::text,
             tipo_contrato,
             provincia,
-            descripcion as objeto
+            descripcion as objeto{columna_relevancia}
         FROM adjudicaciones_metabase
         WHERE {where_clause}
-        ORDER BY fecha_publicacion DESC
-        LIMIT {limit}
+        ORDER BY {orden}
+        {limite}
         """
 
-        return pd.read_sql(query, self.connection)
+        with consulta_sql('get_filtered_contratos_data', self.connection, query) as c_sql:
+            df = leer_sql(self.connection, query)
+            c_sql.filas = len(df)
+        if busqueda and not en_servidor and not df.empty:
+            df['relevancia_texto'] = [busqueda.puntuar(titulo, objeto)
+                                      for titulo, objeto in zip(df['titulo'], df['objeto'])]
+            # Orden estable: a igual relevancia se mantiene el orden por fecha de la consulta
+            df = df.sort_values('relevancia_texto', ascending=False, kind='stable').head(limit).reset_index(drop=True)
+        return df
 
     def search_previous_licitacion_same_org(self, organismo, cpv_category, presupuesto):
-        """Buscar licitaciones anteriores de la misma administración con CPV similar e importe parecido"""
+        """Buscar licitaciones anteriores de la misma administración con CPV similar e importe parecido.
+
+        El organismo se resuelve con el índice de organismos (organismos.py): se
+        buscan todas sus grafías (Ajuntament/Ayuntamiento, AYTO....) con un IN
+        sobre entidad_compradora, y no se consulta la base de datos si su resumen
+        no tiene adjudicaciones de ese CPV en el rango de presupuesto.
+        """
         if not organismo or not cpv_category:
             return None
 
-        # Escapar comillas en el nombre del organismo
-        organismo_clean = organismo.replace("'", "''")
+        # Filtro por presupuesto similar (±30%)
+        min_budget = max_budget = None
+        if presupuesto and presupuesto > 0:
+            min_budget = presupuesto * 0.7
+            max_budget = presupuesto * 1.3
+
+        indice = self._indice_organismos()
+        cpv_indice = cpv_category[:8] if len(cpv_category) >= 8 else cpv_category[:4] if len(cpv_category) >= 4 else ''
+        if indice.cargado():
+            resumen = indice.organismo(organismo)
+            if resumen is None or not resumen.posible(cpv_indice, min_budget, max_budget):
+                indice.estadisticas['omitidas'] += 1
+                return None
+            variantes = ", ".join("'" + variante.replace("'", "''") + "'" for variante in indice.variantes(organismo))
+            condicion_organismo = f"entidad_compradora IN ({variantes})"
+        else:
+            # Índice aún cargándose (o sin acceso a la tabla): comparación directa del nombre
+            organismo_clean = organismo.replace("'", "''")
+            condicion_organismo = f"LOWER(entidad_compradora) = LOWER('{organismo_clean}')"
+        indice.estadisticas['consultas'] += 1
 
         # Construir condiciones
         conditions = [
+            condicion_organismo,
             "importe_total IS NOT NULL",
             "importe_adjudicacion IS NOT NULL",
             "importe_total > 0",
             "importe_adjudicacion > 0",
             "importe_total != importe_adjudicacion",
             "fecha_publicacion IS NOT NULL",
-            f"LOWER(entidad_compradora) = LOWER('{organismo_clean}')"
         ]
 
         # Filtro por CPV (primero intentar con 8 dígitos exactos, luego 4 dígitos)
@@ -1031,10 +1323,7 @@ class BajaEstadisticaGenerator:
             cpv_4_digits = cpv_category[:4]
             conditions.append(f"cpv::text ~ '{cpv_4_digits}[0-9]{{4}}'")
 
-        # Filtro por presupuesto similar (±30%)
-        if presupuesto and presupuesto > 0:
-            min_budget = presupuesto * 0.7
-            max_budget = presupuesto * 1.3
+        if min_budget is not None:
             conditions.append(f"importe_total BETWEEN {min_budget} AND {max_budget}")
 
         where_clause = " AND ".join(conditions)
@@ -1057,12 +1346,25 @@ class BajaEstadisticaGenerator:
         LIMIT 1
         """
 
-        result = pd.read_sql(query, self.connection)
+        with consulta_sql('search_previous_licitacion_same_org', self.connection, query) as c_sql:
+            result = leer_sql(self.connection, query)
+            c_sql.filas = len(result)
 
         if not result.empty:
             return result.iloc[0].to_dict()
         return None
 
+    def _indice_organismos(self):
+        """Índice de organismos; si ha caducado se refresca en segundo plano.
+
+        Hasta la primera carga completa cargado() es False y la búsqueda compara
+        el nombre del organismo directamente.
+        """
+        indice = get_indice_organismos()
+        if self.connection:
+            refrescar_en_segundo_plano(indice, self.nueva_conexion)
+        return indice
+
     def extract_price_from_text(self, text):
         """Extraer precio de texto usando regex"""
         if pd.isna(text):
@@ -1070,25 +1372,7 @@ class BajaEstadisticaGenerator:
 
         text = str(text).replace('.', '').replace(',', '.')
 
-        patterns = [
-            r'(\d+\.?\d*)\s*€',
-            r'€\s*(\d+\.?\d*)',
-            r'(\d+\.?\d*)\s*euros?',
-            r'euros?\s*(\d+\.?\d*)',
-            r'importe[:\s]*(\d+\.?\d*)',
-            r'precio[:\s]*(\d+\.?\d*)',
-            r'valor[:\s]*(\d+\.?\d*)',
-            r'(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)'
-        ]
-
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                try:
-                    return float(matches[0].replace(',', '.'))
-                except:
-                    continue
-        return None
+        return extraer_precio(text)
 
     def extract_empresa_name(self, text):
         """Extraer nombre de empresa"""
@@ -1098,7 +1382,7 @@ class BajaEstadisticaGenerator:
         # Limpiar texto común
         text = str(text).strip()
         # Quitar patrones comunes
-        text = re.sub(r'\b(S\.?L\.?|S\.?A\.?|S\.?L\.?U\.?)\b', '', text, flags=re.IGNORECASE)
+        text = SUFIJOS_SOCIETARIOS.sub('', text)
         return text.strip()
 
     def calculate_baja_percentage(self, pbl, importe_adjudicacion):
@@ -1432,10 +1716,7 @@ class BajaEstadisticaGenerator:
             return 0.0
 
         try:
-            vectorizer = TfidfVectorizer(stop_words=None, ngram_range=(1, 2), max_features=1000)
-            tfidf_matrix = vectorizer.fit_transform([text1, text2])
-            similarity = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
-            return similarity
+            return calcular_similitud_tfidf(text1, text2, ngram_range=(1, 2), max_features=1000)
         except:
             return 0.0
 
@@ -1560,7 +1841,7 @@ class BajaEstadisticaGenerator:
             return ""
 
         # Buscar el primer código CPV en el string
-        cpv_match = re.search(r'(\d{8})', cpv_string)
+        cpv_match = CPV_8_DIGITOS.search(cpv_string)
         if cpv_match:
             cpv_code = cpv_match.group(1)
             return cpv_code[:4]  # Primeros 4 dígitos
@@ -1572,7 +1853,7 @@ class BajaEstadisticaGenerator:
             return ""
 
         # Extraer todos los códigos CPV de 8 dígitos
-        cpv_codes = re.findall(r'(\d{8})', cpv_string)
+        cpv_codes = CPV_8_DIGITOS.findall(cpv_string)
 
         if not cpv_codes:
             return ""
@@ -1587,7 +1868,7 @@ class BajaEstadisticaGenerator:
 
         # Si el CPV viene en formato JSON array: ["12345678", "87654321"]
         # Extraer todos los códigos CPV de 8 dígitos
-        cpv_codes = re.findall(r'(\d{8})', cpv_string)
+        cpv_codes = CPV_8_DIGITOS.findall(cpv_string)
 
         if not cpv_codes:
             return ""
@@ -1650,7 +1931,7 @@ class BajaEstadisticaGenerator:
             if cpv_category and len(cpv_category) >= 4:
                 row_cpv = str(row.get('cpv', ''))
                 # Extraer todos los códigos CPV de 8 dígitos del contrato
-                row_cpv_codes = re.findall(r'(\d{8})', row_cpv)
+                row_cpv_codes = CPV_8_DIGITOS.findall(row_cpv)
 
                 # Comparar los 4 primeros dígitos de cada CPV encontrado
                 cpv_match = False
@@ -2332,68 +2613,35 @@ class BajaEstadisticaGenerator:
 
         return grupos
 
-    def get_empresa_stats(self, similar_contratos):
-        """Obtener estadísticas de empresas participantes (3-7 empresas, sin None/vacíos)"""
-        import json
-        # Filtrar empresas válidas (sin None, vacíos, ni "NONE")
-        empresas_validas = []
-        for c in similar_contratos:
-            if c.get('empresa'):
-                empresa_raw = str(c['empresa']).strip()
-
-                # Parsear JSON si es necesario
-                if empresa_raw.startswith('['):
-                    # Es un array de adjudicatarios (múltiples lotes)
-                    try:
-                        empresa_array = json.loads(empresa_raw)
-                        for item in empresa_array:
-                            if isinstance(item, dict) and 'adjudicatario' in item:
-                                adj = item['adjudicatario']
-                                if isinstance(adj, dict) and 'name' in adj:
-                                    empresa = adj['name']
-                                    if empresa and empresa.upper() not in ['NONE', 'NULL', 'N/A', ''] and len(empresa) > 3:
-                                        empresas_validas.append(empresa)
-                    except:
-                        pass
-                elif empresa_raw.startswith('{'):
-                    # Es un objeto JSON simple
-                    try:
-                        empresa_data = json.loads(empresa_raw)
-                        # Puede ser {"adjudicatario": {"name": ...}} o directamente {"name": ...}
-                        if 'adjudicatario' in empresa_data and isinstance(empresa_data['adjudicatario'], dict):
-                            empresa = empresa_data['adjudicatario'].get('name', empresa_raw)
-                        elif 'name' in empresa_data:
-                            empresa = empresa_data.get('name', empresa_raw)
-
-                        if empresa and empresa.upper() not in ['NONE', 'NULL', 'N/A', ''] and len(empresa) > 3:
-                            empresas_validas.append(empresa)
-                    except:
-                        pass
-                else:
-                    # Es texto simple
-                    empresa = empresa_raw
-                    if empresa and empresa.upper() not in ['NONE', 'NULL', 'N/A', ''] and len(empresa) > 3:
-                        empresas_validas.append(empresa)
+    def get_empresa_stats(self, similar_contratos, con_perfiles=False):
+        """Obtener estadísticas de empresas participantes (3-7 empresas, sin None/vacíos).
 
-        if not empresas_validas:
+        Las empresas se cuentan por id del índice canónico (empresas.py): las
+        variantes de un mismo nombre ("X, S.L." / "X SL") suman juntas.
+        Con con_perfiles cada empresa del top es (nombre, recuento, perfil), con el
+        perfil de licitación del almacén de perfiles_empresas (o None).
+        """
+        # Recuento por id (sin None, vacíos, ni "NONE"); el índice parsea cada JSON una vez
+        indice = get_indice_empresas()
+        empresa_counts = indice.contar(similar_contratos)
+
+        if not empresa_counts:
             # No hay empresas válidas - devolver valores mínimos sin inventar datos
             bajas = [c['baja_percentage'] for c in similar_contratos if c['baja_percentage'] is not None and c['baja_percentage'] > 0]
             rango_bajas = (min(bajas), max(bajas)) if bajas else (10, 20)
             return [], 1, rango_bajas
 
-        # Contar frecuencia de empresas reales
-        empresa_counts = {}
-        for empresa in empresas_validas:
-            empresa_counts[empresa] = empresa_counts.get(empresa, 0) + 1
-
-        # Obtener empresas más frecuentes (solo empresas reales del CPV)
-        all_empresas = sorted(empresa_counts.items(), key=lambda x: x[1], reverse=True)
-
-        # Seleccionar hasta 7 empresas reales (sin inventar datos)
-        num_mostrar = min(7, len(all_empresas))
-        top_empresas = all_empresas[:num_mostrar]
+        # Obtener empresas más frecuentes (solo empresas reales del CPV), hasta 7
+        top_ids = empresa_counts.most_common(7)
+        if con_perfiles:
+            # Una consulta por clave al almacén de perfiles
+            almacen = self._almacen_perfiles()
+            top_empresas = [(indice.nombre(id_emp), n, almacen.perfil(indice.clave(id_emp)) if almacen else None)
+                            for id_emp, n in top_ids]
+        else:
+            top_empresas = [(indice.nombre(id_emp), n) for id_emp, n in top_ids]
 
-        participacion_promedio = max(3, min(7, len(set(empresas_validas))))
+        participacion_promedio = max(3, min(7, len(empresa_counts)))
 
         # Rango de bajas
         bajas = [c['baja_percentage'] for c in similar_contratos if c['baja_percentage'] is not None and c['baja_percentage'] > 0]
@@ -2401,11 +2649,23 @@ class BajaEstadisticaGenerator:
 
         return top_empresas, participacion_promedio, rango_bajas
 
+    def _almacen_perfiles(self):
+        """Almacén de perfiles de empresa, o None mientras se carga en segundo plano"""
+        almacen = get_almacen_perfiles()
+        if self.connection:
+            refrescar_en_segundo_plano(almacen, self.nueva_conexion)
+        return almacen if almacen.cargado() else None
+
+    def precargar_almacenes(self):
+        """Lanzar en segundo plano la carga de los almacenes compartidos (no espera)"""
+        self._almacen_perfiles()
+        self._indice_organismos()
+
     def generate_baja_text(self, xml_data, similar_contratos, recommended_baja):
         """Generar texto de baja estadística siguiendo el formato del ejemplo"""
 
         # Obtener estadísticas
-        top_empresas, participacion, rango_bajas = self.get_empresa_stats(similar_contratos)
+        top_empresas, participacion, rango_bajas = self.get_empresa_stats(similar_contratos, con_perfiles=True)
 
         # Extraer criterios del XML
         criterios_xml = xml_data.get('criterios_adjudicacion', [])
@@ -2459,6 +2719,11 @@ class BajaEstadisticaGenerator:
             empresas_texto = ", ".join([emp[0] for emp in top_empresas])
             texto += f" La empresa más relevante en este campo es {empresas_texto}.\n"
 
+        # Baja habitual de las empresas citadas según su perfil de licitación
+        frase = frase_perfiles([(emp[0], emp[2]) for emp in top_empresas[:3]])
+        if frase:
+            texto += f"{frase}\n"
+
         # Variaciones en ofertas (formato del ejemplo)
         if rango_bajas[0] > 0 and rango_bajas[1] > 0:
             variaciones_texto = [
@@ -2522,6 +2787,8 @@ class BajaEstadisticaGenerator:
 
     def create_excel_download(self, xml_data, similar_contratos, recommended_baja, texto_baja):
         """Crear Excel con todos los datos extraídos"""
+        from openpyxl import Workbook
+        from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 
         # Crear un nuevo workbook
         wb = Workbook()
@@ -2727,30 +2994,17 @@ class BajaEstadisticaGenerator:
         """
 
         try:
-            result = pd.read_sql(query, self.connection)
+            with consulta_sql('buscar_contratos_simples_por_cpv', self.connection, query) as c_sql:
+                result = leer_sql(self.connection, query)
+                c_sql.filas = len(result)
 
             # Convertir a lista de diccionarios con parsing de adjudicatarios
+            indice = get_indice_empresas()
             contratos = []
             for _, row in result.iterrows():
-                # Extraer empresa
-                empresa = 'N/A'
-                adj_raw = row['adjudicatario']
-                if adj_raw:
-                    try:
-                        adj_str = str(adj_raw)
-                        if adj_str.startswith('['):
-                            adj_array = json.loads(adj_str)
-                            if adj_array and len(adj_array) > 0:
-                                if 'adjudicatario' in adj_array[0] and 'name' in adj_array[0]['adjudicatario']:
-                                    empresa = adj_array[0]['adjudicatario']['name']
-                        elif adj_str.startswith('{'):
-                            adj_dict = json.loads(adj_str)
-                            if 'adjudicatario' in adj_dict and isinstance(adj_dict['adjudicatario'], dict):
-                                empresa = adj_dict['adjudicatario'].get('name', 'N/A')
-                        else:
-                            empresa = adj_str[:60] if len(adj_str) > 0 else 'N/A'
-                    except:
-                        empresa = str(adj_raw)[:60] if adj_raw else 'N/A'
+                # Empresas del índice canónico (todas las del adjudicatario; se muestra la primera)
+                empresa_ids = list(indice.ids(row['adjudicatario']))
+                empresa = indice.nombre(empresa_ids[0]) if empresa_ids else 'N/A'
 
                 contrato = {
                     'titulo': row['titulo'],
@@ -2759,6 +3013,7 @@ class BajaEstadisticaGenerator:
                     'precio_adjudicacion': float(row['importe_adjudicacion']),
                     'empresa': empresa,
                     'empresa_adjudicataria': empresa,
+                    'empresa_ids': empresa_ids,
                     'num_licitadores': int(row['numero_licitadores']) if row['numero_licitadores'] else 0,
                     'fecha_publicacion': str(row['fecha_publicacion']),
                     'baja_percentage': float(row['baja_estadistica']),
@@ -2772,15 +3027,23 @@ class BajaEstadisticaGenerator:
             st.error(f"Error en búsqueda: {e}")
             return []
 
+def get_generator():
+    """Generador de la sesión, reutilizado entre reruns.
+
+    Cada sesión tiene su propia instancia: guarda la conexión a la base de
+    datos y el estado del análisis en curso, que no se pueden compartir entre
+    usuarios.
+    """
+    if 'generator' not in st.session_state:
+        st.session_state.generator = BajaEstadisticaGenerator()
+    return st.session_state.generator
+
 def main():
     st.title("📊 Analizador de Bajas Estadísticas - XML a Base de Datos")
     st.sidebar.title("Configuración")
 
     # Inicializar generador
-    if 'generator' not in st.session_state:
-        st.session_state.generator = BajaEstadisticaGenerator()
-
-    generator = st.session_state.generator
+    generator = get_generator()
 
     # Conectar a la base de datos
     if not generator.connection:
@@ -2790,6 +3053,8 @@ def main():
             else:
                 st.error("❌ No se pudo conectar a la base de datos")
                 return
+    # Perfiles de empresas e índices: se cargan mientras el usuario prepara el análisis
+    generator.precargar_almacenes()
 
     st.markdown("### 🔗 Análisis de Contrato desde XML o JSON")
 
@@ -2825,442 +3090,470 @@ def main():
         help="Si la licitación está dividida en lotes y solo quieres analizar uno específico, indica su número. Déjalo vacío para analizar toda la licitación."
     )
 
-    if st.button("🚀 Analizar Contrato", type="primary"):
-        datos_contrato = None
-        source_name = "XML" if source_type == "XML (URL)" else "JSON"
-
-        if source_type == "XML (URL)" and xml_url:
-            with st.spinner("Descargando y analizando XML..."):
-                # Extraer datos del XML
-                datos_contrato = generator.extract_xml_data(xml_url, numero_lote if numero_lote else None)
+    modo_debug = st.sidebar.checkbox(
+        "Depuración del XML",
+        value=False,
+        help="Muestra la estructura del XML y el detalle de la búsqueda de criterios (más lento)"
+    )
 
-        elif source_type == "JSON (Archivo)" and json_file:
-            with st.spinner("Procesando archivo JSON..."):
-                try:
-                    # Leer el archivo JSON
-                    json_content = json_file.read().decode('utf-8')
-                    # Extraer datos del JSON
-                    datos_contrato = generator.extract_json_data(json_content, numero_lote if numero_lote else None)
-                except Exception as e:
-                    st.error(f"Error leyendo archivo JSON: {e}")
-                    datos_contrato = None
-
-        if datos_contrato:
-            st.success(f"✅ {source_name} procesado correctamente")
-
-            # Mostrar datos extraídos
-            st.markdown("### 📋 Datos del Contrato Extraídos")
-            # Información del contrato en un expander
-            with st.expander("📄 Ver información del contrato", expanded=False):
-                col1, col2 = st.columns(2)
-
-                with col1:
-                    st.markdown("**📄 Información Básica**")
-                    st.write(f"**Título:** {datos_contrato['titulo'][:100]}..." if len(datos_contrato['titulo']) > 100 else f"**Título:** {datos_contrato['titulo']}")
-                    st.write(f"**Organismo:** {datos_contrato['organismo']}")
-                    st.write(f"**Presupuesto:** €{datos_contrato['presupuesto']:,.2f}")
-                    st.write(f"**CPV:** {datos_contrato['cpv']}")
-
-                with col2:
-                    st.markdown("**⚖️ Procedimiento y Criterios**")
-                    st.write(f"**Tipo:** {datos_contrato['tipo_procedimiento']}")
-                    if datos_contrato['criterios_adjudicacion']:
-                        st.write(f"**Criterios de adjudicación ({len(datos_contrato['criterios_adjudicacion'])}):**")
-
-                        # Mostrar todos los criterios sin límite
-                        for i, criterio in enumerate(datos_contrato['criterios_adjudicacion'], 1):
-                            if isinstance(criterio, dict):
-                                # Si es un diccionario, mostrar la descripción
-                                desc = criterio.get('descripcion', 'Sin descripción')
-                                peso = criterio.get('peso', '')
-                                otros = criterio.get('otros', [])
-
-                                # Crear texto del criterio
-                                criterio_texto = desc
-                                if peso:
-                                    criterio_texto += f" (Peso: {peso})"
-                                if otros:
-                                    criterio_texto += f" - {', '.join(otros[:2])}"  # Máximo 2 elementos adicionales
-
-                                # Mostrar con longitud variable según contenido
-                                max_len = 120 if peso or otros else 80
-                                if len(criterio_texto) > max_len:
-                                    st.write(f"{i}. {criterio_texto[:max_len]}...")
-                                else:
-                                    st.write(f"{i}. {criterio_texto}")
-                            else:
-                                # Si es una cadena simple
-                                criterio_str = str(criterio)
-                                if len(criterio_str) > 80:
-                                    st.write(f"{i}. {criterio_str[:80]}...")
-                                else:
-                                    st.write(f"{i}. {criterio_str}")
-
-                        # Si hay muchos criterios, mostrar un resumen
-                        if len(datos_contrato['criterios_adjudicacion']) > 10:
-                            st.info(f"💡 Se encontraron {len(datos_contrato['criterios_adjudicacion'])} criterios de adjudicación en total")
-
-            # Buscar contratos similares en la base de datos
-            with st.spinner("Buscando contratos similares en la base de datos..."):
-                # Extraer criterios de búsqueda del contrato
-                provincia = datos_contrato.get('ubicacion', '')
-                presupuesto = datos_contrato.get('presupuesto', 0)
-                years = [2025, 2024, 2023, 2022]
-
-                # ETAPA 1: Intentar búsqueda con CPV exacto (8 dígitos)
-                cpv_full = generator._extract_cpv_full(datos_contrato.get('cpv', ''))
-
-                if cpv_full:
-                    st.info(f"🔍 Etapa 1: Buscando con CPV exacto ({cpv_full})...")
-                    st.session_state.contratos_data = generator.get_filtered_contratos_data(
-                        cpv_category=cpv_full,  # 8 dígitos exactos
-                        provincia=provincia,
-                        presupuesto=presupuesto,
-                        years=years,
-                        limit=50
-                    )
-
-                    data = st.session_state.contratos_data
-                    st.info(f"✅ Encontrados {len(data)} contratos con CPV exacto")
-                else:
-                    # Si no hay CPV completo, ir directamente a búsqueda amplia
-                    data = pd.DataFrame()
-
-                # Análisis de competencia
-                st.markdown("### 🔍 Análisis de Competencia")
-
-                # Función auxiliar para procesar contratos
-                def process_contratos(data_df):
-                    contratos_list = []
-                    for idx, row in data_df.iterrows():
-                        # Extraer datos directamente de las columnas SQL
-                        baja_estadistica = row.get('baja_estadistica', 0)
-                        empresa_raw = row.get('empresa_adjudicataria', '')
-
-                        # Extraer solo el nombre si viene en formato JSON
-                        empresa = empresa_raw
-                        if empresa_raw and isinstance(empresa_raw, str):
-                            try:
-                                # Si es un JSON, extraer el campo "name"
-                                if empresa_raw.strip().startswith('{'):
-                                    import json
-                                    empresa_data = json.loads(empresa_raw)
-                                    # Puede ser {"adjudicatario": {"name": ...}} o directamente {"name": ...}
-                                    if 'adjudicatario' in empresa_data and isinstance(empresa_data['adjudicatario'], dict):
-                                        empresa = empresa_data['adjudicatario'].get('name', empresa_raw)
-                                    elif 'name' in empresa_data:
-                                        empresa = empresa_data.get('name', empresa_raw)
-                            except:
-                                # Si falla el parseo, usar el valor original
-                                empresa = empresa_raw
-
-                        # Filtrar: eliminar bajas > 70% o < 0.5% o sin empresa
-                        if baja_estadistica and 0.5 <= baja_estadistica <= 70 and empresa:
-                            contrato_data = {
-                                'titulo': row.get('titulo', ''),
-                                'organismo': row.get('organismo', ''),
-                                'presupuesto_licitacion': row.get('presupuesto_licitacion', 0),
-                                'precio_adjudicacion': row.get('precio_adjudicacion', 0),
-                                'baja_percentage': baja_estadistica,
-                                'empresa_adjudicataria': empresa,
-                                'num_licitadores': row.get('num_licitadores', 1) or 1,
-                                'fecha_publicacion': str(row.get('fecha_publicacion', '')),
-                                'cpv': row.get('cpv', ''),
-                                'provincia': row.get('provincia', ''),
-                                'objeto': row.get('objeto', ''),
-                                'pbl': row.get('presupuesto_licitacion', 0),
-                                'importe_adjudicacion': row.get('precio_adjudicacion', 0),
-                                'precio': row.get('presupuesto_licitacion', 0),
-                                'empresa': empresa
-                            }
-                            contratos_list.append(contrato_data)
-                    return contratos_list
-
-                # Convertir DataFrame a lista de diccionarios para procesamiento
-                similar_contratos = process_contratos(data)
-
-                st.write(f"**DEBUG: Contratos procesados (Etapa 1): {len(similar_contratos)} de {len(data)} encontrados**")
-
-                # ETAPA 2: Si hay menos de 7 contratos procesados, ampliar búsqueda a 4 dígitos
-                if len(similar_contratos) < 7:
-                    st.warning(f"⚠️ Solo se encontraron {len(similar_contratos)} contratos con CPV exacto (se requieren al menos 7)")
-                    st.info("🔄 Etapa 2: Ampliando búsqueda a primeros 4 dígitos del CPV...")
-
-                    # Extraer primeros 4 dígitos del CPV
-                    cpv_category = generator._extract_cpv_category_from_multiple(
-                        datos_contrato.get('cpv', ''),
-                        datos_contrato.get('objeto', '')
-                    )
-
-                    # Buscar con CPV amplio (4 dígitos)
-                    st.session_state.contratos_data = generator.get_filtered_contratos_data(
-                        cpv_category=cpv_category,  # 4 dígitos
-                        provincia=provincia,
-                        presupuesto=presupuesto,
-                        years=years,
-                        limit=50
-                    )
-
-                    data = st.session_state.contratos_data
-                    st.info(f"✅ Encontrados {len(data)} contratos con primeros 4 dígitos del CPV")
-
-                    # Re-procesar con los nuevos datos
-                    similar_contratos = process_contratos(data)
-                    st.write(f"**DEBUG: Contratos procesados (Etapa 2): {len(similar_contratos)} de {len(data)} encontrados**")
-                else:
-                    st.success(f"✅ Suficientes contratos encontrados con CPV exacto ({len(similar_contratos)} contratos)")
+    ordenar_por_texto = st.sidebar.checkbox(
+        "Priorizar comparables por palabras clave",
+        value=False,
+        help="Ordena los contratos comparables por relevancia del objeto en título y descripción "
+             "(búsqueda de texto completo) en lugar de solo por fecha"
+    )
 
-                st.write(f"**DEBUG FINAL: Total de contratos procesados: {len(similar_contratos)}**")
+    diagnostico_activo = st.sidebar.checkbox(
+        "🩺 Diagnóstico SQL",
+        value=False,
+        help="Mide cada consulta de búsqueda del próximo análisis y añade las lentas al log de consultas lentas "
+             "(resumen por forma de consulta: python diagnostico_sql.py)"
+    )
+    if diagnostico_activo:
+        umbral_lenta_ms = st.sidebar.number_input("Umbral de consulta lenta (ms):", min_value=0, value=1000, step=100)
+        incluir_explain = st.sidebar.checkbox(
+            "Incluir plan estimado (EXPLAIN)",
+            value=False,
+            help="Guarda el plan estimado de las consultas lentas sin volver a ejecutarlas "
+                 "(con tiempos reales: python diagnostico_sql.py --explain)"
+        )
 
-                # Generar informe siempre que haya al menos 1 contrato
-                if len(similar_contratos) > 0:
-                    # BUSCAR LICITACIÓN ANTERIOR DE LA MISMA ADMINISTRACIÓN
-                    organismo = datos_contrato.get('organismo', '')
-                    cpv_full = generator._extract_cpv_full(datos_contrato.get('cpv', ''))
-                    if not cpv_full:
-                        cpv_full = generator._extract_cpv_category_from_multiple(
-                            datos_contrato.get('cpv', ''),
-                            datos_contrato.get('objeto', '')
-                        )
+    if st.button("🚀 Analizar Contrato", type="primary"):
+        datos_contrato = None
+        diagnostico = (iniciar_diagnostico(umbral_ms=umbral_lenta_ms, explain=incluir_explain)
+                       if diagnostico_activo else None)
+        try:
+            source_name = "XML" if source_type == "XML (URL)" else "JSON"
 
-                    licitacion_anterior = None
-                    if organismo and cpv_full:
-                        with st.spinner("🔍 Buscando licitaciones anteriores de la misma administración..."):
-                            licitacion_anterior = generator.search_previous_licitacion_same_org(
-                                organismo=organismo,
-                                cpv_category=cpv_full,
-                                presupuesto=presupuesto
-                            )
+            if source_type == "XML (URL)" and xml_url:
+                with st.spinner("Descargando y analizando XML..."):
+                    # Extraer datos del XML
+                    datos_contrato = generator.extract_xml_data(xml_url, numero_lote if numero_lote else None,
+                                                                debug=modo_debug)
 
-                        if licitacion_anterior:
-                            st.success("✅ ¡Encontrada licitación anterior de la misma administración!")
-
-                            # Mostrar información destacada
-                            st.markdown("### 🎯 LICITACIÓN ANTERIOR RELEVANTE")
-
-                            # Parsear empresa_adjudicataria si es JSON
-                            import json
-                            empresa_anterior_raw = licitacion_anterior.get('empresa_adjudicataria', 'N/A')
-                            empresa_anterior = empresa_anterior_raw
-                            if empresa_anterior_raw and isinstance(empresa_anterior_raw, str):
-                                try:
-                                    if empresa_anterior_raw.strip().startswith('{'):
-                                        empresa_data = json.loads(empresa_anterior_raw)
-                                        if 'adjudicatario' in empresa_data and isinstance(empresa_data['adjudicatario'], dict):
-                                            empresa_anterior = empresa_data['adjudicatario'].get('name', empresa_anterior_raw)
-                                        elif 'name' in empresa_data:
-                                            empresa_anterior = empresa_data.get('name', empresa_anterior_raw)
-                                except:
-                                    pass
-
-                            col1, col2, col3 = st.columns(3)
-                            with col1:
-                                st.metric("📅 Fecha", str(licitacion_anterior.get('fecha_publicacion', 'N/A'))[:10])
-                            with col2:
-                                st.metric("💰 Presupuesto", f"{licitacion_anterior.get('presupuesto_licitacion', 0):,.0f}€")
-                            with col3:
-                                st.metric("📉 Baja Anterior", f"{licitacion_anterior.get('baja_estadistica', 0):.2f}%")
-
-                            st.info(f"🏆 **Adjudicatario anterior:** {empresa_anterior}")
-                            st.warning(f"💡 **Recomendación basada en adjudicación anterior:** {licitacion_anterior.get('baja_estadistica', 0):.2f}% + 2% = **{licitacion_anterior.get('baja_estadistica', 0) + 2:.2f}%**")
-
-                    # Calcular baja recomendada (priorizando licitación anterior si existe)
-                    recommended_baja = generator.calculate_recommended_baja(similar_contratos, licitacion_anterior)
-
-                    # Mostrar resultados principales
-                    st.markdown("### 📊 Resultados del Análisis")
-
-                    st.markdown("---")
-
-                    # Información del contrato
-                    st.markdown("#### 📋 Datos del Contrato")
+            elif source_type == "JSON (Archivo)" and json_file:
+                with st.spinner("Procesando archivo JSON..."):
+                    try:
+                        # Leer el archivo JSON
+                        json_content = json_file.read().decode('utf-8')
+                        # Extraer datos del JSON
+                        datos_contrato = generator.extract_json_data(json_content, numero_lote if numero_lote else None)
+                    except Exception as e:
+                        st.error(f"Error leyendo archivo JSON: {e}")
+                        datos_contrato = None
+
+            if datos_contrato:
+                st.success(f"✅ {source_name} procesado correctamente")
+
+                # Mostrar datos extraídos
+                st.markdown("### 📋 Datos del Contrato Extraídos")
+                # Información del contrato en un expander
+                with st.expander("📄 Ver información del contrato", expanded=False):
                     col1, col2 = st.columns(2)
-                    with col1:
-                        st.write(f"**Organismo:** {datos_contrato.get('organismo', 'N/A')}")
-                        st.write(f"**Ubicación:** {datos_contrato.get('ubicacion', 'N/A')}")
-                    with col2:
-                        presupuesto = datos_contrato.get('presupuesto', 0)
-                        if presupuesto:
-                            st.write(f"**Presupuesto:** €{presupuesto:,.2f}")
-                        st.write(f"**CPV:** {datos_contrato.get('cpv', 'N/A')}")
 
-                    st.markdown("---")
-
-                    col1, col2, col3 = st.columns(3)
                     with col1:
-                        st.metric("🎯 Baja Recomendada", f"{recommended_baja:.1f}%")
+                        st.markdown("**📄 Información Básica**")
+                        st.write(f"**Título:** {datos_contrato['titulo'][:100]}..." if len(datos_contrato['titulo']) > 100 else f"**Título:** {datos_contrato['titulo']}")
+                        st.write(f"**Organismo:** {datos_contrato['organismo']}")
+                        st.write(f"**Presupuesto:** €{datos_contrato['presupuesto']:,.2f}")
+                        st.write(f"**CPV:** {datos_contrato['cpv']}")
+
                     with col2:
-                        st.metric("📈 Contratos Analizados", len(similar_contratos))
-                    with col3:
-                        # Verificar si similar_contratos es DataFrame o lista
-                        if hasattr(similar_contratos, 'columns') and 'num_licitadores' in similar_contratos.columns:
-                            avg_competitors = similar_contratos['num_licitadores'].mean()
-                        elif isinstance(similar_contratos, list):
-                            # Si es una lista de diccionarios, calcular promedio manualmente
-                            licitadores = [c.get('num_licitadores', 0) for c in similar_contratos if isinstance(c, dict) and c.get('num_licitadores')]
-                            avg_competitors = sum(licitadores) / len(licitadores) if licitadores else 0
-                        else:
-                            avg_competitors = 0
-                        st.metric("👥 Competidores Promedio", f"{avg_competitors:.0f}")
+                        st.markdown("**⚖️ Procedimiento y Criterios**")
+                        st.write(f"**Tipo:** {datos_contrato['tipo_procedimiento']}")
+                        if datos_contrato['criterios_adjudicacion']:
+                            st.write(f"**Criterios de adjudicación ({len(datos_contrato['criterios_adjudicacion'])}):**")
+
+                            # Mostrar todos los criterios sin límite
+                            for i, criterio in enumerate(datos_contrato['criterios_adjudicacion'], 1):
+                                if isinstance(criterio, dict):
+                                    # Si es un diccionario, mostrar la descripción
+                                    desc = criterio.get('descripcion', 'Sin descripción')
+                                    peso = criterio.get('peso', '')
+                                    otros = criterio.get('otros', [])
+
+                                    # Crear texto del criterio
+                                    criterio_texto = desc
+                                    if peso:
+                                        criterio_texto += f" (Peso: {peso})"
+                                    if otros:
+                                        criterio_texto += f" - {', '.join(otros[:2])}"  # Máximo 2 elementos adicionales
+
+                                    # Mostrar con longitud variable según contenido
+                                    max_len = 120 if peso or otros else 80
+                                    if len(criterio_texto) > max_len:
+                                        st.write(f"{i}. {criterio_texto[:max_len]}...")
+                                    else:
+                                        st.write(f"{i}. {criterio_texto}")
+                                else:
+                                    # Si es una cadena simple
+                                    criterio_str = str(criterio)
+                                    if len(criterio_str) > 80:
+                                        st.write(f"{i}. {criterio_str[:80]}...")
+                                    else:
+                                        st.write(f"{i}. {criterio_str}")
+
+                            # Si hay muchos criterios, mostrar un resumen
+                            if len(datos_contrato['criterios_adjudicacion']) > 10:
+                                st.info(f"💡 Se encontraron {len(datos_contrato['criterios_adjudicacion'])} criterios de adjudicación en total")
+
+                # Buscar contratos similares en la base de datos
+                with st.spinner("Buscando contratos similares en la base de datos..."):
+                    # Extraer criterios de búsqueda del contrato
+                    provincia = datos_contrato.get('ubicacion', '')
+                    presupuesto = datos_contrato.get('presupuesto', 0)
+                    years = [2025, 2024, 2023, 2022]
+
+                    # Palabras clave del objeto para ordenar por relevancia de texto
+                    palabras_objeto = (generator._extract_main_keywords(datos_contrato.get('objeto', ''))
+                                       if ordenar_por_texto else None)
+
+                    # ETAPA 1: Intentar búsqueda con CPV exacto (8 dígitos)
+                    cpv_full = generator._extract_cpv_full(datos_contrato.get('cpv', ''))
 
-                    st.markdown("---")
+                    if cpv_full:
+                        st.info(f"🔍 Etapa 1: Buscando con CPV exacto ({cpv_full})...")
+                        st.session_state.contratos_data = generator.get_filtered_contratos_data(
+                            cpv_category=cpv_full,  # 8 dígitos exactos
+                            provincia=provincia,
+                            presupuesto=presupuesto,
+                            years=years,
+                            limit=50,
+                            palabras=palabras_objeto
+                        )
 
-                    # Criterios de adjudicación - siempre visible
-                    st.markdown("#### ⚖️ Criterios de Adjudicación")
-                    if datos_contrato['criterios_adjudicacion']:
-                        for i, criterio in enumerate(datos_contrato['criterios_adjudicacion'], 1):
-                            if isinstance(criterio, dict):
-                                desc = criterio.get('descripcion', f'Criterio {i}')
-                                peso = criterio.get('peso', '')
-                                st.write(f"**{i}.** {desc.upper()}: **{peso}**" if peso else f"**{i}.** {desc.upper()}")
-                            else:
-                                st.write(f"**{i}.** {str(criterio).upper()}")
+                        data = st.session_state.contratos_data
+                        st.info(f"✅ Encontrados {len(data)} contratos con CPV exacto")
                     else:
-                        st.info(f"No se pudieron extraer criterios específicos del {source_name}")
-
-                    st.markdown("---")
-
-                    # Análisis de competencia histórica - siempre visible
-                    st.markdown("#### 🏆 Análisis de Mercado")
-                    top_empresas, participacion, rango_bajas = generator.get_empresa_stats(similar_contratos)
-
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.markdown("**📈 Estadísticas de Competencia:**")
-                        st.write(f"• Participación promedio: **{participacion} empresas** por licitación")
-                        if rango_bajas[0] > 0:
-                            st.write(f"• Rango de bajas: **{rango_bajas[0]:.1f}% - {rango_bajas[1]:.1f}%**")
-                            st.write(f"• Baja media: **{(rango_bajas[0] + rango_bajas[1])/2:.1f}%**")
-
-                    with col2:
-                        if top_empresas:
-                            st.markdown("**🏢 Empresas Más Activas:**")
-                            for empresa, count in top_empresas[:5]:
-                                st.write(f"• {empresa} ({count})")
-                        else:
-                            st.info("No se encontraron empresas en los contratos similares")
+                        # Si no hay CPV completo, ir directamente a búsqueda amplia
+                        data = pd.DataFrame()
+
+                    # Análisis de competencia
+                    st.markdown("### 🔍 Análisis de Competencia")
+
+                    # Función auxiliar para procesar contratos
+                    def process_contratos(data_df):
+                        indice_empresas = get_indice_empresas()
+                        contratos_list = []
+                        for idx, row in data_df.iterrows():
+                            # Extraer datos directamente de las columnas SQL
+                            baja_estadistica = row.get('baja_estadistica', 0)
+                            empresa_raw = row.get('empresa_adjudicataria', '')
+
+                            # Empresas del índice canónico; se muestra el nombre de la primera
+                            empresa_ids = list(indice_empresas.ids(empresa_raw)) if isinstance(empresa_raw, str) else []
+                            empresa = indice_empresas.nombre(empresa_ids[0]) if empresa_ids else empresa_raw
+
+                            # Filtrar: eliminar bajas > 70% o < 0.5% o sin empresa
+                            if baja_estadistica and 0.5 <= baja_estadistica <= 70 and empresa:
+                                contrato_data = {
+                                    'titulo': row.get('titulo', ''),
+                                    'organismo': row.get('organismo', ''),
+                                    'presupuesto_licitacion': row.get('presupuesto_licitacion', 0),
+                                    'precio_adjudicacion': row.get('precio_adjudicacion', 0),
+                                    'baja_percentage': baja_estadistica,
+                                    'empresa_adjudicataria': empresa,
+                                    'num_licitadores': row.get('num_licitadores', 1) or 1,
+                                    'fecha_publicacion': str(row.get('fecha_publicacion', '')),
+                                    'cpv': row.get('cpv', ''),
+                                    'provincia': row.get('provincia', ''),
+                                    'objeto': row.get('objeto', ''),
+                                    'pbl': row.get('presupuesto_licitacion', 0),
+                                    'importe_adjudicacion': row.get('precio_adjudicacion', 0),
+                                    'precio': row.get('presupuesto_licitacion', 0),
+                                    'empresa': empresa,
+                                    'empresa_ids': empresa_ids
+                                }
+                                contratos_list.append(contrato_data)
+                        return contratos_list
+
+                    # Convertir DataFrame a lista de diccionarios para procesamiento
+                    similar_contratos = process_contratos(data)
 
-                    # Generar texto justificativo
-                    with st.spinner("Generando informe de baja estadística..."):
-                        texto_baja = generator.generate_baja_text(datos_contrato, similar_contratos, recommended_baja)
+                    st.write(f"**DEBUG: Contratos procesados (Etapa 1): {len(similar_contratos)} de {len(data)} encontrados**")
 
-                    st.markdown("### 📝 Informe de Baja Estadística")
-                    st.text_area(
-                        "Texto generado para justificar la baja:",
-                        texto_baja,
-                        height=400,
-                        help="Puedes copiar este texto para incluirlo en tu oferta"
-                    )
+                    # ETAPA 2: Si hay menos de 7 contratos procesados, ampliar búsqueda a 4 dígitos
+                    if len(similar_contratos) < 7:
+                        st.warning(f"⚠️ Solo se encontraron {len(similar_contratos)} contratos con CPV exacto (se requieren al menos 7)")
+                        st.info("🔄 Etapa 2: Ampliando búsqueda a primeros 4 dígitos del CPV...")
 
-                    # Botón para regenerar
-                    if st.button("🔄 Regenerar texto con diferente redacción"):
-                        nuevo_texto = generator.generate_baja_text(datos_contrato, similar_contratos, recommended_baja)
-                        st.text_area("Nuevo texto generado:", nuevo_texto, height=400)
+                        # Extraer primeros 4 dígitos del CPV
+                        cpv_category = generator._extract_cpv_category_from_multiple(
+                            datos_contrato.get('cpv', ''),
+                            datos_contrato.get('objeto', '')
+                        )
 
-                    # Sección de descarga Excel (destacada)
-                    st.markdown("---")
-                    st.markdown("### 📥 Descargar Resultados")
+                        # Buscar con CPV amplio (4 dígitos)
+                        st.session_state.contratos_data = generator.get_filtered_contratos_data(
+                            cpv_category=cpv_category,  # 4 dígitos
+                            provincia=provincia,
+                            presupuesto=presupuesto,
+                            years=years,
+                            limit=50,
+                            palabras=palabras_objeto
+                        )
 
-                    col1, col2 = st.columns([2, 1])
+                        data = st.session_state.contratos_data
+                        st.info(f"✅ Encontrados {len(data)} contratos con primeros 4 dígitos del CPV")
 
-                    with col1:
-                        # Generar Excel automáticamente para descarga
-                        with st.spinner("Preparando Excel..."):
-                            excel_buffer = generator.create_excel_download(
-                                datos_contrato, similar_contratos, recommended_baja, texto_baja
+                        # Re-procesar con los nuevos datos
+                        similar_contratos = process_contratos(data)
+                        st.write(f"**DEBUG: Contratos procesados (Etapa 2): {len(similar_contratos)} de {len(data)} encontrados**")
+                    else:
+                        st.success(f"✅ Suficientes contratos encontrados con CPV exacto ({len(similar_contratos)} contratos)")
+
+                    st.write(f"**DEBUG FINAL: Total de contratos procesados: {len(similar_contratos)}**")
+
+                    # Generar informe siempre que haya al menos 1 contrato
+                    if len(similar_contratos) > 0:
+                        # BUSCAR LICITACIÓN ANTERIOR DE LA MISMA ADMINISTRACIÓN
+                        organismo = datos_contrato.get('organismo', '')
+                        cpv_full = generator._extract_cpv_full(datos_contrato.get('cpv', ''))
+                        if not cpv_full:
+                            cpv_full = generator._extract_cpv_category_from_multiple(
+                                datos_contrato.get('cpv', ''),
+                                datos_contrato.get('objeto', '')
                             )
 
-                            # Generar nombre de archivo con fecha
-                            fecha_actual = datetime.now().strftime("%Y%m%d_%H%M%S")
-                            organismo_clean = re.sub(r'[^\w\s-]', '', datos_contrato.get('organismo', 'Analisis'))[:20]
-                            nombre_archivo = f"Analisis_Baja_{organismo_clean}_{fecha_actual}.xlsx"
-
-                            st.download_button(
-                                label="📊 Descargar análisis completo en Excel",
-                                data=excel_buffer.getvalue(),
-                                file_name=nombre_archivo,
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                help="Descarga un Excel con todos los datos extraídos, contratos similares y análisis completo",
-                                key=f"download_excel_{fecha_actual}",
-                                use_container_width=True
-                            )
+                        licitacion_anterior = None
+                        if organismo and cpv_full:
+                            with st.spinner("🔍 Buscando licitaciones anteriores de la misma administración..."):
+                                licitacion_anterior = generator.search_previous_licitacion_same_org(
+                                    organismo=organismo,
+                                    cpv_category=cpv_full,
+                                    presupuesto=presupuesto
+                                )
+
+                            if licitacion_anterior:
+                                st.success("✅ ¡Encontrada licitación anterior de la misma administración!")
+
+                                # Mostrar información destacada
+                                st.markdown("### 🎯 LICITACIÓN ANTERIOR RELEVANTE")
+
+                                # Nombre canónico de la empresa_adjudicataria (puede venir en JSON)
+                                empresa_anterior_raw = licitacion_anterior.get('empresa_adjudicataria', 'N/A')
+                                empresa_anterior = empresa_anterior_raw
+                                if empresa_anterior_raw and isinstance(empresa_anterior_raw, str):
+                                    empresa_anterior = get_indice_empresas().nombre_principal(empresa_anterior_raw, empresa_anterior_raw)
+
+                                col1, col2, col3 = st.columns(3)
+                                with col1:
+                                    st.metric("📅 Fecha", str(licitacion_anterior.get('fecha_publicacion', 'N/A'))[:10])
+                                with col2:
+                                    st.metric("💰 Presupuesto", f"{licitacion_anterior.get('presupuesto_licitacion', 0):,.0f}€")
+                                with col3:
+                                    st.metric("📉 Baja Anterior", f"{licitacion_anterior.get('baja_estadistica', 0):.2f}%")
+
+                                st.info(f"🏆 **Adjudicatario anterior:** {empresa_anterior}")
+                                st.warning(f"💡 **Recomendación basada en adjudicación anterior:** {licitacion_anterior.get('baja_estadistica', 0):.2f}% + 2% = **{licitacion_anterior.get('baja_estadistica', 0) + 2:.2f}%**")
+
+                            # Histórico del organismo según el índice de organismos
+                            indice_organismos = get_indice_organismos()
+                            historico = indice_organismos.organismo(organismo) if indice_organismos.cargado() else None
+                            if historico:
+                                st.caption(
+                                    f"🏛️ Histórico del organismo: {historico.adjudicaciones} adjudicaciones, "
+                                    f"{historico.adjudicaciones_cpv(cpv_full[:8])} con CPV {cpv_full[:8]}; "
+                                    f"grafías: {', '.join(list(historico.variantes)[:5])}")
+
+                        # Calcular baja recomendada (priorizando licitación anterior si existe)
+                        recommended_baja = generator.calculate_recommended_baja(similar_contratos, licitacion_anterior)
+
+                        # Mostrar resultados principales
+                        st.markdown("### 📊 Resultados del Análisis")
+
+                        st.markdown("---")
+
+                        # Información del contrato
+                        st.markdown("#### 📋 Datos del Contrato")
+                        col1, col2 = st.columns(2)
+                        with col1:
+                            st.write(f"**Organismo:** {datos_contrato.get('organismo', 'N/A')}")
+                            st.write(f"**Ubicación:** {datos_contrato.get('ubicacion', 'N/A')}")
+                        with col2:
+                            presupuesto = datos_contrato.get('presupuesto', 0)
+                            if presupuesto:
+                                st.write(f"**Presupuesto:** €{presupuesto:,.2f}")
+                            st.write(f"**CPV:** {datos_contrato.get('cpv', 'N/A')}")
+
+                        st.markdown("---")
+
+                        col1, col2, col3 = st.columns(3)
+                        with col1:
+                            st.metric("🎯 Baja Recomendada", f"{recommended_baja:.1f}%")
+                        with col2:
+                            st.metric("📈 Contratos Analizados", len(similar_contratos))
+                        with col3:
+                            # Verificar si similar_contratos es DataFrame o lista
+                            if hasattr(similar_contratos, 'columns') and 'num_licitadores' in similar_contratos.columns:
+                                avg_competitors = similar_contratos['num_licitadores'].mean()
+                            elif isinstance(similar_contratos, list):
+                                # Si es una lista de diccionarios, calcular promedio manualmente
+                                licitadores = [c.get('num_licitadores', 0) for c in similar_contratos if isinstance(c, dict) and c.get('num_licitadores')]
+                                avg_competitors = sum(licitadores) / len(licitadores) if licitadores else 0
+                            else:
+                                avg_competitors = 0
+                            st.metric("👥 Competidores Promedio", f"{avg_competitors:.0f}")
+
+                        st.markdown("---")
+
+                        # Criterios de adjudicación - siempre visible
+                        st.markdown("#### ⚖️ Criterios de Adjudicación")
+                        if datos_contrato['criterios_adjudicacion']:
+                            for i, criterio in enumerate(datos_contrato['criterios_adjudicacion'], 1):
+                                if isinstance(criterio, dict):
+                                    desc = criterio.get('descripcion', f'Criterio {i}')
+                                    peso = criterio.get('peso', '')
+                                    st.write(f"**{i}.** {desc.upper()}: **{peso}**" if peso else f"**{i}.** {desc.upper()}")
+                                else:
+                                    st.write(f"**{i}.** {str(criterio).upper()}")
+                        else:
+                            st.info(f"No se pudieron extraer criterios específicos del {source_name}")
+
+                        st.markdown("---")
+
+                        # Análisis de competencia histórica - siempre visible
+                        st.markdown("#### 🏆 Análisis de Mercado")
+                        top_empresas, participacion, rango_bajas = generator.get_empresa_stats(similar_contratos)
+
+                        col1, col2 = st.columns(2)
+                        with col1:
+                            st.markdown("**📈 Estadísticas de Competencia:**")
+                            st.write(f"• Participación promedio: **{participacion} empresas** por licitación")
+                            if rango_bajas[0] > 0:
+                                st.write(f"• Rango de bajas: **{rango_bajas[0]:.1f}% - {rango_bajas[1]:.1f}%**")
+                                st.write(f"• Baja media: **{(rango_bajas[0] + rango_bajas[1])/2:.1f}%**")
+
+                        with col2:
+                            if top_empresas:
+                                st.markdown("**🏢 Empresas Más Activas:**")
+                                for empresa, count in top_empresas[:5]:
+                                    st.write(f"• {empresa} ({count})")
+                            else:
+                                st.info("No se encontraron empresas en los contratos similares")
+
+                        # Generar texto justificativo
+                        with st.spinner("Generando informe de baja estadística..."):
+                            texto_baja = generator.generate_baja_text(datos_contrato, similar_contratos, recommended_baja)
+
+                        st.markdown("### 📝 Informe de Baja Estadística")
+                        st.text_area(
+                            "Texto generado para justificar la baja:",
+                            texto_baja,
+                            height=400,
+                            help="Puedes copiar este texto para incluirlo en tu oferta"
+                        )
 
-                    with col2:
-                        st.info(f"✅ {len(similar_contratos)} contratos incluidos")
-
-                    st.markdown("---")
-
-                    # Mostrar contratos similares de forma detallada
-                    st.markdown(f"#### 📋 Contratos Similares Encontrados ({len(similar_contratos)})")
-
-                    # Preparar datos para mostrar
-                    import json as json_module
-
-                    for i, contrato in enumerate(similar_contratos[:10], 1):  # Mostrar los primeros 10
-                        with st.container():
-                            col1, col2 = st.columns([3, 1])
-
-                            with col1:
-                                titulo = contrato.get('titulo', 'Sin título')
-                                st.markdown(f"**{i}. {titulo[:80]}{'...' if len(titulo) > 80 else ''}**")
-                                st.write(f"📍 **Organismo:** {contrato.get('organismo', 'N/A')}")
-
-                                # Extraer empresa adjudicataria
-                                empresa_raw = contrato.get('empresa', '')
-                                empresa = 'N/A'
-                                if empresa_raw:
-                                    try:
-                                        if str(empresa_raw).startswith('['):
-                                            emp_array = json_module.loads(str(empresa_raw))
-                                            if emp_array and len(emp_array) > 0 and 'adjudicatario' in emp_array[0]:
-                                                empresa = emp_array[0]['adjudicatario'].get('name', 'N/A')
-                                        elif str(empresa_raw).startswith('{'):
-                                            emp_dict = json_module.loads(str(empresa_raw))
-                                            if 'adjudicatario' in emp_dict and isinstance(emp_dict['adjudicatario'], dict):
-                                                empresa = emp_dict['adjudicatario'].get('name', 'N/A')
-                                        else:
-                                            empresa = str(empresa_raw)[:60]
-                                    except:
-                                        empresa = str(empresa_raw)[:60] if empresa_raw else 'N/A'
-
-                                if empresa and empresa != 'N/A' and len(empresa) > 3:
-                                    st.write(f"🏢 **Adjudicatario:** {empresa}")
-
-                            with col2:
-                                presupuesto = contrato.get('presupuesto_licitacion', 0)
-                                adjudicacion = contrato.get('precio_adjudicacion', 0)
-                                baja = contrato.get('baja_percentage', 0)
-                                num_lic = contrato.get('num_licitadores', 0)
-
-                                st.write(f"💰 **Presupuesto:** €{presupuesto:,.2f}")
-                                st.write(f"💵 **Adjudicación:** €{adjudicacion:,.2f}")
-                                st.write(f"📉 **Baja:** {baja:.2f}%")
-                                st.write(f"👥 **Licitadores:** {num_lic}")
-
-                                fecha = contrato.get('fecha_publicacion', 'N/A')
-                                if fecha != 'N/A':
-                                    fecha_str = str(fecha)[:10] if len(str(fecha)) > 10 else str(fecha)
-                                    st.write(f"📅 {fecha_str}")
-
-                            st.divider()
-
-                    if len(similar_contratos) > 10:
-                        with st.expander(f"Ver los {len(similar_contratos) - 10} contratos restantes"):
-                            for i, contrato in enumerate(similar_contratos[10:], 11):
-                                st.write(f"**{i}. {contrato.get('titulo', 'Sin título')[:80]}**")
-                                st.write(f"   • Baja: {contrato.get('baja_percentage', 0):.1f}% | Presupuesto: €{contrato.get('presupuesto_licitacion', 0):,.2f}")
-                                st.write("---")
+                        # Botón para regenerar
+                        if st.button("🔄 Regenerar texto con diferente redacción"):
+                            nuevo_texto = generator.generate_baja_text(datos_contrato, similar_contratos, recommended_baja)
+                            st.text_area("Nuevo texto generado:", nuevo_texto, height=400)
+
+                        # Sección de descarga Excel (destacada)
+                        st.markdown("---")
+                        st.markdown("### 📥 Descargar Resultados")
+
+                        col1, col2 = st.columns([2, 1])
+
+                        with col1:
+                            # Generar Excel automáticamente para descarga
+                            with st.spinner("Preparando Excel..."):
+                                excel_buffer = generator.create_excel_download(
+                                    datos_contrato, similar_contratos, recommended_baja, texto_baja
+                                )
+
+                                # Generar nombre de archivo con fecha
+                                fecha_actual = datetime.now().strftime("%Y%m%d_%H%M%S")
+                                organismo_clean = re.sub(r'[^\w\s-]', '', datos_contrato.get('organismo', 'Analisis'))[:20]
+                                nombre_archivo = f"Analisis_Baja_{organismo_clean}_{fecha_actual}.xlsx"
+
+                                st.download_button(
+                                    label="📊 Descargar análisis completo en Excel",
+                                    data=excel_buffer.getvalue(),
+                                    file_name=nombre_archivo,
+                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                    help="Descarga un Excel con todos los datos extraídos, contratos similares y análisis completo",
+                                    key=f"download_excel_{fecha_actual}",
+                                    use_container_width=True
+                                )
+
+                        with col2:
+                            st.info(f"✅ {len(similar_contratos)} contratos incluidos")
+
+                        st.markdown("---")
+
+                        # Mostrar contratos similares de forma detallada
+                        st.markdown(f"#### 📋 Contratos Similares Encontrados ({len(similar_contratos)})")
+
+                        for i, contrato in enumerate(similar_contratos[:10], 1):  # Mostrar los primeros 10
+                            with st.container():
+                                col1, col2 = st.columns([3, 1])
+
+                                with col1:
+                                    titulo = contrato.get('titulo', 'Sin título')
+                                    st.markdown(f"**{i}. {titulo[:80]}{'...' if len(titulo) > 80 else ''}**")
+                                    st.write(f"📍 **Organismo:** {contrato.get('organismo', 'N/A')}")
+
+                                    # Empresa adjudicataria (nombre canónico)
+                                    ids = contrato.get('empresa_ids')
+                                    if ids:
+                                        empresa = get_indice_empresas().nombre(ids[0])
+                                    else:
+                                        empresa = get_indice_empresas().nombre_principal(contrato.get('empresa'))
+
+                                    if empresa and empresa != 'N/A' and len(empresa) > 3:
+                                        st.write(f"🏢 **Adjudicatario:** {empresa}")
+
+                                with col2:
+                                    presupuesto = contrato.get('presupuesto_licitacion', 0)
+                                    adjudicacion = contrato.get('precio_adjudicacion', 0)
+                                    baja = contrato.get('baja_percentage', 0)
+                                    num_lic = contrato.get('num_licitadores', 0)
+
+                                    st.write(f"💰 **Presupuesto:** €{presupuesto:,.2f}")
+                                    st.write(f"💵 **Adjudicación:** €{adjudicacion:,.2f}")
+                                    st.write(f"📉 **Baja:** {baja:.2f}%")
+                                    st.write(f"👥 **Licitadores:** {num_lic}")
+
+                                    fecha = contrato.get('fecha_publicacion', 'N/A')
+                                    if fecha != 'N/A':
+                                        fecha_str = str(fecha)[:10] if len(str(fecha)) > 10 else str(fecha)
+                                        st.write(f"📅 {fecha_str}")
+
+                                st.divider()
+
+                        if len(similar_contratos) > 10:
+                            with st.expander(f"Ver los {len(similar_contratos) - 10} contratos restantes"):
+                                for i, contrato in enumerate(similar_contratos[10:], 11):
+                                    st.write(f"**{i}. {contrato.get('titulo', 'Sin título')[:80]}**")
+                                    st.write(f"   • Baja: {contrato.get('baja_percentage', 0):.1f}% | Presupuesto: €{contrato.get('presupuesto_licitacion', 0):,.2f}")
+                                    st.write("---")
 
-                else:
-                    st.warning("⚠️ No se encontraron suficientes contratos similares en la base de datos para realizar el análisis.")
-                    st.info("Esto puede deberse a que el contrato es muy específico o los datos no coinciden con los registros de la base de datos.")
-        else:
-            if source_type == "XML (URL)" and not xml_url:
-                st.info("👆 Introduce la URL del XML del contrato para comenzar el análisis.")
-            elif source_type == "JSON (Archivo)" and not json_file:
-                st.info("👆 Sube un archivo JSON de la licitación para comenzar el análisis.")
+                    else:
+                        st.warning("⚠️ No se encontraron suficientes contratos similares en la base de datos para realizar el análisis.")
+                        st.info("Esto puede deberse a que el contrato es muy específico o los datos no coinciden con los registros de la base de datos.")
             else:
-                st.error(f"❌ No se pudo procesar el {source_name}. Verifica que los datos sean correctos y estén accesibles.")
+                if source_type == "XML (URL)" and not xml_url:
+                    st.info("👆 Introduce la URL del XML del contrato para comenzar el análisis.")
+                elif source_type == "JSON (Archivo)" and not json_file:
+                    st.info("👆 Sube un archivo JSON de la licitación para comenzar el análisis.")
+                else:
+                    st.error(f"❌ No se pudo procesar el {source_name}. Verifica que los datos sean correctos y estén accesibles.")
+        finally:
+            # También si el análisis se interrumpe (error, cancelación o rerun de Streamlit):
+            # el diagnóstico no queda activo en el contexto y se conservan las consultas medidas
+            if diagnostico:
+                finalizar_diagnostico(diagnostico)
+                st.session_state.ultimo_diagnostico = diagnostico.to_dict()
+
+    # Consultas SQL del último análisis
+    if diagnostico_activo and st.session_state.get('ultimo_diagnostico'):
+        with st.sidebar.expander("🩺 Consultas SQL del último análisis", expanded=True):
+            registros = st.session_state.ultimo_diagnostico
+            lentas = sum(1 for r in registros if r['duracion_ms'] >= umbral_lenta_ms)
+            st.caption(f"{len(registros)} consultas, {lentas} por encima de {umbral_lenta_ms} ms")
+            st.dataframe(pd.DataFrame(agregar_por_forma(registros))[
+                ['origen', 'consultas', 'total_ms', 'max_ms', 'filas_media', 'forma']], hide_index=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,857 @@
+"""
+Benchmark reproducible de las rutas principales del análisis de bajas.
+
+Genera un conjunto sintético con la forma de adjudicaciones_metabase (CPVs,
+provincias, títulos y adjudicatario JSON realistas), lo carga en SQLite local
+o en un PostgreSQL local y mide:
+
+- extraer_palabras_clave sobre N títulos
+- buscar_contratos de extremo a extremo (búsqueda normal y ampliada)
+- get_filtered_contratos_data, _simple_search y _ai_guided_search del generador
+- detección de grupos de bajas (detectar_grupo_similar / _find_similar_baja_groups)
+- exportación a Excel (crear_excel / create_excel_download)
+- parseo de los ficheros de ejemplo complete_document.xml y ejemplo.json
+- descarga de páginas de expediente contra un servidor local con latencia y
+  errores 429/503 transitorios (requests.get secuencial frente a Descargador)
+- parseo de páginas HTML de expediente (parser completo con BeautifulSoup frente
+  al parser rápido con lxml), sobre páginas sintéticas o ficheros guardados
+  con --html
+
+El resultado se escribe como JSON para poder comparar ejecuciones:
+
+    python benchmark.py --filas 100000 --salida bench_base.json
+    python benchmark.py --filas 100000 --salida bench_nuevo.json --comparar bench_base.json
+
+Con --dsn se usa PostgreSQL (las tablas se crean en el esquema bench_bajas,
+nunca en public). Sin --dsn se usa un fichero SQLite temporal; las
+construcciones específicas de PostgreSQL de las consultas (casts ::, operador
+~, EXTRACT, INITCAP) se traducen al vuelo.
+"""
+import argparse
+import functools
+import http.server
+import json
+import logging
+import os
+import platform
+import random
+import re
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+ESQUEMA_PG = "bench_bajas"
+
+# ---------------------------------------------------------------------------
+# Datos sintéticos
+# ---------------------------------------------------------------------------
+
+# CPV principal -> (CPVs secundarios, plantillas de título)
+CATALOGO_CPV = {
+    '90910000': (['90911200', '90919200'], [
+        "Servicio de limpieza de edificios municipales de {lugar}",
+        "Limpieza de colegios públicos y dependencias de {lugar}",
+        "Contrato de limpieza viaria y de instalaciones deportivas en {lugar}"]),
+    '79710000': (['79713000', '79714000'], [
+        "Servicio de vigilancia y seguridad de las instalaciones de {lugar}",
+        "Seguridad privada y control de accesos en edificios de {lugar}"]),
+    '45233000': (['45233140', '45233252'], [
+        "Obras de pavimentación y renovación de calzadas en {lugar}",
+        "Ejecución de obras de urbanización del sector industrial de {lugar}",
+        "Reasfaltado de caminos rurales del término municipal de {lugar}"]),
+    '50700000': (['50710000', '50750000'], [
+        "Mantenimiento de instalaciones de climatización de {lugar}",
+        "Mantenimiento preventivo y correctivo de ascensores en {lugar}"]),
+    '72000000': (['72260000', '72510000'], [
+        "Servicios informáticos de soporte y mantenimiento de aplicaciones de {lugar}",
+        "Suministro e implantación de una plataforma de administración electrónica en {lugar}"]),
+    '77310000': (['77311000', '77313000'], [
+        "Conservación y mantenimiento de parques y jardines de {lugar}",
+        "Servicio de jardinería y poda del arbolado urbano de {lugar}"]),
+    '90500000': (['90511000', '90512000'], [
+        "Recogida y transporte de residuos sólidos urbanos de {lugar}",
+        "Gestión de la recogida selectiva de envases en {lugar}"]),
+    '55520000': (['55523100', '55524000'], [
+        "Servicio de comedor escolar en los centros educativos de {lugar}",
+        "Catering para la residencia de mayores de {lugar}"]),
+    '34144900': (['34144910'], [
+        "Suministro de vehículos eléctricos para la policía local de {lugar}",
+        "Adquisición de vehículos de servicios municipales para {lugar}"]),
+    '71000000': (['71240000', '71250000'], [
+        "Redacción del proyecto de rehabilitación del mercado municipal de {lugar}",
+        "Dirección facultativa de las obras del centro cívico de {lugar}"]),
+}
+
+# Provincia canónica -> variantes que aparecen en los datos reales
+PROVINCIAS = {
+    'Valencia': ['Valencia', 'VALENCIA', 'València', 'Valencia/València'],
+    'Alicante': ['Alicante', 'Alacant', 'Alicante/Alacant'],
+    'Castellón': ['Castellón', 'Castelló', 'CASTELLON'],
+    'Barcelona': ['Barcelona', 'BARCELONA'],
+    'Girona': ['Girona', 'Gerona'],
+    'Madrid': ['Madrid', 'MADRID', 'Comunidad de Madrid'],
+    'Sevilla': ['Sevilla', 'SEVILLA'],
+    'Málaga': ['Málaga', 'Malaga'],
+    'Murcia': ['Murcia', 'Región de Murcia'],
+    'Vizcaya': ['Vizcaya', 'Bizkaia'],
+    'Zaragoza': ['Zaragoza'],
+    'A Coruña': ['A Coruña', 'La Coruña', 'Coruña'],
+    'Baleares': ['Illes Balears', 'Islas Baleares'],
+}
+
+MUNICIPIOS = {
+    'Valencia': ['Valencia', 'Gandia', 'Torrent', 'Sagunto'],
+    'Alicante': ['Alicante', 'Elche', 'Benidorm', 'Dénia'],
+    'Castellón': ['Castellón de la Plana', 'Vila-real', 'Vinaròs'],
+    'Barcelona': ['Barcelona', 'Sabadell', 'Terrassa', 'Mataró'],
+    'Girona': ['Girona', 'Figueres', 'Blanes'],
+    'Madrid': ['Madrid', 'Getafe', 'Alcalá de Henares', 'Móstoles'],
+    'Sevilla': ['Sevilla', 'Dos Hermanas', 'Écija'],
+    'Málaga': ['Málaga', 'Marbella', 'Ronda'],
+    'Murcia': ['Murcia', 'Cartagena', 'Lorca'],
+    'Vizcaya': ['Bilbao', 'Getxo', 'Barakaldo'],
+    'Zaragoza': ['Zaragoza', 'Calatayud'],
+    'A Coruña': ['A Coruña', 'Santiago de Compostela', 'Ferrol'],
+    'Baleares': ['Palma', 'Ibiza', 'Manacor'],
+}
+
+CATALANOHABLANTES = {'Valencia', 'Alicante', 'Castellón', 'Barcelona', 'Girona', 'Baleares'}
+
+RAICES_EMPRESA = ['Limpiezas', 'Servicios Integrales', 'Construcciones', 'Mantenimientos', 'Seguridad',
+                  'Jardines', 'Soluciones Tecnológicas', 'Ingeniería', 'Gestión Ambiental', 'Restauración']
+APELLIDOS_EMPRESA = ['del Mediterráneo', 'Levante', 'Ibérica', 'del Norte', 'Martínez', 'Hermanos García',
+                     'Sur', 'Atlántico', 'Integral', 'Castellana', 'Costa', 'Pirineo']
+SUFIJOS = ['S.L.', 'S.A.', 'S.L.U.', 'SL', 'SA', ', S.L.', ', S.A.', '']
+
+
+def _empresas(rng, total=80):
+    """Nombres base de empresa (total <= combinaciones raíz x apellido)"""
+    combinaciones = [f"{raiz} {apellido}" for raiz in RAICES_EMPRESA for apellido in APELLIDOS_EMPRESA]
+    return sorted(rng.sample(combinaciones, min(total, len(combinaciones))))
+
+
+def _adjudicatario_json(rng, nombre):
+    """Reproduce los tres formatos de adjudicatario presentes en la tabla real"""
+    if rng.random() < 0.3:
+        nombre = nombre.upper()
+    nombre = f"{nombre} {rng.choice(SUFIJOS)}".strip().replace(' ,', ',')
+    formato = rng.random()
+    if formato < 0.6:
+        return json.dumps([{"adjudicatario": {"name": nombre, "nif": f"B{rng.randint(10000000, 99999999)}"}}], ensure_ascii=False)
+    if formato < 0.85:
+        return json.dumps({"adjudicatario": {"name": nombre}}, ensure_ascii=False)
+    return json.dumps({"name": nombre}, ensure_ascii=False)
+
+
+def generar_filas(n, semilla=42):
+    """Generador de filas (tuplas) con la forma de adjudicaciones_metabase"""
+    rng = random.Random(semilla)
+    empresas = _empresas(rng)
+    cpvs = list(CATALOGO_CPV)
+    provincias = list(PROVINCIAS)
+    fecha_base = datetime(2018, 1, 1)
+    dias = (datetime(2025, 10, 1) - fecha_base).days
+
+    for i in range(1, n + 1):
+        cpv = rng.choice(cpvs)
+        secundarios, plantillas = CATALOGO_CPV[cpv]
+        provincia = rng.choice(provincias)
+        municipio = rng.choice(MUNICIPIOS[provincia])
+        titulo = rng.choice(plantillas).format(lugar=municipio)
+        if rng.random() < 0.25:
+            titulo = f"{titulo}. Lote {rng.randint(1, 6)}"
+
+        if provincia in CATALANOHABLANTES and rng.random() < 0.4:
+            organismo = f"Ajuntament de {municipio}"
+        elif rng.random() < 0.15:
+            organismo = f"Diputación Provincial de {provincia}"
+        else:
+            organismo = f"Ayuntamiento de {municipio}"
+        if rng.random() < 0.2:
+            organismo = organismo.upper()
+
+        importe_total = round(min(max(rng.lognormvariate(11.5, 1.3), 3000), 20_000_000), 2)
+        baja = min(rng.betavariate(2, 6) * 60, 69)
+        importe_adjudicacion = round(importe_total * (1 - baja / 100), 2)
+
+        lista_cpv = [cpv] + rng.sample(secundarios, rng.randint(0, len(secundarios)))
+        cpv_texto = json.dumps(lista_cpv) if len(lista_cpv) > 1 or rng.random() < 0.5 else cpv
+
+        yield (
+            i,
+            titulo,
+            organismo,
+            fecha_base + timedelta(days=rng.randrange(dias), seconds=rng.randrange(86400)),
+            importe_total,
+            rng.randint(1, 15),
+            importe_adjudicacion,
+            _adjudicatario_json(rng, rng.choice(empresas)),
+            cpv_texto,
+            rng.choice(['Servicios', 'Obras', 'Suministros']),
+            rng.choice(PROVINCIAS[provincia]),
+            f"{titulo}. Incluye las prestaciones descritas en el pliego de prescripciones técnicas.",
+        )
+
+
+COLUMNAS = ['id', 'titulo', 'entidad_compradora', 'fecha_publicacion', 'importe_total', 'numero_licitadores',
+            'importe_adjudicacion', 'adjudicatario', 'cpv', 'tipo_contrato', 'provincia', 'descripcion']
+
+DDL_SQLITE = """
+CREATE TABLE adjudicaciones_metabase (
+    id INTEGER PRIMARY KEY,
+    titulo TEXT,
+    entidad_compradora TEXT,
+    fecha_publicacion TIMESTAMP,
+    importe_total REAL,
+    numero_licitadores INTEGER,
+    importe_adjudicacion REAL,
+    adjudicatario TEXT,
+    cpv TEXT,
+    tipo_contrato TEXT,
+    provincia TEXT,
+    descripcion TEXT
+)
+"""
+
+DDL_POSTGRES = """
+CREATE TABLE adjudicaciones_metabase (
+    id BIGINT PRIMARY KEY,
+    titulo TEXT,
+    entidad_compradora TEXT,
+    fecha_publicacion TIMESTAMP,
+    importe_total DOUBLE PRECISION,
+    numero_licitadores INTEGER,
+    importe_adjudicacion DOUBLE PRECISION,
+    adjudicatario TEXT,
+    cpv TEXT,
+    tipo_contrato TEXT,
+    provincia TEXT,
+    descripcion TEXT
+)
+"""
+
+
+def _lotes(iterable, tam):
+    lote = []
+    for fila in iterable:
+        lote.append(fila)
+        if len(lote) >= tam:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+# ---------------------------------------------------------------------------
+# Backends
+# ---------------------------------------------------------------------------
+
+_CAST_PG = re.compile(r'::\w+')
+_REGEX_PG = re.compile(r'\s~\s')
+_EXTRACT_PG = re.compile(r'EXTRACT\(\s*YEAR\s+FROM\s+(\w+)\s*\)', re.IGNORECASE)
+
+
+def traducir_sql_sqlite(sql):
+    """Adaptar las construcciones de PostgreSQL usadas por la app a SQLite"""
+    sql = _CAST_PG.sub('', sql)
+    sql = _REGEX_PG.sub(' REGEXP ', sql)
+    sql = _EXTRACT_PG.sub(r"CAST(strftime('%Y', \1) AS INTEGER)", sql)
+    return sql
+
+
+class _CursorSQLite(sqlite3.Cursor):
+    def execute(self, sql, parametros=()):
+        return super().execute(traducir_sql_sqlite(sql), parametros)
+
+
+class ConexionSQLite(sqlite3.Connection):
+    """Conexión SQLite que acepta el dialecto PostgreSQL de las consultas de la app"""
+
+    def cursor(self, factory=_CursorSQLite):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=()):
+        return super().execute(traducir_sql_sqlite(sql), parametros)
+
+
+@functools.lru_cache(maxsize=256)
+def _regex(patron):
+    return re.compile(patron)
+
+
+def _regexp(patron, valor):
+    return valor is not None and _regex(patron).search(str(valor)) is not None
+
+
+def _initcap(valor):
+    return valor.title() if isinstance(valor, str) else valor
+
+
+def conectar_sqlite(ruta):
+    conn = sqlite3.connect(ruta, detect_types=sqlite3.PARSE_DECLTYPES, factory=ConexionSQLite,
+                           check_same_thread=False)
+    conn.create_function('REGEXP', 2, _regexp, deterministic=True)
+    conn.create_function('INITCAP', 1, _initcap, deterministic=True)
+    return conn
+
+
+def cargar_sqlite(ruta, filas, semilla):
+    conn = conectar_sqlite(ruta)
+    conn.execute("DROP TABLE IF EXISTS adjudicaciones_metabase")
+    conn.execute(DDL_SQLITE)
+    marcadores = ', '.join('?' * len(COLUMNAS))
+    for lote in _lotes(generar_filas(filas, semilla), 20000):
+        conn.executemany(f"INSERT INTO adjudicaciones_metabase VALUES ({marcadores})", lote)
+    conn.execute("CREATE INDEX idx_bench_fecha ON adjudicaciones_metabase (fecha_publicacion)")
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def conectar_postgres(dsn):
+    import psycopg2
+    return psycopg2.connect(dsn, options=f"-c search_path={ESQUEMA_PG}")
+
+
+def cargar_postgres(dsn, filas, semilla):
+    import psycopg2.extras
+
+    conn = conectar_postgres(dsn)
+    cur = conn.cursor()
+    cur.execute(f"CREATE SCHEMA IF NOT EXISTS {ESQUEMA_PG}")
+    cur.execute(f"DROP TABLE IF EXISTS {ESQUEMA_PG}.adjudicaciones_metabase")
+    cur.execute(DDL_POSTGRES)
+    for lote in _lotes(generar_filas(filas, semilla), 20000):
+        psycopg2.extras.execute_values(cur, "INSERT INTO adjudicaciones_metabase VALUES %s", lote)
+    cur.execute("CREATE INDEX ON adjudicaciones_metabase (fecha_publicacion DESC)")
+    cur.execute("ANALYZE adjudicaciones_metabase")
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Medición
+# ---------------------------------------------------------------------------
+
+def medir(nombre, func, repeticiones, resultados, filas=None):
+    """Ejecutar func varias veces y guardar estadísticas de tiempo (ms)"""
+    tiempos = []
+    salida = None
+    try:
+        for _ in range(repeticiones):
+            t0 = time.perf_counter()
+            salida = func()
+            tiempos.append((time.perf_counter() - t0) * 1000)
+    except Exception as e:
+        resultados[nombre] = {'error': f"{type(e).__name__}: {e}"}
+        print(f"  {nombre:<45} ERROR {type(e).__name__}: {e}")
+        return None
+
+    registro = {
+        'repeticiones': repeticiones,
+        'min_ms': round(min(tiempos), 3),
+        'mediana_ms': round(statistics.median(tiempos), 3),
+        'media_ms': round(statistics.fmean(tiempos), 3),
+        'max_ms': round(max(tiempos), 3),
+    }
+    if filas is not None:
+        try:
+            registro['filas'] = filas(salida) if callable(filas) else filas
+        except Exception:
+            pass
+    resultados[nombre] = registro
+    extra = f" ({registro['filas']} filas)" if 'filas' in registro else ''
+    print(f"  {nombre:<45} mediana {registro['mediana_ms']:>10.2f} ms{extra}")
+    return salida
+
+
+class _ServidorFicheros:
+    """Servidor HTTP local para que las funciones que descargan por URL lean los ficheros de ejemplo"""
+
+    def __init__(self, directorio):
+        manejador = functools.partial(_ManejadorSilencioso, directory=directorio)
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), manejador)
+        self.hilo = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, fichero):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/{fichero}"
+
+    def __enter__(self):
+        self.hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return False
+
+
+class _ManejadorSilencioso(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class _ManejadorExpedientes(http.server.BaseHTTPRequestHandler):
+    """Simula las páginas HTML de expedientes: latencia fija y fallos transitorios.
+
+    /expediente/<n>?r=<ronda>: los n múltiplos de 10 responden 503 la primera vez y
+    los n múltiplos de 15 responden 429 con Retry-After la primera vez.
+    """
+    latencia = 0.05
+    visitas = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            visitas = self.visitas[self.path] = self.visitas.get(self.path, 0) + 1
+        time.sleep(self.latencia)
+        n = int(re.search(r'/expediente/(\d+)', self.path).group(1))
+        if visitas == 1 and n % 15 == 0:
+            self._responder(429, b'', {'Retry-After': '0'})
+        elif visitas == 1 and n % 10 == 0:
+            self._responder(503, b'')
+        else:
+            html = f'<html><body><a href="/sindicacion/expediente_{n}.xml">XML</a></body></html>'
+            self._responder(200, html.encode(), {'Content-Type': 'text/html'})
+
+    def _responder(self, estado, cuerpo, cabeceras=None):
+        self.send_response(estado)
+        for nombre, valor in (cabeceras or {}).items():
+            self.send_header(nombre, valor)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ServidorExpedientes(_ServidorFicheros):
+    def __init__(self):
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _ManejadorExpedientes)
+        self.hilo = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+
+# ---------------------------------------------------------------------------
+# Casos de benchmark
+# ---------------------------------------------------------------------------
+
+LOTES_REFERENCIA = [
+    {'titulo': "Servicio de limpieza de edificios municipales", 'cpv': ['90910000'], 'presupuesto': 250000, 'provincia': 'Valencia'},
+    {'titulo': "Obras de pavimentación de calles", 'cpv': ['45233000'], 'presupuesto': 900000, 'provincia': 'Madrid'},
+    {'titulo': "Mantenimiento de instalaciones de climatización", 'cpv': ['50700000'], 'presupuesto': 120000, 'provincia': None},
+]
+
+
+def bench_parseo(app, generador, resultados, repeticiones):
+    print("Parseo de documentos de ejemplo")
+    import xml.etree.ElementTree as ET
+
+    ruta_xml = os.path.join(DIRECTORIO, 'complete_document.xml')
+    ruta_json = os.path.join(DIRECTORIO, 'ejemplo.json')
+    with open(ruta_xml, 'rb') as f:
+        contenido_xml = f.read()
+    with open(ruta_json, encoding='utf-8') as f:
+        contenido_json = f.read()
+
+    medir("parseo.xml.ElementTree", lambda: ET.fromstring(contenido_xml), repeticiones * 10, resultados)
+    medir("parseo.json.loads", lambda: json.loads(contenido_json), repeticiones * 10, resultados)
+    medir("parseo.extraer_datos_json_completo", lambda: app.extraer_datos_json_completo(contenido_json),
+          repeticiones, resultados, filas=lambda d: len(d['lotes']) if d else 0)
+    medir("parseo.generador.extract_json_data", lambda: generador.extract_json_data(json.loads(contenido_json)),
+          repeticiones, resultados)
+
+    with _ServidorFicheros(DIRECTORIO) as servidor:
+        url = servidor.url('complete_document.xml')
+        medir("parseo.extraer_datos_xml_completo", lambda: app.extraer_datos_xml_completo(url),
+              repeticiones, resultados, filas=lambda d: len(d['lotes']) if d else 0)
+        medir("parseo.generador.extract_xml_data", lambda: generador.extract_xml_data(url),
+              repeticiones, resultados)
+        medir("parseo.generador.extract_xml_data_debug", lambda: generador.extract_xml_data(url, debug=True),
+              repeticiones, resultados)
+
+
+def bench_descargas(resultados, repeticiones, paginas=60):
+    print(f"Descarga de {paginas} páginas de expediente (servidor local, {_ManejadorExpedientes.latencia * 1000:.0f} ms de latencia)")
+    import requests
+    from descargas import Descargador
+    from xml_scraper_generator import XMLScraperBajaGenerator
+
+    rondas = iter(range(10 ** 6))
+    with _ServidorExpedientes() as servidor:
+        def urls():
+            ronda = next(rondas)
+            return [servidor.url(f"expediente/{n}?r={ronda}") for n in range(1, paginas + 1)]
+
+        def secuencial():
+            return [requests.get(url, timeout=10) for url in urls()]
+
+        def concurrente():
+            descargador = Descargador(max_por_host=8, espera_base=0.01)
+            lista = urls()
+            # Cada URL pedida dos veces: la segunda se coalesce con la primera
+            respuestas = descargador.obtener_varios(lista + lista)
+            resultados['descargas.estadisticas'] = dict(descargador.estadisticas)
+            descargador.cerrar()
+            return respuestas
+
+        medir("descargas.requests_get_secuencial", secuencial, 1, resultados,
+              filas=lambda rs: sum(r.ok for r in rs))
+        medir("descargas.descargador_concurrente", concurrente, repeticiones, resultados,
+              filas=lambda rs: sum(not isinstance(r, Exception) and r.ok for r in rs.values()))
+        print(f"    {resultados['descargas.estadisticas']}")
+
+        # Descargador compartido de la aplicación: limitado a 5 peticiones/s por host
+        generador_xml = XMLScraperBajaGenerator()
+        medir("descargas.resolve_xml_urls_5rps", lambda: generador_xml.resolve_xml_urls(urls()), 1,
+              resultados, filas=lambda r: sum(v is not None for v in r.values()))
+
+
+def pagina_expediente_html(rng, n):
+    """Página de detalle de expediente con la estructura habitual de la Plataforma de Contratación"""
+    principal = rng.choice(list(CATALOGO_CPV))
+    secundarios, plantillas = CATALOGO_CPV[principal]
+    provincia = rng.choice(sorted(PROVINCIAS))
+    titulo = rng.choice(plantillas).format(lugar=provincia)
+    importe = f"{rng.randint(20000, 2000000):,}".replace(',', '.') + f",{rng.randint(0, 99):02d}"
+    menu = ''.join(f'<li><a href="/wps/portal/seccion{i}">Sección {i}</a></li>' for i in range(60))
+    pie = ''.join(f'<p>Aviso legal {i}: información sobre el tratamiento de datos personales.</p>' for i in range(40))
+    filas = [
+        ("Expediente", f"EXP-{n:06d}"),
+        ("Objeto del contrato", titulo),
+        ("Presupuesto base de licitación sin impuestos", f"{importe} EUR"),
+        ("Valor estimado del contrato", f"{importe} EUR"),
+        ("Lugar de ejecución", f"{provincia} - España"),
+        ("Código CPV", ' '.join([principal] + secundarios)),
+        ("Tipo de contrato", "Servicios"),
+        ("Procedimiento", "Abierto"),
+    ]
+    detalle = ''.join(f'<tr><th>{etiqueta}</th><td>{valor}</td></tr>' for etiqueta, valor in filas)
+    return (
+        '<html><head><title>Plataforma de Contratación del Sector Público</title>'
+        '<script>var config = {"idioma": "es", "seccion": 3};</script>'
+        '<style>.cabecera { color: #123; }</style></head><body>'
+        f'<div class="cabecera"><ul class="menu">{menu}</ul></div>'
+        f'<h1>Detalle de la licitación: {titulo}</h1>'
+        f'<div id="detalle"><table class="detalle-expediente">{detalle}</table></div>'
+        f'<div class="pie">{pie}</div></body></html>'
+    ).encode('utf-8')
+
+
+def bench_parseo_html(resultados, repeticiones, directorio_html=None, paginas=50, semilla=42):
+    from web_scraper_generator import parsear_expediente_completo, parsear_expediente_rapido
+
+    if directorio_html:
+        nombres = sorted(f for f in os.listdir(directorio_html) if f.lower().endswith(('.html', '.htm')))
+        documentos = []
+        for nombre in nombres:
+            with open(os.path.join(directorio_html, nombre), 'rb') as f:
+                documentos.append(f.read())
+        origen = directorio_html
+    else:
+        rng = random.Random(semilla)
+        documentos = [pagina_expediente_html(rng, n) for n in range(paginas)]
+        origen = 'páginas sintéticas'
+    if not documentos:
+        print(f"Parseo HTML: no hay ficheros .html en {directorio_html}")
+        return
+    print(f"Parseo HTML de {len(documentos)} páginas de expediente ({origen})")
+
+    por_pagina = {}
+    for modo, parser in (('completo', parsear_expediente_completo), ('rapido', parsear_expediente_rapido)):
+        salida = medir(f"parseo_html.{modo}", lambda parser=parser: [parser(d, '') for d in documentos],
+                       repeticiones, resultados, filas=len(documentos))
+        if salida is not None:
+            por_pagina[modo] = salida
+            registro = resultados[f"parseo_html.{modo}"]
+            registro['ms_por_pagina'] = round(registro['mediana_ms'] / len(documentos), 3)
+            print(f"    {registro['ms_por_pagina']:.3f} ms por página")
+
+    if len(por_pagina) == 2:
+        coincidencias = {}
+        for campo in ('objeto', 'presupuesto_base', 'localidad', 'cpv'):
+            normalizar = sorted if campo == 'cpv' else (lambda v: v)
+            coincidencias[campo] = sum(normalizar(a[campo]) == normalizar(b[campo])
+                                       for a, b in zip(por_pagina['completo'], por_pagina['rapido']))
+        resultados['parseo_html.coincidencias'] = coincidencias
+        print(f"    campos iguales en ambos parsers (de {len(documentos)}): {coincidencias}")
+
+
+def bench_palabras_clave(app, titulos, resultados, repeticiones):
+    print(f"Palabras clave sobre {len(titulos)} títulos")
+    medir("palabras_clave.extraer_palabras_clave", lambda: [app.extraer_palabras_clave(t) for t in titulos],
+          repeticiones, resultados, filas=len(titulos))
+
+
+def bench_buscar_contratos(app, resultados, repeticiones):
+    print("buscar_contratos de extremo a extremo")
+    ultimo = []
+    for i, lote in enumerate(LOTES_REFERENCIA, 1):
+        for ampliada in (False, True):
+            nombre = f"buscar_contratos.lote{i}.{'ampliada' if ampliada else 'normal'}"
+            salida = medir(nombre, lambda: app.buscar_contratos(
+                lote['cpv'], lote['presupuesto'] * 0.5, lote['presupuesto'] * 1.5,
+                titulo_referencia=lote['titulo'], limit=10, ampliada=ampliada,
+                provincia_origen=lote['provincia']), repeticiones, resultados, filas=len)
+            if salida:
+                ultimo = salida
+        # Candidatos por similitud de título (pg_trgm en PostgreSQL, similitud local en SQLite)
+        medir(f"buscar_contratos.lote{i}.trigramas", lambda: app.buscar_contratos(
+            lote['cpv'], lote['presupuesto'] * 0.5, lote['presupuesto'] * 1.5,
+            titulo_referencia=lote['titulo'], limit=10, provincia_origen=lote['provincia'],
+            modo_busqueda='trigramas'), repeticiones, resultados, filas=len)
+        # Candidatos por relevancia de palabras clave en título y descripción (tsvector o puntuación local)
+        medir(f"buscar_contratos.lote{i}.texto_completo", lambda: app.buscar_contratos(
+            lote['cpv'], lote['presupuesto'] * 0.5, lote['presupuesto'] * 1.5,
+            titulo_referencia=lote['titulo'], limit=10, provincia_origen=lote['provincia'],
+            modo_busqueda='texto_completo'), repeticiones, resultados, filas=len)
+    # Con presupuesto de tiempo del lote (hilo de vigilancia y statement_timeout por consulta)
+    from cancelacion import TokenCancelacion, sonda_streamlit_compatible
+    import streamlit
+    # Sin la sonda solo cancela la marca pública de nueva_ejecucion() (no el botón Stop)
+    resultados['cancelacion.sonda_streamlit'] = {'version': streamlit.__version__,
+                                                 'compatible': sonda_streamlit_compatible()}
+    print(f"    sonda de ejecución sustituida con Streamlit {streamlit.__version__}: "
+          f"{'compatible' if sonda_streamlit_compatible() else 'NO compatible'}")
+    lote = LOTES_REFERENCIA[0]
+    medir("buscar_contratos.lote1.con_presupuesto", lambda: app.buscar_contratos(
+        lote['cpv'], lote['presupuesto'] * 0.5, lote['presupuesto'] * 1.5,
+        titulo_referencia=lote['titulo'], limit=10, provincia_origen=lote['provincia'],
+        token=TokenCancelacion()), repeticiones, resultados, filas=len)
+    medir("buscar_contratos.palabras_manuales", lambda: app.buscar_contratos(
+        ['90910000'], 125000, 375000, titulo_referencia="limpieza", limit=10,
+        provincia_origen='Valencia', palabras_clave_manual="limpieza, colegios"),
+        repeticiones, resultados, filas=len)
+    return ultimo
+
+
+def bench_generador(generador, resultados, repeticiones, filas_df):
+    print(f"BajaEstadisticaGenerator sobre {filas_df} contratos")
+    medir("generador.get_filtered_contratos_data", lambda: generador.get_filtered_contratos_data(
+        cpv_category='9091', provincia='valencia', presupuesto=250000, limit=500),
+        repeticiones, resultados, filas=len)
+    medir("generador.get_filtered_contratos_data.palabras", lambda: generador.get_filtered_contratos_data(
+        cpv_category='9091', provincia='valencia', presupuesto=250000, limit=50,
+        palabras=['limpieza', 'colegios']), repeticiones, resultados, filas=len)
+    # Sobrecoste del diagnóstico SQL (medición y forma de consulta, sin consultas lentas ni EXPLAIN)
+    from diagnostico_sql import iniciar_diagnostico, finalizar_diagnostico
+
+    def filtrado_con_diagnostico():
+        diagnostico = iniciar_diagnostico(umbral_ms=float('inf'))
+        try:
+            return generador.get_filtered_contratos_data(
+                cpv_category='9091', provincia='valencia', presupuesto=250000, limit=500)
+        finally:
+            finalizar_diagnostico(diagnostico)
+
+    medir("generador.get_filtered_contratos_data.diagnostico", filtrado_con_diagnostico,
+          repeticiones, resultados, filas=len)
+    contratos_df = medir("generador.get_contratos_data", lambda: generador.get_contratos_data(limit=filas_df),
+                         repeticiones, resultados, filas=len)
+    if contratos_df is None or contratos_df.empty:
+        return []
+
+    # Sin presupuesto objetivo para que el scoring recorra todo el DataFrame
+    # (el filtro por rango se ejerce en get_filtered_contratos_data)
+    xml_data = {
+        'titulo': "Servicio de limpieza de edificios municipales",
+        'objeto': "Limpieza de colegios y dependencias municipales",
+        'presupuesto': 0,
+        'ubicacion': 'Valencia',
+        'cpv': '90910000',
+    }
+    similares = medir("generador._simple_search", lambda: generador._simple_search(
+        xml_data, contratos_df, '9091', ['limpieza', 'edificios'], 2020, 2.0, True, 30),
+        repeticiones, resultados, filas=len)
+    medir("generador._ai_guided_search", lambda: generador._ai_guided_search(
+        xml_data, contratos_df, 2020, 2.0, 20), repeticiones, resultados, filas=len)
+    # Grafía distinta de la de los datos (Ajuntament/Ayuntamiento): se resuelve con el índice de organismos.
+    # En la app se carga en segundo plano; aquí se carga antes de medir
+    from organismos import get_indice_organismos
+    get_indice_organismos().refrescar(generador.connection)
+    medir("generador.search_previous_licitacion_same_org", lambda: generador.search_previous_licitacion_same_org(
+        'Ajuntament de València', '90910000', 250000), repeticiones, resultados,
+        filas=lambda r: 0 if r is None else 1)
+    return similares or []
+
+
+def bench_empresas(generador, resultados, repeticiones, n=5000, semilla=42):
+    """Estadísticas de empresas sobre n adjudicatarios con variantes de forma jurídica y mayúsculas"""
+    from empresas import IndiceEmpresas, nombres_adjudicatario
+
+    print(f"Estadísticas de empresas sobre {n} contratos")
+    contratos = [{'empresa': fila[7], 'baja_percentage': 15.0} for fila in generar_filas(n, semilla)]
+    medir("empresas.get_empresa_stats", lambda: generador.get_empresa_stats(contratos),
+          repeticiones, resultados, filas=n)
+    indice = IndiceEmpresas()
+    medir("empresas.indice_en_frio", lambda: IndiceEmpresas().contar(contratos), repeticiones, resultados, filas=n)
+    indice.anotar(contratos)
+    medir("empresas.contar_ids", lambda: indice.contar(contratos), repeticiones * 5, resultados, filas=n)
+    nombres = {nombre for c in contratos for nombre in nombres_adjudicatario(c['empresa'])}
+    resultados['empresas.canonicas'] = {'nombres_distintos': len(nombres), 'empresas': len(indice)}
+    print(f"    {resultados['empresas.canonicas']}")
+
+    from perfiles_empresas import AlmacenPerfiles
+    almacen = medir("empresas.perfiles_refresco_completo",
+                    lambda: _almacen_refrescado(AlmacenPerfiles(), generador.connection), 1, resultados,
+                    filas=lambda a: a.estadisticas['filas'])
+    if almacen is not None:
+        medir("empresas.perfiles_refresco_incremental", lambda: almacen.refrescar(generador.connection),
+              repeticiones, resultados)
+        claves = [indice.clave(id_) for id_ in range(len(indice))]
+        medir("empresas.perfiles_consulta", lambda: [almacen.perfil(clave) for clave in claves],
+              repeticiones, resultados, filas=len(claves))
+
+
+def _almacen_refrescado(almacen, conn):
+    almacen.refrescar(conn)
+    return almacen
+
+
+def bench_grupos(app, generador, resultados, repeticiones):
+    print("Detección de grupos de bajas")
+    rng = random.Random(7)
+    for n in (10, 100, 1000):
+        bajas = [round(rng.betavariate(2, 6) * 60, 2) for _ in range(n)]
+        medir(f"grupos.detectar_grupo_similar.n{n}", lambda: app.detectar_grupo_similar(bajas),
+              repeticiones * 5, resultados, filas=n)
+        medir(f"grupos.recomendacion_baja.n{n}", lambda: app.recomendacion_baja(bajas, 3.5, 1.5),
+              repeticiones * 5, resultados, filas=n)
+        medir(f"grupos._find_similar_baja_groups.n{n}", lambda: generador._find_similar_baja_groups(bajas),
+              repeticiones * 5, resultados, filas=n)
+
+    # Pares justo a la distancia de la tolerancia, como Decimal (así llegan de PostgreSQL)
+    pares = [(Decimal(i) / 100, Decimal(i) / 100 + app.TOLERANCIA_GRUPO) for i in range(1, 5001)]
+    agrupados = sum(len(app.detectar_grupo_similar(list(par))) == 2 for par in pares)
+    resultados['grupos.pares_en_tolerancia'] = {'agrupados': agrupados, 'pares': len(pares)}
+    print(f"    pares a {app.TOLERANCIA_GRUPO}% exacto agrupados: {agrupados} de {len(pares)}")
+
+
+def bench_excel(app, generador, contratos, similares, resultados, repeticiones):
+    print("Exportación a Excel")
+    lote = {'numero': 1, 'titulo': LOTES_REFERENCIA[0]['titulo'], 'presupuesto': 250000,
+            'cpv': ['90910000'], 'criterios': []}
+    if contratos:
+        medir("excel.crear_excel", lambda: app.crear_excel(lote, contratos, 18.5), repeticiones, resultados,
+              filas=len(contratos))
+    xml_data = {'titulo': lote['titulo'], 'objeto': lote['titulo'], 'presupuesto': 250000,
+                'ubicacion': 'Valencia', 'cpv': '90910000', 'organismo': 'Ayuntamiento de Valencia'}
+    medir("excel.create_excel_download", lambda: generador.create_excel_download(
+        xml_data, similares[:50], 18.5, "Texto de prueba"), repeticiones, resultados, filas=len(similares[:50]))
+
+
+# ---------------------------------------------------------------------------
+# Informe
+# ---------------------------------------------------------------------------
+
+def _commit_actual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=DIRECTORIO,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def comparar(actual, ruta_base):
+    with open(ruta_base, encoding='utf-8') as f:
+        base = json.load(f)
+    print(f"\nComparación con {ruta_base} (mediana, ms)")
+    for nombre, datos in actual['resultados'].items():
+        anterior = base.get('resultados', {}).get(nombre)
+        if not anterior or 'mediana_ms' not in anterior or 'mediana_ms' not in datos:
+            continue
+        ratio = datos['mediana_ms'] / anterior['mediana_ms'] if anterior['mediana_ms'] else float('inf')
+        print(f"  {nombre:<45} {anterior['mediana_ms']:>10.2f} -> {datos['mediana_ms']:>10.2f}  x{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de las rutas principales del análisis de bajas")
+    parser.add_argument('--filas', type=int, default=10000, help="Filas sintéticas (10k - 5M)")
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--dsn', default=None, help="DSN de un PostgreSQL local; sin él se usa SQLite")
+    parser.add_argument('--sqlite', default=None, help="Ruta del fichero SQLite (por defecto, temporal)")
+    parser.add_argument('--reutilizar', action='store_true', help="No regenerar los datos si ya existen")
+    parser.add_argument('--titulos', type=int, default=5000, help="Títulos para extraer_palabras_clave")
+    parser.add_argument('--filas-generador', type=int, default=2000,
+                        help="Tamaño del DataFrame usado por _simple_search/_ai_guided_search")
+    parser.add_argument('--html', default=None,
+                        help="Directorio con páginas HTML de expediente guardadas (por defecto, sintéticas)")
+    parser.add_argument('--salida', default='bench_report.json')
+    parser.add_argument('--comparar', default=None, help="Informe JSON anterior con el que comparar")
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+    sys.path.insert(0, DIRECTORIO)
+
+    resultados = {}
+    backend = 'postgres' if args.dsn else 'sqlite'
+    ruta_sqlite = args.sqlite or os.path.join(tempfile.gettempdir(), f"bench_bajas_{args.filas}_{args.semilla}.sqlite")
+
+    print(f"Generando {args.filas} filas en {backend}...")
+    t0 = time.perf_counter()
+    if backend == 'sqlite':
+        if not (args.reutilizar and os.path.exists(ruta_sqlite)):
+            cargar_sqlite(ruta_sqlite, args.filas, args.semilla)
+        nueva_conexion = lambda: conectar_sqlite(ruta_sqlite)
+    else:
+        if not args.reutilizar:
+            cargar_postgres(args.dsn, args.filas, args.semilla)
+        nueva_conexion = lambda: conectar_postgres(args.dsn)
+    resultados['carga_datos'] = {'segundos': round(time.perf_counter() - t0, 3), 'filas': args.filas}
+
+    import analisis_mejorado_FINAL as app
+    from baja_estadistica_generator import BajaEstadisticaGenerator
+
+    for nombre_logger in list(logging.root.manager.loggerDict):
+        if nombre_logger.startswith('streamlit'):
+            logging.getLogger(nombre_logger).setLevel(logging.CRITICAL)
+
+    app.get_connection = nueva_conexion
+    generador = BajaEstadisticaGenerator()
+    generador.connection = nueva_conexion()
+
+    titulos = [fila[1] for fila in generar_filas(min(args.titulos, args.filas), args.semilla + 1)]
+
+    bench_parseo(app, generador, resultados, args.repeticiones)
+    bench_descargas(resultados, args.repeticiones)
+    bench_parseo_html(resultados, args.repeticiones, args.html, semilla=args.semilla)
+    bench_palabras_clave(app, titulos, resultados, args.repeticiones)
+    contratos = bench_buscar_contratos(app, resultados, args.repeticiones)
+    similares = bench_generador(generador, resultados, args.repeticiones, min(args.filas_generador, args.filas))
+    bench_empresas(generador, resultados, args.repeticiones, semilla=args.semilla)
+    bench_grupos(app, generador, resultados, args.repeticiones)
+    bench_excel(app, generador, contratos, similares, resultados, args.repeticiones)
+
+    informe = {
+        'meta': {
+            'fecha': datetime.now().isoformat(timespec='seconds'),
+            'commit': _commit_actual(),
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'backend': backend,
+            'filas': args.filas,
+            'semilla': args.semilla,
+            'repeticiones': args.repeticiones,
+        },
+        'resultados': resultados,
+    }
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(informe, f, ensure_ascii=False, indent=2)
+    print(f"\nInforme guardado en {args.salida}")
+
+    if args.comparar:
+        comparar(informe, args.comparar)
+
+
+if __name__ == "__main__":
+    main()
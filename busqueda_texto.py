@@ -0,0 +1,315 @@
+"""
+Búsqueda por texto de títulos y descripciones dentro de PostgreSQL.
+
+buscar_contratos traía los 300 contratos más recientes del CPV y presupuesto
+(LIMIT 300 ordenado por fecha) y filtraba los títulos por palabras en común en
+Python, y get_filtered_contratos_data no miraba el texto en absoluto: un
+contrato muy parecido pero más antiguo que la ventana no llegaba nunca. Aquí
+la base de datos ordena los candidatos por relevancia de texto y solo envía
+los N mejores. Dos búsquedas:
+
+- BusquedaTrigramas (pg_trgm): similitud de trigramas del título con una
+  referencia. titulo_normalizado es una columna generada (minúsculas y sin
+  acentos con translate(), que es IMMUTABLE) con índice GIN gin_trgm_ops:
+
+      titulo_normalizado % 'referencia'
+      ORDER BY similarity(titulo_normalizado, 'referencia') DESC LIMIT N
+
+- BusquedaTextoCompleto (tsvector): palabras clave sobre titulo y descripcion.
+  documento_busqueda es un tsvector generado con la configuración 'spanish'
+  (raíces y palabras vacías) y también 'simple' (sin raíces, para títulos en
+  catalán, gallego o euskera), con el título con más peso que la descripción:
+
+      documento_busqueda @@ consulta
+      ORDER BY ts_rank_cd(documento_busqueda, consulta) DESC LIMIT N
+
+Las columnas, índices y extensiones se crean fuera de la app con
+migraciones.py (la columna generada reescribe la tabla y el índice se crea
+con CREATE INDEX CONCURRENTLY). disponible() solo comprueba en el catálogo que
+existen y que el índice es válido, y se memoiza por servidor y tabla durante
+INTERVALO_COMPROBACION segundos. Mientras no existan (o en conexiones sin
+ellos: la copia SQLite del benchmark, una instantánea local) cada búsqueda
+calcula en Python una puntuación equivalente (puntuar()) y top_n() se queda
+con los N mejores según se leen los candidatos.
+"""
+import heapq
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from lectura_sql import estado_indice, es_postgres
+
+TABLA_POR_DEFECTO = 'adjudicaciones_metabase'
+# Candidatos que devuelve la base de datos, ordenados por relevancia
+CANDIDATOS = 200
+CANDIDATOS_TRIGRAMAS = CANDIDATOS
+# Umbral de similarity() para el operador % (pg_trgm.similarity_threshold)
+UMBRAL_TRIGRAMAS = 0.2
+# Segundos durante los que se reutiliza la comprobación de columnas e índices
+INTERVALO_COMPROBACION = 600
+
+ACENTOS = 'áàäâéèëêíìïîóòöôúùüûñç'
+SIN_ACENTOS = 'aaaaeeeeiiiioooouuuunc'
+_TRADUCCION = str.maketrans(ACENTOS, SIN_ACENTOS)
+
+# La misma normalización en SQL (translate es IMMUTABLE y vale para una columna generada)
+EXPRESION_NORMALIZADA = f"translate(lower(titulo), '{ACENTOS}', '{SIN_ACENTOS}')"
+
+INDICE_TRIGRAMAS = 'idx_adjudicaciones_titulo_trgm'
+# Se aplican con migraciones.py, nunca desde la app
+DDL_TRIGRAMAS = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS titulo_normalizado text "
+    f"GENERATED ALWAYS AS ({EXPRESION_NORMALIZADA}) STORED",
+    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {INDICE_TRIGRAMAS} "
+    "ON {tabla} USING gin (titulo_normalizado gin_trgm_ops)",
+]
+
+INDICE_TEXTO_COMPLETO = 'idx_adjudicaciones_documento_busqueda'
+# Pesos A-D: título y descripción con raíces en español, y sin raíces ('simple').
+# Se aplican con migraciones.py, nunca desde la app
+DDL_TEXTO_COMPLETO = [
+    "ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS documento_busqueda tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('spanish', coalesce(titulo, '')), 'A') || "
+    "setweight(to_tsvector('spanish', coalesce(descripcion, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(titulo, '')), 'C') || "
+    "setweight(to_tsvector('simple', coalesce(descripcion, '')), 'D')) STORED",
+    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {INDICE_TEXTO_COMPLETO} "
+    "ON {tabla} USING gin (documento_busqueda)",
+]
+# Pesos por defecto de ts_rank_cd para {D, C, B, A}
+PESOS_RANGO = {'A': 1.0, 'B': 0.4, 'C': 0.2, 'D': 0.1}
+
+PALABRA = re.compile(r'[0-9a-z]+')
+PALABRA_CONSULTA = re.compile(r'[0-9a-záàäâéèëêíìïîóòöôúùüûñç]+')
+
+# Palabras vacías de la configuración 'spanish' más frecuentes en títulos de contratos
+PALABRAS_VACIAS = {
+    'de', 'del', 'la', 'el', 'los', 'las', 'y', 'e', 'o', 'u', 'a', 'en', 'para', 'con', 'por', 'al',
+    'un', 'una', 'unos', 'unas', 'su', 'sus', 'se', 'que', 'lo', 'le', 'les', 'sin', 'sobre', 'entre',
+    'como', 'mas', 'pero', 'ni', 'ya', 'este', 'esta', 'estos', 'estas',
+}
+SUFIJOS_ES = ('aciones', 'amientos', 'imientos', 'amiento', 'imiento', 'acion', 'adores', 'adoras',
+              'ador', 'adora', 'idades', 'idad', 'mente', 'ales', 'es', 'os', 'as', 's', 'o', 'a', 'e')
+
+
+def normalizar_titulo(texto):
+    """Equivalente en Python de EXPRESION_NORMALIZADA"""
+    return texto.lower().translate(_TRADUCCION) if texto else ''
+
+
+_lock = threading.Lock()
+_disponibles = {}
+
+
+def _comprobar(conn, tabla, columna, indice, extension=None):
+    """Si existen la columna, su índice (válido) y la extensión; solo lee el catálogo"""
+    cursor = conn.cursor()
+    try:
+        comprobacion = ("SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+                        f"WHERE table_name = '{tabla}' AND column_name = '{columna}')")
+        if extension:
+            comprobacion += f" AND EXISTS (SELECT 1 FROM pg_extension WHERE extname = '{extension}')"
+        cursor.execute(comprobacion)
+        return bool(cursor.fetchone()[0]) and estado_indice(conn, indice) == 'valido'
+    except Exception:
+        conn.rollback()
+        return False
+    finally:
+        cursor.close()
+
+
+def top_n(elementos, puntuar, n=CANDIDATOS, umbral=0.0):
+    """Los n elementos con mayor puntuación (> 0 y >= umbral), de mayor a menor.
+
+    Devuelve [(puntuación, elemento)]; recorre elementos una sola vez con un heap
+    de tamaño n. A igual puntuación se mantiene el orden de llegada.
+    """
+    heap = []
+    for orden, elemento in enumerate(elementos):
+        valor = puntuar(elemento)
+        if valor <= 0 or valor < umbral:
+            continue
+        entrada = (valor, -orden, elemento)
+        if len(heap) < n:
+            heapq.heappush(heap, entrada)
+        elif entrada[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entrada)
+    return [(valor, elemento) for valor, _, elemento in sorted(heap, key=lambda e: e[:2], reverse=True)]
+
+
+class Busqueda(ABC):
+    """Búsqueda ordenada por relevancia de texto, en el servidor o en local"""
+
+    nombre = None
+    columna = None
+    indice = None
+    extension = None
+    umbral_local = 0.0
+
+    def disponible(self, conn, tabla=TABLA_POR_DEFECTO):
+        """Si la búsqueda puede hacerse en la base de datos (memoizado por servidor, tabla y tipo).
+
+        No crea nada: la columna y el índice los crea migraciones.py. Mientras
+        falten se usa la puntuación local.
+        """
+        if not es_postgres(conn):
+            return False
+        clave = (conn.dsn, tabla, self.nombre)
+        with _lock:
+            if clave in _disponibles and time.monotonic() - _disponibles[clave][1] < INTERVALO_COMPROBACION:
+                return _disponibles[clave][0]
+        disponible = _comprobar(conn, tabla, self.columna, self.indice, self.extension)
+        with _lock:
+            _disponibles[clave] = (disponible, time.monotonic())
+        return disponible
+
+    def sentencias_previas(self):
+        return []
+
+    @abstractmethod
+    def expresion_rango(self):
+        """Expresión SQL de la relevancia (mayor es mejor)"""
+
+    @abstractmethod
+    def condicion(self):
+        """Condición SQL que usa el índice para filtrar los candidatos"""
+
+    @abstractmethod
+    def puntuar(self, titulo, descripcion=''):
+        """Relevancia calculada en Python, equivalente a expresion_rango()"""
+
+    def preparar_sesion(self, conn):
+        """Ejecutar las sentencias previas (SET ...) en la sesión"""
+        sentencias = self.sentencias_previas()
+        if sentencias:
+            cursor = conn.cursor()
+            try:
+                for sentencia in sentencias:
+                    cursor.execute(sentencia)
+            finally:
+                cursor.close()
+
+    def mejores(self, elementos, n=CANDIDATOS, texto=lambda e: (e['titulo'], e.get('descripcion', ''))):
+        """Equivalente local de la consulta: [(puntuación, elemento)] de los n mejores"""
+        return top_n(elementos, lambda e: self.puntuar(*texto(e)), n, self.umbral_local)
+
+
+# --- Trigramas (pg_trgm) -------------------------------------------------------
+
+def trigramas(texto):
+    """Conjunto de trigramas como pg_trgm: cada palabra con dos espacios delante y uno detrás"""
+    resultado = set()
+    for palabra in PALABRA.findall(normalizar_titulo(texto)):
+        relleno = f"  {palabra} "
+        resultado.update(relleno[i:i + 3] for i in range(len(relleno) - 2))
+    return resultado
+
+
+def similitud(a, b):
+    """similarity() de pg_trgm: trigramas comunes / trigramas totales"""
+    ta = a if isinstance(a, set) else trigramas(a)
+    tb = b if isinstance(b, set) else trigramas(b)
+    if not ta or not tb:
+        return 0.0
+    comunes = len(ta & tb)
+    return comunes / (len(ta) + len(tb) - comunes)
+
+
+class BusquedaTrigramas(Busqueda):
+    """Similitud de trigramas del título con un texto de referencia"""
+
+    nombre = 'trigramas'
+    columna = 'titulo_normalizado'
+    indice = INDICE_TRIGRAMAS
+    extension = 'pg_trgm'
+
+    def __init__(self, referencia, umbral=UMBRAL_TRIGRAMAS):
+        self.referencia = referencia
+        self.umbral = self.umbral_local = umbral
+        self._trigramas = trigramas(referencia)
+        self._literal = normalizar_titulo(referencia).replace("'", "''")
+
+    def sentencias_previas(self):
+        return [f"SET pg_trgm.similarity_threshold = {float(self.umbral)}"]
+
+    def expresion_rango(self):
+        return f"similarity(titulo_normalizado, '{self._literal}')"
+
+    def condicion(self):
+        return f"titulo_normalizado % '{self._literal}'"
+
+    def puntuar(self, titulo, descripcion=''):
+        return similitud(self._trigramas, trigramas(titulo or ''))
+
+
+def top_por_similitud(elementos, referencia, n=CANDIDATOS_TRIGRAMAS, umbral=UMBRAL_TRIGRAMAS,
+                      texto=lambda elemento: elemento['titulo']):
+    """Los n elementos más parecidos a referencia (similitud >= umbral), de mayor a menor"""
+    busqueda = BusquedaTrigramas(referencia, umbral)
+    return busqueda.mejores(elementos, n, texto=lambda e: (texto(e), ''))
+
+
+# --- Texto completo (tsvector) -------------------------------------------------
+
+def raiz(palabra):
+    """Raíz aproximada en español (sin acentos): aproxima el stemmer de la configuración 'spanish'"""
+    palabra = normalizar_titulo(palabra)
+    for sufijo in SUFIJOS_ES:
+        if len(palabra) - len(sufijo) >= 4 and palabra.endswith(sufijo):
+            return palabra[:-len(sufijo)]
+    return palabra
+
+
+def _terminos(palabras):
+    """Palabras clave (pueden ser de varias palabras) -> lista de grupos de palabras"""
+    grupos = []
+    for palabra in palabras:
+        grupo = [p for p in PALABRA_CONSULTA.findall(str(palabra).lower()) if len(p) > 1 and p not in PALABRAS_VACIAS]
+        if grupo and grupo not in grupos:
+            grupos.append(grupo)
+    return grupos
+
+
+class BusquedaTextoCompleto(Busqueda):
+    """Palabras clave sobre título y descripción con ts_rank_cd (spanish + simple)"""
+
+    nombre = 'texto_completo'
+    columna = 'documento_busqueda'
+    indice = INDICE_TEXTO_COMPLETO
+
+    def __init__(self, palabras):
+        self.grupos = _terminos(palabras)
+        self._raices = [[raiz(p) for p in grupo] for grupo in self.grupos]
+        # Cada palabra clave es un grupo (AND de sus palabras); los grupos se combinan con OR
+        texto = ' | '.join('(' + ' & '.join(grupo) + ')' for grupo in self.grupos)
+        self._literal = texto.replace("'", "''")
+
+    def __bool__(self):
+        return bool(self.grupos)
+
+    def consulta(self):
+        return f"(to_tsquery('spanish', '{self._literal}') || to_tsquery('simple', '{self._literal}'))"
+
+    def expresion_rango(self):
+        return f"ts_rank_cd(documento_busqueda, {self.consulta()})"
+
+    def condicion(self):
+        return f"documento_busqueda @@ {self.consulta()}"
+
+    def puntuar(self, titulo, descripcion=''):
+        """Suma de pesos de las apariciones de cada grupo presente (como ts_rank_cd con coberturas de un término)"""
+        campos = [
+            ('A', [raiz(p) for p in PALABRA_CONSULTA.findall((titulo or '').lower())]),
+            ('B', [raiz(p) for p in PALABRA_CONSULTA.findall((descripcion or '').lower())]),
+        ]
+        rango = 0.0
+        for raices in self._raices:
+            for peso, tokens in campos:
+                if all(r in tokens for r in raices):
+                    rango += PESOS_RANGO[peso] * min(tokens.count(r) for r in raices)
+        return rango
+
+
+BUSQUEDAS = {'trigramas': BusquedaTrigramas, 'texto_completo': BusquedaTextoCompleto}
@@ -0,0 +1,220 @@
+"""
+Límites de tiempo y cancelación de las consultas de búsqueda.
+
+Si el usuario cambia un widget a mitad de análisis, Streamlit pide una nueva
+ejecución pero la consulta en curso de buscar_contratos sigue corriendo en el
+servidor (el hilo del script está bloqueado dentro de psycopg2 y no llega a un
+punto de interrupción hasta que termina), de modo que las consultas
+abandonadas se acumulan en el PostgreSQL compartido.
+
+- statement_timeout: cada conexión de la app se abre con STATEMENT_TIMEOUT_MS
+  y vigilar() lo reduce al tiempo que le queda al lote antes de cada consulta.
+- TokenCancelacion: se crea por lote con un presupuesto de tiempo. Mientras
+  dura una consulta, vigilar() arranca un hilo que comprueba cada
+  INTERVALO_VIGILANCIA segundos si el presupuesto se ha agotado o si la
+  ejecución de Streamlit ha sido sustituida por otra, y en ese caso cancela la
+  consulta en el servidor (conn.cancel(), el equivalente de pg_cancel_backend
+  para la propia sesión; conn.interrupt() en SQLite).
+- Ejecución sustituida: la app llama a nueva_ejecucion() al principio de cada
+  ejecución completa del script (las de un fragmento no pasan por ahí). Con
+  runner.fastReruns (activado por defecto) la nueva ejecución empieza sin
+  esperar a la anterior, así que la marca de parada que deja en session_state
+  llega a la ejecución bloqueada en la consulta. La petición de parada del
+  botón Stop de Streamlit no tiene señal pública: se consulta además el estado
+  interno de ScriptRequests, solo si sonda_streamlit_compatible() ha
+  comprobado que se comporta como se espera en la versión instalada.
+- La consulta cancelada termina con ConsultaCancelada; quien la lanzó se
+  queda con los mejores resultados leídos hasta ese momento.
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from lectura_sql import es_postgres
+
+# Límite de cualquier consulta de la app en el servidor
+STATEMENT_TIMEOUT_MS = 30000
+# Presupuesto de tiempo de las búsquedas de un lote
+PRESUPUESTO_LOTE_S = 20
+# Segundos entre comprobaciones del hilo de vigilancia
+INTERVALO_VIGILANCIA = 0.2
+
+
+class ConsultaCancelada(Exception):
+    """La consulta se canceló por presupuesto agotado o ejecución sustituida"""
+
+    def __init__(self, motivo):
+        super().__init__(motivo)
+        self.motivo = motivo
+
+
+def opciones_conexion(statement_timeout_ms=STATEMENT_TIMEOUT_MS):
+    """Valor de options para psycopg2.connect con el statement_timeout por defecto"""
+    return f"-c statement_timeout={int(statement_timeout_ms)}"
+
+
+def nueva_ejecucion():
+    """Marcar el principio de una ejecución completa del script en la sesión.
+
+    Activa la marca de parada de la ejecución anterior (si sigue en marcha,
+    sus consultas se cancelan) y deja una nueva en session_state.
+    """
+    import streamlit as st
+    anterior = st.session_state.get('parada_ejecucion')
+    if anterior is not None:
+        anterior.set()
+    st.session_state.parada_ejecucion = threading.Event()
+
+
+def _peticion_interrumpe(peticiones):
+    """Si el ScriptRequests tiene pendiente una parada o una nueva ejecución que interrumpe el script"""
+    estado = getattr(getattr(peticiones, '_state', None), 'name', None)
+    if estado == 'STOP':
+        return True
+    if estado in ('RERUN', 'RERUN_REQUESTED'):
+        # Las ejecuciones de un fragmento (salvo st.rerun(scope="fragment")) no interrumpen el script
+        datos = getattr(peticiones, '_rerun_data', None)
+        return not (getattr(datos, 'fragment_id_queue', None)
+                    and not getattr(datos, 'is_fragment_scoped_rerun', False))
+    return False
+
+
+@functools.lru_cache(maxsize=None)
+def sonda_streamlit_compatible():
+    """Comprobar con ScriptRequests nuevos que su estado interno se lee como se espera"""
+    try:
+        from streamlit.runtime.scriptrunner_utils.script_requests import ScriptRequests, RerunData
+        sin_peticion, completa, fragmento, parada = (ScriptRequests() for _ in range(4))
+        completa.request_rerun(RerunData())
+        fragmento.request_rerun(RerunData(fragment_id='fragmento'))
+        parada.request_stop()
+        return (not _peticion_interrumpe(sin_peticion) and _peticion_interrumpe(completa)
+                and not _peticion_interrumpe(fragmento) and _peticion_interrumpe(parada))
+    except Exception:
+        return False
+
+
+def ejecucion_sustituida_streamlit():
+    """Función que dice si la ejecución actual de Streamlit ha sido sustituida o parada.
+
+    Hay que llamarla desde el hilo del script: la comprobación se hace después
+    desde el hilo de vigilancia, que no tiene contexto de Streamlit. Fuera de
+    Streamlit la función devuelta siempre responde False.
+    """
+    try:
+        import streamlit as st
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        contexto = get_script_run_ctx()
+        parada = st.session_state.get('parada_ejecucion') if contexto is not None else None
+    except Exception:
+        return lambda: False
+    peticiones = getattr(contexto, 'script_requests', None) if sonda_streamlit_compatible() else None
+
+    def sustituida():
+        if parada is not None and parada.is_set():
+            return True
+        return peticiones is not None and _peticion_interrumpe(peticiones)
+    return sustituida
+
+
+class TokenCancelacion:
+    """Presupuesto de tiempo y cancelación compartidos por las consultas de un lote"""
+
+    def __init__(self, presupuesto_s=PRESUPUESTO_LOTE_S, sustituida=None):
+        self.presupuesto_s = presupuesto_s
+        self.limite = time.monotonic() + presupuesto_s if presupuesto_s else None
+        self.sustituida = sustituida or (lambda: False)
+        self.motivo = None
+        self.canceladas = 0
+
+    def restante(self):
+        """Segundos que quedan del presupuesto (None si no hay límite)"""
+        if self.limite is None:
+            return None
+        return max(0.0, self.limite - time.monotonic())
+
+    def cancelado(self):
+        """Comprobar (y recordar) si hay que dejar de consultar"""
+        if self.motivo is None:
+            if self.sustituida():
+                self.motivo = "ejecución sustituida"
+            elif self.limite is not None and time.monotonic() >= self.limite:
+                self.motivo = f"presupuesto de {self.presupuesto_s:g} s agotado"
+        return self.motivo is not None
+
+    def comprobar(self):
+        """Lanzar ConsultaCancelada si hay que dejar de consultar"""
+        if self.cancelado():
+            raise ConsultaCancelada(self.motivo)
+
+
+def _fijar_statement_timeout(conn, milisegundos):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SET statement_timeout = {int(milisegundos)}")
+    finally:
+        cursor.close()
+
+
+def _cancelar_en_servidor(conn):
+    try:
+        if es_postgres(conn):
+            conn.cancel()
+        elif hasattr(conn, 'interrupt'):
+            conn.interrupt()
+    except Exception:
+        pass
+
+
+@contextmanager
+def vigilar(conn, token=None, statement_timeout_ms=STATEMENT_TIMEOUT_MS):
+    """Ejecutar consultas en conn bajo el statement_timeout y la cancelación del token.
+
+    Sin token solo se aplica el statement_timeout. Si el token se cancela
+    mientras hay una consulta en curso, esta se cancela en el servidor y el
+    bloque termina con ConsultaCancelada.
+    """
+    if token is not None:
+        token.comprobar()
+    if es_postgres(conn):
+        restante = token.restante() if token is not None else None
+        if restante is not None:
+            statement_timeout_ms = max(1, min(statement_timeout_ms, int(restante * 1000)))
+        _fijar_statement_timeout(conn, statement_timeout_ms)
+    if token is None:
+        yield
+        return
+
+    terminado = threading.Event()
+    cancelada = []
+
+    def vigilancia():
+        while not terminado.wait(INTERVALO_VIGILANCIA):
+            if token.cancelado():
+                cancelada.append(True)
+                _cancelar_en_servidor(conn)
+                return
+
+    hilo = threading.Thread(target=vigilancia, name="vigilancia_consulta", daemon=True)
+    hilo.start()
+    try:
+        yield
+    except Exception as e:
+        if cancelada or token.cancelado() or _es_cancelacion(e):
+            token.canceladas += 1
+            if es_postgres(conn) and not conn.autocommit:
+                conn.rollback()
+            raise ConsultaCancelada(token.motivo or "statement_timeout") from e
+        raise
+    finally:
+        terminado.set()
+        hilo.join()
+    if cancelada:
+        # La consulta terminó justo antes de la cancelación
+        token.canceladas += 1
+
+
+def _es_cancelacion(error):
+    """QueryCanceledError de psycopg2 (cancelación o statement_timeout) o 'interrupted' de SQLite"""
+    return type(error).__name__ == 'QueryCanceledError' or 'interrupted' in str(error)
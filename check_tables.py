@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
+import sys
 import psycopg2
+from estadisticas_tablas import CatalogoEstadisticas, formatear_tamano
+
+# --exacto para forzar COUNT(*) (recorre la tabla completa)
+contar_exacto = '--exacto' in sys.argv
 
 conn = psycopg2.connect(
     host='195.154.137.88',
@@ -10,6 +15,7 @@ conn = psycopg2.connect(
 )
 
 cursor = conn.cursor()
+catalogo = CatalogoEstadisticas(conn)
 
 # Ver todas las tablas
 cursor.execute("""
@@ -36,21 +42,21 @@ for table in adj_tables:
     print(f"  ✓ {table[0]}")
 
     # Ver estructura de la tabla
-    cursor.execute(f"""
-        SELECT column_name, data_type
-        FROM information_schema.columns
-        WHERE table_name = '{table[0]}'
-        ORDER BY ordinal_position;
-    """)
-    columns = cursor.fetchall()
+    columns = catalogo.estructura(table[0])
     print(f"    Columnas: {len(columns)}")
     for col in columns[:10]:  # Primeras 10 columnas
         print(f"      - {col[0]} ({col[1]})")
 
     # Contar registros
-    cursor.execute(f"SELECT COUNT(*) FROM {table[0]};")
-    count = cursor.fetchone()[0]
-    print(f"    Registros: {count:,}\n")
+    if contar_exacto:
+        cursor.execute(f"SELECT COUNT(*) FROM {table[0]};")
+        count = cursor.fetchone()[0]
+        print(f"    Registros: {count:,}\n")
+    else:
+        stats = catalogo.estadisticas_tabla(table[0])
+        count = stats['filas_estimadas'] if stats else None
+        count_str = f"~{count:,}" if count is not None else "N/A (sin ANALYZE)"
+        print(f"    Registros (estimado): {count_str} · {formatear_tamano(stats['tamano_bytes'] if stats else None)}\n")
 
 cursor.close()
 conn.close()
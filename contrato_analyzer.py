@@ -1,14 +1,11 @@
-import mysql.connector
 import pandas as pd
 import streamlit as st
-import plotly.express as px
-import plotly.graph_objects as go
 from datetime import datetime, timedelta
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import re
 import warnings
+from recursos import extraer_precio, calcular_similitud_tfidf
+from lectura_sql import leer_sql
+# mysql.connector, sklearn y plotly se importan donde se usan
 warnings.filterwarnings('ignore')
 
 class ContratoAnalyzer:
@@ -17,6 +14,8 @@ class ContratoAnalyzer:
 
     def connect_to_database(self):
         """Conectar a la base de datos MySQL"""
+        import mysql.connector
+
         try:
             self.connection = mysql.connector.connect(
                 host=st.secrets["mysql"]["host"],
@@ -33,7 +32,7 @@ class ContratoAnalyzer:
     def get_contratos_data(self, limit=5000):
         """Obtener datos de la tabla contratos"""
         query = f"SELECT * FROM contratos LIMIT {limit}"
-        return pd.read_sql(query, self.connection)
+        return leer_sql(self.connection, query)
 
     def get_contrato_structure(self):
         """Obtener estructura de la tabla contratos"""
@@ -50,26 +49,7 @@ class ContratoAnalyzer:
 
         text = str(text).replace('.', '').replace(',', '.')
 
-        # Buscar patrones de precio
-        patterns = [
-            r'(\d+\.?\d*)\s*€',
-            r'€\s*(\d+\.?\d*)',
-            r'(\d+\.?\d*)\s*euros?',
-            r'euros?\s*(\d+\.?\d*)',
-            r'importe[:\s]*(\d+\.?\d*)',
-            r'precio[:\s]*(\d+\.?\d*)',
-            r'valor[:\s]*(\d+\.?\d*)',
-            r'(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)'
-        ]
-
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                try:
-                    return float(matches[0].replace(',', '.'))
-                except:
-                    continue
-        return None
+        return extraer_precio(text)
 
     def clean_cpv_code(self, cpv_text):
         """Limpiar y extraer código CPV"""
@@ -85,11 +65,8 @@ class ContratoAnalyzer:
         if pd.isna(text1) or pd.isna(text2):
             return 0
 
-        vectorizer = TfidfVectorizer(stop_words='english', lowercase=True)
         try:
-            tfidf_matrix = vectorizer.fit_transform([str(text1), str(text2)])
-            similarity = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
-            return similarity
+            return calcular_similitud_tfidf(text1, text2, stop_words='english', lowercase=True)
         except:
             return 0
 
@@ -274,15 +251,23 @@ class ContratoAnalyzer:
 
         return similar_contratos[:20]  # Top 20
 
+def get_analyzer():
+    """Analizador de la sesión, reutilizado entre reruns.
+
+    Cada sesión tiene su propia instancia: guarda la conexión a la base de
+    datos y el estado del análisis en curso, que no se pueden compartir entre
+    usuarios.
+    """
+    if 'analyzer' not in st.session_state:
+        st.session_state.analyzer = ContratoAnalyzer()
+    return st.session_state.analyzer
+
 def main():
     st.title("📊 Analizador de Bajas Estadísticas - Contratos")
     st.sidebar.title("Configuración")
 
     # Inicializar analizador
-    if 'analyzer' not in st.session_state:
-        st.session_state.analyzer = ContratoAnalyzer()
-
-    analyzer = st.session_state.analyzer
+    analyzer = get_analyzer()
 
     # Conectar a la base de datos
     if not analyzer.connection:
@@ -372,6 +357,8 @@ def main():
                                     st.write(contrato['row_data'].to_dict())
 
                         # Gráfico de scores
+                        import plotly.express as px
+
                         scores = [c['score'] for c in similar_contratos[:10]]
                         fig = px.bar(
                             x=[f"Contrato {i+1}" for i in range(len(scores))],
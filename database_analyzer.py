@@ -7,6 +7,9 @@ from datetime import datetime, timedelta
 import numpy as np
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import StandardScaler
+from lectura_sql import leer_sql, leer_sql_por_bloques, leer_pagina
+from estadisticas_tablas import CatalogoEstadisticas, formatear_tamano
+from muestreo_sql import leer_muestra
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -14,6 +17,7 @@ class DatabaseAnalyzer:
     def __init__(self):
         self.connection = None
         self.tables = []
+        self.catalogo = None
 
     def connect_to_database(self):
         """Conectar a la base de datos PostgreSQL"""
@@ -25,6 +29,7 @@ class DatabaseAnalyzer:
                 password=st.secrets["postgres"]["password"],
                 database=st.secrets["postgres"]["database"]
             )
+            self.catalogo = CatalogoEstadisticas(self.connection)
             return True
         except Exception as e:
             st.error(f"Error conectando a la base de datos: {e}")
@@ -47,31 +52,60 @@ class DatabaseAnalyzer:
         return tables
 
     def get_table_structure(self, table_name):
-        """Obtener estructura de una tabla"""
-        cursor = self.connection.cursor()
-        cursor.execute(f"""
-            SELECT
-                column_name,
-                data_type,
-                is_nullable,
-                column_default
-            FROM information_schema.columns
-            WHERE table_name = '{table_name}'
-            ORDER BY ordinal_position;
-        """)
-        columns = cursor.fetchall()
-        cursor.close()
-        return columns
+        """Obtener estructura de una tabla (cacheada hasta refrescar estadísticas)"""
+        return self.catalogo.estructura(table_name)
+
+    def get_table_stats(self, table_name):
+        """Filas estimadas y tamaño de una tabla según el catálogo, sin COUNT(*)"""
+        return self.catalogo.estadisticas_tabla(table_name)
+
+    def get_column_stats(self, table_name):
+        """Estadísticas por columna de pg_stats como DataFrame"""
+        columnas = self.catalogo.estadisticas_columnas(table_name)
+        return pd.DataFrame([
+            {
+                'Campo': nombre,
+                '% Nulos': round(info['null_frac'] * 100, 2) if info['null_frac'] is not None else None,
+                'Distintos (est.)': info['n_distinct'],
+                'Ancho medio': info['avg_width'],
+                'Correlación': info['correlacion'],
+                'Buckets histograma': max(len(info['histograma']) - 1, 0),
+                'Valores más comunes': ', '.join(info['valores_comunes'][:5]),
+            }
+            for nombre, info in columnas.items()
+        ])
+
+    def refresh_stats(self, table_name=None, analyze=False):
+        """Refrescar la caché de esquema/estadísticas (opcionalmente con ANALYZE)"""
+        self.catalogo.refrescar(table_name, analizar=analyze)
+
+    def get_table_data(self, table_name, limit=1000, sampling=None, columns=None):
+        """Obtener datos de una tabla.
 
-    def get_table_data(self, table_name, limit=1000):
-        """Obtener datos de una tabla"""
-        query = f"SELECT * FROM {table_name} LIMIT {limit}"
-        return pd.read_sql(query, self.connection)
+        sampling: None (primeras filas) o 'SYSTEM'/'BERNOULLI' para una muestra aleatoria
+        columns: columnas a leer (todas si es None)
+        """
+        if sampling:
+            return leer_muestra(self.connection, table_name, limit, columns, metodo=sampling,
+                                catalogo=self.catalogo)
+        query = f"SELECT {', '.join(columns) if columns else '*'} FROM {table_name} LIMIT {limit}"
+        return leer_sql(self.connection, query)
+
+    def iter_table_data(self, table_name, chunk_size=2000, limit=None):
+        """Generador de DataFrames de una tabla leídos por bloques con cursor de servidor"""
+        query = f"SELECT * FROM {table_name}"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        return leer_sql_por_bloques(self.connection, query, itersize=chunk_size)
+
+    def get_table_page(self, table_name, page, page_size=100):
+        """Obtener una página (0-indexada) de una tabla"""
+        return leer_pagina(self.connection, f"SELECT * FROM {table_name}", page, page_size)
 
     def execute_custom_query(self, query):
         """Ejecutar consulta personalizada"""
         try:
-            return pd.read_sql(query, self.connection)
+            return leer_sql(self.connection, query)
         except Exception as e:
             st.error(f"Error ejecutando consulta: {e}")
             return pd.DataFrame()
@@ -102,16 +136,82 @@ def main():
         selected_table = st.sidebar.selectbox("Selecciona una tabla:", st.session_state.tables)
 
         if selected_table:
+            # Estadísticas estimadas del catálogo (instantáneas, sin recorrer la tabla)
+            st.sidebar.subheader("📊 Estadísticas de la tabla")
+            try:
+                stats = analyzer.get_table_stats(selected_table)
+            except Exception as e:
+                stats = None
+                st.sidebar.error(f"Error leyendo estadísticas: {e}")
+            if stats:
+                filas_est = stats['filas_estimadas']
+                st.sidebar.metric("Registros (estimado)", f"{filas_est:,}" if filas_est is not None else "N/A")
+                st.sidebar.write(f"**Tamaño:** {formatear_tamano(stats['tamano_bytes'])}")
+                ultimo = stats['ultimo_analyze']
+                st.sidebar.caption(f"Último ANALYZE: {ultimo:%Y-%m-%d %H:%M}" if ultimo else "Sin ANALYZE registrado")
+
+            ejecutar_analyze = st.sidebar.checkbox("Ejecutar ANALYZE al refrescar", value=False)
+            if st.sidebar.button("🔄 Refrescar estadísticas"):
+                try:
+                    with st.spinner("Refrescando estadísticas..."):
+                        analyzer.refresh_stats(selected_table, analyze=ejecutar_analyze)
+                except Exception as e:
+                    st.sidebar.error(f"Error refrescando estadísticas: {e}")
+                else:
+                    st.rerun()
+
             # Mostrar estructura de la tabla
             with st.expander(f"📋 Estructura de {selected_table}"):
                 structure = analyzer.get_table_structure(selected_table)
                 structure_df = pd.DataFrame(structure, columns=['Campo', 'Tipo', 'Null', 'Default'])
                 st.dataframe(structure_df)
 
+            with st.expander(f"🧮 Estadísticas por columna de {selected_table}"):
+                try:
+                    column_stats = analyzer.get_column_stats(selected_table)
+                    if column_stats.empty:
+                        st.info("Sin estadísticas de columnas: ejecuta ANALYZE desde la barra lateral")
+                    else:
+                        st.dataframe(column_stats)
+                except Exception as e:
+                    st.error(f"Error leyendo estadísticas de columnas: {e}")
+
+            # Navegación por páginas (solo se lee del servidor la página pedida)
+            with st.expander(f"📄 Navegar {selected_table} por páginas"):
+                col_tam, col_pag = st.columns(2)
+                with col_tam:
+                    page_size = st.selectbox("Filas por página:", [50, 100, 500, 1000], index=1,
+                                             key=f"page_size_{selected_table}")
+                with col_pag:
+                    page = st.number_input("Página:", min_value=1, value=1, step=1,
+                                           key=f"page_{selected_table}")
+                try:
+                    page_data = analyzer.get_table_page(selected_table, int(page) - 1, page_size)
+                    if page_data.empty:
+                        st.info("No hay registros en esta página")
+                    else:
+                        st.dataframe(page_data)
+                except Exception as e:
+                    st.error(f"Error cargando la página: {e}")
+
+            # Muestreo en el servidor
+            st.sidebar.subheader("🎲 Muestreo")
+            metodos_muestreo = {
+                "Aleatorio por páginas (TABLESAMPLE SYSTEM)": "SYSTEM",
+                "Aleatorio por filas (TABLESAMPLE BERNOULLI)": "BERNOULLI",
+                "Primeras filas (LIMIT)": None,
+            }
+            metodo = st.sidebar.selectbox("Método de muestreo:", list(metodos_muestreo))
+            sample_size = st.sidebar.number_input("Tamaño de la muestra:", min_value=100, max_value=100000,
+                                                  value=1000, step=100)
+            solo_numericas = st.sidebar.checkbox("Leer solo columnas numéricas", value=False)
+
             # Cargar datos
             if st.button(f"🔍 Explorar datos de {selected_table}"):
                 with st.spinner("Cargando datos..."):
-                    data = analyzer.get_table_data(selected_table)
+                    columns = analyzer.catalogo.columnas_numericas(selected_table) if solo_numericas else None
+                    data = analyzer.get_table_data(selected_table, int(sample_size),
+                                                   sampling=metodos_muestreo[metodo], columns=columns or None)
 
                     if not data.empty:
                         st.subheader(f"📊 Datos de {selected_table}")
@@ -0,0 +1,177 @@
+"""
+Descargas HTTP concurrentes con límites por host, reintentos y coalescencia.
+
+Los scrapers descargaban cada página con requests.get: una conexión nueva por
+petición, sin reintentos y de una en una. Descargador comparte una
+requests.Session (keep-alive y pool de conexiones) entre un pool de hilos y
+aplica por host:
+
+- un máximo de peticiones simultáneas (semáforo),
+- un ritmo máximo de peticiones por segundo (intervalo mínimo entre inicios),
+- reintentos con espera exponencial y jitter ante 429, 5xx y errores de red,
+  respetando la cabecera Retry-After,
+- coalescencia: peticiones idénticas en curso comparten una sola descarga.
+
+Uso:
+    descargador = Descargador(headers={'User-Agent': ...}, max_por_host=4, por_segundo=5)
+    respuesta = descargador.obtener(url)             # síncrono, como requests.get
+    respuestas = descargador.obtener_varios(urls)     # {url: Response o excepción}
+
+No depende de Streamlit: se puede probar contra un servidor HTTP local.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+
+class _LimiteHost:
+    """Semáforo de concurrencia y ritmo de peticiones de un host"""
+
+    def __init__(self, max_simultaneas, por_segundo):
+        self.semaforo = threading.BoundedSemaphore(max_simultaneas)
+        self.intervalo = 1.0 / por_segundo if por_segundo else 0.0
+        self._lock = threading.Lock()
+        self._siguiente = 0.0
+
+    def esperar_turno(self):
+        """Bloquear hasta que el ritmo permita iniciar otra petición"""
+        if not self.intervalo:
+            return
+        with self._lock:
+            ahora = time.monotonic()
+            turno = max(ahora, self._siguiente)
+            self._siguiente = turno + self.intervalo
+        if turno > ahora:
+            time.sleep(turno - ahora)
+
+
+class Descargador:
+    """Cliente HTTP compartido para descargar muchas URLs en paralelo de forma educada"""
+
+    def __init__(self, headers=None, max_por_host=4, por_segundo=None, reintentos=4,
+                 espera_base=0.5, espera_maxima=30.0, timeout=15, max_hilos=16):
+        self.max_por_host = max_por_host
+        self.por_segundo = por_segundo
+        self.reintentos = reintentos
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        if headers:
+            self.session.headers.update(headers)
+        adaptador = HTTPAdapter(pool_connections=max_hilos, pool_maxsize=max_hilos)
+        self.session.mount('http://', adaptador)
+        self.session.mount('https://', adaptador)
+
+        self._pool = ThreadPoolExecutor(max_workers=max_hilos, thread_name_prefix='descarga')
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._en_curso = {}
+        self.estadisticas = {'peticiones': 0, 'reintentos': 0, 'coalescidas': 0}
+
+    def _limite(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = _LimiteHost(self.max_por_host, self.por_segundo)
+            return self._hosts[host]
+
+    def _espera(self, intento, respuesta=None):
+        """Segundos a esperar antes del reintento: Retry-After si existe, si no exponencial con jitter"""
+        if respuesta is not None:
+            retry_after = respuesta.headers.get('Retry-After')
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.espera_maxima)
+                except ValueError:
+                    try:
+                        fecha = parsedate_to_datetime(retry_after)
+                        return min(max(fecha.timestamp() - time.time(), 0.0), self.espera_maxima)
+                    except (TypeError, ValueError):
+                        pass
+        espera = min(self.espera_base * (2 ** intento), self.espera_maxima)
+        return espera * (0.5 + random.random() / 2)
+
+    def _descargar(self, url, timeout):
+        limite = self._limite(url)
+        intento = 0
+        while True:
+            respuesta = None
+            error = None
+            with limite.semaforo:
+                limite.esperar_turno()
+                with self._lock:
+                    self.estadisticas['peticiones'] += 1
+                try:
+                    respuesta = self.session.get(url, timeout=timeout or self.timeout)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+
+            reintentable = error is not None or respuesta.status_code in ESTADOS_REINTENTABLES
+            if not reintentable or intento >= self.reintentos:
+                if error is not None:
+                    raise error
+                return respuesta
+
+            # La espera se hace fuera del semáforo para no bloquear otras descargas del host
+            time.sleep(self._espera(intento, respuesta))
+            intento += 1
+            with self._lock:
+                self.estadisticas['reintentos'] += 1
+
+    def enviar(self, url, timeout=None):
+        """Future con la respuesta de url; si ya hay una descarga idéntica en curso se reutiliza"""
+        with self._lock:
+            futuro = self._en_curso.get(url)
+            if futuro is not None:
+                self.estadisticas['coalescidas'] += 1
+                return futuro
+            futuro = self._pool.submit(self._descargar, url, timeout)
+            self._en_curso[url] = futuro
+        futuro.add_done_callback(lambda _f, url=url: self._terminar(url, _f))
+        return futuro
+
+    def _terminar(self, url, futuro):
+        with self._lock:
+            if self._en_curso.get(url) is futuro:
+                del self._en_curso[url]
+
+    def obtener(self, url, timeout=None):
+        """Descargar url y devolver la respuesta (tras los reintentos); propaga errores de red"""
+        return self.enviar(url, timeout).result()
+
+    def obtener_varios(self, urls, timeout=None, al_completar=None):
+        """Descargar varias URLs en paralelo.
+
+        Devuelve {url: Response o excepción}. al_completar(url, resultado) se llama
+        desde el hilo que invoca, en orden de finalización (útil para barras de progreso).
+        """
+        # Las URLs repetidas reciben el mismo Future por coalescencia
+        futuros = {}
+        for url in urls:
+            futuros[self.enviar(url, timeout)] = url
+
+        resultados = {}
+        for futuro in as_completed(futuros):
+            url = futuros[futuro]
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                resultado = e
+            resultados[url] = resultado
+            if al_completar:
+                al_completar(url, resultado)
+        return resultados
+
+    def cerrar(self):
+        self._pool.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,371 @@
+"""
+Diagnóstico de las consultas SQL de búsqueda.
+
+Algunos lotes tardan 20 segundos y no se sabía qué consulta era la culpable.
+Con el diagnóstico activo (iniciar_diagnostico) cada consulta generada por
+buscar_contratos, get_filtered_contratos_data,
+search_previous_licitacion_same_org y buscar_contratos_simples_por_cpv se
+mide con consulta_sql(): duración, filas devueltas, origen y forma de la
+consulta (el SQL con los literales sustituidos por ?, para agrupar las que
+solo cambian de parámetros).
+
+Las que superan el umbral se añaden como línea JSON al log de consultas
+lentas (variable de entorno CONSULTAS_LENTAS_LOG o consultas_lentas.jsonl),
+opcionalmente con el plan estimado (EXPLAIN sin ANALYZE en PostgreSQL,
+EXPLAIN QUERY PLAN en SQLite), que no ejecuta la consulta. EXPLAIN (ANALYZE,
+BUFFERS) sí la vuelve a ejecutar: dentro del análisis duplicaría el tiempo de
+una consulta lenta fuera del presupuesto del lote y sin poder cancelarla, así
+que se lanza desde la línea de comandos sobre la consulta más lenta de cada
+forma del log (--explain).
+
+Igual que en trazas.py, sin diagnóstico activo consulta_sql() devuelve un
+objeto nulo compartido y el coste es una consulta a una ContextVar.
+
+Informe agregado por forma de consulta:
+    python diagnostico_sql.py [--log consultas_lentas.jsonl] [--top 20]
+    python diagnostico_sql.py --explain [--dsn "host=... dbname=..."]
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime
+
+from lectura_sql import es_postgres
+
+# Milisegundos a partir de los cuales una consulta se considera lenta
+UMBRAL_LENTA_MS = 1000
+RUTA_LOG_POR_DEFECTO = 'consultas_lentas.jsonl'
+# Líneas del plan que se guardan como máximo por consulta
+MAX_LINEAS_PLAN = 200
+
+_diagnostico_actual = ContextVar('diagnostico_sql', default=None)
+_lock_log = threading.Lock()
+
+_LITERAL_TEXTO = re.compile(r"'(?:[^']|'')*'")
+_LITERAL_NUMERO = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b")
+_LISTA = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+# Cadenas "x ~ ? OR x ~ ? OR ..." (CPV, años) con un número variable de términos
+_CADENA_OR = re.compile(r"((?:EXTRACT\([^)]*\)|[\w.:]+)\s*(?:~|=|LIKE)\s*\?)(?:\s+OR\s+\1)+", re.IGNORECASE)
+_ESPACIOS = re.compile(r"\s+")
+
+
+def forma_consulta(query):
+    """SQL normalizado: literales -> ?, listas IN y cadenas OR repetidas colapsadas, espacios simples"""
+    forma = _LITERAL_TEXTO.sub('?', query)
+    forma = _LITERAL_NUMERO.sub('?', forma)
+    forma = _ESPACIOS.sub(' ', forma).strip()
+    forma = _LISTA.sub('(?, ...)', forma)
+    forma = _CADENA_OR.sub(r'\1 OR ...', forma)
+    return forma
+
+
+def huella_consulta(forma):
+    return hashlib.sha1(forma.encode('utf-8')).hexdigest()[:10]
+
+
+def _es_select(query):
+    return query.lstrip().lstrip('(').lower().startswith(('select', 'with'))
+
+
+def plan_consulta(conn, query, analizar=True):
+    """Plan de la consulta como lista de líneas ([] si no se puede obtener).
+
+    PostgreSQL: EXPLAIN (ANALYZE, BUFFERS), que ejecuta la consulta; SQLite y
+    otros: EXPLAIN QUERY PLAN.
+    """
+    if not _es_select(query):
+        return []
+    if es_postgres(conn):
+        opciones = "(ANALYZE, BUFFERS)" if analizar else ""
+        sentencia = f"EXPLAIN {opciones} {query}"
+    else:
+        sentencia = f"EXPLAIN QUERY PLAN {query}"
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sentencia)
+        filas = cursor.fetchall()
+    except Exception as e:
+        if es_postgres(conn) and not conn.autocommit:
+            conn.rollback()
+        return [f"(no disponible: {e})"]
+    finally:
+        cursor.close()
+    if es_postgres(conn):
+        lineas = [fila[0] for fila in filas]
+    else:
+        # (id, padre, no usado, detalle)
+        lineas = [str(fila[-1]) for fila in filas]
+    return lineas[:MAX_LINEAS_PLAN]
+
+
+class RegistroConsulta:
+    """Una consulta medida: origen, forma, duración, filas y plan"""
+
+    __slots__ = ('origen', 'sql', 'forma', 'huella', 'inicio', 'duracion_ms', 'filas', 'error', 'plan',
+                 '_diagnostico', '_conn', '_t0')
+
+    def __init__(self, diagnostico, origen, conn, query):
+        self.origen = origen
+        self.sql = query
+        self.forma = forma_consulta(query)
+        self.huella = huella_consulta(self.forma)
+        self.inicio = datetime.now()
+        self.duracion_ms = None
+        self.filas = None
+        self.error = None
+        self.plan = None
+        self._diagnostico = diagnostico
+        self._conn = conn
+        self._t0 = None
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duracion_ms = (time.perf_counter() - self._t0) * 1000
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self._diagnostico._registrar(self)
+        return False
+
+    def lenta(self):
+        return self.duracion_ms is not None and self.duracion_ms >= self._diagnostico.umbral_ms
+
+    def to_dict(self):
+        datos = {
+            'inicio': self.inicio.isoformat(timespec='seconds'),
+            'origen': self.origen,
+            'huella': self.huella,
+            'duracion_ms': round(self.duracion_ms, 3) if self.duracion_ms is not None else None,
+            'filas': self.filas,
+            'forma': self.forma,
+            'sql': self.sql,
+        }
+        if self.error:
+            datos['error'] = self.error
+        if self.plan:
+            datos['plan'] = self.plan
+        return datos
+
+
+class _RegistroNulo:
+    """Registro sin efecto usado cuando el diagnóstico no está activo"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __setattr__(self, nombre, valor):
+        pass
+
+
+REGISTRO_NULO = _RegistroNulo()
+
+
+class DiagnosticoSQL:
+    """Consultas medidas durante una ejecución (por ejemplo, un análisis completo)"""
+
+    def __init__(self, umbral_ms=UMBRAL_LENTA_MS, explain=False, ruta_log=None):
+        self.umbral_ms = umbral_ms
+        self.explain = explain
+        self.ruta_log = ruta_log or os.environ.get('CONSULTAS_LENTAS_LOG') or RUTA_LOG_POR_DEFECTO
+        self.registros = []
+        self._token = None
+
+    def _registrar(self, registro):
+        self.registros.append(registro)
+        if not registro.lenta():
+            return
+        if self.explain and registro.error is None:
+            # Solo el plan estimado: ANALYZE repetiría la consulta lenta (diagnostico_sql.py --explain)
+            registro.plan = plan_consulta(registro._conn, registro.sql, analizar=False)
+        try:
+            with _lock_log:
+                with open(self.ruta_log, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(registro.to_dict(), ensure_ascii=False, default=str) + '\n')
+        except OSError:
+            pass
+
+    def lentas(self):
+        return [r for r in self.registros if r.lenta()]
+
+    def to_dict(self):
+        return [r.to_dict() for r in self.registros]
+
+
+def iniciar_diagnostico(umbral_ms=UMBRAL_LENTA_MS, explain=False, ruta_log=None):
+    """Activar el diagnóstico en el contexto actual y devolverlo"""
+    diagnostico = DiagnosticoSQL(umbral_ms, explain, ruta_log)
+    diagnostico._token = _diagnostico_actual.set(diagnostico)
+    return diagnostico
+
+
+def finalizar_diagnostico(diagnostico):
+    """Desactivar el diagnóstico; sus registros siguen disponibles"""
+    if diagnostico._token is not None:
+        try:
+            _diagnostico_actual.reset(diagnostico._token)
+        except ValueError:
+            # Token de otro contexto: basta con desactivarlo
+            _diagnostico_actual.set(None)
+        diagnostico._token = None
+    return diagnostico
+
+
+def consulta_sql(origen, conn, query):
+    """Context manager que mide una consulta si el diagnóstico está activo.
+
+    Uso:
+        with consulta_sql('buscar_contratos', conn, query) as c:
+            df = leer_sql(conn, query)
+            c.filas = len(df)
+    """
+    diagnostico = _diagnostico_actual.get()
+    if diagnostico is None:
+        return REGISTRO_NULO
+    return RegistroConsulta(diagnostico, origen, conn, query)
+
+
+def _percentil(valores, q):
+    ordenados = sorted(valores)
+    posicion = min(len(ordenados) - 1, max(0, int(round(q * (len(ordenados) - 1)))))
+    return ordenados[posicion]
+
+
+def agregar_por_forma(registros):
+    """Resumen por forma de consulta, de mayor a menor tiempo total.
+
+    registros: dicts en el formato de RegistroConsulta.to_dict (p. ej. las líneas del log).
+    """
+    grupos = {}
+    for registro in registros:
+        if registro.get('duracion_ms') is None:
+            continue
+        grupo = grupos.setdefault(registro['huella'], {
+            'huella': registro['huella'], 'forma': registro['forma'], 'origenes': set(),
+            'duraciones': [], 'filas': [], 'errores': 0, 'ultima': registro.get('inicio'),
+        })
+        grupo['origenes'].add(registro.get('origen') or '?')
+        grupo['duraciones'].append(registro['duracion_ms'])
+        if registro.get('filas') is not None:
+            grupo['filas'].append(registro['filas'])
+        if registro.get('error'):
+            grupo['errores'] += 1
+        grupo['ultima'] = max(grupo['ultima'] or '', registro.get('inicio') or '')
+
+    resumen = []
+    for grupo in grupos.values():
+        duraciones = grupo['duraciones']
+        resumen.append({
+            'huella': grupo['huella'],
+            'origen': ', '.join(sorted(grupo['origenes'])),
+            'consultas': len(duraciones),
+            'total_ms': round(sum(duraciones), 1),
+            'media_ms': round(sum(duraciones) / len(duraciones), 1),
+            'p95_ms': round(_percentil(duraciones, 0.95), 1),
+            'max_ms': round(max(duraciones), 1),
+            'filas_media': round(sum(grupo['filas']) / len(grupo['filas']), 1) if grupo['filas'] else None,
+            'errores': grupo['errores'],
+            'ultima': grupo['ultima'],
+            'forma': grupo['forma'],
+        })
+    resumen.sort(key=lambda r: r['total_ms'], reverse=True)
+    return resumen
+
+
+def leer_log(ruta=None):
+    """Registros del log de consultas lentas (se ignoran las líneas corruptas)"""
+    ruta = ruta or os.environ.get('CONSULTAS_LENTAS_LOG') or RUTA_LOG_POR_DEFECTO
+    registros = []
+    try:
+        with open(ruta, encoding='utf-8') as f:
+            for linea in f:
+                try:
+                    registros.append(json.loads(linea))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return registros
+
+
+def formatear_informe(resumen, top=20, ancho_forma=160):
+    """Informe por forma de consulta como lista de líneas de texto"""
+    if not resumen:
+        return ["Sin consultas registradas"]
+    lineas = [f"{'huella':<10}  {'n':>5}  {'total ms':>10}  {'media':>9}  {'p95':>9}  {'max':>9}  {'filas':>7}  origen"]
+    for r in resumen[:top]:
+        filas = f"{r['filas_media']:.0f}" if r['filas_media'] is not None else '-'
+        lineas.append(f"{r['huella']:<10}  {r['consultas']:>5}  {r['total_ms']:>10.1f}  {r['media_ms']:>9.1f}  "
+                      f"{r['p95_ms']:>9.1f}  {r['max_ms']:>9.1f}  {filas:>7}  {r['origen']}")
+        forma = r['forma'] if len(r['forma']) <= ancho_forma else r['forma'][:ancho_forma - 3] + '...'
+        lineas.append(f"            {forma}")
+    return lineas
+
+
+def consultas_a_explicar(registros, top=20):
+    """La consulta más lenta (sin error) de cada una de las top formas por tiempo total"""
+    mas_lentas = {}
+    for registro in registros:
+        if registro.get('error') or not registro.get('sql') or registro.get('duracion_ms') is None:
+            continue
+        actual = mas_lentas.get(registro['huella'])
+        if actual is None or registro['duracion_ms'] > actual['duracion_ms']:
+            mas_lentas[registro['huella']] = registro
+    return [mas_lentas[r['huella']] for r in agregar_por_forma(registros)[:top] if r['huella'] in mas_lentas]
+
+
+def explicar_log(conn, registros, top=20):
+    """Líneas con el EXPLAIN (ANALYZE, BUFFERS) de la consulta más lenta de cada forma"""
+    lineas = []
+    for registro in consultas_a_explicar(registros, top):
+        lineas.append(f"== {registro['huella']} {registro.get('origen') or '?'} "
+                      f"({registro['duracion_ms']:.1f} ms, {registro.get('inicio')})")
+        lineas.extend(f"   {linea}" for linea in plan_consulta(conn, registro['sql']))
+    return lineas or ["Sin consultas que explicar"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Informe del log de consultas lentas agrupado por forma de consulta")
+    parser.add_argument('--log', default=None, help=f"Ruta del log (por defecto CONSULTAS_LENTAS_LOG o {RUTA_LOG_POR_DEFECTO})")
+    parser.add_argument('--top', type=int, default=20, help="Formas de consulta a mostrar")
+    parser.add_argument('--origen', default=None, help="Solo las consultas de este origen (p. ej. buscar_contratos)")
+    parser.add_argument('--json', action='store_true', help="Salida en JSON")
+    parser.add_argument('--explain', action='store_true',
+                        help="Ejecutar EXPLAIN (ANALYZE, BUFFERS) de la consulta más lenta de cada forma")
+    parser.add_argument('--dsn', default=None,
+                        help="Cadena de conexión de PostgreSQL para --explain (por defecto la de migraciones.py)")
+    args = parser.parse_args(argv)
+
+    registros = leer_log(args.log)
+    if args.origen:
+        registros = [r for r in registros if r.get('origen') == args.origen]
+    if args.explain:
+        import psycopg2
+        from migraciones import dsn_por_defecto
+        conn = psycopg2.connect(args.dsn if args.dsn is not None else dsn_por_defecto())
+        try:
+            print("\n".join(explicar_log(conn, registros, args.top)))
+        finally:
+            conn.close()
+        return
+    resumen = agregar_por_forma(registros)
+    if args.json:
+        print(json.dumps(resumen[:args.top], ensure_ascii=False, indent=2))
+    else:
+        print(f"{len(registros)} consultas lentas, {len(resumen)} formas distintas")
+        print("\n".join(formatear_informe(resumen, args.top)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Índice canónico de empresas adjudicatarias.
+
+El nombre del adjudicatario se sacaba del texto/JSON de la columna
+adjudicatario en varios sitios (buscar_contratos, get_empresa_stats,
+buscar_contratos_simples_por_cpv, process_contratos, generate_baja_text), cada
+uno con su json.loads por fila y por análisis, y las estadísticas contaban
+cadenas: "LIMPIEZAS LEVANTE, S.L." y "Limpiezas Levante SL" eran dos empresas.
+
+IndiceEmpresas parsea cada valor de adjudicatario una sola vez (memoizado),
+normaliza mayúsculas, acentos, puntuación y forma jurídica (S.L., S.A.,
+S.L.U., ...) en una clave canónica y le asigna un id entero. Los contratos
+guardan 'empresa_ids' junto al resto de datos y las estadísticas por empresa
+son recuentos de enteros.
+
+Formatos de adjudicatario en adjudicaciones_metabase:
+    [{"adjudicatario": {"name": ..., "nif": ...}}, ...]   (uno por lote)
+    {"adjudicatario": {"name": ...}}
+    {"name": ...}
+    texto plano
+"""
+import json
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+import streamlit as st
+
+VALORES_VACIOS = {'NONE', 'NULL', 'N/A', ''}
+
+# Formas jurídicas al final del nombre, ya sin puntos y en mayúsculas
+FORMA_JURIDICA = re.compile(
+    r'\s+(S\s?L\s?U|S\s?L\s?L|S\s?L\s?P|S\s?A\s?U|S\s?L|S\s?A|S\s?COOP(\s?V|\s?A)?|SCCL|S\s?C|'
+    r'SOCIEDAD LIMITADA( UNIPERSONAL)?|SOCIEDAD ANONIMA( UNIPERSONAL)?|SOCIEDAD COOPERATIVA)$')
+NO_ALFANUMERICO = re.compile(r'[^0-9A-Z& ]+')
+ESPACIOS = re.compile(r'\s+')
+
+# Tamaño máximo de la memoria de valores de adjudicatario ya parseados
+MAX_MEMORIA = 200000
+
+
+def nombres_adjudicatario(valor):
+    """Nombres de empresa contenidos en un valor de la columna adjudicatario (lista, puede estar vacía)"""
+    if valor is None:
+        return []
+    if isinstance(valor, (list, dict)):
+        datos = valor
+    else:
+        texto = str(valor).strip()
+        if not texto:
+            return []
+        if texto[0] not in '[{':
+            return [texto[:80]]
+        try:
+            datos = json.loads(texto)
+        except ValueError:
+            return [texto[:80]]
+
+    elementos = datos if isinstance(datos, list) else [datos]
+    nombres = []
+    for item in elementos:
+        if not isinstance(item, dict):
+            continue
+        # {"adjudicatario": {"name": ...}} o directamente {"name": ...}
+        adj = item.get('adjudicatario') if isinstance(item.get('adjudicatario'), dict) else item
+        nombre = adj.get('name')
+        if isinstance(nombre, str) and nombre.strip():
+            nombres.append(nombre.strip())
+    return nombres
+
+
+def nombre_valido(nombre):
+    return bool(nombre) and nombre.strip().upper() not in VALORES_VACIOS and len(nombre.strip()) > 3
+
+
+def clave_empresa(nombre):
+    """Clave canónica: sin acentos, mayúsculas, sin puntuación ni forma jurídica final"""
+    texto = unicodedata.normalize('NFKD', nombre).encode('ascii', 'ignore').decode('ascii').upper()
+    texto = texto.replace('.', '')
+    texto = ESPACIOS.sub(' ', NO_ALFANUMERICO.sub(' ', texto)).strip()
+    anterior = None
+    while texto != anterior:
+        anterior = texto
+        texto = FORMA_JURIDICA.sub('', texto).strip()
+    return texto
+
+
+class IndiceEmpresas:
+    """Diccionario de empresas: clave canónica -> id entero, con el nombre más frecuente para mostrar"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._claves = []
+        self._variantes = []
+        self._memoria = {}
+
+    def __len__(self):
+        return len(self._variantes)
+
+    def id_empresa(self, nombre):
+        """Id canónico de un nombre de empresa (None si no es un nombre válido)"""
+        if not nombre_valido(nombre):
+            return None
+        clave = clave_empresa(nombre)
+        if not clave:
+            return None
+        with self._lock:
+            id_ = self._ids.get(clave)
+            if id_ is None:
+                id_ = self._ids[clave] = len(self._variantes)
+                self._claves.append(clave)
+                self._variantes.append(Counter())
+            self._variantes[id_][nombre.strip()] += 1
+        return id_
+
+    def ids(self, valor):
+        """Ids de las empresas de un valor de adjudicatario; cada valor distinto se parsea una vez"""
+        if valor is None:
+            return ()
+        clave = valor if isinstance(valor, str) else json.dumps(valor, sort_keys=True, ensure_ascii=False)
+        ids = self._memoria.get(clave)
+        if ids is None:
+            ids = tuple(id_ for id_ in map(self.id_empresa, nombres_adjudicatario(valor)) if id_ is not None)
+            with self._lock:
+                if len(self._memoria) >= MAX_MEMORIA:
+                    self._memoria.clear()
+                self._memoria[clave] = ids
+        return ids
+
+    def nombre(self, id_):
+        """Nombre para mostrar: la variante más frecuente de la empresa"""
+        with self._lock:
+            return self._variantes[id_].most_common(1)[0][0]
+
+    def clave(self, id_):
+        """Clave canónica de la empresa (estable entre procesos, a diferencia del id)"""
+        return self._claves[id_]
+
+    def nombre_principal(self, valor, defecto='N/A'):
+        """Nombre canónico de la primera empresa del valor de adjudicatario"""
+        ids = self.ids(valor)
+        return self.nombre(ids[0]) if ids else defecto
+
+    def anotar(self, contratos, campo='empresa'):
+        """Añadir 'empresa_ids' a cada contrato (dict) a partir de contrato[campo]"""
+        for contrato in contratos:
+            if 'empresa_ids' not in contrato:
+                contrato['empresa_ids'] = list(self.ids(contrato.get(campo)))
+        return contratos
+
+    def contar(self, contratos, campo='empresa'):
+        """Counter id -> número de adjudicaciones; usa 'empresa_ids' si los contratos ya lo tienen"""
+        recuentos = Counter()
+        for contrato in contratos:
+            ids = contrato.get('empresa_ids')
+            if ids is None:
+                ids = self.ids(contrato.get(campo))
+            recuentos.update(ids)
+        return recuentos
+
+
+@st.cache_resource
+def get_indice_empresas():
+    """Índice compartido por todas las sesiones del proceso"""
+    return IndiceEmpresas()
@@ -0,0 +1,265 @@
+"""
+Estadísticas sobre tablas completas leídas por bloques, con memoria acotada.
+
+Los análisis de correlaciones y anomalías trabajaban sobre un DataFrame en
+memoria. Aquí se acumulan sobre los bloques que entrega un cursor de servidor
+(lectura_sql.leer_sql_por_bloques):
+
+- AcumuladorCovarianza: medias, varianzas y covarianzas por pares de columnas
+  (observaciones completas por par, como DataFrame.corr) fusionando cada
+  bloque con la fórmula de Chan/Welford. Memoria O(columnas²).
+- ResumenCuantiles: resumen fusionable tipo t-digest; cuantiles con error
+  relativo pequeño en las colas y memoria O(compresión) por columna.
+
+En PostgreSQL los agregados se calculan en el servidor con corr() y
+percentile_cont; correlaciones_tabla y anomalias_tabla eligen el camino según
+la conexión.
+"""
+import numpy as np
+import pandas as pd
+from lectura_sql import leer_sql_por_bloques, ITERSIZE_POR_DEFECTO, es_postgres
+
+
+class AcumuladorCovarianza:
+    """Medias y comomentos por pares de columnas, actualizables por bloques"""
+
+    def __init__(self, columnas):
+        self.columnas = list(columnas)
+        k = len(self.columnas)
+        # Matrices [i, j]: estadísticos de la columna i sobre las filas con i y j no nulos
+        self.n = np.zeros((k, k))
+        self.media = np.zeros((k, k))
+        self.m2 = np.zeros((k, k))
+        self.comomento = np.zeros((k, k))
+
+    def actualizar(self, valores):
+        """Incorporar un bloque (array filas × columnas, con NaN para nulos)"""
+        valores = np.asarray(valores, dtype=float)
+        if not len(valores):
+            return self
+        validos = ~np.isnan(valores)
+        # Centrar el bloque reduce la cancelación numérica en las sumas de cuadrados
+        desplazamiento = np.nan_to_num(np.nanmean(np.where(validos, valores, np.nan), axis=0))
+        x = np.where(validos, valores - desplazamiento, 0.0)
+        m = validos.astype(float)
+
+        n_b = m.T @ m
+        with np.errstate(invalid='ignore', divide='ignore'):
+            suma = x.T @ m
+            media_b = np.where(n_b > 0, suma / n_b, 0.0)
+            m2_b = (x * x).T @ m - np.where(n_b > 0, suma * suma / n_b, 0.0)
+            comomento_b = x.T @ x - np.where(n_b > 0, suma * suma.T / n_b, 0.0)
+        media_b = media_b + desplazamiento[:, None]
+        return self._fusionar(n_b, media_b, m2_b, comomento_b)
+
+    def fusionar(self, otro):
+        """Combinar con otro acumulador de las mismas columnas (p. ej. de otro proceso)"""
+        return self._fusionar(otro.n, otro.media, otro.m2, otro.comomento)
+
+    def _fusionar(self, n_b, media_b, m2_b, comomento_b):
+        n = self.n + n_b
+        with np.errstate(invalid='ignore', divide='ignore'):
+            peso = np.where(n > 0, self.n * n_b / n, 0.0)
+            delta = media_b - self.media
+            self.media = self.media + np.where(n > 0, delta * n_b / n, 0.0)
+            self.m2 = self.m2 + m2_b + delta * delta * peso
+            self.comomento = self.comomento + comomento_b + delta * delta.T * peso
+        self.n = n
+        return self
+
+    def medias(self):
+        return pd.Series(np.diag(self.media), index=self.columnas)
+
+    def correlacion(self):
+        """Matriz de correlación de Pearson (equivalente a DataFrame.corr())"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = self.comomento / np.sqrt(self.m2 * self.m2.T)
+        corr = np.where(self.n > 1, np.clip(corr, -1.0, 1.0), np.nan)
+        np.fill_diagonal(corr, np.where(np.diag(self.n) > 1, 1.0, np.nan))
+        return pd.DataFrame(corr, index=self.columnas, columns=self.columnas)
+
+
+class ResumenCuantiles:
+    """Resumen fusionable de una distribución para estimar cuantiles (t-digest simplificado)"""
+
+    def __init__(self, compresion=500):
+        self.compresion = compresion
+        self.centros = np.empty(0)
+        self.pesos = np.empty(0)
+        self.n = 0
+        self.minimo = np.inf
+        self.maximo = -np.inf
+
+    def actualizar(self, valores):
+        valores = np.asarray(valores, dtype=float)
+        valores = valores[~np.isnan(valores)]
+        if not len(valores):
+            return self
+        self.minimo = min(self.minimo, valores.min())
+        self.maximo = max(self.maximo, valores.max())
+        return self._comprimir(np.concatenate([self.centros, valores]),
+                               np.concatenate([self.pesos, np.ones(len(valores))]))
+
+    def fusionar(self, otro):
+        self.minimo = min(self.minimo, otro.minimo)
+        self.maximo = max(self.maximo, otro.maximo)
+        return self._comprimir(np.concatenate([self.centros, otro.centros]),
+                               np.concatenate([self.pesos, otro.pesos]))
+
+    def _comprimir(self, centros, pesos):
+        orden = np.argsort(centros, kind='mergesort')
+        centros, pesos = centros[orden], pesos[orden]
+        total = pesos.sum()
+        q = (np.cumsum(pesos) - pesos / 2) / total
+        # Función de escala k1: grupos más finos cerca de los extremos de la distribución
+        k = self.compresion / (2 * np.pi) * np.arcsin(2 * q - 1)
+        grupo = np.floor(k - k.min()).astype(int)
+        inicios = np.flatnonzero(np.r_[True, np.diff(grupo) != 0])
+        pesos_g = np.add.reduceat(pesos, inicios)
+        self.centros = np.add.reduceat(centros * pesos, inicios) / pesos_g
+        self.pesos = pesos_g
+        self.n = int(round(total))
+        return self
+
+    def cuantil(self, q):
+        """Cuantil q (0-1) interpolando linealmente entre centroides"""
+        if self.n == 0:
+            return np.nan
+        if len(self.centros) == 1:
+            return float(self.centros[0])
+        posiciones = (np.cumsum(self.pesos) - self.pesos / 2) / self.n
+        x = np.r_[0.0, posiciones, 1.0]
+        y = np.r_[self.minimo, self.centros, self.maximo]
+        return float(np.interp(q, x, y))
+
+
+def correlaciones_por_bloques(bloques, columnas):
+    """Matriz de correlación y número de filas a partir de un iterable de DataFrames"""
+    acumulador = AcumuladorCovarianza(columnas)
+    filas = 0
+    for bloque in bloques:
+        acumulador.actualizar(_a_numerico(bloque, columnas))
+        filas += len(bloque)
+    return acumulador.correlacion(), filas
+
+
+def anomalias_por_bloques(fabrica_bloques, columnas, max_outliers=1000, compresion=500, limites=None):
+    """Anomalías por IQR en dos pasadas: cuantiles con resúmenes y recuento de valores fuera de rango.
+
+    fabrica_bloques: callable sin argumentos que devuelve un iterable nuevo de DataFrames.
+    limites: {columna: (inferior, superior)} ya calculados (se omite la primera pasada).
+    Devuelve el mismo dict que detect_anomalies; la lista de outliers se limita a max_outliers.
+    """
+    if limites is None:
+        resumenes = {col: ResumenCuantiles(compresion) for col in columnas}
+        for bloque in fabrica_bloques():
+            valores = _a_numerico(bloque, columnas)
+            for i, col in enumerate(columnas):
+                resumenes[col].actualizar(valores[:, i])
+
+        limites = {}
+        for col, resumen in resumenes.items():
+            if resumen.n > 3:
+                limites[col] = _limites_iqr(resumen.cuantil(0.25), resumen.cuantil(0.75))
+    if not limites:
+        return {}
+
+    filas = 0
+    recuentos = dict.fromkeys(limites, 0)
+    ejemplos = {col: [] for col in limites}
+    for bloque in fabrica_bloques():
+        valores = _a_numerico(bloque, columnas)
+        filas += len(valores)
+        for i, col in enumerate(columnas):
+            if col not in limites:
+                continue
+            inferior, superior = limites[col]
+            fuera = valores[(valores[:, i] < inferior) | (valores[:, i] > superior), i]
+            recuentos[col] += len(fuera)
+            if len(ejemplos[col]) < max_outliers:
+                ejemplos[col].extend(fuera[:max_outliers - len(ejemplos[col])].tolist())
+
+    return {
+        col: {
+            "count": recuentos[col],
+            "percentage": (recuentos[col] / filas) * 100 if filas else 0,
+            "outliers": ejemplos[col],
+            "bounds": {"lower": inferior, "upper": superior}
+        }
+        for col, (inferior, superior) in limites.items()
+    }
+
+
+def _limites_iqr(q1, q3):
+    iqr = q3 - q1
+    return (q1 - 1.5 * iqr, q3 + 1.5 * iqr)
+
+
+def _a_numerico(bloque, columnas):
+    return bloque[list(columnas)].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
+
+# --- Agregados en el servidor (PostgreSQL) ------------------------------------
+
+def correlaciones_sql(conn, tabla, columnas, where=None):
+    """Matriz de correlación calculada con corr() en PostgreSQL"""
+    pares = [(a, b) for i, a in enumerate(columnas) for b in columnas[i + 1:]]
+    if not pares:
+        return pd.DataFrame(np.ones((len(columnas), len(columnas))), index=columnas, columns=columnas)
+    expresiones = ', '.join(f"corr({a}::float8, {b}::float8)" for a, b in pares)
+    query = f"SELECT {expresiones} FROM {tabla}" + (f" WHERE {where}" if where else "")
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query)
+        valores = cursor.fetchone()
+    finally:
+        cursor.close()
+
+    corr = pd.DataFrame(np.eye(len(columnas)), index=columnas, columns=columnas)
+    for (a, b), valor in zip(pares, valores):
+        corr.loc[a, b] = corr.loc[b, a] = valor if valor is not None else np.nan
+    return corr
+
+
+def limites_iqr_sql(conn, tabla, columnas, where=None):
+    """Límites IQR por columna con percentile_cont en PostgreSQL (columnas con más de 3 valores)"""
+    expresiones = ', '.join(
+        f"count({col}), percentile_cont(ARRAY[0.25, 0.75]) WITHIN GROUP (ORDER BY {col}::float8)"
+        for col in columnas)
+    query = f"SELECT {expresiones} FROM {tabla}" + (f" WHERE {where}" if where else "")
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query)
+        fila = cursor.fetchone()
+    finally:
+        cursor.close()
+
+    limites = {}
+    for i, col in enumerate(columnas):
+        n, cuartiles = fila[2 * i], fila[2 * i + 1]
+        if n > 3 and cuartiles:
+            limites[col] = _limites_iqr(*cuartiles)
+    return limites
+
+
+# --- Punto de entrada por tabla ------------------------------------------------
+
+def _consulta(tabla, columnas, where):
+    query = f"SELECT {', '.join(columnas)} FROM {tabla}"
+    return query + (f" WHERE {where}" if where else "")
+
+
+def correlaciones_tabla(conn, tabla, columnas, where=None, itersize=ITERSIZE_POR_DEFECTO):
+    """Matriz de correlación de la tabla completa (corr() en PostgreSQL, por bloques en el resto)"""
+    if es_postgres(conn):
+        return correlaciones_sql(conn, tabla, columnas, where)
+    bloques = leer_sql_por_bloques(conn, _consulta(tabla, columnas, where), itersize=itersize)
+    return correlaciones_por_bloques(bloques, columnas)[0]
+
+
+def anomalias_tabla(conn, tabla, columnas, where=None, max_outliers=1000, itersize=ITERSIZE_POR_DEFECTO):
+    """Anomalías por IQR de la tabla completa con el mismo formato que detect_anomalies"""
+    query = _consulta(tabla, columnas, where)
+    limites = limites_iqr_sql(conn, tabla, columnas, where) if es_postgres(conn) else None
+    return anomalias_por_bloques(lambda: leer_sql_por_bloques(conn, query, itersize=itersize),
+                                 columnas, max_outliers=max_outliers, limites=limites)
@@ -0,0 +1,276 @@
+"""
+Caché de esquema y estadísticas de tablas a partir del catálogo del servidor.
+
+COUNT(*) recorre la tabla entera y las consultas a information_schema se
+repetían en cada rerun de Streamlit. Aquí se leen una sola vez (hasta que se
+pide refrescar) las estimaciones que el propio servidor mantiene para el
+planificador:
+
+- PostgreSQL: pg_class.reltuples / relpages, tamaño en disco, fecha del último
+  ANALYZE y pg_stats por columna (null_frac, n_distinct, valores más comunes,
+  histogram_bounds, correlation).
+- MySQL: information_schema.TABLES (TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH) y la
+  cardinalidad de los índices en information_schema.STATISTICS.
+
+Las cifras son estimaciones: tan recientes como el último ANALYZE (o
+autovacuum). refrescar(analizar=True) lanza ANALYZE, que lee una muestra y no
+la tabla completa.
+"""
+import csv
+from datetime import datetime
+
+from lectura_sql import es_mysql
+
+
+TIPOS_NUMERICOS = {
+    # PostgreSQL
+    'smallint', 'integer', 'bigint', 'numeric', 'real', 'double precision',
+    # MySQL
+    'tinyint', 'mediumint', 'int', 'decimal', 'float', 'double',
+}
+
+
+def _parsear_array_pg(texto):
+    """Convertir la representación de texto de un anyarray ('{a,"b c"}') en lista"""
+    if not texto or len(texto) < 2:
+        return []
+    interior = texto[1:-1]
+    if not interior:
+        return []
+    return next(csv.reader([interior], quotechar='"', escapechar='\\'))
+
+
+class CatalogoEstadisticas:
+    """Estructura y estadísticas estimadas de las tablas de un esquema, cacheadas en memoria"""
+
+    def __init__(self, connection, esquema=None):
+        self.connection = connection
+        self.mysql = es_mysql(connection)
+        self.esquema = esquema or (None if self.mysql else 'public')
+        self._estructuras = None
+        self._tablas = {}
+        self._columnas = {}
+        self.cargado_en = None
+
+    def _consultar(self, query, params=None):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        except Exception:
+            if not self.mysql:
+                self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    # --- Estructura -------------------------------------------------------
+
+    def _cargar_estructuras(self):
+        """Leer las columnas de todas las tablas del esquema en una sola consulta"""
+        if self.mysql:
+            filas = self._consultar("""
+                SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE, IS_NULLABLE, COLUMN_DEFAULT
+                FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = COALESCE(%s, DATABASE())
+                ORDER BY TABLE_NAME, ORDINAL_POSITION
+            """, (self.esquema,))
+        else:
+            filas = self._consultar("""
+                SELECT table_name, column_name, data_type, is_nullable, column_default
+                FROM information_schema.columns
+                WHERE table_schema = %s
+                ORDER BY table_name, ordinal_position
+            """, (self.esquema,))
+
+        estructuras = {}
+        for tabla, *columna in filas:
+            estructuras.setdefault(tabla, []).append(tuple(columna))
+        self._estructuras = estructuras
+        self.cargado_en = datetime.now()
+
+    def estructura(self, tabla):
+        """Lista de (columna, tipo, nullable, default) de la tabla"""
+        if self._estructuras is None:
+            self._cargar_estructuras()
+        return self._estructuras.get(tabla, [])
+
+    def columnas_numericas(self, tabla):
+        """Nombres de las columnas numéricas de la tabla"""
+        numericas = []
+        for columna in self.estructura(tabla):
+            tipo = columna[1].decode() if isinstance(columna[1], (bytes, bytearray)) else str(columna[1])
+            if tipo.lower() in TIPOS_NUMERICOS:
+                numericas.append(columna[0])
+        return numericas
+
+    def clave_primaria(self, tabla):
+        """Columnas de la clave primaria de la tabla (lista vacía si no tiene)"""
+        if self.mysql:
+            filas = self._consultar("""
+                SELECT COLUMN_NAME
+                FROM information_schema.KEY_COLUMN_USAGE
+                WHERE TABLE_SCHEMA = COALESCE(%s, DATABASE()) AND TABLE_NAME = %s
+                AND CONSTRAINT_NAME = 'PRIMARY'
+                ORDER BY ORDINAL_POSITION
+            """, (self.esquema, tabla))
+        else:
+            filas = self._consultar("""
+                SELECT a.attname
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indrelid
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = ANY(i.indkey)
+                WHERE n.nspname = %s AND c.relname = %s AND i.indisprimary
+            """, (self.esquema, tabla))
+        return [fila[0] for fila in filas]
+
+    def tablas(self):
+        if self._estructuras is None:
+            self._cargar_estructuras()
+        return sorted(self._estructuras)
+
+    # --- Estadísticas de tabla ----------------------------------------------
+
+    def estadisticas_tabla(self, tabla):
+        """Filas estimadas, tamaño y fecha de la última estadística de la tabla"""
+        if tabla not in self._tablas:
+            self._tablas[tabla] = (self._estadisticas_tabla_mysql(tabla) if self.mysql
+                                   else self._estadisticas_tabla_postgres(tabla))
+        return self._tablas[tabla]
+
+    def _estadisticas_tabla_postgres(self, tabla):
+        filas = self._consultar("""
+            SELECT c.reltuples::bigint,
+                   c.relpages,
+                   pg_total_relation_size(c.oid),
+                   s.n_live_tup,
+                   GREATEST(s.last_analyze, s.last_autoanalyze)
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+            WHERE n.nspname = %s AND c.relname = %s
+        """, (self.esquema, tabla))
+        if not filas:
+            return None
+        reltuples, relpages, tamano, n_live_tup, ultimo_analyze = filas[0]
+        # reltuples = -1 (PG14+) o 0 con páginas: la tabla nunca se ha analizado
+        filas_estimadas = reltuples
+        if reltuples is None or reltuples < 0 or (reltuples == 0 and relpages):
+            filas_estimadas = n_live_tup
+        return {
+            'filas_estimadas': int(filas_estimadas) if filas_estimadas is not None else None,
+            'tamano_bytes': tamano,
+            'paginas': relpages,
+            'ultimo_analyze': ultimo_analyze,
+            'fuente': 'pg_class.reltuples',
+        }
+
+    def _estadisticas_tabla_mysql(self, tabla):
+        filas = self._consultar("""
+            SELECT TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH, UPDATE_TIME
+            FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = COALESCE(%s, DATABASE()) AND TABLE_NAME = %s
+        """, (self.esquema, tabla))
+        if not filas:
+            return None
+        table_rows, data_length, index_length, update_time = filas[0]
+        return {
+            'filas_estimadas': int(table_rows) if table_rows is not None else None,
+            'tamano_bytes': (data_length or 0) + (index_length or 0),
+            'paginas': None,
+            'ultimo_analyze': update_time,
+            'fuente': 'information_schema.TABLES',
+        }
+
+    def filas_estimadas(self, tabla):
+        estadisticas = self.estadisticas_tabla(tabla)
+        return estadisticas['filas_estimadas'] if estadisticas else None
+
+    # --- Estadísticas por columna -------------------------------------------
+
+    def estadisticas_columnas(self, tabla):
+        """Dict columna -> {null_frac, n_distinct, valores_comunes, histograma, correlacion}"""
+        if tabla not in self._columnas:
+            self._columnas[tabla] = (self._estadisticas_columnas_mysql(tabla) if self.mysql
+                                     else self._estadisticas_columnas_postgres(tabla))
+        return self._columnas[tabla]
+
+    def _estadisticas_columnas_postgres(self, tabla):
+        filas = self._consultar("""
+            SELECT attname, null_frac, n_distinct, avg_width,
+                   most_common_vals::text, histogram_bounds::text, correlation
+            FROM pg_stats
+            WHERE schemaname = %s AND tablename = %s
+        """, (self.esquema, tabla))
+        total = self.filas_estimadas(tabla)
+        columnas = {}
+        for attname, null_frac, n_distinct, avg_width, comunes, histograma, correlacion in filas:
+            # n_distinct negativo es una fracción del número de filas
+            distintos = n_distinct
+            if n_distinct is not None and n_distinct < 0:
+                distintos = round(-n_distinct * total) if total else None
+            columnas[attname] = {
+                'null_frac': null_frac,
+                'n_distinct': distintos,
+                'avg_width': avg_width,
+                'valores_comunes': _parsear_array_pg(comunes),
+                'histograma': _parsear_array_pg(histograma),
+                'correlacion': correlacion,
+            }
+        return columnas
+
+    def _estadisticas_columnas_mysql(self, tabla):
+        # MySQL solo expone la cardinalidad estimada de las columnas indexadas
+        filas = self._consultar("""
+            SELECT COLUMN_NAME, MAX(CARDINALITY)
+            FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = COALESCE(%s, DATABASE()) AND TABLE_NAME = %s
+            GROUP BY COLUMN_NAME
+        """, (self.esquema, tabla))
+        return {
+            columna: {
+                'null_frac': None,
+                'n_distinct': cardinalidad,
+                'avg_width': None,
+                'valores_comunes': [],
+                'histograma': [],
+                'correlacion': None,
+            }
+            for columna, cardinalidad in filas
+        }
+
+    # --- Refresco ------------------------------------------------------------
+
+    def refrescar(self, tabla=None, analizar=False):
+        """Vaciar la caché (de una tabla o completa) y, opcionalmente, recalcular las estadísticas en el servidor"""
+        if analizar and tabla:
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute(f"ANALYZE TABLE {tabla}" if self.mysql else f"ANALYZE {tabla}")
+                if self.mysql:
+                    cursor.fetchall()
+                else:
+                    self.connection.commit()
+            finally:
+                cursor.close()
+
+        if tabla:
+            self._tablas.pop(tabla, None)
+            self._columnas.pop(tabla, None)
+        else:
+            self._tablas.clear()
+            self._columnas.clear()
+        self._estructuras = None
+        self.cargado_en = None
+
+
+def formatear_tamano(num_bytes):
+    """Tamaño en bytes legible (KB, MB, GB)"""
+    if num_bytes is None:
+        return 'N/A'
+    tamano = float(num_bytes)
+    for unidad in ('B', 'KB', 'MB', 'GB'):
+        if tamano < 1024 or unidad == 'GB':
+            return f"{tamano:,.0f} {unidad}" if unidad == 'B' else f"{tamano:,.1f} {unidad}"
+        tamano /= 1024
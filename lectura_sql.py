@@ -0,0 +1,169 @@
+"""
+Lectura de resultados SQL por bloques.
+
+pd.read_sql y cursor.fetchall() materializan el resultado completo en el
+cliente: psycopg2 recibe todas las filas en memoria de libpq antes de devolver
+la primera y mysql.connector hace lo mismo con cursores buffered. Aquí se
+centraliza una lectura en streaming:
+
+- PostgreSQL: cursor con nombre (server-side, DECLARE ... CURSOR) y itersize,
+  de modo que el servidor envía las filas en bloques.
+- MySQL: cursor no buffered, leyendo con fetchmany.
+- Otros conectores (sqlite3, etc.): cursor normal con fetchmany.
+
+Las consultas que no son SELECT/WITH (SHOW, DESCRIBE...) no admiten cursores
+con nombre y se leen con un cursor normal.
+"""
+import uuid
+import pandas as pd
+
+ITERSIZE_POR_DEFECTO = 2000
+# Filas por consulta de leer_filas_nuevas (tramos de id)
+FILAS_POR_TRAMO = 50000
+
+
+def es_postgres(conn):
+    """Si la conexión es de psycopg2 (PostgreSQL)"""
+    return type(conn).__module__.startswith('psycopg2')
+
+
+def es_mysql(conn):
+    """Si la conexión es de mysql.connector"""
+    return type(conn).__module__.startswith('mysql')
+
+
+def _es_select(query):
+    return query.lstrip().lstrip('(').lower().startswith(('select', 'with'))
+
+
+def _abrir_cursor(conn, query, itersize):
+    if es_postgres(conn) and _es_select(query):
+        # Cursor server-side; con autocommit necesita WITH HOLD para sobrevivir fuera de la transacción
+        cur = conn.cursor(name=f"lectura_{uuid.uuid4().hex[:12]}", withhold=bool(conn.autocommit))
+        cur.itersize = itersize
+        return cur
+    if es_mysql(conn):
+        return conn.cursor(buffered=False)
+    return conn.cursor()
+
+
+def _cerrar_cursor(conn, cur):
+    try:
+        cur.close()
+    except Exception:
+        # mysql.connector no permite cerrar un cursor no buffered con filas pendientes
+        if es_mysql(conn) and hasattr(conn, 'consume_results'):
+            conn.consume_results()
+            cur.close()
+
+
+def iterar_filas(conn, query, params=None, itersize=ITERSIZE_POR_DEFECTO):
+    """Generador de bloques (columnas, filas) de como máximo itersize filas.
+
+    Si la consulta no devuelve filas no se produce ningún bloque; las columnas
+    siguen disponibles a través de leer_sql_por_bloques.
+    """
+    for columnas, filas in _bloques(conn, query, params, itersize):
+        if filas:
+            yield columnas, filas
+
+
+def _bloques(conn, query, params, itersize):
+    cur = _abrir_cursor(conn, query, itersize)
+    try:
+        if params is not None:
+            cur.execute(query, params)
+        else:
+            cur.execute(query)
+
+        columnas = None
+        while True:
+            filas = cur.fetchmany(itersize)
+            if columnas is None:
+                # En cursores con nombre description solo existe tras el primer fetch
+                columnas = [d[0] for d in cur.description] if cur.description else []
+            if not filas:
+                yield columnas, []
+                break
+            yield columnas, filas
+    except Exception:
+        if es_postgres(conn) and not conn.autocommit:
+            conn.rollback()
+        raise
+    finally:
+        _cerrar_cursor(conn, cur)
+
+
+def leer_sql_por_bloques(conn, query, params=None, itersize=ITERSIZE_POR_DEFECTO):
+    """Generador de DataFrames de como máximo itersize filas.
+
+    Si no hay resultados se produce un único DataFrame vacío con las columnas.
+    """
+    hubo_datos = False
+    for columnas, filas in _bloques(conn, query, params, itersize):
+        if filas:
+            hubo_datos = True
+            yield pd.DataFrame.from_records(filas, columns=columnas, coerce_float=True)
+        elif not hubo_datos:
+            yield pd.DataFrame(columns=columnas)
+
+
+def leer_sql(conn, query, params=None, itersize=ITERSIZE_POR_DEFECTO):
+    """Equivalente a pd.read_sql leyendo por bloques desde el servidor"""
+    bloques = list(leer_sql_por_bloques(conn, query, params, itersize))
+    if not bloques:
+        return pd.DataFrame()
+    if len(bloques) == 1:
+        return bloques[0]
+    return pd.concat(bloques, ignore_index=True)
+
+
+def leer_pagina(conn, query, pagina, tam_pagina, params=None):
+    """Leer una página (0-indexada) de una consulta SELECT con LIMIT/OFFSET en el servidor"""
+    query = query.strip().rstrip(';')
+    paginada = f"SELECT * FROM ({query}) AS pagina_sql LIMIT {int(tam_pagina)} OFFSET {int(pagina) * int(tam_pagina)}"
+    return leer_sql(conn, paginada, params, itersize=max(int(tam_pagina), 1))
+
+
+def leer_filas_nuevas(conn, tabla, columnas, marca_agua=0, condicion=None, itersize=ITERSIZE_POR_DEFECTO,
+                      filas_por_tramo=FILAS_POR_TRAMO):
+    """DataFrames con las filas de tabla cuyo id supera marca_agua, en orden de id.
+
+    Sirve para mantener agregados incrementales: se guarda el mayor id leído y la
+    siguiente lectura solo recorre las filas nuevas (rango sobre la clave primaria).
+    Se lee en tramos de filas_por_tramo filas, cada uno con su propia consulta
+    (id > último id leído ... LIMIT), para que ninguna consulta recorra la tabla
+    entera en la primera carga.
+    """
+    campos = ', '.join(['id'] + [c for c in columnas if c != 'id'])
+    while True:
+        query = f"SELECT {campos} FROM {tabla} WHERE id > {int(marca_agua)}"
+        if condicion:
+            query += f" AND {condicion}"
+        query += f" ORDER BY id LIMIT {int(filas_por_tramo)}"
+        leidas = 0
+        for bloque in leer_sql_por_bloques(conn, query, itersize=itersize):
+            if not bloque.empty:
+                leidas += len(bloque)
+                marca_agua = max(marca_agua, int(bloque['id'].max()))
+                yield bloque
+        if leidas < filas_por_tramo:
+            return
+
+
+def estado_indice(conn, indice):
+    """Estado de un índice de PostgreSQL: 'valido', 'invalido' o None si no existe.
+
+    Un CREATE INDEX CONCURRENTLY interrumpido deja el índice creado pero
+    inválido: el planificador no lo usa y hay que eliminarlo y crearlo de nuevo.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                    "WHERE c.relname = %s", (indice,))
+        fila = cur.fetchone()
+    finally:
+        cur.close()
+    if fila is None:
+        return None
+    return 'valido' if fila[0] else 'invalido'
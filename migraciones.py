@@ -0,0 +1,123 @@
+"""
+Migraciones de esquema que necesitan las búsquedas de la app.
+
+Las columnas generadas y los índices de las búsquedas por texto (y el
+índice de organismos) se creaban desde la propia app, dentro del análisis del
+primer usuario que elegía el modo: ALTER TABLE ... ADD COLUMN ... GENERATED ... STORED reescribe toda la
+tabla con un bloqueo ACCESS EXCLUSIVE y un CREATE INDEX normal bloquea las
+escrituras, los dos sin statement_timeout. Ahora la app solo comprueba en el
+catálogo si existen (y si no, puntúa en local) y se crean con este script:
+
+    python migraciones.py                      # todas las migraciones
+    python migraciones.py trigramas --dsn "host=... dbname=... user=..."
+    python migraciones.py --estado             # solo informar
+
+- Los índices se crean con CREATE INDEX CONCURRENTLY, que no bloquea las
+  escrituras (no puede ir dentro de una transacción: la conexión usa
+  autocommit). Si un intento anterior se interrumpió y dejó el índice
+  inválido, se elimina y se crea de nuevo.
+- Añadir una columna generada STORED reescribe la tabla: conviene lanzarlo en
+  una ventana de mantenimiento. Se espera el bloqueo como mucho
+  --lock-timeout segundos para no dejar en cola detrás del ALTER al resto de
+  sesiones.
+
+La conexión se toma de --dsn, de la variable DATABASE_URL o de la sección
+[postgres] de .streamlit/secrets.toml (la misma que usa la app).
+"""
+import argparse
+import os
+import sys
+import time
+
+from lectura_sql import estado_indice
+from busqueda_texto import (TABLA_POR_DEFECTO, DDL_TRIGRAMAS, INDICE_TRIGRAMAS,
+                            DDL_TEXTO_COMPLETO, INDICE_TEXTO_COMPLETO)
+from organismos import DDL_INDICE_ORGANISMO, INDICE_ORGANISMO
+
+RUTA_SECRETS = os.path.join('.streamlit', 'secrets.toml')
+# Segundos máximos esperando un bloqueo de la tabla
+LOCK_TIMEOUT_S = 10
+
+# Nombre -> (sentencias en orden, índices que crean)
+MIGRACIONES = {
+    'trigramas': (DDL_TRIGRAMAS, [INDICE_TRIGRAMAS]),
+    'texto_completo': (DDL_TEXTO_COMPLETO, [INDICE_TEXTO_COMPLETO]),
+    'organismos': ([DDL_INDICE_ORGANISMO], [INDICE_ORGANISMO]),
+}
+
+
+def dsn_por_defecto():
+    """DSN de DATABASE_URL o de .streamlit/secrets.toml; '' deja que libpq use las variables PG*"""
+    if os.environ.get('DATABASE_URL'):
+        return os.environ['DATABASE_URL']
+    if os.path.exists(RUTA_SECRETS):
+        import tomllib
+        with open(RUTA_SECRETS, 'rb') as f:
+            postgres = tomllib.load(f).get('postgres', {})
+        return ' '.join(f"{clave}={postgres[campo]}" for clave, campo in
+                        [('host', 'host'), ('port', 'port'), ('dbname', 'database'),
+                         ('user', 'user'), ('password', 'password')] if campo in postgres)
+    return ''
+
+
+def _ejecutar(cursor, sentencia):
+    print(f"→ {sentencia}")
+    inicio = time.monotonic()
+    cursor.execute(sentencia)
+    print(f"  {time.monotonic() - inicio:.1f} s")
+
+
+def aplicar(conn, nombre, tabla=TABLA_POR_DEFECTO, lock_timeout_s=LOCK_TIMEOUT_S):
+    """Aplicar una migración (todas sus sentencias son idempotentes)"""
+    ddls, indices = MIGRACIONES[nombre]
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SET statement_timeout = 0")
+        cursor.execute(f"SET lock_timeout = {int(lock_timeout_s * 1000)}")
+        for indice in indices:
+            if estado_indice(conn, indice) == 'invalido':
+                _ejecutar(cursor, f"DROP INDEX CONCURRENTLY IF EXISTS {indice}")
+        for ddl in ddls:
+            _ejecutar(cursor, ddl.format(tabla=tabla))
+    finally:
+        cursor.close()
+
+
+def estado(conn, nombre):
+    """Estado de los índices de una migración: índice -> 'valido' / 'invalido' / None"""
+    return {indice: estado_indice(conn, indice) for indice in MIGRACIONES[nombre][1]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Crear las columnas e índices que usan las búsquedas de la app")
+    parser.add_argument('migraciones', nargs='*', metavar='MIGRACION',
+                        help=f"Migraciones a aplicar (por defecto todas: {', '.join(MIGRACIONES)})")
+    parser.add_argument('--dsn', default=None, help="Cadena de conexión de PostgreSQL")
+    parser.add_argument('--tabla', default=TABLA_POR_DEFECTO)
+    parser.add_argument('--lock-timeout', type=float, default=LOCK_TIMEOUT_S,
+                        help="Segundos máximos esperando el bloqueo de la tabla")
+    parser.add_argument('--estado', action='store_true', help="Solo mostrar qué índices existen")
+    args = parser.parse_args(argv)
+    desconocidas = set(args.migraciones) - set(MIGRACIONES)
+    if desconocidas:
+        parser.error(f"migraciones desconocidas: {', '.join(sorted(desconocidas))}")
+
+    import psycopg2
+    conn = psycopg2.connect(args.dsn if args.dsn is not None else dsn_por_defecto())
+    try:
+        for nombre in args.migraciones or list(MIGRACIONES):
+            print(f"== {nombre}")
+            if not args.estado:
+                try:
+                    aplicar(conn, nombre, args.tabla, args.lock_timeout)
+                except psycopg2.Error as e:
+                    print(f"❌ {nombre}: {e}", file=sys.stderr)
+            for indice, valor in estado(conn, nombre).items():
+                print(f"  {indice}: {valor or 'no existe'}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Muestras aleatorias de tablas calculadas en el servidor.
+
+SELECT ... LIMIT n devuelve las primeras filas en orden físico (normalmente
+de inserción), así que clustering, tendencias o correlaciones sobre ese trozo
+no representan la tabla. Aquí se piden muestras aleatorias al servidor:
+
+- PostgreSQL: TABLESAMPLE SYSTEM (por páginas, muy barato) o BERNOULLI (por
+  filas, recorre la tabla pero solo transfiere la muestra), con REPEATABLE
+  para que la misma semilla devuelva la misma muestra.
+- MySQL: muestra por clave, un hash CRC32 de la clave primaria y la semilla
+  filtrado por umbral, reproducible y uniforme. Sin clave primaria se usa
+  RAND(semilla).
+
+El porcentaje se calcula a partir de las filas estimadas del catálogo
+(estadisticas_tablas); si el filtro WHERE deja menos filas de las pedidas se
+repite la muestra con un porcentaje mayor. La muestra sale algo más grande de
+lo pedido (SOBREMUESTREO), así que se ordena por un hash de la fila y la
+semilla antes del LIMIT: sin ese ORDER BY sobrevivirían las primeras filas en
+orden físico y, con el porcentaje al 100%, la consulta volvería a ser el
+SELECT ... LIMIT n que este módulo sustituye. Solo se leen las columnas pedidas.
+"""
+from estadisticas_tablas import CatalogoEstadisticas
+from lectura_sql import leer_sql
+
+METODOS_POSTGRES = ('SYSTEM', 'BERNOULLI')
+
+# Margen sobre el porcentaje exacto para que la muestra no se quede corta
+SOBREMUESTREO = 1.5
+# Multiplicador del porcentaje en cada reintento cuando faltan filas
+FACTOR_REINTENTO = 4
+
+
+def _lista_columnas(columnas):
+    return ', '.join(columnas) if columnas else '*'
+
+
+def _porcentaje(n, total):
+    if not total or total <= 0:
+        return 100.0
+    return min(100.0, max(0.0001, n / total * 100 * SOBREMUESTREO))
+
+
+def consulta_muestra_postgres(tabla, n, porcentaje, columnas=None, where=None, metodo='SYSTEM', semilla=42):
+    """SQL de una muestra TABLESAMPLE de como máximo n filas"""
+    metodo = metodo.upper()
+    if metodo not in METODOS_POSTGRES:
+        raise ValueError(f"Método de muestreo no soportado: {metodo}")
+    query = (f"SELECT {_lista_columnas(columnas)} FROM {tabla} "
+             f"TABLESAMPLE {metodo} ({porcentaje:.4f}) REPEATABLE ({int(semilla)})")
+    if where:
+        query += f" WHERE {where}"
+    return query + f" ORDER BY md5(ctid::text || '{int(semilla)}') LIMIT {int(n)}"
+
+
+def consulta_muestra_mysql(tabla, n, porcentaje, columnas=None, where=None, clave=None, semilla=42):
+    """SQL de una muestra por clave (hash de la clave primaria) de como máximo n filas"""
+    umbral = int(porcentaje / 100 * 1000000)
+    if clave:
+        hash_clave = f"MOD(CRC32(CONCAT_WS(':', {', '.join(clave)}, {int(semilla)})), 1000000)"
+        condicion = f"{hash_clave} < {umbral}"
+        orden = hash_clave
+    else:
+        condicion = f"RAND({int(semilla)}) < {porcentaje / 100:.6f}"
+        # Otra semilla: el orden no debe depender del valor que ha pasado el filtro
+        orden = f"RAND({int(semilla) + 1})"
+    query = f"SELECT {_lista_columnas(columnas)} FROM {tabla} WHERE {condicion}"
+    if where:
+        query += f" AND ({where})"
+    return query + f" ORDER BY {orden} LIMIT {int(n)}"
+
+
+def leer_muestra(conn, tabla, n, columnas=None, where=None, metodo='SYSTEM', semilla=42, catalogo=None):
+    """DataFrame con una muestra aleatoria de como máximo n filas de la tabla"""
+    catalogo = catalogo or CatalogoEstadisticas(conn)
+    porcentaje = _porcentaje(n, catalogo.filas_estimadas(tabla))
+    clave = catalogo.clave_primaria(tabla) if catalogo.mysql else None
+
+    while True:
+        if catalogo.mysql:
+            query = consulta_muestra_mysql(tabla, n, porcentaje, columnas, where, clave, semilla)
+        else:
+            query = consulta_muestra_postgres(tabla, n, porcentaje, columnas, where, metodo, semilla)
+        muestra = leer_sql(conn, query)
+        if len(muestra) >= n or porcentaje >= 100:
+            return muestra
+        porcentaje = min(100.0, porcentaje * FACTOR_REINTENTO)
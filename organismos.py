@@ -0,0 +1,235 @@
+"""
+Índice de organismos contratantes.
+
+search_previous_licitacion_same_org filtraba con
+LOWER(entidad_compradora) = LOWER('...'): no usa un índice normal, recorre la
+tabla en cada análisis y no encuentra las variantes del mismo comprador
+("Ajuntament de València" / "Ayuntamiento de Valencia" / "AYTO. VALENCIA").
+
+clave_organismo() normaliza el nombre (sin acentos, mayúsculas, sin
+puntuación, tratamientos ni artículos) y une alias (catalán, gallego,
+abreviaturas y topónimos con doble forma oficial). IndiceOrganismos agrupa por
+clave las grafías reales de entidad_compradora y un resumen de adjudicaciones
+por CPV y presupuesto, refrescado de forma incremental por id. Con él la
+búsqueda es una consulta entidad_compradora IN (grafías) que resuelve el
+índice DDL_INDICE_ORGANISMO (lo crea migraciones.py, con CREATE INDEX
+CONCURRENTLY), y se omite cuando el resumen ya dice que el organismo no tiene
+adjudicaciones de ese CPV en ese rango de presupuesto. El índice se carga en
+segundo plano (precarga.py); mientras no termina la primera carga la búsqueda
+compara el nombre directamente.
+"""
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+import pandas as pd
+import streamlit as st
+
+from lectura_sql import leer_filas_nuevas
+from recursos import CPV_8_DIGITOS
+
+TABLA_POR_DEFECTO = 'adjudicaciones_metabase'
+COLUMNAS = ['entidad_compradora', 'cpv', 'importe_total', 'fecha_publicacion']
+# Segundos entre refrescos incrementales
+INTERVALO_REFRESCO = 600
+
+INDICE_ORGANISMO = 'idx_adjudicaciones_entidad_fecha'
+# Se aplica con migraciones.py, nunca desde la app
+DDL_INDICE_ORGANISMO = (
+    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {INDICE_ORGANISMO} "
+    "ON {tabla} (entidad_compradora, fecha_publicacion DESC)"
+)
+
+# Palabra -> forma canónica (tras quitar acentos y pasar a mayúsculas)
+ALIAS = {
+    'AJUNTAMENT': 'AYUNTAMIENTO', 'CONCELLO': 'AYUNTAMIENTO', 'AYTO': 'AYUNTAMIENTO',
+    'AYUNT': 'AYUNTAMIENTO', 'AJUNT': 'AYUNTAMIENTO', 'UDALA': 'AYUNTAMIENTO',
+    'DIPUTACIO': 'DIPUTACION', 'DEPUTACION': 'DIPUTACION', 'DIP': 'DIPUTACION',
+    'CONSELLERIA': 'CONSEJERIA', 'CONSELLARIA': 'CONSEJERIA', 'CONSELL': 'CONSEJO',
+    'UNIVERSITAT': 'UNIVERSIDAD', 'UNIVERSIDADE': 'UNIVERSIDAD',
+    'MANCOMUNITAT': 'MANCOMUNIDAD', 'COMUNITAT': 'COMUNIDAD',
+    'ALACANT': 'ALICANTE', 'CASTELLO': 'CASTELLON', 'GERONA': 'GIRONA', 'LERIDA': 'LLEIDA',
+    'ORENSE': 'OURENSE', 'DONOSTIA': 'SAN SEBASTIAN', 'ELX': 'ELCHE', 'XATIVA': 'JATIVA',
+}
+# Tratamientos y artículos/preposiciones que no distinguen organismos
+PALABRAS_VACIAS = {
+    'EXCMO', 'EXCMA', 'EXCM', 'EXCELENTISIMO', 'EXCELENTISIMA', 'ILMO', 'ILMA', 'ILUSTRISIMO',
+    'ILUSTRISIMA', 'MI', 'M', 'I',
+    'DE', 'DEL', 'LA', 'EL', 'LAS', 'LOS', 'LES', 'ELS', 'L', 'D', 'DA', 'DO', 'DAS', 'DOS', 'A', 'O',
+    'Y', 'E',
+}
+NO_ALFANUMERICO = re.compile(r'[^0-9A-Z]+')
+
+
+def clave_organismo(nombre):
+    """Clave normalizada de un organismo ('' si no hay nombre)"""
+    if not isinstance(nombre, str):
+        return ''
+    texto = unicodedata.normalize('NFKD', nombre).encode('ascii', 'ignore').decode('ascii').upper()
+    palabras = []
+    for palabra in NO_ALFANUMERICO.sub(' ', texto).split():
+        palabra = ALIAS.get(palabra, palabra)
+        if palabra not in PALABRAS_VACIAS:
+            palabras.append(palabra)
+    return ' '.join(palabras)
+
+
+class ResumenOrganismo:
+    """Grafías y adjudicaciones de un organismo por CPV y presupuesto"""
+
+    def __init__(self):
+        self.variantes = Counter()
+        self.adjudicaciones = 0
+        self.por_cpv = Counter()
+        # Prefijo de 4 dígitos -> [presupuesto mínimo, presupuesto máximo]
+        self.presupuestos = {}
+        self.ultima = None
+
+    def copia(self):
+        """Copia independiente (para leerla fuera del lock del índice)"""
+        copia = ResumenOrganismo()
+        copia.variantes = self.variantes.copy()
+        copia.adjudicaciones = self.adjudicaciones
+        copia.por_cpv = self.por_cpv.copy()
+        copia.presupuestos = {prefijo: list(rango) for prefijo, rango in self.presupuestos.items()}
+        copia.ultima = self.ultima
+        return copia
+
+    def actualizar(self, entidad, cpvs, presupuesto, fecha):
+        self.variantes[entidad] += 1
+        self.adjudicaciones += 1
+        self.por_cpv.update(cpvs)
+        if presupuesto is not None:
+            for prefijo in {cpv[:4] for cpv in cpvs}:
+                rango = self.presupuestos.get(prefijo)
+                if rango is None:
+                    self.presupuestos[prefijo] = [presupuesto, presupuesto]
+                else:
+                    rango[0] = min(rango[0], presupuesto)
+                    rango[1] = max(rango[1], presupuesto)
+        if fecha is not None and (self.ultima is None or fecha > self.ultima):
+            self.ultima = fecha
+
+    def adjudicaciones_cpv(self, cpv):
+        """Adjudicaciones con ese CPV (8 dígitos exactos) o prefijo (menos dígitos)"""
+        if len(cpv) >= 8:
+            return self.por_cpv.get(cpv[:8], 0)
+        return sum(n for codigo, n in self.por_cpv.items() if codigo.startswith(cpv))
+
+    def posible(self, cpv, presupuesto_min=None, presupuesto_max=None):
+        """False si con seguridad no hay adjudicaciones del CPV en el rango de presupuesto"""
+        if cpv and not self.adjudicaciones_cpv(cpv):
+            return False
+        if cpv and presupuesto_min is not None:
+            rango = self.presupuestos.get(cpv[:4])
+            if rango is None or rango[1] < presupuesto_min or rango[0] > presupuesto_max:
+                return False
+        return True
+
+    def resumen(self):
+        return {
+            'variantes': dict(self.variantes.most_common()),
+            'adjudicaciones': self.adjudicaciones,
+            'cpv_principales': dict(self.por_cpv.most_common(10)),
+            'presupuestos_por_cpv': {prefijo: tuple(rango) for prefijo, rango in self.presupuestos.items()},
+            'ultima_adjudicacion': self.ultima.strftime('%Y-%m-%d') if self.ultima else None,
+        }
+
+
+def _fecha(valor):
+    try:
+        fecha = pd.Timestamp(valor)
+    except (TypeError, ValueError):
+        return None
+    return None if pd.isna(fecha) else fecha.to_pydatetime()
+
+
+class IndiceOrganismos:
+    """Resúmenes por clave de organismo con refresco incremental por id"""
+
+    def __init__(self, tabla=TABLA_POR_DEFECTO, intervalo=INTERVALO_REFRESCO):
+        self.tabla = tabla
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._refresco = threading.Lock()
+        self._organismos = {}
+        self._claves = {}
+        self.marca_agua = 0
+        self.ultimo_refresco = None
+        self.estadisticas = {'refrescos': 0, 'filas': 0, 'consultas': 0, 'omitidas': 0}
+
+    def __len__(self):
+        return len(self._organismos)
+
+    def cargado(self):
+        return self.ultimo_refresco is not None
+
+    def caducado(self):
+        return self.ultimo_refresco is None or time.monotonic() - self.ultimo_refresco > self.intervalo
+
+    def refrescar(self, conn):
+        """Incorporar las filas nuevas (id > marca de agua). Devuelve el número de filas leídas.
+
+        Si otra sesión ya está refrescando no se espera: se devuelve 0.
+        """
+        if not self._refresco.acquire(blocking=False):
+            return 0
+        try:
+            filas = 0
+            for bloque in leer_filas_nuevas(conn, self.tabla, COLUMNAS, self.marca_agua,
+                                            condicion="entidad_compradora IS NOT NULL"):
+                self._incorporar(bloque)
+                filas += len(bloque)
+                with self._lock:
+                    self.marca_agua = max(self.marca_agua, int(bloque['id'].max()))
+            with self._lock:
+                self.ultimo_refresco = time.monotonic()
+                self.estadisticas['refrescos'] += 1
+                self.estadisticas['filas'] += filas
+            return filas
+        finally:
+            self._refresco.release()
+
+    def _clave(self, entidad):
+        clave = self._claves.get(entidad)
+        if clave is None:
+            clave = self._claves[entidad] = clave_organismo(entidad)
+        return clave
+
+    def _incorporar(self, bloque):
+        importes = pd.to_numeric(bloque['importe_total'], errors='coerce')
+        with self._lock:
+            for entidad, cpv, importe, fecha in zip(bloque['entidad_compradora'], bloque['cpv'],
+                                                    importes, bloque['fecha_publicacion']):
+                clave = self._clave(entidad)
+                if not clave:
+                    continue
+                resumen = self._organismos.get(clave)
+                if resumen is None:
+                    resumen = self._organismos[clave] = ResumenOrganismo()
+                cpvs = set(CPV_8_DIGITOS.findall(str(cpv))) if cpv else set()
+                resumen.actualizar(entidad, cpvs, float(importe) if importe > 0 else None, _fecha(fecha))
+
+    def organismo(self, nombre):
+        """Copia del ResumenOrganismo del organismo (por su clave) o None.
+
+        Es una copia tomada con el lock: otra sesión puede estar incorporando
+        filas al resumen original mientras se lee.
+        """
+        with self._lock:
+            resumen = self._organismos.get(clave_organismo(nombre))
+            return resumen.copia() if resumen else None
+
+    def variantes(self, nombre):
+        """Grafías de entidad_compradora que corresponden al organismo (lista tomada con el lock)"""
+        with self._lock:
+            resumen = self._organismos.get(clave_organismo(nombre))
+            return list(resumen.variantes) if resumen else []
+
+
+@st.cache_resource
+def get_indice_organismos():
+    """Índice compartido por todas las sesiones del proceso"""
+    return IndiceOrganismos()
@@ -0,0 +1,235 @@
+"""
+Perfiles de licitación de las empresas adjudicatarias.
+
+El informe nombra las "empresas más sobresalientes" pero saber cómo suelen
+ofertar exigía consultas a mano. AlmacenPerfiles mantiene, por empresa (clave
+canónica de empresas.py):
+
+- adjudicaciones por prefijo CPV (4 dígitos) y por provincia,
+- media y cuantiles de la baja (resumen fusionable de estadisticas_streaming),
+- rango típico de presupuesto (p25-p75, mínimo y máximo),
+- actividad reciente: adjudicaciones por mes y fecha de la última.
+
+Se rellena leyendo adjudicaciones_metabase por bloques y se refresca de forma
+incremental: solo se leen las filas con id mayor que la marca de agua de la
+última lectura. La carga se hace en segundo plano (precarga.py); hasta que
+termina la primera, cargado() es False y el informe se genera sin perfiles.
+perfil(clave) es una única consulta a un dict.
+"""
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from empresas import get_indice_empresas
+from estadisticas_streaming import ResumenCuantiles
+from lectura_sql import leer_filas_nuevas
+from recursos import CPV_8_DIGITOS
+
+TABLA_POR_DEFECTO = 'adjudicaciones_metabase'
+COLUMNAS = ['adjudicatario', 'cpv', 'provincia', 'importe_total', 'importe_adjudicacion', 'fecha_publicacion']
+DIGITOS_CPV = 4
+# Mismo filtro de bajas que el análisis de competencia
+BAJA_MIN = 0.5
+BAJA_MAX = 70
+# Segundos entre refrescos incrementales
+INTERVALO_REFRESCO = 600
+# Adjudicaciones mínimas para citar el perfil de una empresa en el informe
+MIN_ADJUDICACIONES_INFORME = 3
+
+
+class PerfilEmpresa:
+    """Agregados de las adjudicaciones de una empresa, actualizables por bloques"""
+
+    def __init__(self):
+        self.adjudicaciones = 0
+        self.por_cpv = Counter()
+        self.por_provincia = Counter()
+        self.por_mes = Counter()
+        self.ultima = None
+        self.suma_bajas = 0.0
+        self.n_bajas = 0
+        self.bajas = ResumenCuantiles(compresion=50)
+        self.presupuestos = ResumenCuantiles(compresion=50)
+
+    def actualizar(self, filas):
+        """filas: lista de (prefijos_cpv, provincia, baja, presupuesto, fecha)"""
+        bajas, presupuestos = [], []
+        for prefijos, provincia, baja, presupuesto, fecha in filas:
+            self.adjudicaciones += 1
+            self.por_cpv.update(prefijos)
+            if provincia:
+                self.por_provincia[provincia] += 1
+            if fecha is not None:
+                self.por_mes[fecha.strftime('%Y-%m')] += 1
+                if self.ultima is None or fecha > self.ultima:
+                    self.ultima = fecha
+            if baja is not None:
+                bajas.append(baja)
+            if presupuesto is not None:
+                presupuestos.append(presupuesto)
+        if bajas:
+            self.suma_bajas += sum(bajas)
+            self.n_bajas += len(bajas)
+            self.bajas.actualizar(bajas)
+        if presupuestos:
+            self.presupuestos.actualizar(presupuestos)
+        return self
+
+    def recientes(self, meses=12, hoy=None):
+        """Adjudicaciones en los últimos meses (mes actual incluido)"""
+        hoy = hoy or datetime.now()
+        indice_hoy = hoy.year * 12 + hoy.month - 1
+        total = 0
+        for mes, n in self.por_mes.items():
+            anio, num = map(int, mes.split('-'))
+            if indice_hoy - (anio * 12 + num - 1) < meses:
+                total += n
+        return total
+
+    def resumen(self):
+        return {
+            'adjudicaciones': self.adjudicaciones,
+            'baja_media': self.suma_bajas / self.n_bajas if self.n_bajas else None,
+            'baja_p25': self.bajas.cuantil(0.25) if self.n_bajas else None,
+            'baja_mediana': self.bajas.cuantil(0.5) if self.n_bajas else None,
+            'baja_p75': self.bajas.cuantil(0.75) if self.n_bajas else None,
+            'presupuesto_min': float(self.presupuestos.minimo) if self.presupuestos.n else None,
+            'presupuesto_p25': self.presupuestos.cuantil(0.25) if self.presupuestos.n else None,
+            'presupuesto_p75': self.presupuestos.cuantil(0.75) if self.presupuestos.n else None,
+            'presupuesto_max': float(self.presupuestos.maximo) if self.presupuestos.n else None,
+            'victorias_por_cpv': dict(self.por_cpv.most_common()),
+            'victorias_por_provincia': dict(self.por_provincia.most_common()),
+            'ultima_adjudicacion': self.ultima.strftime('%Y-%m-%d') if self.ultima else None,
+            'adjudicaciones_12_meses': self.recientes(12),
+        }
+
+
+def _fecha(valor):
+    if valor is None or valor is pd.NaT:
+        return None
+    try:
+        fecha = pd.Timestamp(valor)
+    except (TypeError, ValueError):
+        return None
+    return None if pd.isna(fecha) else fecha.to_pydatetime()
+
+
+class AlmacenPerfiles:
+    """Perfiles por clave canónica de empresa con refresco incremental por id"""
+
+    def __init__(self, tabla=TABLA_POR_DEFECTO, intervalo=INTERVALO_REFRESCO):
+        self.tabla = tabla
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._refresco = threading.Lock()
+        self._perfiles = {}
+        self.marca_agua = 0
+        self.ultimo_refresco = None
+        self.estadisticas = {'refrescos': 0, 'filas': 0}
+
+    def __len__(self):
+        return len(self._perfiles)
+
+    def cargado(self):
+        return self.ultimo_refresco is not None
+
+    def caducado(self):
+        return self.ultimo_refresco is None or time.monotonic() - self.ultimo_refresco > self.intervalo
+
+    def refrescar(self, conn):
+        """Incorporar las filas nuevas (id > marca de agua). Devuelve el número de filas leídas.
+
+        Si otra sesión ya está refrescando no se espera: se devuelve 0.
+        """
+        if not self._refresco.acquire(blocking=False):
+            return 0
+        try:
+            filas = 0
+            for bloque in leer_filas_nuevas(conn, self.tabla, COLUMNAS, self.marca_agua,
+                                            condicion="adjudicatario IS NOT NULL"):
+                self._incorporar(bloque)
+                filas += len(bloque)
+                with self._lock:
+                    self.marca_agua = max(self.marca_agua, int(bloque['id'].max()))
+            with self._lock:
+                self.ultimo_refresco = time.monotonic()
+                self.estadisticas['refrescos'] += 1
+                self.estadisticas['filas'] += filas
+            return filas
+        finally:
+            self._refresco.release()
+
+    def _incorporar(self, bloque):
+        indice = get_indice_empresas()
+        total = pd.to_numeric(bloque['importe_total'], errors='coerce').to_numpy(dtype=float)
+        adjudicacion = pd.to_numeric(bloque['importe_adjudicacion'], errors='coerce').to_numpy(dtype=float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bajas = np.where(total > 0, (total - adjudicacion) / total * 100, np.nan)
+
+        # Agrupar el bloque por empresa y actualizar cada perfil una sola vez
+        por_empresa = defaultdict(list)
+        for adj, cpv, provincia, baja, presupuesto, fecha in zip(
+                bloque['adjudicatario'], bloque['cpv'], bloque['provincia'], bajas, total,
+                bloque['fecha_publicacion']):
+            ids = indice.ids(adj)
+            if not ids:
+                continue
+            prefijos = {c[:DIGITOS_CPV] for c in CPV_8_DIGITOS.findall(str(cpv))} if cpv else set()
+            fila = (
+                prefijos,
+                provincia.strip().lower() if isinstance(provincia, str) and provincia.strip() else None,
+                float(baja) if BAJA_MIN <= baja <= BAJA_MAX else None,
+                float(presupuesto) if presupuesto > 0 else None,
+                _fecha(fecha),
+            )
+            for id_ in ids:
+                por_empresa[indice.clave(id_)].append(fila)
+
+        with self._lock:
+            for clave, filas in por_empresa.items():
+                perfil = self._perfiles.get(clave)
+                if perfil is None:
+                    perfil = self._perfiles[clave] = PerfilEmpresa()
+                perfil.actualizar(filas)
+
+    def perfil(self, clave):
+        """Resumen del perfil de la empresa (dict) o None si no tiene adjudicaciones"""
+        with self._lock:
+            perfil = self._perfiles.get(clave)
+            return perfil.resumen() if perfil else None
+
+    def limpiar(self):
+        with self._lock:
+            self._perfiles.clear()
+            self.marca_agua = 0
+            self.ultimo_refresco = None
+
+
+@st.cache_resource
+def get_almacen_perfiles():
+    """Almacén compartido por todas las sesiones del proceso"""
+    return AlmacenPerfiles()
+
+
+def frase_perfiles(empresas):
+    """Frase del informe con la baja habitual de las empresas citadas.
+
+    empresas: lista de (nombre, perfil); solo se citan los perfiles con
+    suficientes adjudicaciones y baja conocida. Devuelve '' si no hay ninguno.
+    """
+    partes = []
+    for nombre, perfil in empresas:
+        if perfil and perfil['adjudicaciones'] >= MIN_ADJUDICACIONES_INFORME and perfil['baja_media'] is not None:
+            partes.append((nombre, perfil))
+    if not partes:
+        return ''
+    descripciones = [f"{nombre} un {perfil['baja_media']:.1f}% ({perfil['adjudicaciones']} adjudicaciones)"
+                     for nombre, perfil in partes]
+    if len(descripciones) > 1:
+        descripciones = [", ".join(descripciones[:-1]) + " y " + descripciones[-1]]
+    return f"Según su histórico, la baja media de {descripciones[0]}."
@@ -0,0 +1,165 @@
+"""
+Perfiles de espacios de nombres de los documentos de licitación.
+
+Los extractores tenían un único mapa de namespaces (UBL/eForms) mientras que
+los documentos de la Plataforma de Contratación usan CODICE (urn:dgpe...). Con
+el mapa equivocado las rutas directas (find('.//cac:...')) no encuentran nada
+y todo acaba en recorridos de root.iter() comparando tag.split('}')[-1].
+
+detectar_perfil() mira una sola vez los espacios de nombres declarados en la
+raíz y elige el perfil (CODICE, eForms o UBL); perfil_documento() lo memoiza
+por familia de documento (publicador + tag raíz), de modo que los siguientes
+documentos de la misma familia no vuelven a inspeccionarse. Con el perfil, las
+rutas directas y root.iter('{uri}Tag') (filtrado en C) aciertan a la primera.
+"""
+import io
+import threading
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+
+ESPACIOS_UBL = {
+    'cac': 'urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2',
+    'cbc': 'urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2',
+    'ext': 'urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2',
+}
+ESPACIOS_EFORMS = dict(ESPACIOS_UBL, **{
+    'efac': 'http://data.europa.eu/p27/eforms-ubl-extensions/1',
+    'efext': 'http://data.europa.eu/p27/eforms-ubl-extension-aggregate-components/1',
+    'efbc': 'http://data.europa.eu/p27/eforms-ubl-extension-basic-components/1',
+})
+ESPACIOS_CODICE = {
+    'cac': 'urn:dgpe:names:draft:codice:schema:xsd:CommonAggregateComponents-2',
+    'cbc': 'urn:dgpe:names:draft:codice:schema:xsd:CommonBasicComponents-2',
+    'ext': 'urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2',
+    'cac-place-ext': 'urn:dgpe:names:draft:codice-place-ext:schema:xsd:CommonAggregateComponents-2',
+    'cbc-place-ext': 'urn:dgpe:names:draft:codice-place-ext:schema:xsd:CommonBasicComponents-2',
+}
+
+
+class PerfilEspacios:
+    """Mapa de prefijos de una familia de documentos y utilidades para construir tags y rutas"""
+
+    def __init__(self, nombre, espacios, marcas):
+        self.nombre = nombre
+        self.espacios = espacios
+        # Prefijos de URI cuya presencia identifica la familia
+        self.marcas = marcas
+        self._rutas = {}
+
+    def coincide(self, uris):
+        return any(uri and uri.startswith(marca) for uri in uris for marca in self.marcas)
+
+    def qn(self, nombre):
+        """Tag en notación Clark: 'cac:ProcurementProject' -> '{urn...}ProcurementProject'"""
+        prefijo, _, local = nombre.rpartition(':')
+        return f"{{{self.espacios[prefijo]}}}{local}" if prefijo else local
+
+    def ruta(self, ruta):
+        """Ruta ElementPath con tags en notación Clark (sirve para find/findall/iterfind)"""
+        if ruta not in self._rutas:
+            self._rutas[ruta] = '/'.join(
+                paso if paso in ('', '.', '..', '*') else self.qn(paso) for paso in ruta.split('/'))
+        return self._rutas[ruta]
+
+    def __repr__(self):
+        return f"PerfilEspacios({self.nombre!r})"
+
+
+# Orden de detección: eForms es UBL con extensiones, así que va antes que UBL
+PERFILES = [
+    PerfilEspacios('codice', ESPACIOS_CODICE, ('urn:dgpe:names:draft:codice',)),
+    PerfilEspacios('eforms', ESPACIOS_EFORMS, ('http://data.europa.eu/p27/eforms',)),
+    PerfilEspacios('ubl', ESPACIOS_UBL, ('urn:oasis:names:specification:ubl:schema:xsd:Common',)),
+]
+PERFILES_POR_NOMBRE = {perfil.nombre: perfil for perfil in PERFILES}
+
+
+def _espacio(tag):
+    return tag[1:].split('}')[0] if isinstance(tag, str) and tag.startswith('{') else None
+
+
+def espacios_declarados(root, contenido=None):
+    """URIs de espacios de nombres declarados en la raíz del documento.
+
+    lxml conserva las declaraciones (nsmap). ElementTree no: si se tiene el
+    contenido se leen los eventos start-ns hasta la primera etiqueta; si no, se
+    usan los namespaces de la raíz y sus hijos directos.
+    """
+    if hasattr(root, 'nsmap'):
+        return set(root.nsmap.values()) | {_espacio(root.tag)}
+    if contenido is not None:
+        uris = set()
+        fuente = io.BytesIO(contenido.encode('utf-8') if isinstance(contenido, str) else contenido)
+        try:
+            for evento, dato in ET.iterparse(fuente, events=('start-ns', 'start')):
+                if evento == 'start':
+                    break
+                uris.add(dato[1])
+            return uris | {_espacio(root.tag)}
+        except ET.ParseError:
+            pass
+    return {_espacio(root.tag)} | {_espacio(hijo.tag) for hijo in root}
+
+
+def detectar_perfil(root, contenido=None):
+    """Perfil cuyo namespace declara el documento, o None si no es de ninguna familia conocida"""
+    uris = espacios_declarados(root, contenido)
+    for perfil in PERFILES:
+        if perfil.coincide(uris):
+            return perfil
+    return None
+
+
+def publicador(url):
+    """Host de una URL (None si no hay URL)"""
+    return urlsplit(url).netloc or None if url else None
+
+
+class CachePerfiles:
+    """Perfil detectado por familia de documento (publicador, tag raíz)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._perfiles = {}
+        self.estadisticas = {'aciertos': 0, 'detecciones': 0}
+
+    def perfil(self, root, origen=None, contenido=None):
+        clave = (publicador(origen), root.tag)
+        with self._lock:
+            if clave in self._perfiles:
+                self.estadisticas['aciertos'] += 1
+                return self._perfiles[clave]
+        perfil = detectar_perfil(root, contenido)
+        with self._lock:
+            self._perfiles[clave] = perfil
+            self.estadisticas['detecciones'] += 1
+        return perfil
+
+    def familias(self):
+        """{(publicador, tag raíz): nombre del perfil}"""
+        with self._lock:
+            return {clave: perfil.nombre if perfil else None for clave, perfil in self._perfiles.items()}
+
+    def limpiar(self):
+        with self._lock:
+            self._perfiles.clear()
+
+
+PERFILES_DOCUMENTO = CachePerfiles()
+
+
+def perfil_documento(root, origen=None, contenido=None):
+    """Perfil del documento memoizado por familia (ver CachePerfiles)"""
+    return PERFILES_DOCUMENTO.perfil(root, origen, contenido)
+
+
+def iter_tag(elemento, perfil, nombre):
+    """Elementos con el tag nombre ('cac:ProcurementProjectLot') bajo elemento, incluido él.
+
+    Con perfil se usa iter() con el tag en notación Clark (filtrado en C); sin
+    perfil, el recorrido completo comparando el nombre local del tag.
+    """
+    if perfil is not None:
+        return elemento.iter(perfil.qn(nombre))
+    local = nombre.rpartition(':')[2]
+    return (e for e in elemento.iter() if isinstance(e.tag, str) and e.tag.rpartition('}')[2] == local)
@@ -0,0 +1,219 @@
+"""
+Planes de extracción de campos de documentos de licitación con XPath compiladas.
+
+Los extractores probaban una lista de rutas root.find(path, namespaces) campo a
+campo y, si ninguna acertaba, recorrían root.iter() comparando subcadenas de
+los tags. Aquí cada campo declara una sola vez su lista ordenada de rutas
+XPath; el plan las compila con lxml al importarse, una vez por familia de
+espacios de nombres (CODICE urn:dgpe..., eForms y UBL urn:oasis..., ver
+perfiles_xml), y evaluar() resuelve todos los campos de una vez sobre el árbol.
+
+Para cada campo gana la primera ruta que produce un valor válido. Las
+estadísticas de aciertos por ruta permiten ver qué rutas aciertan de verdad y
+reordenarlas por tasa de éxito.
+
+Uso:
+    plan = PlanExtraccion([
+        Campo('objeto', ['.//cac:ProcurementProject/cbc:Name'], convertir=texto_minimo(15)),
+        Campo('cpv', ['.//cbc:ItemClassificationCode'], convertir=codigo_cpv, multiple=True),
+    ])
+    valores, rutas = plan.evaluar(documento_xml(contenido))
+"""
+import re
+import threading
+
+from lxml import etree
+
+from perfiles_xml import PERFILES, perfil_documento
+
+FAMILIAS = {perfil.nombre: perfil.espacios for perfil in PERFILES}
+
+# Parser sin resolución de entidades externas ni acceso a red
+_PARSER = etree.XMLParser(resolve_entities=False, no_network=True, remove_comments=True)
+
+NUMERO = re.compile(r'(\d+\.?\d*)')
+NO_DIGITOS = re.compile(r'[^\d]')
+CPV_8 = re.compile(r'\d{8}')
+
+
+def documento_xml(contenido):
+    """Árbol lxml de un documento XML (bytes o str)"""
+    if isinstance(contenido, str):
+        contenido = contenido.encode('utf-8')
+    return etree.fromstring(contenido, parser=_PARSER)
+
+
+def familia_documento(root, origen=None):
+    """Familia de espacios de nombres del documento ('codice', 'eforms' o 'ubl').
+
+    Se resuelve con el perfil memoizado por publicador y tag raíz (perfiles_xml);
+    los documentos de familia desconocida se tratan como UBL.
+    """
+    perfil = perfil_documento(root, origen)
+    return perfil.nombre if perfil else 'ubl'
+
+
+# --- Conversores: nodo -> valor (None si el nodo no sirve) --------------------
+
+def _texto(nodo):
+    return nodo.text.strip() if isinstance(nodo.text, str) else ''
+
+
+def texto_minimo(longitud):
+    """Texto del nodo si tiene más de longitud caracteres"""
+    def convertir(nodo):
+        texto = _texto(nodo)
+        return texto if len(texto) > longitud else None
+    return convertir
+
+
+def importe_minimo(minimo):
+    """Primer número del texto del nodo si es mayor que minimo"""
+    def convertir(nodo):
+        match = NUMERO.search(_texto(nodo).replace(',', '.'))
+        if match:
+            valor = float(match.group(1))
+            if valor > minimo:
+                return valor
+        return None
+    return convertir
+
+
+def numero(nodo):
+    try:
+        return float(_texto(nodo))
+    except ValueError:
+        return None
+
+
+def codigo_cpv(nodo):
+    """CPV de 8 dígitos de un ItemClassificationCode"""
+    cpv = NO_DIGITOS.sub('', _texto(nodo))[:8]
+    return cpv if len(cpv) == 8 else None
+
+
+def cpvs_en_texto(nodo):
+    """Todos los códigos de 8 dígitos del texto del nodo"""
+    return CPV_8.findall(_texto(nodo)) or None
+
+
+def elemento(nodo):
+    return nodo
+
+
+class Campo:
+    """Campo del plan: rutas XPath en orden de prioridad y conversor del nodo al valor.
+
+    rutas: lista de XPath (prefijos cac/cbc/...) o de tuplas (XPath, conversor) cuando
+    una ruta necesita un conversor distinto del del campo.
+    multiple: devolver todos los valores de la primera ruta que acierte (lista).
+    """
+
+    def __init__(self, nombre, rutas, convertir=elemento, multiple=False):
+        self.nombre = nombre
+        self.rutas = [ruta if isinstance(ruta, tuple) else (ruta, convertir) for ruta in rutas]
+        self.multiple = multiple
+
+
+class EstadisticasPlan:
+    """Intentos y aciertos por (campo, ruta), compartibles entre hilos"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.intentos = {}
+        self.aciertos = {}
+        self.evaluaciones = {}
+
+    def registrar(self, campo, intentadas, acertada):
+        with self._lock:
+            self.evaluaciones[campo] = self.evaluaciones.get(campo, 0) + 1
+            for ruta in intentadas:
+                self.intentos[(campo, ruta)] = self.intentos.get((campo, ruta), 0) + 1
+            if acertada is not None:
+                self.aciertos[(campo, acertada)] = self.aciertos.get((campo, acertada), 0) + 1
+
+    def tabla(self):
+        """Lista de dicts {campo, ruta, intentos, aciertos, tasa_acierto}"""
+        with self._lock:
+            filas = []
+            for (campo, ruta), intentos in self.intentos.items():
+                aciertos = self.aciertos.get((campo, ruta), 0)
+                filas.append({
+                    'campo': campo,
+                    'ruta': ruta,
+                    'intentos': intentos,
+                    'aciertos': aciertos,
+                    'tasa_acierto': round(aciertos / intentos, 3) if intentos else 0.0,
+                })
+        return filas
+
+    def rutas_por_exito(self, campo):
+        """Rutas del campo ordenadas por aciertos sobre evaluaciones del campo (mayor primero)"""
+        with self._lock:
+            total = self.evaluaciones.get(campo, 0)
+            rutas = {ruta: n for (c, ruta), n in self.aciertos.items() if c == campo}
+        return sorted(rutas, key=lambda ruta: rutas[ruta] / total if total else 0, reverse=True)
+
+    def limpiar(self):
+        with self._lock:
+            self.intentos.clear()
+            self.aciertos.clear()
+            self.evaluaciones.clear()
+
+
+ESTADISTICAS = EstadisticasPlan()
+
+
+class PlanExtraccion:
+    """Campos con sus rutas XPath compiladas para cada familia de espacios de nombres"""
+
+    def __init__(self, campos, familias=None, estadisticas=None):
+        self.campos = list(campos)
+        self.familias = familias or FAMILIAS
+        self.estadisticas = estadisticas if estadisticas is not None else ESTADISTICAS
+        # compiladas[familia][campo] = [(ruta, XPath compilada, conversor)]
+        self.compiladas = {
+            familia: {
+                campo.nombre: [(ruta, etree.XPath(ruta, namespaces=espacios), convertir)
+                               for ruta, convertir in campo.rutas]
+                for campo in self.campos
+            }
+            for familia, espacios in self.familias.items()
+        }
+
+    def evaluar(self, nodo, familia=None, campos=None):
+        """Resolver los campos sobre nodo.
+
+        Devuelve (valores, rutas): {campo: valor} y {campo: ruta que acertó o None}.
+        Los campos sin acierto valen None (o [] si son múltiples).
+        """
+        familia = familia or familia_documento(nodo.getroottree().getroot())
+        compiladas = self.compiladas.get(familia) or next(iter(self.compiladas.values()))
+        valores, rutas = {}, {}
+        for campo in self.campos:
+            if campos is not None and campo.nombre not in campos:
+                continue
+            valor, intentadas, acertada = self._evaluar_campo(nodo, campo, compiladas[campo.nombre])
+            valores[campo.nombre] = valor
+            rutas[campo.nombre] = acertada
+            self.estadisticas.registrar(campo.nombre, intentadas, acertada)
+        return valores, rutas
+
+    def _evaluar_campo(self, nodo, campo, compiladas):
+        intentadas = []
+        for ruta, xpath, convertir in compiladas:
+            intentadas.append(ruta)
+            encontrados = []
+            for resultado in xpath(nodo):
+                valor = convertir(resultado)
+                if valor is None:
+                    continue
+                if not campo.multiple:
+                    return valor, intentadas, ruta
+                if isinstance(valor, list):
+                    encontrados.extend(valor)
+                else:
+                    encontrados.append(valor)
+            if encontrados:
+                return encontrados, intentadas, ruta
+        return ([] if campo.multiple else None), intentadas, None
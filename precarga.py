@@ -0,0 +1,68 @@
+"""
+Carga en segundo plano de los almacenes compartidos por las sesiones.
+
+El almacén de perfiles de empresas y el índice de organismos se construían
+dentro del análisis del primer usuario (y otra vez en cada reinicio del
+proceso): con la marca de agua a 0 leían toda adjudicaciones_metabase bajo un
+spinner, y con el statement_timeout de las conexiones de la app la lectura
+completa acababa cancelada una y otra vez.
+
+refrescar_en_segundo_plano() lanza el refresco en un hilo con su propia
+conexión y vuelve enseguida. El almacén lee con leer_filas_nuevas() por
+tramos de id (una consulta corta por tramo, cada una dentro del
+statement_timeout) y avanza la marca de agua tras cada bloque, así que una
+interrupción no pierde lo leído. El error del último refresco fallido queda
+en almacen.estadisticas['error']. Mientras un almacén no está cargado el
+análisis se sirve sin él: el informe sin perfiles de empresas y la búsqueda
+por organismo comparando el nombre.
+"""
+import threading
+
+from lectura_sql import es_postgres
+
+_lock = threading.Lock()
+_hilos = {}
+
+
+def en_curso(almacen):
+    """Si hay un refresco en segundo plano del almacén en marcha"""
+    with _lock:
+        hilo = _hilos.get(id(almacen))
+        return hilo is not None and hilo.is_alive()
+
+
+def refrescar_en_segundo_plano(almacen, conectar):
+    """Refrescar el almacén en un hilo si ha caducado y no hay otro refresco en marcha.
+
+    conectar: función sin argumentos que abre una conexión nueva (o devuelve
+    None); se llama en el hilo del que pide el refresco y el hilo la cierra al
+    terminar. Devuelve True si se ha lanzado un refresco.
+    """
+    with _lock:
+        hilo = _hilos.get(id(almacen))
+        if not almacen.caducado() or (hilo is not None and hilo.is_alive()):
+            return False
+        conn = conectar()
+        if conn is None:
+            return False
+        hilo = threading.Thread(target=_refrescar, args=(almacen, conn),
+                                name=f"precarga_{type(almacen).__name__}", daemon=True)
+        _hilos[id(almacen)] = hilo
+    hilo.start()
+    return True
+
+
+def _refrescar(almacen, conn):
+    try:
+        if es_postgres(conn):
+            # Cada tramo es su propia consulta: sin una transacción abierta durante toda la carga
+            conn.autocommit = True
+        almacen.refrescar(conn)
+        almacen.estadisticas.pop('error', None)
+    except Exception as e:
+        almacen.estadisticas['error'] = str(e)
+    finally:
+        try:
+            conn.close()
+        except Exception:
+            pass
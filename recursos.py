@@ -0,0 +1,65 @@
+"""
+Recursos compartidos por las aplicaciones Streamlit del proyecto.
+
+Streamlit vuelve a ejecutar el script principal en cada interacción, por lo que
+cualquier objeto costoso creado a nivel de módulo en la página se reconstruye en
+cada rerun. Este módulo se importa (y por tanto se evalúa) una sola vez por
+proceso: aquí viven las expresiones regulares compiladas y las factorías
+cacheadas con st.cache_resource para objetos sin estado de usuario (descargador
+HTTP compartido). Las dependencias pesadas (sklearn) se importan dentro de las
+funciones, la primera vez que se necesitan.
+"""
+import re
+import streamlit as st
+
+# Patrones de importes usados por extract_price_from_text en los distintos generadores
+PATRONES_PRECIO = [
+    re.compile(r'(\d+\.?\d*)\s*€', re.IGNORECASE),
+    re.compile(r'€\s*(\d+\.?\d*)', re.IGNORECASE),
+    re.compile(r'(\d+\.?\d*)\s*euros?', re.IGNORECASE),
+    re.compile(r'euros?\s*(\d+\.?\d*)', re.IGNORECASE),
+    re.compile(r'importe[:\s]*(\d+\.?\d*)', re.IGNORECASE),
+    re.compile(r'precio[:\s]*(\d+\.?\d*)', re.IGNORECASE),
+    re.compile(r'valor[:\s]*(\d+\.?\d*)', re.IGNORECASE),
+    re.compile(r'(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)', re.IGNORECASE)
+]
+
+# Variante reducida (símbolo €, palabra "euros" y número con separadores)
+PATRONES_PRECIO_BASICOS = [PATRONES_PRECIO[0], PATRONES_PRECIO[1], PATRONES_PRECIO[2], PATRONES_PRECIO[7]]
+
+CPV_8_DIGITOS = re.compile(r'(\d{8})')
+SUFIJOS_SOCIETARIOS = re.compile(r'\b(S\.?L\.?|S\.?A\.?|S\.?L\.?U\.?)\b', re.IGNORECASE)
+
+
+def extraer_precio(text, patrones=PATRONES_PRECIO):
+    """Aplicar los patrones compilados sobre un texto ya normalizado y devolver el primer importe válido"""
+    for pattern in patrones:
+        matches = pattern.findall(text)
+        if matches:
+            try:
+                return float(matches[0].replace(',', '.'))
+            except:
+                continue
+    return None
+
+
+@st.cache_resource
+def get_descargador(user_agent=None):
+    """Descargador HTTP compartido (sesión, límites por host y reintentos) para los scrapers"""
+    from descargas import Descargador
+    headers = {'User-Agent': user_agent} if user_agent else None
+    return Descargador(headers=headers, max_por_host=4, por_segundo=5)
+
+
+def calcular_similitud_tfidf(text1, text2, **params):
+    """Similitud coseno TF-IDF entre dos textos.
+
+    Cada llamada ajusta su propio vectorizador (params se pasan a
+    TfidfVectorizer). Las excepciones se propagan al llamador.
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    vectorizer = TfidfVectorizer(**params)
+    tfidf_matrix = vectorizer.fit_transform([str(text1), str(text2)])
+    return cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
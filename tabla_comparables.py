@@ -0,0 +1,159 @@
+"""
+Presentación de los contratos comparables y de los mensajes de la búsqueda.
+
+Las secciones de resultados escribían cada contrato campo a campo con
+st.write/st.markdown/st.columns (y buscar_contratos escribía cada línea del
+top 10), cientos de mensajes por el websocket por lote y un renderizado lento
+en las tabletas. Aquí:
+
+- mostrar_comparables(): una única tabla st.dataframe (serializada con Arrow,
+  columnas ordenables y desplazamiento virtualizado) y, al seleccionar una
+  fila, su ficha de detalle en un solo bloque de markdown.
+- LogBusqueda: recoge los mensajes de diagnóstico de la búsqueda (hasta
+  MAX_MENSAJES) y los muestra juntos en un expander plegado.
+"""
+from datetime import datetime
+
+import pandas as pd
+import streamlit as st
+
+# Mensajes que se guardan por búsqueda; el resto solo se cuentan
+MAX_MENSAJES = 200
+# Filas visibles de la tabla antes de desplazarse (35 px por fila más la cabecera)
+FILAS_VISIBLES = 12
+
+ICONOS_NIVEL = {'warning': '⚠️ ', 'error': '❌ '}
+
+
+class LogBusqueda:
+    """Mensajes de diagnóstico de una búsqueda, mostrados de una vez en un expander"""
+
+    def __init__(self, max_mensajes=MAX_MENSAJES):
+        self.max_mensajes = max_mensajes
+        self.mensajes = []
+        self.omitidos = 0
+
+    def __len__(self):
+        return len(self.mensajes) + self.omitidos
+
+    def _anadir(self, nivel, texto):
+        if len(self.mensajes) < self.max_mensajes:
+            self.mensajes.append((nivel, str(texto)))
+        else:
+            self.omitidos += 1
+
+    def info(self, texto):
+        self._anadir('info', texto)
+
+    def success(self, texto):
+        self._anadir('success', texto)
+
+    def warning(self, texto):
+        self._anadir('warning', texto)
+
+    def write(self, texto):
+        self._anadir('write', texto)
+
+    def text(self, texto):
+        self._anadir('text', f"`{texto}`")
+
+    def avisos(self):
+        return sum(1 for nivel, _ in self.mensajes if nivel == 'warning')
+
+    def mostrar(self, titulo="🧾 Detalle de la búsqueda"):
+        """Un único expander plegado con todos los mensajes"""
+        if not len(self):
+            return
+        avisos = self.avisos()
+        etiqueta = f"{titulo} ({len(self)} mensajes{f', {avisos} avisos' if avisos else ''})"
+        lineas = [ICONOS_NIVEL.get(nivel, '') + texto if not texto.startswith(('⚠', '❌')) else texto
+                  for nivel, texto in self.mensajes]
+        if self.omitidos:
+            lineas.append(f"… {self.omitidos} mensajes más no mostrados")
+        with st.expander(etiqueta, expanded=False):
+            st.markdown("\n\n".join(lineas))
+
+
+def _fecha(valor):
+    if not valor:
+        return None
+    if isinstance(valor, datetime):
+        return valor
+    fecha = pd.to_datetime(str(valor)[:10], errors='coerce')
+    return None if pd.isna(fecha) else fecha
+
+
+def tabla_comparables(contratos):
+    """DataFrame de presentación de los contratos comparables (una fila por contrato)"""
+    filas = []
+    for c in contratos:
+        palabras = c.get('palabras_comunes') or set()
+        filas.append({
+            'Título': c.get('titulo') or '',
+            'Organismo': c.get('organismo') or '',
+            'Adjudicatario': c.get('empresa') or 'N/A',
+            'Provincia': c.get('provincia') or '',
+            'Fecha': _fecha(c.get('fecha_publicacion')),
+            'Presupuesto': float(c['importe_total']) if c.get('importe_total') is not None else None,
+            'Adjudicación': float(c['importe_adjudicacion']) if c.get('importe_adjudicacion') is not None else None,
+            'Baja %': float(c['baja']) if c.get('baja') is not None else None,
+            'Licitadores': int(c['numero_licitadores']) if c.get('numero_licitadores') else None,
+            'Zona': '📍' if c.get('proximidad', 0) == 1 else '📌',
+            'Palabras': ', '.join(sorted(palabras)),
+            'CPV': str(c.get('cpv') or ''),
+        })
+    df = pd.DataFrame(filas)
+    if not df.empty:
+        df.index = pd.RangeIndex(1, len(df) + 1, name='#')
+    return df
+
+
+CONFIGURACION_COLUMNAS = {
+    'Título': st.column_config.TextColumn(width='large'),
+    'Fecha': st.column_config.DateColumn(format='YYYY-MM-DD'),
+    'Presupuesto': st.column_config.NumberColumn(format='€%.2f'),
+    'Adjudicación': st.column_config.NumberColumn(format='€%.2f'),
+    'Baja %': st.column_config.NumberColumn(format='%.2f%%'),
+    'Zona': st.column_config.TextColumn(help="📍 misma provincia · 📌 otra provincia", width='small'),
+}
+
+
+def _ficha(contrato):
+    """Detalle de un contrato en un solo bloque de markdown"""
+    fecha = str(contrato['fecha_publicacion'])[:10] if contrato.get('fecha_publicacion') else 'N/A'
+    palabras = ', '.join(sorted(contrato.get('palabras_comunes') or [])) or '—'
+    return "\n".join([
+        f"**{contrato.get('titulo', '')}**",
+        "",
+        f"- **📍 Organismo:** {contrato.get('organismo', 'N/A')}",
+        f"- **🏢 Adjudicatario:** {contrato.get('empresa', 'N/A')}",
+        f"- **📍 Provincia:** {contrato.get('provincia') or 'N/A'} · **🔢 CPV:** {contrato.get('cpv', 'N/A')}",
+        f"- **💰 Presupuesto:** €{contrato['importe_total']:,.2f} · **💵 Adjudicación:** "
+        f"€{contrato['importe_adjudicacion']:,.2f} · **📉 Baja:** {contrato['baja']:.2f}%",
+        f"- **📅 Fecha:** {fecha} · **👥 Licitadores:** {contrato.get('numero_licitadores') or 'N/A'}",
+        f"- **💡 Palabras clave coincidentes:** {palabras}",
+    ])
+
+
+def mostrar_comparables(contratos, clave):
+    """Tabla de comparables con ficha de la fila seleccionada.
+
+    clave: identificador único de la tabla en la página (p. ej. el número de lote).
+    """
+    df = tabla_comparables(contratos)
+    if df.empty:
+        return
+    seleccion = st.dataframe(
+        df,
+        column_config=CONFIGURACION_COLUMNAS,
+        height=min(len(df), FILAS_VISIBLES) * 35 + 38,
+        width='stretch',
+        on_select='rerun',
+        selection_mode='single-row',
+        key=f"comparables_{clave}",
+    )
+    filas = seleccion.selection.rows if seleccion else []
+    if filas:
+        st.markdown(_ficha(contratos[filas[0]]))
+    else:
+        st.caption("Selecciona una fila para ver el detalle del contrato; pulsa en una cabecera para ordenar.")
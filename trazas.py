@@ -0,0 +1,226 @@
+"""
+Trazas ligeras por etapas para medir dónde se va el tiempo de un análisis.
+
+Cada etapa se mide con un span (context manager) que registra tiempo de reloj,
+tiempo de CPU, filas procesadas y atributos libres. Los spans se anidan
+formando un árbol bajo la traza activa del hilo/contexto actual.
+
+Si no hay traza activa (iniciar_traza no se ha llamado), span() devuelve un
+objeto nulo compartido y el decorador trazar() llama directamente a la
+función, de modo que el coste con las trazas desactivadas es una consulta a
+una ContextVar.
+
+Uso:
+    traza = iniciar_traza("analisis")
+    with span("consulta_sql") as s:
+        ...
+        s.filas = len(resultados)
+    finalizar_traza(traza)
+    traza.to_dict()
+"""
+import functools
+import json
+import os
+import time
+from contextvars import ContextVar
+from datetime import datetime
+
+_traza_actual = ContextVar('traza_actual', default=None)
+
+
+class Span:
+    """Etapa medida: tiempos, filas, atributos y etapas hijas"""
+
+    __slots__ = ('nombre', 'atributos', 'filas', 'hijos', 'wall_ms', 'cpu_ms', 'error',
+                 '_traza', '_t0', '_c0')
+
+    def __init__(self, nombre, traza=None, **atributos):
+        self.nombre = nombre
+        self.atributos = atributos
+        self.filas = None
+        self.hijos = []
+        self.wall_ms = None
+        self.cpu_ms = None
+        self.error = None
+        self._traza = traza
+        self._t0 = None
+        self._c0 = None
+
+    def anotar(self, **atributos):
+        """Añadir atributos libres al span (parámetros, tamaños, etc.)"""
+        self.atributos.update(atributos)
+
+    def _iniciar(self):
+        self._t0 = time.perf_counter()
+        self._c0 = time.process_time()
+
+    def _cerrar(self):
+        self.wall_ms = (time.perf_counter() - self._t0) * 1000
+        self.cpu_ms = (time.process_time() - self._c0) * 1000
+
+    def __enter__(self):
+        traza = self._traza
+        traza.pila[-1].hijos.append(self)
+        traza.pila.append(self)
+        self._iniciar()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._cerrar()
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        pila = self._traza.pila
+        if pila and pila[-1] is self:
+            pila.pop()
+        return False
+
+    def to_dict(self):
+        datos = {
+            'nombre': self.nombre,
+            'wall_ms': round(self.wall_ms, 3) if self.wall_ms is not None else None,
+            'cpu_ms': round(self.cpu_ms, 3) if self.cpu_ms is not None else None,
+        }
+        if self.filas is not None:
+            datos['filas'] = self.filas
+        if self.atributos:
+            datos['atributos'] = {k: _serializable(v) for k, v in self.atributos.items()}
+        if self.error:
+            datos['error'] = self.error
+        if self.hijos:
+            datos['hijos'] = [h.to_dict() for h in self.hijos]
+        return datos
+
+
+class _SpanNulo:
+    """Span sin efecto usado cuando no hay traza activa"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __setattr__(self, nombre, valor):
+        pass
+
+    def anotar(self, **atributos):
+        pass
+
+
+SPAN_NULO = _SpanNulo()
+
+
+class Traza:
+    """Árbol de spans de una ejecución (por ejemplo, un análisis completo)"""
+
+    def __init__(self, nombre, **atributos):
+        self.raiz = Span(nombre, self, **atributos)
+        self.pila = [self.raiz]
+        self.inicio = datetime.now()
+        self._token = None
+
+    def to_dict(self):
+        datos = self.raiz.to_dict()
+        datos['inicio'] = self.inicio.isoformat(timespec='seconds')
+        return datos
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), ensure_ascii=False, **kwargs)
+
+
+def formatear_traza(datos, nivel=0):
+    """Árbol de una traza (en formato to_dict) como lista de líneas de texto"""
+    texto = f"{'  ' * nivel}{datos['nombre']}: {datos.get('wall_ms') or 0:.1f} ms (CPU {datos.get('cpu_ms') or 0:.1f} ms)"
+    if datos.get('filas') is not None:
+        texto += f" · {datos['filas']} filas"
+    if datos.get('error'):
+        texto += f" · ERROR {datos['error']}"
+    lineas = [texto]
+    for hijo in datos.get('hijos', []):
+        lineas.extend(formatear_traza(hijo, nivel + 1))
+    return lineas
+
+
+def _serializable(valor):
+    if isinstance(valor, (str, int, float, bool)) or valor is None:
+        return valor
+    return str(valor)
+
+
+def iniciar_traza(nombre, **atributos):
+    """Activar una traza nueva en el contexto actual y devolverla"""
+    traza = Traza(nombre, **atributos)
+    traza._token = _traza_actual.set(traza)
+    traza.raiz._iniciar()
+    return traza
+
+
+def finalizar_traza(traza, ruta_log=None):
+    """Cerrar la traza, desactivarla y, si procede, añadirla como línea JSON al log.
+
+    Si no se indica ruta_log se usa la variable de entorno TRAZAS_LOG (si existe).
+    """
+    traza.raiz._cerrar()
+    if traza._token is not None:
+        try:
+            _traza_actual.reset(traza._token)
+        except ValueError:
+            # Token de otro contexto: basta con desactivar la traza
+            _traza_actual.set(None)
+        traza._token = None
+
+    ruta_log = ruta_log or os.environ.get('TRAZAS_LOG')
+    if ruta_log:
+        try:
+            with open(ruta_log, 'a', encoding='utf-8') as f:
+                f.write(traza.to_json() + '\n')
+        except OSError:
+            pass
+    return traza
+
+
+def traza_activa():
+    return _traza_actual.get()
+
+
+def span(nombre, **atributos):
+    """Context manager que mide una etapa dentro de la traza activa"""
+    traza = _traza_actual.get()
+    if traza is None:
+        return SPAN_NULO
+    return Span(nombre, traza, **atributos)
+
+
+def span_actual():
+    """Span abierto más interno de la traza activa (o el span nulo)"""
+    traza = _traza_actual.get()
+    if traza is None:
+        return SPAN_NULO
+    return traza.pila[-1]
+
+
+def trazar(nombre=None, filas=None):
+    """Decorador que envuelve la función en un span.
+
+    filas: callable opcional que recibe el resultado y devuelve el número de filas.
+    """
+    def decorador(func):
+        nombre_span = nombre or func.__name__
+
+        @functools.wraps(func)
+        def envoltura(*args, **kwargs):
+            traza = _traza_actual.get()
+            if traza is None:
+                return func(*args, **kwargs)
+            with Span(nombre_span, traza) as s:
+                resultado = func(*args, **kwargs)
+                if filas is not None and s.filas is None:
+                    try:
+                        s.filas = filas(resultado)
+                    except Exception:
+                        pass
+                return resultado
+        return envoltura
+    return decorador
@@ -1,20 +1,270 @@
-import mysql.connector
 import pandas as pd
 import streamlit as st
-import plotly.express as px
-import plotly.graph_objects as go
 from datetime import datetime, timedelta
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import re
 import random
 import requests
-from bs4 import BeautifulSoup
 import time
 import warnings
+from recursos import extraer_precio, calcular_similitud_tfidf, get_descargador, PATRONES_PRECIO_BASICOS
+from lectura_sql import leer_sql
+# mysql.connector, BeautifulSoup, lxml y sklearn se importan en las funciones que los usan
 warnings.filterwarnings('ignore')
 
+# Patrones de la página de detalle de un expediente, compilados una sola vez
+PATRONES_PRESUPUESTO = [re.compile(p, re.IGNORECASE | re.DOTALL) for p in [
+    r'Presupuesto.*?sin.*?impuestos.*?(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)',
+    r'Valor.*?estimado.*?(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)',
+    r'Presupuesto.*?base.*?(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)',
+    r'(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)\s*€.*?sin.*?impuestos',
+    r'(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)\s*euros.*?sin.*?IVA'
+]]
+PATRONES_LOCALIDAD = [re.compile(p, re.IGNORECASE) for p in [
+    r'Lugar.*?ejecución.*?([A-ZÁÉÍÓÚ][a-záéíóúñ\s]+)',
+    r'Localidad.*?([A-ZÁÉÍÓÚ][a-záéíóúñ\s]+)',
+    r'Provincia.*?([A-ZÁÉÍÓÚ][a-záéíóúñ\s]+)',
+    r'Ubicación.*?([A-ZÁÉÍÓÚ][a-záéíóúñ\s]+)'
+]]
+PATRONES_CPV = [re.compile(p) for p in [
+    r'CPV.*?(\d{8})',
+    r'(\d{8}).*?CPV',
+    r'Código.*?CPV.*?(\d{8})',
+    r'(\d{8}-\d)',
+]]
+IMPORTE = re.compile(r'(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)')
+OBJETO_TD = re.compile(r'Objeto.*contrato', re.I)
+OBJETO_TH = re.compile(r'^Objeto', re.I)
+NO_DIGITOS = re.compile(r'[^\d]')
+PALABRAS_IMPORTE = ('presupuesto', 'valor', 'importe')
+
+# Nodos que interesan de la página: título, filas de tablas de detalle y contenedores del objeto
+_XPATH_EXPEDIENTE = None
+
+
+def _xpath_expediente():
+    global _XPATH_EXPEDIENTE
+    if _XPATH_EXPEDIENTE is None:
+        from lxml import etree
+        _XPATH_EXPEDIENTE = etree.XPath(
+            '//h1 | //tr'
+            ' | //*[contains(concat(" ", normalize-space(@class), " "), " titulo-expediente ")]'
+            ' | //*[contains(@id, "objeto")]'
+            ' | //*[contains(concat(" ", normalize-space(@class), " "), " objeto-contrato ")]'
+        )
+    return _XPATH_EXPEDIENTE
+
+
+def _documento_html(content):
+    """Árbol lxml del HTML; los bytes en UTF-8 se declaran como tales (lxml asume latin-1 sin <meta charset>)"""
+    from lxml import html as lxml_html
+
+    parser = None
+    if isinstance(content, bytes):
+        try:
+            content.decode('utf-8')
+            parser = lxml_html.HTMLParser(encoding='utf-8')
+        except UnicodeDecodeError:
+            pass
+    return lxml_html.fromstring(content, parser=parser)
+
+
+def _datos_vacios(url):
+    return {
+        'objeto': None,
+        'presupuesto_base': None,
+        'localidad': None,
+        'cpv': [],
+        'url': url
+    }
+
+
+def _presupuesto_en_texto(texto):
+    for pattern in PATRONES_PRESUPUESTO:
+        match = pattern.search(texto)
+        if match:
+            precio_text = match.group(1).replace('.', '').replace(',', '.')
+            try:
+                return float(precio_text)
+            except:
+                continue
+    return None
+
+
+def _presupuesto_en_filas(filas):
+    """Primera fila cuya etiqueta habla de presupuesto/valor/importe y cuyo valor tiene un importe"""
+    for etiqueta, valor in filas:
+        if any(keyword in etiqueta.lower() for keyword in PALABRAS_IMPORTE):
+            price_match = IMPORTE.search(valor)
+            if price_match:
+                precio_text = price_match.group(1).replace('.', '').replace(',', '.')
+                try:
+                    return float(precio_text)
+                except:
+                    continue
+    return None
+
+
+def _localidad_en_texto(texto):
+    for pattern in PATRONES_LOCALIDAD:
+        match = pattern.search(texto)
+        if match:
+            localidad = match.group(1).strip()
+            if len(localidad) > 3 and len(localidad) < 50:
+                return localidad
+    return None
+
+
+def _cpvs_en_texto(texto):
+    cpvs_found = set()
+    for pattern in PATRONES_CPV:
+        for match in pattern.findall(texto):
+            cpv_clean = NO_DIGITOS.sub('', match)[:8]
+            if len(cpv_clean) == 8:
+                cpvs_found.add(cpv_clean)
+    return cpvs_found
+
+
+def parsear_expediente_completo(content, url):
+    """Parser original: árbol BeautifulSoup completo y búsquedas sucesivas por campo"""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, 'html.parser')
+    contract_data = _datos_vacios(url)
+
+    # Extraer objeto del contrato
+    objeto_selectors = [
+        'h1',
+        '.titulo-expediente',
+        '[id*="objeto"]',
+        'td:contains("Objeto del contrato") + td',
+        'th:contains("Objeto") + td',
+        '.objeto-contrato'
+    ]
+
+    for selector in objeto_selectors:
+        try:
+            if ':contains(' in selector:
+                # Buscar por texto
+                if 'Objeto del contrato' in selector:
+                    element = soup.find('td', string=OBJETO_TD)
+                    if element and element.find_next_sibling('td'):
+                        contract_data['objeto'] = element.find_next_sibling('td').get_text(strip=True)
+                        break
+                elif 'Objeto' in selector and 'th:' in selector:
+                    element = soup.find('th', string=OBJETO_TH)
+                    if element and element.find_next_sibling('td'):
+                        contract_data['objeto'] = element.find_next_sibling('td').get_text(strip=True)
+                        break
+            else:
+                element = soup.select_one(selector)
+                if element:
+                    text = element.get_text(strip=True)
+                    if len(text) > 20:  # Filtrar textos muy cortos
+                        contract_data['objeto'] = text
+                        break
+        except:
+            continue
+
+    # Extraer presupuesto base
+    page_text = soup.get_text()
+    contract_data['presupuesto_base'] = _presupuesto_en_texto(page_text)
+
+    # Si no encontramos con patrones, buscar en tablas
+    if not contract_data['presupuesto_base']:
+        filas = []
+        for row in soup.find_all('tr'):
+            cells = row.find_all(['td', 'th'])
+            if len(cells) >= 2:
+                filas.append((cells[0].get_text(strip=True), cells[1].get_text(strip=True)))
+        contract_data['presupuesto_base'] = _presupuesto_en_filas(filas)
+
+    # Extraer localidad y CPV
+    contract_data['localidad'] = _localidad_en_texto(page_text)
+    contract_data['cpv'] = list(_cpvs_en_texto(page_text))
+
+    return contract_data
+
+
+def parsear_expediente_rapido(content, url):
+    """Parser rápido: lxml, solo título y tablas de detalle, y un único recorrido de los nodos.
+
+    Los patrones de texto se aplican primero al texto de las tablas de detalle; solo si
+    un campo no aparece ahí se recurre al texto completo de la página.
+    """
+    root = _documento_html(content)
+    contract_data = _datos_vacios(url)
+
+    # Candidatos a objeto por prioridad (mismo orden que los selectores del parser completo)
+    candidatos = {}
+    vistos = set()
+    filas = []
+    partes = []
+
+    def primero(rango, texto, minimo=20):
+        # Como select_one: solo cuenta el primer elemento de cada selector
+        if rango in vistos:
+            return
+        vistos.add(rango)
+        if len(texto) > minimo:
+            candidatos[rango] = texto
+
+    for nodo in _xpath_expediente()(root):
+        tag = nodo.tag
+        if tag == 'tr':
+            celdas = [c for c in nodo if c.tag in ('td', 'th')]
+            textos = [' '.join(c.text_content().split()) for c in celdas]
+            partes.append(' '.join(textos))
+            if len(celdas) >= 2:
+                filas.append((textos[0], textos[1]))
+                for celda, siguiente in zip(celdas, celdas[1:]):
+                    propio = (celda.text or '').strip()
+                    if siguiente.tag != 'td' or len(celda):
+                        continue
+                    if celda.tag == 'td' and 3 not in candidatos and OBJETO_TD.search(propio):
+                        candidatos[3] = ' '.join(siguiente.text_content().split())
+                    elif celda.tag == 'th' and 4 not in candidatos and OBJETO_TH.search(propio):
+                        candidatos[4] = ' '.join(siguiente.text_content().split())
+            continue
+
+        texto = ' '.join(nodo.text_content().split())
+        clases = f" {' '.join((nodo.get('class') or '').split())} "
+        if tag == 'h1':
+            primero(0, texto)
+            partes.append(texto)
+        if ' titulo-expediente ' in clases:
+            primero(1, texto)
+        if 'objeto' in (nodo.get('id') or ''):
+            primero(2, texto)
+        if ' objeto-contrato ' in clases:
+            primero(5, texto)
+
+    if candidatos:
+        contract_data['objeto'] = candidatos[min(candidatos)]
+
+    texto_detalle = '\n'.join(partes)
+    texto_pagina = None
+
+    presupuesto = _presupuesto_en_texto(texto_detalle) or _presupuesto_en_filas(filas)
+    if not presupuesto:
+        texto_pagina = root.text_content()
+        presupuesto = _presupuesto_en_texto(texto_pagina)
+    contract_data['presupuesto_base'] = presupuesto
+
+    localidad = _localidad_en_texto(texto_detalle)
+    if not localidad:
+        texto_pagina = texto_pagina if texto_pagina is not None else root.text_content()
+        localidad = _localidad_en_texto(texto_pagina)
+    contract_data['localidad'] = localidad
+
+    cpvs = _cpvs_en_texto(texto_detalle)
+    if not cpvs:
+        texto_pagina = texto_pagina if texto_pagina is not None else root.text_content()
+        cpvs = _cpvs_en_texto(texto_pagina)
+    contract_data['cpv'] = list(cpvs)
+
+    return contract_data
+
+
 class WebScraperBajaGenerator:
     def __init__(self):
         self.connection = None
@@ -50,6 +300,8 @@ class WebScraperBajaGenerator:
 
     def connect_to_database(self):
         """Conectar a la base de datos MySQL"""
+        import mysql.connector
+
         try:
             self.connection = mysql.connector.connect(
                 host=st.secrets["mysql"]["host"],
@@ -63,135 +315,21 @@ class WebScraperBajaGenerator:
             st.error(f"Error conectando a la base de datos: {e}")
             return False
 
-    def extract_contract_data_from_url(self, url):
-        """Extraer datos del contrato desde la URL de contratación del estado"""
+    def extract_contract_data_from_url(self, url, modo='rapido'):
+        """Extraer datos del contrato desde la URL de contratación del estado.
+
+        modo: 'rapido' (lxml, solo tablas de detalle, una pasada) o 'completo' (BeautifulSoup)
+        """
         try:
             st.info("🔍 Extrayendo datos del enlace...")
 
-            # Realizar petición web
-            response = requests.get(url, headers=self.headers, timeout=10)
+            # Realizar petición web (sesión compartida con reintentos y límite por host)
+            response = get_descargador(self.headers['User-Agent']).obtener(url, timeout=10)
             response.raise_for_status()
 
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            # Inicializar datos
-            contract_data = {
-                'objeto': None,
-                'presupuesto_base': None,
-                'localidad': None,
-                'cpv': [],
-                'url': url
-            }
-
-            # Extraer objeto del contrato
-            objeto_selectors = [
-                'h1',
-                '.titulo-expediente',
-                '[id*="objeto"]',
-                'td:contains("Objeto del contrato") + td',
-                'th:contains("Objeto") + td',
-                '.objeto-contrato'
-            ]
-
-            for selector in objeto_selectors:
-                try:
-                    if ':contains(' in selector:
-                        # Buscar por texto
-                        if 'Objeto del contrato' in selector:
-                            element = soup.find('td', string=re.compile(r'Objeto.*contrato', re.I))
-                            if element and element.find_next_sibling('td'):
-                                contract_data['objeto'] = element.find_next_sibling('td').get_text(strip=True)
-                                break
-                        elif 'Objeto' in selector and 'th:' in selector:
-                            element = soup.find('th', string=re.compile(r'^Objeto', re.I))
-                            if element and element.find_next_sibling('td'):
-                                contract_data['objeto'] = element.find_next_sibling('td').get_text(strip=True)
-                                break
-                    else:
-                        element = soup.select_one(selector)
-                        if element:
-                            text = element.get_text(strip=True)
-                            if len(text) > 20:  # Filtrar textos muy cortos
-                                contract_data['objeto'] = text
-                                break
-                except:
-                    continue
-
-            # Extraer presupuesto base
-            presupuesto_patterns = [
-                r'Presupuesto.*?sin.*?impuestos.*?(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)',
-                r'Valor.*?estimado.*?(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)',
-                r'Presupuesto.*?base.*?(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)',
-                r'(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)\s*€.*?sin.*?impuestos',
-                r'(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)\s*euros.*?sin.*?IVA'
-            ]
-
-            page_text = soup.get_text()
-            for pattern in presupuesto_patterns:
-                match = re.search(pattern, page_text, re.IGNORECASE | re.DOTALL)
-                if match:
-                    precio_text = match.group(1).replace('.', '').replace(',', '.')
-                    try:
-                        contract_data['presupuesto_base'] = float(precio_text)
-                        break
-                    except:
-                        continue
-
-            # Si no encontramos con patrones, buscar en tablas
-            if not contract_data['presupuesto_base']:
-                tables = soup.find_all('table')
-                for table in tables:
-                    rows = table.find_all('tr')
-                    for row in rows:
-                        cells = row.find_all(['td', 'th'])
-                        if len(cells) >= 2:
-                            first_cell = cells[0].get_text(strip=True).lower()
-                            if any(keyword in first_cell for keyword in ['presupuesto', 'valor', 'importe']):
-                                second_cell = cells[1].get_text(strip=True)
-                                price_match = re.search(r'(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)', second_cell)
-                                if price_match:
-                                    precio_text = price_match.group(1).replace('.', '').replace(',', '.')
-                                    try:
-                                        contract_data['presupuesto_base'] = float(precio_text)
-                                        break
-                                    except:
-                                        continue
-
-            # Extraer localidad
-            localidad_patterns = [
-                r'Lugar.*?ejecución.*?([A-ZÁÉÍÓÚ][a-záéíóúñ\s]+)',
-                r'Localidad.*?([A-ZÁÉÍÓÚ][a-záéíóúñ\s]+)',
-                r'Provincia.*?([A-ZÁÉÍÓÚ][a-záéíóúñ\s]+)',
-                r'Ubicación.*?([A-ZÁÉÍÓÚ][a-záéíóúñ\s]+)'
-            ]
-
-            for pattern in localidad_patterns:
-                match = re.search(pattern, page_text, re.IGNORECASE)
-                if match:
-                    localidad = match.group(1).strip()
-                    if len(localidad) > 3 and len(localidad) < 50:
-                        contract_data['localidad'] = localidad
-                        break
-
-            # Extraer CPV
-            cpv_patterns = [
-                r'CPV.*?(\d{8})',
-                r'(\d{8}).*?CPV',
-                r'Código.*?CPV.*?(\d{8})',
-                r'(\d{8}-\d)',
-            ]
-
-            cpvs_found = set()
-            for pattern in cpv_patterns:
-                matches = re.findall(pattern, page_text)
-                for match in matches:
-                    cpv_clean = re.sub(r'[^\d]', '', match)[:8]
-                    if len(cpv_clean) == 8:
-                        cpvs_found.add(cpv_clean)
-
-            contract_data['cpv'] = list(cpvs_found)
-
-            return contract_data
+            if modo == 'completo':
+                return parsear_expediente_completo(response.content, url)
+            return parsear_expediente_rapido(response.content, url)
 
         except requests.RequestException as e:
             st.error(f"Error al acceder a la URL: {e}")
@@ -203,7 +341,7 @@ class WebScraperBajaGenerator:
     def get_contratos_data(self, limit=5000):
         """Obtener datos de la tabla contratos"""
         query = f"SELECT * FROM contratos LIMIT {limit}"
-        return pd.read_sql(query, self.connection)
+        return leer_sql(self.connection, query)
 
     def find_similar_contratos_from_db(self, contract_data, all_contratos):
         """Encontrar contratos similares en la base de datos"""
@@ -325,32 +463,15 @@ class WebScraperBajaGenerator:
 
         text = str(text).replace('.', '').replace(',', '.')
 
-        patterns = [
-            r'(\d+\.?\d*)\s*€',
-            r'€\s*(\d+\.?\d*)',
-            r'(\d+\.?\d*)\s*euros?',
-            r'(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)'
-        ]
-
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                try:
-                    return float(matches[0].replace(',', '.'))
-                except:
-                    continue
-        return None
+        return extraer_precio(text, PATRONES_PRECIO_BASICOS)
 
     def calculate_text_similarity(self, text1, text2):
         """Calcular similitud entre textos usando TF-IDF"""
         if not text1 or not text2:
             return 0
 
-        vectorizer = TfidfVectorizer(stop_words='english', lowercase=True)
         try:
-            tfidf_matrix = vectorizer.fit_transform([str(text1), str(text2)])
-            similarity = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
-            return similarity
+            return calcular_similitud_tfidf(text1, text2, stop_words='english', lowercase=True)
         except:
             return 0
 
@@ -503,14 +624,22 @@ class WebScraperBajaGenerator:
 
         return texto
 
-def main():
-    st.title("🌐 Generador de Bajas Estadísticas desde Web")
-    st.sidebar.title("Configuración")
+def get_generator():
+    """Generador de la sesión, reutilizado entre reruns.
 
+    Cada sesión tiene su propia instancia: guarda la conexión a la base de
+    datos y el estado del análisis en curso, que no se pueden compartir entre
+    usuarios.
+    """
     if 'generator' not in st.session_state:
         st.session_state.generator = WebScraperBajaGenerator()
+    return st.session_state.generator
+
+def main():
+    st.title("🌐 Generador de Bajas Estadísticas desde Web")
+    st.sidebar.title("Configuración")
 
-    generator = st.session_state.generator
+    generator = get_generator()
 
     # Conectar a la base de datos
     if not generator.connection:
@@ -521,6 +650,9 @@ def main():
                 st.error("❌ No se pudo conectar a la base de datos")
                 return
 
+    modos_parser = {"Rápido (lxml, tablas de detalle)": 'rapido', "Completo (BeautifulSoup)": 'completo'}
+    modo_parser = modos_parser[st.sidebar.selectbox("Parser HTML:", list(modos_parser))]
+
     st.subheader("🔗 Análisis desde URL de Contratación del Estado")
 
     # Input para URL
@@ -533,7 +665,7 @@ def main():
         if st.button("🚀 Analizar Contrato y Generar Baja Estadística"):
             with st.spinner("Extrayendo datos del contrato..."):
                 # Extraer datos del contrato
-                contract_data = generator.extract_contract_data_from_url(url_input)
+                contract_data = generator.extract_contract_data_from_url(url_input, modo=modo_parser)
 
                 if contract_data:
                     # Mostrar datos extraídos
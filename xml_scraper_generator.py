@@ -1,23 +1,130 @@
-import mysql.connector
 import pandas as pd
 import streamlit as st
-import plotly.express as px
-import plotly.graph_objects as go
 from datetime import datetime, timedelta
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import re
 import random
 import requests
-import xml.etree.ElementTree as ET
-from urllib.parse import unquote
 import time
 import io
-from xlsxwriter import Workbook
 import warnings
+from recursos import extraer_precio, calcular_similitud_tfidf, get_descargador, PATRONES_PRECIO_BASICOS
+from lectura_sql import leer_sql
+from plan_extraccion import (Campo, PlanExtraccion, ESTADISTICAS, documento_xml, familia_documento,
+                             texto_minimo, importe_minimo, numero, codigo_cpv, cpvs_en_texto)
+from lxml import etree
+# mysql.connector y sklearn se importan en los métodos que los usan
 warnings.filterwarnings('ignore')
 
+URL_SINDICACION_XML = "https://contrataciondelestado.es/sindicacion/sindicacion_643/licitacionesPerfilContratante"
+ID_EVL = re.compile(r'idEvl=([^&]+)')
+
+# Patrones de enlaces XML en las páginas HTML de expedientes
+PATRONES_XML_HTML = [
+    re.compile(r'href="([^"]*\.xml[^"]*)"', re.IGNORECASE),
+    re.compile(r'href="([^"]*sindicacion[^"]*)"', re.IGNORECASE),
+    re.compile(r'"(https://[^"]*\.xml[^"]*)"', re.IGNORECASE),
+    re.compile(r'"([^"]*FileSystem/servlet/GetDocumentByIdServlet[^"]*)"', re.IGNORECASE)
+]
+
+
+# Planes de extracción: rutas por campo en orden de prioridad, compiladas al importar.
+# Las rutas con local-name() sustituyen a los recorridos de root.iter() sin namespace.
+PLAN_CONTRATO = PlanExtraccion([
+    # Objeto del contrato - evitar el órgano de contratación
+    Campo('objeto', [
+        './/cac:ProcurementProject/cbc:Name',
+        './/cac:ProcurementProjectLot/cac:ProcurementProject/cbc:Name',
+        './/cac:ProcurementProject/cbc:Description',
+        './/cac:TenderingProcess/cbc:Description',
+        './/cbc:Description[not(ancestor::cac:ContractingParty)]',
+        './/cbc:Title[not(ancestor::cac:ContractingParty)]',
+        './/cbc:Name[not(ancestor::cac:ContractingParty)]',
+        ".//*[local-name()='Name']",
+        ".//*[local-name()='Description']",
+        ".//*[local-name()='Title']",
+    ], convertir=texto_minimo(15)),
+    # Presupuesto base - priorizar TaxExclusiveAmount (sin impuestos)
+    Campo('presupuesto_base', [
+        './/cbc:TaxExclusiveAmount',
+        './/cbc:EstimatedOverallContractAmount',
+        './/cbc:TotalAmount',
+        ".//*[local-name()='TaxExclusiveAmount']",
+        # Cualquier importe: solo valores grandes para evitar pequeños importes
+        (".//*[contains(local-name(), 'Amount')]", importe_minimo(10000)),
+    ], convertir=importe_minimo(1000)),
+    # Localidad - priorizar CountrySubentity (provincia)
+    Campo('localidad', [
+        './/cbc:CountrySubentity',
+        './/cbc:CityName',
+        ".//*[local-name()='CountrySubentity']",
+        ".//*[local-name()='CityName']",
+    ], convertir=texto_minimo(2)),
+    # CPV: todos los ItemClassificationCode (principal y adicionales)
+    Campo('cpv', [
+        './/cbc:ItemClassificationCode',
+        (".//*[contains(local-name(), 'ItemClassificationCode') "
+         "or contains(translate(local-name(), 'cpv', 'CPV'), 'CPV')]", cpvs_en_texto),
+    ], convertir=codigo_cpv, multiple=True),
+    Campo('terminos_adjudicacion', [
+        './/cac:AwardingTerms',
+        ".//*[contains(local-name(), 'AwardingTerms')]",
+    ]),
+])
+
+# Criterios dentro de AwardingTerms (UBL: AwardingCriterion, CODICE: AwardingCriteria)
+PLAN_TERMINOS = PlanExtraccion([
+    Campo('criterios', [
+        './/cac:AwardingCriterion',
+        './/cac:AwardingCriteria',
+        ".//*[local-name()='AwardingCriterion' or local-name()='AwardingCriteria']",
+    ], multiple=True),
+])
+
+PLAN_CRITERIO = PlanExtraccion([
+    Campo('criterio_nombre', [
+        './/cbc:Name',
+        ".//*[local-name()='Name']",
+        # CODICE no tiene Name: el nombre del criterio va en Description
+        './cbc:Description',
+    ], convertir=texto_minimo(0)),
+    Campo('criterio_descripcion', [
+        './/cbc:Description',
+        ".//*[local-name()='Description']",
+    ], convertir=texto_minimo(0)),
+    Campo('criterio_peso', [
+        './/cbc:WeightNumeric',
+        './/cbc:Weight',
+        './/cbc:AwardingCriterionWeight',
+        ".//*[local-name()='WeightNumeric' or local-name()='Weight']",
+    ], convertir=numero),
+])
+
+
+def _convertir_url_html_a_xml(html_url):
+    """URL XML de sindicación a partir del idEvl de una URL HTML (None si no lo tiene)"""
+    # Extraer el ID del expediente de la URL HTML
+    if 'idEvl=' in html_url:
+        id_match = ID_EVL.search(html_url)
+        if id_match:
+            encoded_id = id_match.group(1)
+            return f"{URL_SINDICACION_XML}?idLicitacion={encoded_id}"
+    return None
+
+
+def buscar_xml_en_html(html):
+    """Primer enlace XML encontrado en el HTML de un expediente (None si no hay)"""
+    for pattern in PATRONES_XML_HTML:
+        for match in pattern.findall(html):
+            if 'xml' in match.lower() or 'sindicacion' in match.lower():
+                # Construir URL completa si es relativa
+                if match.startswith('/'):
+                    match = 'https://contrataciondelestado.es' + match
+                elif not match.startswith('http'):
+                    match = 'https://contrataciondelestado.es/' + match
+                return match
+    return None
+
+
 class XMLScraperBajaGenerator:
     def __init__(self):
         self.connection = None
@@ -53,6 +160,8 @@ class XMLScraperBajaGenerator:
 
     def connect_to_database(self):
         """Conectar a la base de datos MySQL"""
+        import mysql.connector
+
         try:
             self.connection = mysql.connector.connect(
                 host=st.secrets["mysql"]["host"],
@@ -72,21 +181,12 @@ class XMLScraperBajaGenerator:
             st.info("🔍 Extrayendo datos del XML...")
 
             # Realizar petición al XML
-            response = requests.get(xml_url, headers=self.headers, timeout=15)
+            response = get_descargador(self.headers['User-Agent']).obtener(xml_url, timeout=15)
             response.raise_for_status()
 
-            # Parsear XML
-            root = ET.fromstring(response.content)
-
-            # Namespace común en XML de contratación del estado
-            namespaces = {
-                'cac': 'urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2',
-                'cbc': 'urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2',
-                'ext': 'urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2',
-                'efac': 'http://data.europa.eu/p27/eforms-ubl-extensions/1',
-                'efext': 'http://data.europa.eu/p27/eforms-ubl-extension-aggregate-components/1',
-                'efbc': 'http://data.europa.eu/p27/eforms-ubl-extension-basic-components/1'
-            }
+            # Parsear XML y detectar la familia de espacios de nombres (CODICE, eForms o UBL)
+            root = documento_xml(response.content)
+            familia = familia_documento(root, origen=xml_url)
 
             contract_data = {
                 'objeto': None,
@@ -97,233 +197,23 @@ class XMLScraperBajaGenerator:
                 'xml_url': xml_url
             }
 
-            # Extraer objeto del contrato - EVITAR órgano de contratación
-            objeto_paths = [
-                './/cac:ProcurementProject/cbc:Name',  # PRIORITARIO - dentro de ProcurementProject
-                './cac:ProcurementProject/cbc:Name',   # Directo desde root
-                './/cac:ProcurementProjectLot/cac:ProcurementProject/cbc:Name',
-                './/cac:ProcurementProject/cbc:Description',
-                './/cac:TenderingProcess/cbc:Description',  # Descripción del proceso
-                './/cbc:Description[not(ancestor::cac:ContractingParty)]',  # Evitar ContractingParty
-                './/cbc:Title[not(ancestor::cac:ContractingParty)]'  # Evitar ContractingParty
-            ]
+            # Todos los campos en una sola evaluación del plan
+            valores, rutas = PLAN_CONTRATO.evaluar(root, familia)
+            contract_data['objeto'] = valores['objeto']
+            contract_data['presupuesto_base'] = valores['presupuesto_base']
+            contract_data['localidad'] = valores['localidad']
+            contract_data['cpv'] = list(dict.fromkeys(valores['cpv']))
 
-            for path in objeto_paths:
-                try:
-                    element = root.find(path, namespaces)
-                    if element is not None and element.text:
-                        text = element.text.strip()
-                        if len(text) > 15:  # Reducir filtro de longitud
-                            contract_data['objeto'] = text
-                            st.info(f"✅ Objeto encontrado con path: {path}")
-                            break
-                except Exception as e:
-                    st.warning(f"Error con path {path}: {e}")
-                    continue
-
-            # Diagnóstico específico de ProcurementProject
-            if not contract_data['objeto']:
-                st.warning("🔍 Diagnosticando contenido de ProcurementProject...")
-                procurement_projects = root.findall('.//cac:ProcurementProject', namespaces)
-                st.info(f"Encontrados {len(procurement_projects)} elementos ProcurementProject")
-
-                for i, pp in enumerate(procurement_projects):
-                    name_elem = pp.find('./cbc:Name', namespaces)
-                    if name_elem is not None and name_elem.text:
-                        text = name_elem.text.strip()
-                        st.info(f"ProcurementProject[{i}] Name: {text[:100]}...")
-                        if len(text) > 15:
-                            contract_data['objeto'] = text
-                            st.success(f"✅ Objeto extraído de ProcurementProject[{i}]")
-                            break
-
-            # Búsqueda más amplia de todos los cbc:Name (excluyendo órgano contratación)
-            if not contract_data['objeto']:
-                st.warning("⚠️ Buscando en todos los cbc:Name...")
-                name_elements = root.findall('.//cbc:Name', namespaces)
-                st.info(f"Encontrados {len(name_elements)} elementos cbc:Name en total")
-
-                for i, elem in enumerate(name_elements):
-                    if elem.text and len(elem.text.strip()) > 15:
-                        # Verificar que no esté dentro de ContractingParty (órgano de contratación)
-                        parent = elem.getparent()
-                        is_contracting_party = False
-
-                        # Recorrer hacia arriba para ver si está en ContractingParty
-                        current = parent
-                        while current is not None:
-                            if 'ContractingParty' in current.tag:
-                                is_contracting_party = True
-                                break
-                            current = current.getparent()
-
-                        if not is_contracting_party:
-                            st.info(f"cbc:Name[{i}]: {elem.text[:60]}...")
-                            contract_data['objeto'] = elem.text.strip()
-                            st.success(f"✅ Objeto encontrado en cbc:Name[{i}] (no es órgano contratación)")
-                            break
-                        else:
-                            st.warning(f"Saltando cbc:Name[{i}]: es del órgano de contratación")
-
-            # Si no encontramos con namespace, intentar sin namespace
-            if not contract_data['objeto']:
-                st.warning("⚠️ Intentando búsqueda sin namespace...")
-                for tag in ['Name', 'Description', 'Title']:
-                    elements = root.iter()
-                    for elem in elements:
-                        if elem.tag.endswith(f':{tag}') or elem.tag.endswith(tag):
-                            if elem.text and len(elem.text.strip()) > 15:
-                                contract_data['objeto'] = elem.text.strip()
-                                st.info(f"✅ Objeto encontrado sin namespace: {elem.text[:50]}...")
-                                break
-                    if contract_data['objeto']:
-                        break
-
-            # Extraer presupuesto base - priorizar TaxExclusiveAmount (sin impuestos)
-            presupuesto_paths = [
-                './/cbc:TaxExclusiveAmount',  # PRIORITARIO - presupuesto sin impuestos
-                './/cac:BudgetAmount/cbc:TaxExclusiveAmount',
-                './/cac:ProcurementProject/cac:BudgetAmount/cbc:TaxExclusiveAmount',
-                './/cbc:EstimatedOverallContractAmount',
-                './/cac:ProcurementProject/cac:BudgetAmount/cbc:EstimatedOverallContractAmount',
-                './/cbc:TotalAmount',
-                './/cac:ProcurementProject/cac:BudgetAmount/cbc:TotalAmount',
-                './/cac:BudgetAmount/cbc:EstimatedOverallContractAmount',
-                './/cac:BudgetAmount/cbc:TotalAmount'
-            ]
-
-            for path in presupuesto_paths:
-                try:
-                    element = root.find(path, namespaces)
-                    if element is not None and element.text:
-                        # Limpiar y convertir el precio
-                        price_text = element.text.strip().replace(',', '.')
-                        price_match = re.search(r'(\d+\.?\d*)', price_text)
-                        if price_match:
-                            price_value = float(price_match.group(1))
-                            # Validar que el precio sea razonable
-                            if price_value > 1000:
-                                contract_data['presupuesto_base'] = price_value
-                                break
-                except:
-                    continue
-
-            # Si no encontramos con namespace, buscar TaxExclusiveAmount específicamente
-            if not contract_data['presupuesto_base']:
-                elements = root.iter()
-                for elem in elements:
-                    if elem.tag.endswith('TaxExclusiveAmount') and elem.text:
-                        try:
-                            price_text = elem.text.strip().replace(',', '.')
-                            price_match = re.search(r'(\d+\.?\d*)', price_text)
-                            if price_match:
-                                price_value = float(price_match.group(1))
-                                if price_value > 1000:
-                                    contract_data['presupuesto_base'] = price_value
-                                    break
-                        except:
-                            continue
-
-            # Si aún no encontramos, buscar cualquier Amount
-            if not contract_data['presupuesto_base']:
-                elements = root.iter()
-                for elem in elements:
-                    if 'Amount' in elem.tag and elem.text:
-                        try:
-                            price_text = elem.text.strip().replace(',', '.')
-                            price_match = re.search(r'(\d+\.?\d*)', price_text)
-                            if price_match:
-                                price_value = float(price_match.group(1))
-                                if price_value > 10000:  # Solo valores grandes para evitar pequeños importes
-                                    contract_data['presupuesto_base'] = price_value
-                                    break
-                        except:
-                            continue
-
-            # Extraer localidad - priorizar CountrySubentity (provincia)
-            localidad_paths = [
-                './/cbc:CountrySubentity',  # PRIORITARIO - provincia/comunidad
-                './/cac:Address/cbc:CountrySubentity',
-                './/cac:RealizedLocation/cac:Address/cbc:CountrySubentity',
-                './/cbc:CityName',  # Ciudad como segunda opción
-                './/cac:Address/cbc:CityName',
-                './/cac:RealizedLocation/cac:Address/cbc:CityName'
-            ]
-
-            for path in localidad_paths:
-                try:
-                    element = root.find(path, namespaces)
-                    if element is not None and element.text:
-                        localidad = element.text.strip()
-                        if len(localidad) > 2:
-                            contract_data['localidad'] = localidad
-                            break
-                except:
-                    continue
-
-            # Si no encontramos con namespace, buscar CountrySubentity específicamente
-            if not contract_data['localidad']:
-                elements = root.iter()
-                for elem in elements:
-                    if elem.tag.endswith('CountrySubentity') and elem.text:
-                        localidad = elem.text.strip()
-                        if len(localidad) > 2:
-                            contract_data['localidad'] = localidad
-                            break
-
-            # Si aún no encontramos, buscar CityName
-            if not contract_data['localidad']:
-                for tag in ['CityName']:
-                    elements = root.iter()
-                    for elem in elements:
-                        if elem.tag.endswith(tag) and elem.text:
-                            localidad = elem.text.strip()
-                            if len(localidad) > 2:
-                                contract_data['localidad'] = localidad
-                                break
-                    if contract_data['localidad']:
-                        break
-
-            # Extraer códigos CPV
-            cpv_paths = [
-                './/cac:AdditionalCommodityClassification/cbc:ItemClassificationCode',
-                './/cac:CommodityClassification/cbc:ItemClassificationCode',
-                './/cbc:ItemClassificationCode'
-            ]
-
-            cpvs_found = set()
-
-            for path in cpv_paths:
-                try:
-                    elements = root.findall(path, namespaces)
-                    for element in elements:
-                        if element.text:
-                            cpv_code = element.text.strip()
-                            # Limpiar CPV - tomar solo los primeros 8 dígitos
-                            cpv_clean = re.sub(r'[^\d]', '', cpv_code)[:8]
-                            if len(cpv_clean) == 8:
-                                cpvs_found.add(cpv_clean)
-                except:
-                    continue
-
-            # Si no encontramos con namespace, buscar cualquier código que parezca CPV
-            if not cpvs_found:
-                elements = root.iter()
-                for elem in elements:
-                    if elem.text and ('ItemClassificationCode' in elem.tag or 'CPV' in elem.tag.upper()):
-                        cpv_text = elem.text.strip()
-                        cpv_matches = re.findall(r'\d{8}', cpv_text)
-                        for match in cpv_matches:
-                            cpvs_found.add(match)
-
-            contract_data['cpv'] = list(cpvs_found)
+            if rutas['objeto']:
+                st.info(f"✅ Objeto encontrado con path: {rutas['objeto']} ({familia.upper()})")
 
             # Mostrar estructura del XML para diagnóstico
             with st.expander("🔍 Estructura del XML (Diagnóstico)"):
                 self.show_xml_structure(root)
 
             # Extraer criterios de adjudicación desde AwardingTerms
-            contract_data['criterios_adjudicacion'] = self.extract_awarding_criteria(root, namespaces)
+            contract_data['criterios_adjudicacion'] = self.extract_awarding_criteria(
+                root, familia, valores['terminos_adjudicacion'])
 
             # Mostrar diagnóstico de criterios extraídos
             criterios_found = contract_data['criterios_adjudicacion']
@@ -339,7 +229,7 @@ class XMLScraperBajaGenerator:
         except requests.RequestException as e:
             st.error(f"Error al acceder al XML: {e}")
             return None
-        except ET.ParseError as e:
+        except etree.XMLSyntaxError as e:
             st.error(f"Error parseando XML: {e}")
             return None
         except Exception as e:
@@ -357,6 +247,8 @@ class XMLScraperBajaGenerator:
             if element_count >= max_elements:
                 break
 
+            if not isinstance(elem.tag, str):
+                continue
             tag_clean = elem.tag.split('}')[-1] if '}' in elem.tag else elem.tag
             unique_tags.add(tag_clean)
 
@@ -373,7 +265,7 @@ class XMLScraperBajaGenerator:
         tags_text = ", ".join([f"`{tag}`" for tag in tags_sorted])
         st.write(tags_text)
 
-    def extract_awarding_criteria(self, root, namespaces):
+    def extract_awarding_criteria(self, root, familia=None, awarding_terms=None):
         """Extraer criterios de adjudicación desde AwardingTerms"""
         criterios = {
             'precio_puntos': None,
@@ -385,135 +277,70 @@ class XMLScraperBajaGenerator:
 
         try:
             st.info("🔍 Buscando criterios de adjudicación en el XML...")
+            familia = familia or familia_documento(root)
 
-            # Buscar AwardingTerms con múltiples estrategias
-            awarding_terms_paths = [
-                './/cac:AwardingTerms',
-                './/cac:TenderingTerms/cac:AwardingTerms',
-                './/cac:ProcurementProject/cac:AwardingTerms',
-                './/cac:ContractingSystem/cac:AwardingTerms'
-            ]
-
-            awarding_terms = None
-            for path in awarding_terms_paths:
-                awarding_terms = root.find(path, namespaces)
-                if awarding_terms is not None:
-                    st.info(f"✅ Encontrado AwardingTerms en: {path}")
-                    break
-
+            # Buscar AwardingTerms (si no lo ha resuelto ya el plan del contrato)
             if awarding_terms is None:
-                # Buscar sin namespace de forma más exhaustiva
-                st.info("🔄 Buscando AwardingTerms sin namespace...")
-                for elem in root.iter():
-                    if 'AwardingTerms' in elem.tag:
-                        awarding_terms = elem
-                        st.info(f"✅ Encontrado AwardingTerms sin namespace: {elem.tag}")
-                        break
+                valores, _ = PLAN_CONTRATO.evaluar(root, familia, campos={'terminos_adjudicacion'})
+                awarding_terms = valores['terminos_adjudicacion']
 
             if awarding_terms is None:
-                # Buscar cualquier elemento que contenga "Award" o "Criterion"
-                st.info("🔄 Búsqueda ampliada de criterios...")
-                for elem in root.iter():
-                    if any(word in elem.tag for word in ['Award', 'Criterion', 'Criteria']):
-                        st.info(f"📋 Elemento relacionado encontrado: {elem.tag}")
-                        if elem.text:
-                            st.write(f"   Contenido: {elem.text[:100]}...")
-
                 st.warning("⚠️ No se encontraron AwardingTerms en el XML")
                 return criterios
 
-            if awarding_terms is not None:
-                # Extraer criterios individuales
-                criteria_paths = [
-                    './/cac:AwardingCriterion',
-                    './/cac:AwardingCriteria',
-                    'cac:AwardingCriterion',
-                    'cac:AwardingCriteria'
-                ]
-
-                for criteria_path in criteria_paths:
-                    criteria_elements = awarding_terms.findall(criteria_path, namespaces)
-
-                    if not criteria_elements:
-                        # Buscar sin namespace
-                        criteria_elements = awarding_terms.findall(criteria_path.split(':')[-1])
-
-                    for criterion in criteria_elements:
-                        criterio_info = {
-                            'nombre': '',
-                            'descripcion': '',
-                            'peso': None,
-                            'tipo': ''
-                        }
-
-                        # Extraer nombre del criterio
-                        name_elem = criterion.find('.//cbc:Name', namespaces) or criterion.find('Name')
-                        if name_elem is not None and name_elem.text:
-                            criterio_info['nombre'] = name_elem.text.strip()
-
-                        # Extraer descripción
-                        desc_elem = criterion.find('.//cbc:Description', namespaces) or criterion.find('Description')
-                        if desc_elem is not None and desc_elem.text:
-                            criterio_info['descripcion'] = desc_elem.text.strip()
-
-                        # Extraer peso/puntuación
-                        weight_paths = [
-                            './/cbc:WeightNumeric',
-                            './/cbc:Weight',
-                            './/cbc:AwardingCriterionWeight',
-                            'WeightNumeric',
-                            'Weight'
-                        ]
-
-                        for weight_path in weight_paths:
-                            weight_elem = criterion.find(weight_path, namespaces) if ':' in weight_path else criterion.find(weight_path)
-                            if weight_elem is not None and weight_elem.text:
-                                try:
-                                    criterio_info['peso'] = float(weight_elem.text.strip())
-                                    break
-                                except:
-                                    continue
-
-                        # Determinar tipo de criterio
-                        nombre_lower = criterio_info['nombre'].lower()
-                        desc_lower = criterio_info['descripcion'].lower()
-
-                        if any(word in nombre_lower + desc_lower for word in ['precio', 'económic', 'ofertas', 'coste', 'importe']):
-                            criterio_info['tipo'] = 'precio'
-                        elif any(word in nombre_lower + desc_lower for word in ['técnic', 'calidad', 'memoria', 'propuesta', 'valor']):
-                            criterio_info['tipo'] = 'tecnico'
-                        else:
-                            criterio_info['tipo'] = 'otro'
-
-                        if criterio_info['nombre'] or criterio_info['descripcion']:
-                            criterios['criterios_detalle'].append(criterio_info)
-
-                # Sumar puntos por tipo
-                precio_total = 0
-                tecnico_total = 0
-
-                for criterio in criterios['criterios_detalle']:
-                    if criterio['peso'] is not None:
-                        if criterio['tipo'] == 'precio':
-                            precio_total += criterio['peso']
-                        elif criterio['tipo'] == 'tecnico':
-                            tecnico_total += criterio['peso']
-
-                # Si encontramos distribución de puntos
-                if precio_total > 0 or tecnico_total > 0:
-                    criterios['precio_puntos'] = precio_total
-                    criterios['tecnico_puntos'] = tecnico_total
-                    criterios['total_puntos'] = precio_total + tecnico_total
-
-                    # Ajustar a 100 si es diferente
-                    if criterios['total_puntos'] != 100 and criterios['total_puntos'] > 0:
-                        factor = 100 / criterios['total_puntos']
-                        criterios['precio_puntos'] = round(precio_total * factor)
-                        criterios['tecnico_puntos'] = round(tecnico_total * factor)
-                        criterios['total_puntos'] = 100
-
-                # Obtener texto completo de AwardingTerms para análisis adicional
-                criterios['descripcion_raw'] = ET.tostring(awarding_terms, encoding='unicode', method='text')
+            # Extraer criterios individuales
+            valores, _ = PLAN_TERMINOS.evaluar(awarding_terms, familia)
+            for criterion in valores['criterios']:
+                datos_criterio, _ = PLAN_CRITERIO.evaluar(criterion, familia)
+                criterio_info = {
+                    'nombre': datos_criterio['criterio_nombre'] or '',
+                    'descripcion': datos_criterio['criterio_descripcion'] or '',
+                    'peso': datos_criterio['criterio_peso'],
+                    'tipo': ''
+                }
+                if criterio_info['descripcion'] == criterio_info['nombre']:
+                    criterio_info['descripcion'] = ''
+
+                # Determinar tipo de criterio
+                nombre_lower = criterio_info['nombre'].lower()
+                desc_lower = criterio_info['descripcion'].lower()
+
+                if any(word in nombre_lower + desc_lower for word in ['precio', 'económic', 'ofertas', 'coste', 'importe']):
+                    criterio_info['tipo'] = 'precio'
+                elif any(word in nombre_lower + desc_lower for word in ['técnic', 'calidad', 'memoria', 'propuesta', 'valor']):
+                    criterio_info['tipo'] = 'tecnico'
+                else:
+                    criterio_info['tipo'] = 'otro'
+
+                if criterio_info['nombre'] or criterio_info['descripcion']:
+                    criterios['criterios_detalle'].append(criterio_info)
+
+            # Sumar puntos por tipo
+            precio_total = 0
+            tecnico_total = 0
+
+            for criterio in criterios['criterios_detalle']:
+                if criterio['peso'] is not None:
+                    if criterio['tipo'] == 'precio':
+                        precio_total += criterio['peso']
+                    elif criterio['tipo'] == 'tecnico':
+                        tecnico_total += criterio['peso']
+
+            # Si encontramos distribución de puntos
+            if precio_total > 0 or tecnico_total > 0:
+                criterios['precio_puntos'] = precio_total
+                criterios['tecnico_puntos'] = tecnico_total
+                criterios['total_puntos'] = precio_total + tecnico_total
+
+                # Ajustar a 100 si es diferente
+                if criterios['total_puntos'] != 100 and criterios['total_puntos'] > 0:
+                    factor = 100 / criterios['total_puntos']
+                    criterios['precio_puntos'] = round(precio_total * factor)
+                    criterios['tecnico_puntos'] = round(tecnico_total * factor)
+                    criterios['total_puntos'] = 100
+
+            # Obtener texto completo de AwardingTerms para análisis adicional
+            criterios['descripcion_raw'] = etree.tostring(awarding_terms, encoding='unicode', method='text')
 
         except Exception as e:
             st.warning(f"Error extrayendo criterios de adjudicación: {e}")
@@ -523,21 +350,7 @@ class XMLScraperBajaGenerator:
     def convert_html_url_to_xml(self, html_url):
         """Convertir URL HTML a URL XML equivalente"""
         try:
-            # Extraer el ID del expediente de la URL HTML
-            if 'idEvl=' in html_url:
-                # Extraer y decodificar el ID
-                id_match = re.search(r'idEvl=([^&]+)', html_url)
-                if id_match:
-                    encoded_id = id_match.group(1)
-                    decoded_id = unquote(encoded_id)
-
-                    # Construir URL del XML
-                    base_xml_url = "https://contrataciondelestado.es/sindicacion/sindicacion_643/licitacionesPerfilContratante"
-                    xml_url = f"{base_xml_url}?idLicitacion={encoded_id}"
-
-                    return xml_url
-
-            return None
+            return _convertir_url_html_a_xml(html_url)
         except Exception as e:
             st.error(f"Error convirtiendo URL: {e}")
             return None
@@ -547,34 +360,45 @@ class XMLScraperBajaGenerator:
         try:
             st.info("🔍 Buscando XML en la página...")
 
-            response = requests.get(html_url, headers=self.headers, timeout=10)
+            response = get_descargador(self.headers['User-Agent']).obtener(html_url, timeout=10)
             response.raise_for_status()
 
-            # Buscar patrones de XML en el HTML
-            xml_patterns = [
-                r'href="([^"]*\.xml[^"]*)"',
-                r'href="([^"]*sindicacion[^"]*)"',
-                r'"(https://[^"]*\.xml[^"]*)"',
-                r'"([^"]*FileSystem/servlet/GetDocumentByIdServlet[^"]*)"'
-            ]
-
-            for pattern in xml_patterns:
-                matches = re.findall(pattern, response.text, re.IGNORECASE)
-                for match in matches:
-                    if 'xml' in match.lower() or 'sindicacion' in match.lower():
-                        # Construir URL completa si es relativa
-                        if match.startswith('/'):
-                            match = 'https://contrataciondelestado.es' + match
-                        elif not match.startswith('http'):
-                            match = 'https://contrataciondelestado.es/' + match
-                        return match
-
-            return None
+            return buscar_xml_en_html(response.text)
 
         except Exception as e:
             st.error(f"Error buscando XML: {e}")
             return None
 
+    def resolve_xml_urls(self, html_urls, al_completar=None):
+        """Resolver en paralelo muchas URLs HTML de expedientes a su URL XML.
+
+        Devuelve {html_url: xml_url o None}. Las URLs con idEvl se convierten sin
+        descargar; el resto se descarga con el descargador compartido.
+        """
+        resultados = {}
+        pendientes = []
+        for html_url in dict.fromkeys(html_urls):
+            xml_url = _convertir_url_html_a_xml(html_url)
+            if xml_url:
+                resultados[html_url] = xml_url
+                if al_completar:
+                    al_completar(html_url, xml_url)
+            else:
+                pendientes.append(html_url)
+
+        def procesar(html_url, respuesta):
+            xml_url = None
+            if not isinstance(respuesta, Exception) and respuesta.ok:
+                xml_url = buscar_xml_en_html(respuesta.text)
+            resultados[html_url] = xml_url
+            if al_completar:
+                al_completar(html_url, xml_url)
+
+        if pendientes:
+            get_descargador(self.headers['User-Agent']).obtener_varios(pendientes, timeout=10,
+                                                                     al_completar=procesar)
+        return resultados
+
     def get_available_tables(self):
         """Obtener lista de tablas disponibles"""
         try:
@@ -607,7 +431,7 @@ class XMLScraperBajaGenerator:
 
             st.info(f"Usando tabla: {contratos_table}")
             query = f"SELECT * FROM {contratos_table} LIMIT {limit}"
-            return pd.read_sql(query, self.connection)
+            return leer_sql(self.connection, query)
 
         except Exception as e:
             st.error(f"Error cargando datos de contratos: {e}")
@@ -924,32 +748,15 @@ class XMLScraperBajaGenerator:
 
         text = str(text).replace('.', '').replace(',', '.')
 
-        patterns = [
-            r'(\d+\.?\d*)\s*€',
-            r'€\s*(\d+\.?\d*)',
-            r'(\d+\.?\d*)\s*euros?',
-            r'(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)'
-        ]
-
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                try:
-                    return float(matches[0].replace(',', '.'))
-                except:
-                    continue
-        return None
+        return extraer_precio(text, PATRONES_PRECIO_BASICOS)
 
     def calculate_text_similarity(self, text1, text2):
         """Calcular similitud entre textos usando TF-IDF"""
         if not text1 or not text2:
             return 0
 
-        vectorizer = TfidfVectorizer(stop_words='english', lowercase=True)
         try:
-            tfidf_matrix = vectorizer.fit_transform([str(text1), str(text2)])
-            similarity = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
-            return similarity
+            return calcular_similitud_tfidf(text1, text2, stop_words='english', lowercase=True)
         except:
             return 0
 
@@ -1353,14 +1160,22 @@ class XMLScraperBajaGenerator:
 
         return texto
 
-def main():
-    st.title("🌐 Generador de Bajas Estadísticas desde XML")
-    st.sidebar.title("Configuración")
+def get_generator():
+    """Generador de la sesión, reutilizado entre reruns.
 
+    Cada sesión tiene su propia instancia: guarda la conexión a la base de
+    datos y el estado del análisis en curso, que no se pueden compartir entre
+    usuarios.
+    """
     if 'generator' not in st.session_state:
         st.session_state.generator = XMLScraperBajaGenerator()
+    return st.session_state.generator
 
-    generator = st.session_state.generator
+def main():
+    st.title("🌐 Generador de Bajas Estadísticas desde XML")
+    st.sidebar.title("Configuración")
+
+    generator = get_generator()
 
     # Conectar a la base de datos
     if not generator.connection:
@@ -1371,6 +1186,14 @@ def main():
                 st.error("❌ No se pudo conectar a la base de datos")
                 return
 
+    # Aciertos de las rutas XPath de los planes de extracción (para reordenarlas por éxito)
+    with st.sidebar.expander("📈 Aciertos de rutas XPath"):
+        aciertos_rutas = ESTADISTICAS.tabla()
+        if aciertos_rutas:
+            st.dataframe(pd.DataFrame(aciertos_rutas))
+        else:
+            st.caption("Aún no se ha analizado ningún XML")
+
     st.subheader("🔗 Análisis desde URL de Contratación del Estado")
 
     # Input para URL
@@ -1525,6 +1348,33 @@ def main():
                 else:
                     st.error("❌ No se pudo encontrar o generar la URL del XML")
 
+    # Resolución en lote de expedientes HTML a XML
+    with st.expander("📦 Resolver expedientes en lote (HTML → XML)"):
+        urls_lote = st.text_area("Una URL HTML de expediente por línea:", height=150)
+        if st.button("🔎 Resolver XML de todos los expedientes"):
+            # Sin repetidas: resolve_xml_urls llama a al_completar una vez por URL distinta
+            html_urls = list(dict.fromkeys(u.strip() for u in urls_lote.splitlines() if u.strip().startswith('http')))
+            if html_urls:
+                progreso = st.progress(0.0)
+                completadas = []
+
+                def avanzar(html_url, xml_url):
+                    completadas.append(html_url)
+                    progreso.progress(len(completadas) / len(html_urls))
+
+                with st.spinner(f"Resolviendo {len(html_urls)} expedientes..."):
+                    resueltas = generator.resolve_xml_urls(html_urls, al_completar=avanzar)
+
+                resultado_lote = pd.DataFrame(
+                    [{'URL HTML': u, 'URL XML': resueltas.get(u)} for u in html_urls])
+                encontrados = resultado_lote['URL XML'].notna().sum()
+                st.success(f"✅ XML encontrado para {encontrados} de {len(resultado_lote)} expedientes")
+                st.dataframe(resultado_lote)
+                st.download_button("📥 Descargar CSV", resultado_lote.to_csv(index=False).encode('utf-8'),
+                                   file_name="expedientes_xml.csv", mime="text/csv")
+            else:
+                st.warning("Introduce al menos una URL que empiece por http")
+
     # Información adicional
     with st.expander("ℹ️ Información sobre URLs"):
         st.write("""